@@ -16,6 +16,32 @@ import yaml
 from typing import Dict, List, Optional, Tuple
 import uuid
 import time
+import sys
+import argparse
+import ast
+import re
+import difflib
+import functools
+import graphlib
+import heapq
+import asyncio
+import socket
+import threading
+import collections
+import itertools
+import cProfile
+import pstats
+import marshal
+import tracemalloc
+import bisect
+import http.server
+import zlib
+import shutil
+import atexit
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # =================== КОНФИГУРАЦИЯ ===================
 st.set_page_config(
@@ -89,18 +115,479 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# =================== МЕТРИКАЛАР ===================
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_SHARD_LIMIT = 64
+METRIC_LRU_CACHES = ('compile_formula', 'code128_svg', 'qr_matrix', 'qr_svg')
+METRICS_DEFAULTS = {'enabled': True, 'host': '127.0.0.1', 'port': 9464}
+SQL_WRITE_FAMILIES = {'INSERT', 'UPDATE', 'DELETE', 'REPLACE'}
+
+class Metric:
+    """Counter ёки histogram: ҳар бир оқим ўз қийматларини қулфсиз ёзади, тўплашда бирлаштирилади"""
+
+    def __init__(self, name: str, help_text: str, kind: str, labels: Tuple = (), buckets: Tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labels = labels
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _values(self) -> Dict:
+        try:
+            return self._local.values
+        except AttributeError:
+            # Қулф фақат оқимнинг биринчи ёзувида олинади
+            values = self._local.values = {}
+            with self._lock:
+                if len(self._shards) >= METRIC_SHARD_LIMIT:
+                    self._fold_dead()
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def inc(self, amount: float = 1, *labels):
+        values = self._values()
+        values[labels] = values.get(labels, 0) + amount
+
+    def observe(self, value: float, *labels):
+        values = self._values()
+        slot = values.get(labels)
+        if slot is None:
+            slot = values[labels] = [0] * (len(self.buckets) + 2)
+        slot[bisect.bisect_left(self.buckets, value)] += 1
+        slot[-1] += value
+
+    def _merge(self, target: Dict, values: Dict):
+        for labels, value in list(values.items()):
+            if self.kind == 'histogram':
+                slot = target.setdefault(labels, [0] * (len(self.buckets) + 2))
+                for i, item in enumerate(list(value)):
+                    slot[i] += item
+            else:
+                target[labels] = target.get(labels, 0) + value
+
+    def _fold_dead(self):
+        # Тугаган оқимлар (Streamlit ҳар қайта юклашда янги оқим очади) умумий қийматга қўшилади
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                self._merge(self._retired, values)
+        self._shards = alive
+
+    def collect(self) -> Dict:
+        with self._lock:
+            self._fold_dead()
+            totals = {}
+            self._merge(totals, self._retired)
+            for _, values in self._shards:
+                self._merge(totals, values)
+        return totals
+
+class CallbackMetric:
+    """Тўплаш пайтида манбадан ўқиладиган gauge ёки counter"""
+
+    def __init__(self, name: str, help_text: str, kind: str, labels: Tuple, source):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labels = labels
+        self.source = source
+
+    def collect(self) -> Dict:
+        return self.source()
+
+def _metric_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _metric_labels(names: Tuple, values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_metric_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+@functools.lru_cache(maxsize=1024)
+def sql_family(sql: str) -> str:
+    """SQL ифоданинг тури (SELECT, INSERT, ...) — метрика белгиси учун"""
+    match = re.match(r'\s*(?:--[^\n]*\n\s*|/\*.*?\*/\s*)*([A-Za-z]+)', sql, re.S)
+    return match.group(1).upper() if match else 'OTHER'
+
+def _lru_cache_stats(field: str) -> Dict:
+    stats = {}
+    for name in METRIC_LRU_CACHES:
+        func = globals().get(name)
+        if func is not None:
+            stats[(name,)] = getattr(func.cache_info(), field)
+    return stats
+
+def _active_session_counts() -> Dict:
+    sessions = get_session_registry().snapshot()
+    signed_in = int((sessions['username'] != '—').sum())
+    return {('authenticated',): signed_in, ('anonymous',): len(sessions) - signed_in}
+
+def _database_file_sizes() -> Dict:
+    return {(kind,): os.path.getsize(path) if os.path.exists(path) else 0
+            for kind, path in (('db', db.db_path), ('wal', db.db_path + '-wal'))}
+
+class MetricsRegistry:
+    """Илова ва база метрикалари (Prometheus матн форматида)"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.page_renders = self.add(Metric(
+            'lab_page_renders_total', 'Page renders per menu item', 'counter', ('page',)))
+        self.rerun_seconds = self.add(Metric(
+            'lab_rerun_duration_seconds', 'Streamlit script rerun duration', 'histogram',
+            ('page',), METRIC_BUCKETS))
+        self.sql_seconds = self.add(Metric(
+            'lab_sql_duration_seconds', 'SQL statement execution time, excluding row fetches', 'histogram',
+            ('family',), METRIC_BUCKETS))
+        self.rows_written = self.add(Metric(
+            'lab_rows_written_total', 'Rows changed by write statements', 'counter', ('family',)))
+        self.add(CallbackMetric('lab_cache_hits_total', 'LRU cache hits', 'counter', ('cache',),
+                                lambda: _lru_cache_stats('hits')))
+        self.add(CallbackMetric('lab_cache_misses_total', 'LRU cache misses', 'counter', ('cache',),
+                                lambda: _lru_cache_stats('misses')))
+        self.add(CallbackMetric('lab_active_sessions', 'Open browser sessions', 'gauge', ('state',),
+                                _active_session_counts))
+        self.add(CallbackMetric('lab_database_file_bytes', 'SQLite database and WAL file size', 'gauge', ('file',),
+                                _database_file_sizes))
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def record_sql(self, sql: str, seconds: float, rowcount: int):
+        family = sql_family(sql)
+        self.sql_seconds.observe(seconds, family)
+        if rowcount > 0 and family in SQL_WRITE_FAMILIES:
+            self.rows_written.inc(rowcount, family)
+
+    def exposition(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                values = metric.collect()
+            except Exception:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in sorted(values.items()):
+                if metric.kind != 'histogram':
+                    lines.append(f"{metric.name}{_metric_labels(metric.labels, labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    le = 'le="{}"'.format('+Inf' if bound == float('inf') else repr(bound))
+                    lines.append(f"{metric.name}_bucket{_metric_labels(metric.labels, labels, le)} {cumulative}")
+                lines.append(f"{metric.name}_sum{_metric_labels(metric.labels, labels)} {value[-1]}")
+                lines.append(f"{metric.name}_count{_metric_labels(metric.labels, labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+@st.cache_resource
+def get_metrics():
+    return MetricsRegistry()
+
+class MeteredCursor(sqlite3.Cursor):
+    """Бажариш вақти ва ёзилган қаторларни метрикаларга ёзувчи курсор"""
+
+    def execute(self, sql, parameters=(), /):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.metrics.record_sql(sql, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.metrics.record_sql(sql, time.perf_counter() - start, self.rowcount)
+
+class MeteredConnection(sqlite3.Connection):
+    """Барча курсорлари MeteredCursor бўлган уланиш"""
+    metrics = None
+
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# =================== УМУМИЙ КЕШ ===================
+# Кеш номлари ва уларни эскиртирувчи жадваллар (ёзувда триггер версияни оширади)
+SHARED_CACHE_SOURCES = {
+    'parameters': ('test_parameters',),
+    'norms': ('age_gender_norms',),
+    'templates': ('form_templates',),
+    'critical_limits': ('critical_limits',),
+}
+SHARED_CACHE_STATS_TTL = 60
+SHARED_CACHE_COMPRESS_MIN = 1024
+SHARED_CACHE_DIR_ENV = 'MEDICAL_LAB_CACHE_DIR'
+
+def shared_cache_dumps(value) -> bytes:
+    """JSON (бажариладиган код сақламайди), катта қийматлар zlib билан сиқилади"""
+    payload = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if len(payload) >= SHARED_CACHE_COMPRESS_MIN:
+        return b'z' + zlib.compress(payload, 6)
+    return b'j' + payload
+
+def _shared_cache_rows(value):
+    # JSON массивлари: қаторлар рўйхати — list, скаляр қатор — tuple (SQLite қаторлари каби)
+    if isinstance(value, dict):
+        return {key: _shared_cache_rows(item) for key, item in value.items()}
+    if isinstance(value, list):
+        if value and not any(isinstance(item, (list, dict)) for item in value):
+            return tuple(value)
+        return [_shared_cache_rows(item) for item in value]
+    return value
+
+def shared_cache_loads(blob: bytes):
+    """shared_cache_dumps тескариси; нотаниш ёки бузилган ёзувда ValueError"""
+    if blob[:1] not in (b'j', b'z'):
+        raise ValueError("Нотаниш кеш ёзуви")
+    try:
+        payload = zlib.decompress(blob[1:]) if blob[:1] == b'z' else blob[1:]
+    except zlib.error as e:
+        raise ValueError(str(e))
+    return _shared_cache_rows(json.loads(payload))
+
+class FileSharedCache:
+    """Жараёнлараро кеш: ҳар бир ёзув алоҳида файл (/dev/shm да — умумий хотира)"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Каталог номи олдиндан маълум: уни бошқа фойдаланувчи яратиб қўйган бўлиши мумкин
+        info = os.lstat(directory)
+        if os.path.islink(directory) or not os.path.isdir(directory) or info.st_uid != os.getuid():
+            raise PermissionError(f"Кеш каталоги ишончсиз (символик ҳавола ёки бошқа эгаси): {directory}")
+        if info.st_mode & 0o077:
+            os.chmod(directory, 0o700)
+
+    def _path(self, namespace: str, key: str, version: str) -> str:
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"{namespace}-{digest}-{version}.bin")
+
+    def get(self, namespace: str, key: str, version: str) -> Optional[bytes]:
+        try:
+            with open(self._path(namespace, key, version), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, namespace: str, key: str, version: str, blob: bytes):
+        path = self._path(namespace, key, version)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(blob)
+        # Атомар алмаштириш: бошқа жараён ҳеч қачон ярим ёзилган файлни ўқимайди
+        os.replace(tmp, path)
+        stem = path[:-len(f"-{version}.bin")]
+        for old in Path(self.directory).glob(f"{os.path.basename(stem)}-*.bin"):
+            if str(old) != path:
+                try:
+                    old.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        for path in Path(self.directory).glob('*.bin'):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+class MemorySharedCache:
+    """FileSharedCache нинг жараён ичидаги ўринбосари (синов ва битта жараён учун)"""
+
+    def __init__(self):
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str, version: str) -> Optional[bytes]:
+        with self._lock:
+            return self.entries.get((namespace, key, version))
+
+    def set(self, namespace: str, key: str, version: str, blob: bytes):
+        with self._lock:
+            for old in [k for k in self.entries if k[:2] == (namespace, key)]:
+                del self.entries[old]
+            self.entries[(namespace, key, version)] = blob
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+class SharedCache:
+    """Версияли калитлар орқали барча реплика бир хил маълумотни кўрадиган кеш"""
+
+    def __init__(self, db_manager, backend):
+        self.db = db_manager
+        self.backend = backend
+        self.stats = collections.Counter()
+        self.warning = None
+        self._local = {}
+
+    def version(self, conn, namespace: str) -> str:
+        if namespace == 'stats':
+            # Қўшилган ёзувлар дарҳол, ўзгартириш ва ўчиришлар TTL ичида кўринади
+            result_id = conn.execute("SELECT MAX(id) FROM test_results").fetchone()[0]
+            patient_id = conn.execute("SELECT MAX(id) FROM patients").fetchone()[0]
+            return f"{result_id}.{patient_id}.{int(time.time() // SHARED_CACHE_STATS_TTL)}"
+        row = conn.execute("SELECT version FROM cache_versions WHERE namespace = ?", (namespace,)).fetchone()
+        return str(row[0] if row else 0)
+
+    def get_or_compute(self, namespace: str, key: str, compute, conn=None):
+        conn = conn or self.db.conn
+        if conn.in_transaction:
+            # Тасдиқланмаган ўзгаришлар кешга тушмаслиги керак
+            self.stats[(namespace, 'bypass')] += 1
+            return compute(conn)
+        version = self.version(conn, namespace)
+        memo = self._local.get((namespace, key))
+        if memo is not None and memo[0] == version:
+            self.stats[(namespace, 'local')] += 1
+            return memo[1]
+        blob = self.backend.get(namespace, key, version)
+        try:
+            value = shared_cache_loads(blob) if blob is not None else None
+        except ValueError:
+            # Эски форматдаги ёки бузилган ёзув қайта ҳисобланади
+            blob = None
+        if blob is not None:
+            self.stats[(namespace, 'shared')] += 1
+        else:
+            value = compute(conn)
+            self.backend.set(namespace, key, version, shared_cache_dumps(value))
+            self.stats[(namespace, 'miss')] += 1
+        self._local[(namespace, key)] = (version, value)
+        return value
+
+    def clear(self):
+        self._local.clear()
+        self.backend.clear()
+
+def shared_cache_directory(db_path: str) -> str:
+    """Бир базага уланган барча жараёнлар учун бир хил каталог"""
+    digest = hashlib.sha1(os.path.abspath(db_path).encode('utf-8')).hexdigest()[:12]
+    base = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+    return os.path.join(base, f"medical-lab-cache-{digest}")
+
+@st.cache_resource
+def get_shared_cache():
+    location = os.environ.get(SHARED_CACHE_DIR_ENV) or shared_cache_directory(db.db_path)
+    warning = None
+    try:
+        backend = MemorySharedCache() if location == ':memory:' else FileSharedCache(location)
+    except PermissionError as e:
+        backend, warning = MemorySharedCache(), str(e)
+        print(f"Умумий кеш ўчирилди: {e}", file=sys.stderr)
+    cache = SharedCache(db, backend)
+    cache.warning = warning
+    get_metrics().add(CallbackMetric(
+        'lab_shared_cache_requests_total', 'Shared cache lookups by outcome', 'counter', ('namespace', 'result'),
+        lambda: dict(cache.stats)))
+    return cache
+
+def cached_parameters(conn=None) -> List[Tuple]:
+    """Барча тахлил параметрлари (умумий кешдан)"""
+    return get_shared_cache().get_or_compute('parameters', 'all', lambda c: c.execute('''
+        SELECT parameter_code, parameter_name, unit, default_min_value, default_max_value, category, formula
+        FROM test_parameters ORDER BY parameter_name
+    ''').fetchall(), conn)
+
+def cached_norms(conn=None) -> Dict[str, List[Tuple]]:
+    """Параметр бўйича норма қаторлари: (age_min, age_max, gender, menstrual_phase, min, max)"""
+    def compute(c):
+        norms = collections.defaultdict(list)
+        for row in c.execute('''
+            SELECT parameter_code, age_min, age_max, gender, menstrual_phase, min_value, max_value
+            FROM age_gender_norms ORDER BY parameter_code, id
+        '''):
+            norms[row[0]].append(row[1:])
+        return dict(norms)
+    return get_shared_cache().get_or_compute('norms', 'all', compute, conn)
+
+def cached_critical_limits(conn=None) -> Dict[str, Tuple]:
+    return get_shared_cache().get_or_compute('critical_limits', 'all', lambda c: {
+        row[0]: row[1:] for row in c.execute(
+            "SELECT parameter_code, low_critical, high_critical FROM critical_limits")
+    }, conn)
+
+def cached_templates(conn=None) -> List[Tuple]:
+    return get_shared_cache().get_or_compute('templates', 'all', lambda c: c.execute(
+        "SELECT * FROM form_templates ORDER BY template_name").fetchall(), conn)
+
+def cached_dashboard_counts(conn=None) -> Dict[str, int]:
+    """Асосий панел кўрсаткичлари (реплика орасида бўлинади)"""
+    def compute(c):
+        return {
+            'patients': c.execute("SELECT COUNT(*) FROM patients").fetchone()[0],
+            'tests': c.execute("SELECT COUNT(*) FROM test_results").fetchone()[0],
+            'today_tests': c.execute(
+                "SELECT COUNT(*) FROM test_results WHERE DATE(test_date) = DATE('now')").fetchone()[0],
+            'today_patients': c.execute(
+                "SELECT COUNT(DISTINCT patient_id) FROM test_results WHERE DATE(test_date) = DATE('now')"
+            ).fetchone()[0],
+            'today_abnormal': c.execute('''
+                SELECT COUNT(*) FROM test_results
+                WHERE DATE(test_date) = DATE('now') AND status != 'normal'
+            ''').fetchone()[0],
+        }
+    return get_shared_cache().get_or_compute('stats', f"dashboard:{date.today()}", compute, conn)
+
 # =================== МАЪЛУМОТЛАР БАЗАСИ ===================
+# Ҳар бир ўзгариши change_journal га ёзиладиган жадваллар (инкрементал резерв нусха учун)
+CHANGE_JOURNAL_TABLES = ['patients', 'test_results', 'age_gender_norms', 'doctors', 'form_templates']
+
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, db_path: Optional[str] = None):
         # Streamlit Cloud учун временный файл
-        if 'STREAMLIT_SHARING' in os.environ or 'IS_STREAMLIT_CLOUD' in os.environ:
+        if db_path:
+            self.db_path = db_path
+        elif os.environ.get('MEDICAL_LAB_DB'):
+            self.db_path = os.environ['MEDICAL_LAB_DB']
+        elif 'STREAMLIT_SHARING' in os.environ or 'IS_STREAMLIT_CLOUD' in os.environ:
             self.db_path = os.path.join(tempfile.gettempdir(), 'medical_lab.db')
         else:
             self.db_path = 'medical_lab.db'
-        
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+
+        self.conn = self.connect()
         self.create_tables()
         self.init_default_data()
+
+    def connect(self):
+        """Базага янги уланиш (фон оқимлари ўз уланишидан фойдаланади)"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30, factory=MeteredConnection)
+        conn.metrics = get_metrics()
+        # WAL режимида ўқувчилар ёзувчини блокламайди
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Ота ёзуви йўқ қаторлар пайдо бўлмаслиги учун
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+    
+    @contextlib.contextmanager
+    def write_connection(self):
+        """BEGIN IMMEDIATE ишлатадиган амаллар учун қисқа муддатли уланиш"""
+        # self.conn барча сессия оқимларида умумий: ундаги транзакция бошқа сессиянинг
+        # транзакцияси билан тўқнашади ёки уни commit/rollback қилиб юборади
+        conn = self.connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
     
     def create_tables(self):
         """Базанинг барча таблицаларини яратиш"""
@@ -215,7 +702,348 @@ class DatabaseManager:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+
+        # Анализаторлардан келган ASTM хабарлари
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analyzer_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                peer TEXT,
+                instrument TEXT,
+                raw_message TEXT NOT NULL,
+                imported_count INTEGER DEFAULT 0,
+                unmatched_count INTEGER DEFAULT 0,
+                error TEXT,
+                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Когорта кубиги: параметр × ой × ёш гуруҳи × жинс бўйича йиғиндилар
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cohort_cube (
+                parameter_code TEXT NOT NULL,
+                month TEXT NOT NULL,
+                age_band TEXT NOT NULL,
+                gender TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                abnormal INTEGER NOT NULL DEFAULT 0,
+                low INTEGER NOT NULL DEFAULT 0,
+                high INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (parameter_code, month, age_band, gender)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cohort_cube_month ON cohort_cube (month)")
+
+        # Дельта-текширув қоидалари
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS delta_check_rules (
+                parameter_code TEXT PRIMARY KEY,
+                abs_threshold REAL,
+                pct_threshold REAL,
+                rate_threshold REAL,
+                max_interval_days INTEGER DEFAULT 30,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Бемор ва параметр бўйича охирги қиймат (дельта-текширув учун)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS latest_results (
+                patient_id INTEGER NOT NULL,
+                parameter_code TEXT NOT NULL,
+                result_value REAL NOT NULL,
+                test_date DATE NOT NULL,
+                PRIMARY KEY (patient_id, parameter_code)
+            ) WITHOUT ROWID
+        ''')
+
+        # Ички сифат назорати: назорат материали натижалари
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS qc_results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                parameter_code TEXT NOT NULL,
+                level TEXT NOT NULL,
+                lot_number TEXT,
+                value REAL NOT NULL,
+                z_score REAL,
+                rules TEXT,
+                status TEXT NOT NULL,
+                source TEXT,
+                measured_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_qc_results_param ON qc_results (parameter_code, level, id)")
+
+        # Параметр ва даража бўйича жорий ҳолат: Велфорд статистикаси ва қоидалар ойнаси
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS qc_state (
+                parameter_code TEXT NOT NULL,
+                level TEXT NOT NULL,
+                target_mean REAL,
+                target_sd REAL,
+                n INTEGER NOT NULL DEFAULT 0,
+                mean REAL NOT NULL DEFAULT 0,
+                m2 REAL NOT NULL DEFAULT 0,
+                window TEXT NOT NULL DEFAULT '[]',
+                status TEXT NOT NULL DEFAULT 'accept',
+                last_rules TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (parameter_code, level)
+            ) WITHOUT ROWID
+        ''')
+
+        # Назорати рад этилган параметрлар бўйича ушлаб қолинган анализатор натижалари
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS held_results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id INTEGER,
+                patient_id INTEGER NOT NULL,
+                parameter_code TEXT NOT NULL,
+                row_data TEXT NOT NULL,
+                reason TEXT,
+                held_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (patient_id) REFERENCES patients (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_held_results_patient ON held_results (patient_id)")
+
+        # Тахлил буюртмалари (иш рўйхати)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id INTEGER NOT NULL,
+                doctor_id INTEGER,
+                category TEXT NOT NULL,
+                parameter_codes TEXT NOT NULL DEFAULT '[]',
+                priority TEXT NOT NULL DEFAULT 'routine',
+                priority_rank INTEGER NOT NULL DEFAULT 1,
+                status TEXT NOT NULL DEFAULT 'pending',
+                notes TEXT,
+                change_seq INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (patient_id) REFERENCES patients (id),
+                FOREIGN KEY (doctor_id) REFERENCES doctors (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_worklist ON orders (category, status, priority_rank, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_changes ON orders (category, change_seq)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_seq ON orders (change_seq)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_patient ON orders (patient_id, status)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_doctor ON orders (doctor_id)")
+
+        # TAT скетчлари: кўрсаткич × категория × кун × смена бўйича логарифмик гистограмма
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS tat_sketch (
+                metric TEXT NOT NULL,
+                category TEXT NOT NULL,
+                day TEXT NOT NULL,
+                shift TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (metric, category, day, shift, bucket)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tat_sketch_day ON tat_sketch (metric, day)")
+
+        # Намуналар (пробиркалар) ва уларнинг штрих-кодлари
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS specimens (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                barcode TEXT UNIQUE NOT NULL,
+                patient_id INTEGER NOT NULL,
+                order_id INTEGER,
+                specimen_type TEXT,
+                status TEXT NOT NULL DEFAULT 'labelled',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                collected_at TIMESTAMP,
+                received_at TIMESTAMP,
+                FOREIGN KEY (patient_id) REFERENCES patients (id),
+                FOREIGN KEY (order_id) REFERENCES orders (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_specimens_order ON specimens (order_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_specimens_patient ON specimens (patient_id)")
+
+        # Критик (ҳаёт учун хавфли) қиймат чегаралари
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS critical_limits (
+                parameter_code TEXT PRIMARY KEY,
+                low_critical REAL,
+                high_critical REAL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Юборилиши керак бўлган огоҳлантиришлар навбати
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS alert_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id INTEGER,
+                parameter_code TEXT NOT NULL,
+                result_value REAL,
+                limit_kind TEXT NOT NULL,
+                limit_value REAL,
+                test_date DATE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_alert_outbox_due ON alert_outbox (status, next_attempt_at)")
+
+        # Такрорий беморларни излаш учун нормалланган калитлар ва блоклаш индекси
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS patient_keys (
+                patient_id INTEGER PRIMARY KEY,
+                name_key TEXT NOT NULL,
+                full_name TEXT,
+                birth_date TEXT,
+                phone TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS patient_blocks (
+                block TEXT NOT NULL,
+                patient_id INTEGER NOT NULL,
+                PRIMARY KEY (block, patient_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS patient_merges (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                keep_id INTEGER NOT NULL,
+                merged_id INTEGER NOT NULL,
+                merged_patient_code TEXT,
+                moved TEXT,
+                merged_by TEXT,
+                merged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Ўчирилган ёзувлар сават (қайта тиклаш учун)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS recycle_bin (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                entity TEXT NOT NULL,
+                entity_id INTEGER NOT NULL,
+                label TEXT,
+                payload TEXT NOT NULL,
+                deleted_by TEXT,
+                deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Техник хизмат вазифалари журнали
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id TEXT NOT NULL,
+                task TEXT NOT NULL,
+                started_at TIMESTAMP NOT NULL,
+                duration_ms REAL NOT NULL,
+                status TEXT NOT NULL,
+                details TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_maintenance_runs_task ON maintenance_runs (task, started_at)")
+
+        # Кунлик идентификатор кетма-кетликлари
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS id_sequences (
+                name TEXT NOT NULL,
+                day TEXT NOT NULL,
+                last_value INTEGER NOT NULL,
+                PRIMARY KEY (name, day)
+            ) WITHOUT ROWID
+        ''')
+
+        # Умумий кеш версиялари: маълумотнома жадвалларига ёзилганда триггер оширади
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cache_versions (
+                namespace TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        for namespace, tables in SHARED_CACHE_SOURCES.items():
+            for table in tables:
+                for event in ('INSERT', 'UPDATE', 'DELETE'):
+                    cursor.execute(f'''
+                        CREATE TRIGGER IF NOT EXISTS cache_bump_{table}_{event.lower()}
+                        AFTER {event} ON {table} BEGIN
+                            INSERT INTO cache_versions (namespace, version) VALUES ('{namespace}', 1)
+                            ON CONFLICT(namespace) DO UPDATE SET version = version + 1;
+                        END
+                    ''')
+
+        # Аудит журнали: ким, қачон, қайси ёзувни қандай ўзгартирди
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS audit_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                logged_at TEXT NOT NULL,
+                actor TEXT NOT NULL,
+                action TEXT NOT NULL,
+                entity TEXT NOT NULL,
+                entity_id TEXT NOT NULL,
+                changes TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_entity ON audit_log (entity, entity_id, logged_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_actor ON audit_log (actor, logged_at)")
+
+        # Тизим созламалари (калит-қиймат, JSON)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_config (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Аввалги версия сақлаган очиқ SMTP пароли
+        cursor.execute("DELETE FROM app_config WHERE key = 'email_password'")
+
+        # Эски базалар учун қўшимча устунлар
+        self.ensure_column('test_results', 'menstrual_phase', 'TEXT')
+        self.ensure_column('test_results', 'delta_flag', 'TEXT')
+        self.ensure_column('test_parameters', 'formula', 'TEXT')
+        self.ensure_column('test_results', 'order_id', 'INTEGER')
+        for stage_column in ('collected_at', 'received_at', 'resulted_at', 'validated_at', 'printed_at'):
+            self.ensure_column('orders', stage_column, 'TIMESTAMP')
+
+        # Индекслар
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_results_patient ON test_results (patient_id, test_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_results_date ON test_results (test_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_norms_parameter ON age_gender_norms (parameter_code)")
         
+        # Намуна нормалар ҳар ишга тушишда қайта қўшилиб кетмаслиги учун
+        cursor.execute('''
+            DELETE FROM age_gender_norms WHERE id NOT IN (
+                SELECT MIN(id) FROM age_gender_norms
+                GROUP BY parameter_code, age_min, age_max, COALESCE(gender, ''),
+                         COALESCE(menstrual_phase, ''), min_value, max_value
+            )
+        ''')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_norms_unique ON age_gender_norms
+            (parameter_code, age_min, age_max, COALESCE(gender, ''), COALESCE(menstrual_phase, ''),
+             min_value, max_value)
+        ''')
+
+        # Ўзгаришлар журнали: seq қайта ишлатилмайди (AUTOINCREMENT), сиқилгандан кейин ҳам ўсади
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS change_journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+                table_name TEXT NOT NULL,
+                op TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                row_data TEXT
+            )
+        ''')
+        self.install_change_journal(cursor)
+
         self.conn.commit()
     
     def init_default_data(self):
@@ -243,6 +1071,10 @@ class DatabaseManager:
             ('Гормонлар', 'Прогестерон', 'PROGEST', 'нмоль/л', 0, 100, 1, 1, 0.3, 56),
             ('Клиник', 'WBC', 'WBC', '×10⁹/л', 0, 100, 0, 0, 4.0, 10.0),
             ('Клиник', 'HGB', 'HGB', 'г/л', 0, 100, 0, 0, 130, 160),
+            ('Биохимик', 'Умумий холестерин', 'CHOL', 'ммоль/л', 0, 100, 0, 0, 0, 5.2),
+            ('Биохимик', 'ЛПВП холестерин', 'HDL', 'ммоль/л', 0, 100, 0, 0, 1.0, 3.0),
+            ('Биохимик', 'Триглицеридлар', 'TG', 'ммоль/л', 0, 100, 0, 0, 0, 1.7),
+            ('Гормонлар', 'Инсулин', 'INSULIN', 'мкМЕ/мл', 0, 100, 0, 0, 2.6, 24.9),
         ]
         
         for param in default_params:
@@ -253,9 +1085,27 @@ class DatabaseManager:
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', param)
         
-        # Ёш боғлиқ нормалар
+        # Ҳисобланадиган параметрлар (формулада бошқа параметр кодлари, AGE ва FEMALE)
+        calculated_params = [
+            ('Биохимик', 'eGFR (CKD-EPI 2021)', 'EGFR', 'мл/мин/1.73м²', 90, 200,
+             '142 * min(CREAT / 88.4 / where(FEMALE, 0.7, 0.9), 1) ** where(FEMALE, -0.241, -0.302)'
+             ' * max(CREAT / 88.4 / where(FEMALE, 0.7, 0.9), 1) ** -1.2'
+             ' * 0.9938 ** AGE * where(FEMALE, 1.012, 1)'),
+            ('Биохимик', 'ЛПНП (Фридевальд)', 'LDL', 'ммоль/л', 0, 3.4,
+             'where(TG < 4.5, CHOL - HDL - TG / 2.2, nan)'),
+            ('Биохимик', 'HOMA-IR', 'HOMA_IR', 'индекс', 0, 2.7,
+             'GLUCOSE * INSULIN / 22.5'),
+        ]
+        for category, name, code, unit, default_min, default_max, formula in calculated_params:
+            cursor.execute('''
+                INSERT OR IGNORE INTO test_parameters
+                (category, parameter_name, parameter_code, unit, default_min_value, default_max_value, formula)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (category, name, code, unit, default_min, default_max, formula))
+        
+        # Ёш боғлиқ нормалар (ёш чегаралари иккала томондан киритилади: 0–0 — бир ёшгача)
         age_norms = [
-            ('WBC', 0, 1, None, None, 6.0, 17.5),
+            ('WBC', 0, 0, None, None, 6.0, 17.5),
             ('WBC', 1, 3, None, None, 6.0, 17.0),
             ('WBC', 4, 5, None, None, 5.5, 15.5),
             ('WBC', 6, 15, None, None, 4.5, 13.5),
@@ -270,6 +1120,13 @@ class DatabaseManager:
             ('ESTRADIOL', 18, 50, 'Аёл', 'Менопауза', 0, 32),
         ]
         
+        # Аввалги 0–1 ёзуви 1–3 билан 1 ёшда устма-уст тушарди
+        cursor.execute('''
+            UPDATE OR IGNORE age_gender_norms SET age_max = 0
+            WHERE parameter_code = 'WBC' AND age_min = 0 AND age_max = 1 AND gender IS NULL
+              AND menstrual_phase IS NULL AND min_value = 6.0 AND max_value = 17.5
+        ''')
+        
         for norm in age_norms:
             cursor.execute('''
                 INSERT OR IGNORE INTO age_gender_norms 
@@ -277,6 +1134,41 @@ class DatabaseManager:
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', norm)
         
+        # Дельта-текширув қоидалари: (код, мутлақ, %, кунлик тезлик, максимал оралиқ)
+        delta_rules = [
+            ('HGB', 20, None, None, 7),
+            ('WBC', None, 50, None, 7),
+            ('GLUCOSE', None, 60, None, 7),
+            ('CREAT', None, 50, 13.25, 30),
+        ]
+        cursor.executemany('''
+            INSERT OR IGNORE INTO delta_check_rules
+            (parameter_code, abs_threshold, pct_threshold, rate_threshold, max_interval_days)
+            VALUES (?, ?, ?, ?, ?)
+        ''', delta_rules)
+        
+        # Критик чегаралар: (код, паст, юқори)
+        critical_limits = [
+            ('HGB', 70, 200),
+            ('WBC', 2.0, 30.0),
+            ('GLUCOSE', 2.5, 25.0),
+            ('CREAT', None, 500),
+        ]
+        cursor.executemany('''
+            INSERT OR IGNORE INTO critical_limits (parameter_code, low_critical, high_critical)
+            VALUES (?, ?, ?)
+        ''', critical_limits)
+        
+        # Охирги қийматлар жадвалини бир марта тўлдириш
+        if self.get_config('latest_results_built') is None:
+            cursor.execute('''
+                INSERT OR REPLACE INTO latest_results (patient_id, parameter_code, result_value, test_date)
+                SELECT patient_id, parameter_code, result_value, MAX(test_date)
+                FROM test_results
+                GROUP BY patient_id, parameter_code
+            ''')
+            self.set_config('latest_results_built', True)
+        
         # Намуна шифокорлар
         cursor.execute("SELECT COUNT(*) FROM doctors")
         if cursor.fetchone()[0] == 0:
@@ -342,6 +1234,131 @@ class DatabaseManager:
     def get_cursor(self):
         return self.conn.cursor()
 
+    def ensure_column(self, table: str, column: str, ddl: str):
+        """Жадвалда устун бўлмаса, уни қўшиш"""
+        columns = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+    def install_change_journal(self, cursor):
+        """Журнал триггерлари; жадвал устунлари ўзгарган бўлса, қайта яратилади"""
+        for table in CHANGE_JOURNAL_TABLES:
+            columns = cursor.execute(f"PRAGMA table_info({table})").fetchall()
+
+            def image(ref):
+                values = []
+                for _, name, col_type, *_ in columns:
+                    if col_type.upper() in ('INTEGER', 'TEXT'):
+                        values.append(f"'{name}', {ref}.{name}")
+                    else:
+                        # json_object ҳақиқий сонларни 15 хонагача қисқартиради — 17 хона аниқ тикланади
+                        values.append(f"'{name}', CASE WHEN typeof({ref}.{name}) != 'real' THEN {ref}.{name} "
+                                      f"WHEN abs({ref}.{name}) <= 1.7976931348623157e308 "
+                                      f"THEN json(printf('%!.17g', {ref}.{name})) "
+                                      f"ELSE json(IIF({ref}.{name} > 0, '9e999', '-9e999')) END")
+                return f"json_object({', '.join(values)})"
+
+            insert = "INSERT INTO change_journal (table_name, op, row_id, row_data)"
+            bodies = {
+                'insert': f"{insert} VALUES ('{table}', 'I', NEW.rowid, {image('NEW')});",
+                'update': f"{insert} SELECT '{table}', 'D', OLD.rowid, NULL WHERE OLD.rowid <> NEW.rowid; "
+                          f"{insert} VALUES ('{table}', 'U', NEW.rowid, {image('NEW')});",
+                'delete': f"{insert} VALUES ('{table}', 'D', OLD.rowid, NULL);",
+            }
+            for event, body in bodies.items():
+                name = f"journal_{table}_{event}"
+                sql = f"CREATE TRIGGER {name} AFTER {event.upper()} ON {table} BEGIN {body} END"
+                existing = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                                          (name,)).fetchone()
+                if existing is None or existing[0] != sql:
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+                    cursor.execute(sql)
+
+    def get_config(self, key: str, default=None, conn=None):
+        """Сақланган созламани олиш"""
+        row = (conn or self.conn).execute("SELECT value FROM app_config WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_config(self, key: str, value, conn=None):
+        """Созламани сақлаш"""
+        conn = conn or self.conn
+        conn.execute('''
+            INSERT INTO app_config (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+        ''', (key, json.dumps(value, default=str)))
+        conn.commit()
+
+    def find_reference(self, cursor, parameter_code: str, age: int, gender: str,
+                       menstrual_phase: Optional[str] = None,
+                       default_min: Optional[float] = None,
+                       default_max: Optional[float] = None) -> Tuple[Optional[float], Optional[float]]:
+        """Ёш, жинс ва фазага мос норма чегараларини топиш"""
+        if cursor.connection.in_transaction:
+            # Очиқ транзакцияда тасдиқланмаган нормалар ҳам ҳисобга олинади
+            cursor.execute('''
+                SELECT min_value, max_value FROM age_gender_norms
+                WHERE parameter_code = ?
+                AND (age_min <= ? OR age_min IS NULL)
+                AND (age_max >= ? OR age_max IS NULL)
+                AND (gender = ? OR gender IS NULL)
+                AND (menstrual_phase = ? OR menstrual_phase IS NULL)
+                LIMIT 1
+            ''', (parameter_code, age, age, gender, menstrual_phase))
+            norm = cursor.fetchone()
+        else:
+            norm = next((row[4:] for row in cached_norms(cursor.connection).get(parameter_code, ())
+                         if (row[0] is None or (age is not None and row[0] <= age))
+                         and (row[1] is None or (age is not None and row[1] >= age))
+                         and (row[2] is None or row[2] == gender)
+                         and (row[3] is None or row[3] == menstrual_phase)), None)
+        if norm and norm[0] is not None and norm[1] is not None:
+            return norm[0], norm[1]
+        if default_min is not None and default_max is not None:
+            return default_min, default_max
+        return None, None
+
+    def insert_test_results(self, rows: List[Dict], conn=None, check_qc: bool = True) -> int:
+        """Натижаларни битта транзакцияда оммавий ёзиш"""
+        conn = conn or self.conn
+        if check_qc and self.get_config('qc_block_release', True, conn):
+            blocked = qc_release_blocked(conn, {row['parameter_code'] for row in rows})
+            if blocked:
+                raise QCReleaseBlocked(blocked)
+        if any('delta_flag' not in row for row in rows):
+            annotate_delta_flags(conn, rows)
+        rows = [{'result_text': None, 'notes': None, 'menstrual_phase': None, 'order_id': None, **row}
+                for row in rows]
+        conn.executemany('''
+            INSERT INTO test_results
+            (patient_id, test_type, parameter_code, result_value, result_text,
+             unit, reference_min, reference_max, status, test_date, notes, menstrual_phase,
+             delta_flag, order_id)
+            VALUES (:patient_id, :test_type, :parameter_code, :result_value, :result_text,
+                    :unit, :reference_min, :reference_max, :status, :test_date, :notes,
+                    :menstrual_phase, :delta_flag, :order_id)
+        ''', rows)
+        # Натижаси киритилган буюртмалар ишга олинган ҳисобланади
+        order_ids = sorted({row['order_id'] for row in rows if row['order_id']})
+        if order_ids:
+            advance_orders(conn, order_ids, 'in_progress', from_statuses=('pending',))
+            record_order_stage(conn, order_ids, 'resulted')
+        conn.executemany('''
+            INSERT INTO latest_results (patient_id, parameter_code, result_value, test_date)
+            VALUES (:patient_id, :parameter_code, :result_value, :test_date)
+            ON CONFLICT (patient_id, parameter_code) DO UPDATE SET
+                result_value = excluded.result_value,
+                test_date = excluded.test_date
+            WHERE excluded.test_date >= latest_results.test_date
+        ''', rows)
+        # Критик қийматлар огоҳлантириш навбатига ўша транзакцияда ёзилади
+        alerts = enqueue_critical_alerts(self, conn, rows)
+        # Йиғинди кубиги ўша транзакцияда янгиланади
+        refresh_cohort_cube(conn, commit=False)
+        conn.commit()
+        if alerts:
+            ALERT_WAKEUP.set()
+        return len(rows)
+
 # =================== БАЗАНИ ИНИЦИАЛИЗАЦИЯЛАШ ===================
 @st.cache_resource
 def init_database():
@@ -349,30 +1366,4675 @@ def init_database():
 
 db = init_database()
 
-# =================== ТИЗИМГА КИРИШ ===================
-def login_page():
-    """Кириш саҳифаси"""
-    st.markdown('<h1 class="main-title">🔐 Тиббий тахлиллар тизимига кириш</h1>', unsafe_allow_html=True)
-    
-    col1, col2, col3 = st.columns([1, 2, 1])
-    
-    with col2:
-        with st.container():
-            st.markdown('<div class="card">', unsafe_allow_html=True)
-            
-            username = st.text_input("👤 Фойдаланувчи номи", key="login_username")
-            password = st.text_input("🔑 Парол", type="password", key="login_password")
-            
-            col_a, col_b = st.columns(2)
-            with col_a:
-                login_btn = st.button("🚪 Тизимга кириш", use_container_width=True)
-                if login_btn:
-                    if username and password:
-                        if db.verify_password(username, password):
-                            st.session_state.logged_in = True
-                            st.session_state.username = username
-                            st.success("✅ Муваффақиятли кирилди!")
-                            time.sleep(1)
+# =================== ЁРДАМЧИ ФУНКЦИЯЛАР ===================
+STATUS_LABELS = {
+    'normal': "✅ Норма",
+    'low': "⬇️ Паст",
+    'high': "⬆️ Юқори",
+    'unknown': "❓ Норма номаълум",
+}
+
+def calculate_age(birth_date, on_date: Optional[date] = None) -> int:
+    """Туғилган санадан тўлиқ ёшни ҳисоблаш"""
+    if isinstance(birth_date, str):
+        birth_date = datetime.strptime(birth_date[:10], '%Y-%m-%d').date()
+    return ((on_date or date.today()) - birth_date).days // 365
+
+def classify_result(value, min_val, max_val) -> str:
+    """Натижа ҳолатини норма чегараларига қараб аниқлаш"""
+    if min_val is None or max_val is None:
+        return 'unknown'
+    if value < min_val:
+        return 'low'
+    if value > max_val:
+        return 'high'
+    return 'normal'
+
+# =================== ASTM АНАЛИЗАТОР ИНТЕГРАЦИЯСИ ===================
+# E1381 (LIS1-A) кадр қатлами ва E1394 (LIS2-A2) ёзувлари
+ENQ, ACK, NAK, EOT = b'\x05', b'\x06', b'\x15', b'\x04'
+STX, ETX, ETB = 0x02, 0x03, 0x17
+ASTM_DEFAULT_PORT = 5150
+ASTM_MAX_FRAME_TEXT = 240
+ASTM_RECEIVE_TIMEOUT = 30
+ASTM_MAX_RETRIES = 6
+
+def astm_checksum(body: bytes) -> bytes:
+    """FN дан ETX/ETB гача байтлар йиғиндиси (mod 256), икки белгили hex"""
+    return f"{sum(body) & 0xFF:02X}".encode('ascii')
+
+def astm_frames(records: List[str]) -> List[bytes]:
+    """Ёзувларни кадрларга бўлиш (узун ёзувлар ETB билан давом этади)"""
+    frames = []
+    frame_number = 1
+    for record in records:
+        data = (record + '\r').encode('utf-8')
+        chunks = [data[i:i + ASTM_MAX_FRAME_TEXT] for i in range(0, len(data), ASTM_MAX_FRAME_TEXT)]
+        for i, chunk in enumerate(chunks):
+            terminator = ETX if i == len(chunks) - 1 else ETB
+            body = str(frame_number % 8).encode('ascii') + chunk + bytes([terminator])
+            frames.append(bytes([STX]) + body + astm_checksum(body) + b'\r\n')
+            frame_number += 1
+    return frames
+
+class ASTMReceiver:
+    """ENQ → кадрлар → EOT оқимини бўлаклаб қабул қилувчи ҳолат машинаси"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.messages: List[List[str]] = []
+        self.reset()
+
+    def reset(self):
+        self.in_transfer = False
+        self.last_frame_number = None
+        self.record = bytearray()
+        self.records: List[str] = []
+
+    def feed(self, data: bytes) -> bytes:
+        """Келган байтларни қайта ишлаб, жўнатувчига жавобни (ACK/NAK) қайтариш"""
+        replies = bytearray()
+        self.buffer.extend(data)
+        while self.buffer:
+            if not self.in_transfer:
+                idx = self.buffer.find(ENQ)
+                if idx < 0:
+                    self.buffer.clear()
+                    break
+                del self.buffer[:idx + 1]
+                self.reset()
+                self.in_transfer = True
+                replies += ACK
+                continue
+
+            first = self.buffer[0]
+            if first == EOT[0]:
+                del self.buffer[0]
+                if self.records:
+                    self.messages.append(self.records)
+                self.reset()
+                continue
+            if first == ENQ[0]:
+                # Жўнатувчи сессияни қайта бошлади
+                del self.buffer[0]
+                self.reset()
+                self.in_transfer = True
+                replies += ACK
+                continue
+            if first != STX:
+                del self.buffer[0]
+                continue
+
+            end = self.buffer.find(b'\n')
+            if end < 0:
+                break
+            frame = bytes(self.buffer[:end + 1])
+            del self.buffer[:end + 1]
+            replies += ACK if self._accept_frame(frame) else NAK
+        return bytes(replies)
+
+    def _accept_frame(self, frame: bytes) -> bool:
+        # STX FN <матн> ETX|ETB C1 C2 CR LF
+        if len(frame) < 7:
+            return False
+        term_pos = len(frame) - 5
+        terminator = frame[term_pos]
+        if terminator not in (ETX, ETB):
+            return False
+        body = frame[1:term_pos + 1]
+        if frame[term_pos + 1:term_pos + 3].upper() != astm_checksum(body):
+            return False
+
+        frame_number = body[0] - ord('0')
+        if frame_number == self.last_frame_number:
+            # ACK йўқолган бўлса, жўнатувчи кадрни такрорлайди
+            return True
+        expected = 1 if self.last_frame_number is None else (self.last_frame_number + 1) % 8
+        if frame_number != expected:
+            return False
+        self.last_frame_number = frame_number
+
+        self.record.extend(body[1:-1])
+        if terminator == ETX:
+            text = self.record.decode('utf-8', errors='replace')
+            self.records.extend(r for r in text.split('\r') if r.strip())
+            self.record.clear()
+        return True
+
+class ASTMRecordParser:
+    """E1394 ёзувларини (H, P, O, R, L) натижалар рўйхатига айлантириш"""
+
+    def __init__(self):
+        self.field_sep = '|'
+        self.repeat_sep = '\\'
+        self.component_sep = '^'
+
+    def parse(self, records: List[str]) -> Dict:
+        message = {'instrument': None, 'results': [], 'terminated': False}
+        patient_code = None
+        specimen_id = None
+
+        for record in records:
+            record = record.strip('\r\n')
+            if not record:
+                continue
+            # Айрим анализаторлар ёзув олдидан кадр рақамини қолдиради
+            if record[0].isdigit() and len(record) > 1:
+                record = record[1:]
+            record_type = record[0].upper()
+
+            if record_type == 'H':
+                self.field_sep = record[1]
+                self.repeat_sep = record[2]
+                self.component_sep = record[3]
+                fields = record.split(self.field_sep)
+                sender = fields[4] if len(fields) > 4 else ''
+                message['instrument'] = sender.split(self.component_sep)[0] or None
+                continue
+
+            fields = record.split(self.field_sep)
+            if record_type == 'P':
+                patient_code = self._field(fields, 3) or self._field(fields, 4) or self._field(fields, 5)
+                patient_code = patient_code.split(self.component_sep)[0].strip() or None
+                specimen_id = None
+            elif record_type == 'O':
+                specimen_id = self._field(fields, 3).split(self.component_sep)[0].strip() or None
+            elif record_type == 'R':
+                message['results'].append({
+                    'patient_code': patient_code,
+                    'specimen_id': specimen_id,
+                    'parameter_code': self._test_code(self._field(fields, 3)),
+                    'raw_value': self._field(fields, 4).split(self.component_sep)[0].strip(),
+                    'unit': self._field(fields, 5).split(self.component_sep)[0].strip(),
+                    'reference_range': self._field(fields, 6),
+                    'flag': self._field(fields, 7),
+                    'result_status': self._field(fields, 9),
+                    'completed_at': self._field(fields, 13),
+                })
+            elif record_type == 'L':
+                message['terminated'] = True
+        return message
+
+    @staticmethod
+    def _field(fields: List[str], position: int) -> str:
+        # Стандартдаги майдон рақамлари 1 дан бошланади
+        return fields[position - 1] if len(fields) >= position else ''
+
+    def _test_code(self, universal_id: str) -> str:
+        components = universal_id.split(self.repeat_sep)[0].split(self.component_sep)
+        local = [c.strip() for c in components[3:] if c.strip()]
+        if local:
+            return local[0].upper()
+        named = [c.strip() for c in components if c.strip()]
+        return named[-1].upper() if named else ''
+
+def parse_astm_value(raw_value: str) -> Optional[float]:
+    """'<0.1', '>500', '5,8' каби қийматларни сонга айлантириш"""
+    cleaned = raw_value.strip().lstrip('<>=').replace(',', '.')
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+def parse_astm_date(value: str) -> date:
+    """YYYYMMDD[HHMMSS] форматидаги санани ўқиш"""
+    try:
+        return datetime.strptime(value.strip()[:8], '%Y%m%d').date()
+    except ValueError:
+        return date.today()
+
+def parse_astm_range(value: str) -> Tuple[Optional[float], Optional[float]]:
+    """Анализатор юборган норма оралиғини ('3.9-6.1', '3.9 to 6.1') ўқиш"""
+    text = value.replace(' to ', '-').replace('^', '-').strip()
+    parts = [p for p in text.split('-') if p.strip()]
+    if len(parts) != 2:
+        return None, None
+    low, high = parse_astm_value(parts[0]), parse_astm_value(parts[1])
+    if low is None or high is None:
+        return None, None
+    return low, high
+
+def import_astm_message(db_manager, conn, records: List[str], peer: Optional[str] = None) -> Dict:
+    """ASTM хабарини беморлар ва параметрларга боғлаб оммавий ёзиш"""
+    message = ASTMRecordParser().parse(records)
+    results = message['results']
+    cursor = conn.cursor()
+
+    patient_codes = sorted({r['patient_code'] for r in results if r['patient_code']})
+    patients = {}
+    if patient_codes:
+        placeholders = ','.join('?' * len(patient_codes))
+        cursor.execute(f'''
+            SELECT patient_id, id, birth_date, gender FROM patients
+            WHERE patient_id IN ({placeholders})
+        ''', patient_codes)
+        patients = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    parameter_codes = sorted({r['parameter_code'] for r in results if r['parameter_code']})
+    parameters = {}
+    if parameter_codes:
+        placeholders = ','.join('?' * len(parameter_codes))
+        cursor.execute(f'''
+            SELECT parameter_code, category, unit, default_min_value, default_max_value
+            FROM test_parameters WHERE parameter_code IN ({placeholders})
+        ''', parameter_codes)
+        parameters = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    rows = []
+    unmatched = []
+    reference_cache = {}
+    qc_recorded = 0
+    for result in results:
+        # Назорат материаллари бемор ўрнига "QC<даража>" коди билан келади
+        if result['patient_code'] and result['patient_code'].upper().startswith('QC') \
+                and result['parameter_code'] in parameters:
+            value = parse_astm_value(result['raw_value'])
+            if value is not None:
+                level = result['patient_code'][2:].strip('-_ ') or '1'
+                record_qc_result(conn, result['parameter_code'], level, value,
+                                 lot_number=result['specimen_id'] or None,
+                                 source=message['instrument'] or peer or 'ASTM', commit=False)
+                qc_recorded += 1
+                continue
+        patient = patients.get(result['patient_code'])
+        parameter = parameters.get(result['parameter_code'])
+        value = parse_astm_value(result['raw_value'])
+        if patient is None or parameter is None or value is None:
+            unmatched.append(result)
+            continue
+
+        internal_id, birth_date, gender = patient
+        category, unit, default_min, default_max = parameter
+        test_date = parse_astm_date(result['completed_at'])
+        try:
+            age = calculate_age(birth_date, test_date)
+        except (TypeError, ValueError):
+            age = 30
+
+        key = (result['parameter_code'], age, gender)
+        if key not in reference_cache:
+            ref_min, ref_max = db_manager.find_reference(
+                cursor, result['parameter_code'], age, gender, None, default_min, default_max)
+            if ref_min is None:
+                ref_min, ref_max = parse_astm_range(result['reference_range'])
+            reference_cache[key] = (ref_min, ref_max)
+        ref_min, ref_max = reference_cache[key]
+
+        notes = f"ASTM: {message['instrument'] or peer or 'анализатор'}"
+        if result['specimen_id']:
+            notes += f", намуна {result['specimen_id']}"
+        rows.append({
+            'patient_id': internal_id,
+            'test_type': category,
+            'parameter_code': result['parameter_code'],
+            'result_value': value,
+            'result_text': result['raw_value'],
+            'unit': result['unit'] or unit,
+            'reference_min': ref_min,
+            'reference_max': ref_max,
+            'status': classify_result(value, ref_min, ref_max),
+            'test_date': test_date,
+            'notes': notes,
+        })
+
+    # Назорати ўтмаган параметрлар натижалари held_results да назорат ўтгунча сақланади
+    held = []
+    blocked = {}
+    if rows and db_manager.get_config('qc_block_release', True, conn):
+        blocked = qc_release_blocked(conn, {row['parameter_code'] for row in rows})
+        if blocked:
+            held = [row for row in rows if row['parameter_code'] in blocked]
+            rows = [row for row in rows if row['parameter_code'] not in blocked]
+
+    delta_flagged = annotate_delta_flags(conn, rows) if rows else 0
+    if rows:
+        db_manager.insert_test_results(rows, conn, check_qc=False)
+
+    message_id = conn.execute('''
+        INSERT INTO analyzer_messages (peer, instrument, raw_message, imported_count, unmatched_count, error)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (peer, message['instrument'], '\n'.join(records), len(rows), len(unmatched),
+          str(QCReleaseBlocked(blocked)) if held else None)).lastrowid
+    if held:
+        conn.executemany('''
+            INSERT INTO held_results (message_id, patient_id, parameter_code, row_data, reason)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(message_id, row['patient_id'], row['parameter_code'], json.dumps(row, default=str),
+               blocked[row['parameter_code']]) for row in held])
+    conn.commit()
+    # Шу хабардаги назорат материаллари блокни олган бўлса, аввал ушланганлар чиқарилади
+    released = release_held_results(db_manager, conn) if qc_recorded else 0
+    return {'instrument': message['instrument'], 'imported': len(rows), 'unmatched': unmatched,
+            'delta_flagged': delta_flagged, 'qc_recorded': qc_recorded, 'held': len(held),
+            'released': released}
+
+class ASTMListener:
+    """Кўп анализатор уланишларига битта asyncio циклида хизмат қилувчи TCP тингловчи"""
+
+    def __init__(self, db_manager, host: str = '0.0.0.0', port: int = ASTM_DEFAULT_PORT):
+        self.db = db_manager
+        self.host = host
+        self.port = port
+        self.stats = {'connections': 0, 'active': 0, 'messages': 0, 'imported': 0,
+                      'unmatched': 0, 'delta_flagged': 0, 'qc_recorded': 0, 'held': 0, 'released': 0,
+                      'errors': 0}
+        self.last_error = None
+        self._loop = None
+        self._thread = None
+        self._conn = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.last_error = None
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name="astm-listener", daemon=True)
+        self._thread.start()
+        ready.wait(10)
+        if self.last_error:
+            raise self.last_error
+
+    def stop(self):
+        if self.running and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(10)
+
+    def _run(self, ready: threading.Event):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # Базага ёзиш битта алоҳида оқимда: уланишлар ўзаро блокланмайди
+        writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="astm-db")
+        self._writer_pool = writer_pool
+        try:
+            server = loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        except OSError as e:
+            self.last_error = e
+            ready.set()
+            loop.close()
+            return
+        self.port = server.sockets[0].getsockname()[1]
+        self._loop = loop
+        ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            writer_pool.shutdown(wait=True)
+            loop.close()
+            self._loop = None
+
+    async def _handle(self, reader, writer):
+        peername = writer.get_extra_info('peername')
+        peer = f"{peername[0]}:{peername[1]}" if peername else None
+        receiver = ASTMReceiver()
+        self.stats['connections'] += 1
+        self.stats['active'] += 1
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(4096), timeout=ASTM_RECEIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # Ярим қолган узатишни бекор қилиб, уланишни сақлаб қоламиз
+                    receiver.reset()
+                    continue
+                if not data:
+                    break
+                reply = receiver.feed(data)
+                if reply:
+                    writer.write(reply)
+                    await writer.drain()
+                while receiver.messages:
+                    records = receiver.messages.pop(0)
+                    await loop.run_in_executor(self._writer_pool, self._ingest, records, peer)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.stats['active'] -= 1
+            writer.close()
+
+    def _ingest(self, records: List[str], peer: Optional[str]):
+        if self._conn is None:
+            self._conn = self.db.connect()
+        try:
+            summary = import_astm_message(self.db, self._conn, records, peer)
+            self.stats['messages'] += 1
+            self.stats['imported'] += summary['imported']
+            self.stats['unmatched'] += len(summary['unmatched'])
+            self.stats['delta_flagged'] += summary['delta_flagged']
+            self.stats['qc_recorded'] += summary['qc_recorded']
+            self.stats['held'] += summary['held']
+            self.stats['released'] += summary['released']
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.last_error = e
+            try:
+                self._conn.rollback()
+                self._conn.execute('''
+                    INSERT INTO analyzer_messages (peer, raw_message, error) VALUES (?, ?, ?)
+                ''', (peer, '\n'.join(records), str(e)))
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+def build_astm_records(patient_code: str, results: List[Tuple[str, float, str]],
+                       instrument: str = "LIS-SIM", specimen_id: Optional[str] = None) -> List[str]:
+    """Битта бемор натижаларидан E1394 ёзувларини тузиш"""
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    specimen_id = specimen_id or uuid.uuid4().hex[:10].upper()
+    tests = '\\'.join(f"^^^{code}" for code, _, _ in results)
+    records = [
+        f"H|\\^&|||{instrument}^1.0|||||||P|LIS2-A2|{timestamp}",
+        f"P|1|{patient_code}",
+        f"O|1|{specimen_id}||{tests}|R||{timestamp}",
+    ]
+    for i, (code, value, unit) in enumerate(results, 1):
+        records.append(f"R|{i}|^^^{code}|{value}|{unit}||N||F||||{timestamp}")
+    records.append("L|1|N")
+    return records
+
+class ASTMSimulator:
+    """Анализатор ўрнида ENQ/ACK алмашинуви билан хабар юборувчи синов клиенти"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = ASTM_DEFAULT_PORT, timeout: float = 10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def _expect_ack(self, sock) -> bool:
+        reply = sock.recv(1)
+        if not reply:
+            raise ConnectionError("Тингловчи уланишни узди")
+        return reply == ACK
+
+    def send(self, records: List[str], sock=None) -> bool:
+        """Битта хабарни юбориш; барча кадрлар қабул қилинса True"""
+        own_socket = sock is None
+        if own_socket:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            sock.sendall(ENQ)
+            if not self._expect_ack(sock):
+                return False
+            for frame in astm_frames(records):
+                for _ in range(ASTM_MAX_RETRIES):
+                    sock.sendall(frame)
+                    if self._expect_ack(sock):
+                        break
+                else:
+                    sock.sendall(EOT)
+                    return False
+            sock.sendall(EOT)
+            return True
+        finally:
+            if own_socket:
+                sock.close()
+
+    def run_load(self, messages: List[List[str]], connections: int = 10) -> Dict:
+        """Хабарларни бир вақтда бир нечта уланиш орқали юбориш"""
+        batches = [messages[i::connections] for i in range(connections)]
+        outcome = {'sent': 0, 'failed': 0}
+        lock = threading.Lock()
+
+        def worker(batch):
+            sent = failed = 0
+            with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+                for records in batch:
+                    if self.send(records, sock):
+                        sent += 1
+                    else:
+                        failed += 1
+            with lock:
+                outcome['sent'] += sent
+                outcome['failed'] += failed
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(b,)) for b in batches if b]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        outcome['seconds'] = time.perf_counter() - started
+        return outcome
+
+def demo_astm_messages(conn, count: int) -> List[List[str]]:
+    """Базадаги беморлар ва параметрлардан тасодифий симулятор хабарлари"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT patient_id FROM patients ORDER BY RANDOM() LIMIT 200")
+    patient_codes = [r[0] for r in cursor.fetchall()]
+    cursor.execute("""
+        SELECT parameter_code, unit, default_min_value, default_max_value
+        FROM test_parameters WHERE default_min_value IS NOT NULL AND default_max_value IS NOT NULL
+    """)
+    params = cursor.fetchall()
+    if not patient_codes or not params:
+        return []
+    rng = np.random.default_rng()
+    messages = []
+    for _ in range(count):
+        chosen = rng.choice(len(params), size=min(3, len(params)), replace=False)
+        results = []
+        for idx in chosen:
+            code, unit, low, high = params[idx]
+            spread = (high - low) or 1.0
+            results.append((code, round(float(rng.uniform(low - spread * 0.2, high + spread * 0.2)), 2), unit))
+        messages.append(build_astm_records(str(rng.choice(patient_codes)), results))
+    return messages
+
+@st.cache_resource
+def get_astm_listener():
+    return ASTMListener(db)
+
+# =================== АРХИВ (ЭСКИ НАТИЖАЛАР) ===================
+ARCHIVE_AFTER_DAYS = 730
+ARCHIVE_BATCH_SIZE = 5000
+ARCHIVE_MAX_ATTACHED = 9
+# Энг эски йиллар йиғиладиган умумий файл: бир вақтда улашадиган файллар ARCHIVE_MAX_ATTACHED дан ошмайди
+ARCHIVE_COMBINED = 'older'
+
+class ArchiveManager:
+    """Эски натижаларни йиллик SQLite файлларига кўчириш ва уларни бирлаштириб ўқиш"""
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.archive_dir = os.path.join(os.path.dirname(os.path.abspath(db_manager.db_path)), 'archive')
+        # Умумий уланишда ATTACH ва кўринишни бир вақтда фақат битта сессия созлайди
+        self._lock = threading.Lock()
+
+    def archive_path(self, year) -> str:
+        return os.path.join(self.archive_dir, f"test_results_{year}.db")
+
+    def archive_years(self) -> List[int]:
+        if not os.path.isdir(self.archive_dir):
+            return []
+        years = []
+        for name in os.listdir(self.archive_dir):
+            if name.startswith('test_results_') and name.endswith('.db'):
+                try:
+                    years.append(int(name[len('test_results_'):-3]))
+                except ValueError:
+                    continue
+        return sorted(years)
+
+    def archive_sources(self) -> List:
+        """Улашадиган архивлар: умумий файл (бўлса) ва алоҳида йиллар"""
+        combined = [ARCHIVE_COMBINED] if os.path.exists(self.archive_path(ARCHIVE_COMBINED)) else []
+        return combined + self.archive_years()
+
+    def consolidate(self) -> List[int]:
+        """Ортиқча энг эски йилларни умумий файлга кўчириш; кўчирилган йиллар қайтарилади"""
+        years = self.archive_years()
+        excess = years[:max(len(years) - (ARCHIVE_MAX_ATTACHED - 1), 0)]
+        if not excess:
+            return []
+        conn = self.db.connect()
+        try:
+            combined = self._attach(conn, ARCHIVE_COMBINED)
+            columns = ', '.join(name for name, _ in self._columns(conn))
+            for year in excess:
+                alias = self._attach(conn, year)
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO {combined}.test_results ({columns})
+                    SELECT {columns} FROM {alias}.test_results
+                ''')
+                conn.commit()
+                conn.execute(f"DETACH DATABASE {alias}")
+                os.remove(self.archive_path(year))
+            merged = sorted(set(self.db.get_config('archive_combined_years', [], conn)) | set(excess))
+            self.db.set_config('archive_combined_years', merged, conn)
+        finally:
+            conn.close()
+        return excess
+
+    @staticmethod
+    def _columns(conn, schema: str = 'main') -> List[Tuple[str, str]]:
+        return [(row[1], row[2]) for row in conn.execute(f"PRAGMA {schema}.table_info(test_results)")]
+
+    def _attach(self, conn, year: int) -> str:
+        alias = f"arch_{year}"
+        attached = {row[1] for row in conn.execute("PRAGMA database_list")}
+        if alias not in attached:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            conn.execute("ATTACH DATABASE ? AS " + alias, (self.archive_path(year),))
+        self._sync_schema(conn, alias)
+        return alias
+
+    def _sync_schema(self, conn, alias: str):
+        # Архив жадвали асосий жадвал устунларини такрорлайди (ташқи калитларсиз)
+        main_columns = self._columns(conn)
+        archive_columns = {name for name, _ in self._columns(conn, alias)}
+        if not archive_columns:
+            column_defs = ', '.join(
+                'id INTEGER PRIMARY KEY' if name == 'id' else f"{name} {col_type}"
+                for name, col_type in main_columns
+            )
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {alias}.test_results ({column_defs})")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_archive_patient ON test_results (patient_id, test_date)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_archive_date ON test_results (test_date)")
+        else:
+            for name, col_type in main_columns:
+                if name not in archive_columns:
+                    conn.execute(f"ALTER TABLE {alias}.test_results ADD COLUMN {name} {col_type}")
+
+    def run(self, max_age_days: Optional[int] = None, batch_size: int = ARCHIVE_BATCH_SIZE,
+            max_batches: Optional[int] = None, conn=None) -> Dict:
+        """Эски натижаларни бўлиб-бўлиб кўчириш (ҳар бир бўлак алоҳида транзакция)"""
+        own_conn = conn is None
+        conn = conn or self.db.connect()
+        if max_age_days is None:
+            max_age_days = self.db.get_config('archive_after_days', ARCHIVE_AFTER_DAYS, conn)
+        cutoff = date.today() - timedelta(days=int(max_age_days))
+        summary = {'moved': 0, 'batches': 0, 'years': set(), 'cutoff': cutoff}
+        started = time.perf_counter()
+        previous = None
+        try:
+            columns = ', '.join(name for name, _ in self._columns(conn))
+            while max_batches is None or summary['batches'] < max_batches:
+                row = conn.execute("SELECT MIN(test_date) FROM test_results WHERE test_date < ?",
+                                   (cutoff,)).fetchone()
+                if not row or row[0] is None:
+                    break
+                year = int(str(row[0])[:4])
+                # Кўп йиллик биринчи архивлашда SQLite нинг улаш чегарасига етмаслик учун
+                if previous is not None and previous != f"arch_{year}":
+                    conn.execute(f"DETACH DATABASE {previous}")
+                alias = previous = self._attach(conn, year)
+                year_end = min(date(year + 1, 1, 1), cutoff)
+
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("DROP TABLE IF EXISTS temp.archive_batch")
+                conn.execute('''
+                    CREATE TEMP TABLE archive_batch AS
+                    SELECT id FROM main.test_results
+                    WHERE test_date >= ? AND test_date < ?
+                    ORDER BY test_date, id
+                    LIMIT ?
+                ''', (date(year, 1, 1), year_end, batch_size))
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO {alias}.test_results ({columns})
+                    SELECT {columns} FROM main.test_results
+                    WHERE id IN (SELECT id FROM temp.archive_batch)
+                ''')
+                moved = conn.execute('''
+                    DELETE FROM main.test_results WHERE id IN (SELECT id FROM temp.archive_batch)
+                ''').rowcount
+                conn.commit()
+
+                if moved <= 0:
+                    break
+                summary['moved'] += moved
+                summary['batches'] += 1
+                summary['years'].add(year)
+
+            if summary['moved']:
+                archived_total = self.db.get_config('archived_results', 0, conn) + summary['moved']
+                self.db.set_config('archived_results', archived_total, conn)
+            boundary = self.db.get_config('archive_boundary', None, conn)
+            if boundary is None or str(cutoff) > boundary:
+                self.db.set_config('archive_boundary', str(cutoff), conn)
+        finally:
+            if own_conn:
+                conn.close()
+        with self._lock:
+            summary['combined'] = self.consolidate()
+        summary['years'] = sorted(summary['years'])
+        summary['seconds'] = time.perf_counter() - started
+        return summary
+
+    def results_source(self, conn, start_date=None) -> str:
+        """Давр учун ўқиладиган манба: фақат «иссиқ» жадвал ёки архив билан бирлашма"""
+        boundary = self.db.get_config('archive_boundary', None, conn)
+        if boundary is None or not self.archive_sources():
+            return 'test_results'
+        if start_date is not None and str(start_date) >= boundary:
+            return 'test_results'
+        return self.attach_all(conn)
+
+    def attach_all(self, conn) -> str:
+        """Архивларни улаб, test_results_all вақтинчалик кўринишини яратиш"""
+        with self._lock:
+            if len(self.archive_sources()) > ARCHIVE_MAX_ATTACHED:
+                # Аввалги версия қолдирган ортиқча йиллар (ҳеч бир йил тушиб қолмаслиги керак)
+                self.consolidate()
+            sources = self.archive_sources()
+            wanted = {f"arch_{source}" for source in sources}
+            # Умумий файлга кўчирилган йиллар бу уланишда ҳали уланган бўлиши мумкин
+            stale = [row[1] for row in conn.execute("PRAGMA database_list")
+                     if row[1].startswith('arch_') and row[1] not in wanted]
+            if stale:
+                conn.execute("DROP VIEW IF EXISTS temp.test_results_all")
+                for alias in stale:
+                    conn.execute(f"DETACH DATABASE {alias}")
+            aliases = [self._attach(conn, source) for source in sources]
+            columns = ', '.join(name for name, _ in self._columns(conn))
+            selects = [f"SELECT {columns} FROM main.test_results"]
+            selects += [f"SELECT {columns} FROM {alias}.test_results" for alias in aliases]
+            definition = "test_results_all AS " + " UNION ALL ".join(selects)
+            current = conn.execute("SELECT sql FROM temp.sqlite_master WHERE name = 'test_results_all'").fetchone()
+            # Кўриниш фақат таркиби ўзгарганда алмаштирилади: уни ўқиётган сўровлар бузилмайди
+            if current is None or current[0] != "CREATE VIEW " + definition:
+                conn.execute("DROP VIEW IF EXISTS temp.test_results_all")
+                conn.execute("CREATE TEMP VIEW " + definition)
+        return 'test_results_all'
+
+@st.cache_resource
+def get_archive_manager():
+    return ArchiveManager(db)
+
+# =================== КОГОРТА КУБИГИ ===================
+COHORT_AGE_BANDS = ['0-17', '18-30', '31-45', '46-60', '60+']
+
+COHORT_CUBE_SELECT = """
+    SELECT parameter_code, month,
+           CASE
+               WHEN age < 18 THEN '0-17'
+               WHEN age <= 30 THEN '18-30'
+               WHEN age <= 45 THEN '31-45'
+               WHEN age <= 60 THEN '46-60'
+               ELSE '60+'
+           END AS age_band,
+           gender,
+           COUNT(*), SUM(status != 'normal'), SUM(status = 'low'), SUM(status = 'high')
+    FROM (
+        SELECT tr.parameter_code, tr.status,
+               strftime('%Y-%m', tr.test_date) AS month,
+               CAST((julianday(tr.test_date) - julianday(p.birth_date)) / 365.25 AS INTEGER) AS age,
+               p.gender
+        FROM {source} tr
+        JOIN patients p ON p.id = tr.patient_id
+        WHERE tr.id > ? AND tr.id <= ?
+    )
+    WHERE month IS NOT NULL
+    GROUP BY parameter_code, month, age_band, gender
+"""
+
+def _cube_upsert(conn, source: str, low_id: int, high_id: int):
+    conn.execute(f'''
+        INSERT INTO cohort_cube (parameter_code, month, age_band, gender, total, abnormal, low, high)
+        {COHORT_CUBE_SELECT.format(source=source)}
+        ON CONFLICT (parameter_code, month, age_band, gender) DO UPDATE SET
+            total = total + excluded.total,
+            abnormal = abnormal + excluded.abnormal,
+            low = low + excluded.low,
+            high = high + excluded.high
+    ''', (low_id, high_id))
+
+def _cube_set_watermark(conn, last_id: int):
+    conn.execute('''
+        INSERT INTO app_config (key, value, updated_at) VALUES ('cohort_cube_watermark', ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+    ''', (json.dumps(last_id),))
+
+def refresh_cohort_cube(conn, commit: bool = True) -> int:
+    """Охирги янгиланишдан кейин ёзилган натижаларни кубга қўшиш"""
+    # Фақат янги қўшилган натижалар (id > watermark) ҳисобга олинади. Натижани таҳрирлаш,
+    # беморларни бирлаштириш ва архивга кўчириш кубни ўзгартирмайди — улар тунги техник
+    # хизматдаги тўлиқ қайта қуриш ('cohort_cube' вазифаси) билан тўғриланади
+    if commit:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT value FROM app_config WHERE key = 'cohort_cube_watermark'").fetchone()
+        if row is None:
+            if commit:
+                conn.rollback()
+                return rebuild_cohort_cube(conn)
+            # Ҳали қурилмаган куб — кейинги даврий янгиланишда тўлиқ қурилади
+            return 0
+        watermark = json.loads(row[0])
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM test_results").fetchone()[0]
+        if last_id > watermark:
+            _cube_upsert(conn, 'test_results', watermark, last_id)
+            _cube_set_watermark(conn, last_id)
+        if commit:
+            conn.commit()
+        return max(last_id - watermark, 0)
+    except Exception:
+        if commit:
+            conn.rollback()
+        raise
+
+def rebuild_cohort_cube(conn, source: Optional[str] = None) -> int:
+    """Кубни бутун тарих (архив билан бирга) бўйича қайта қуриш"""
+    source = source or get_archive_manager().results_source(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Барча натижалар архивланган бўлса ҳам чегара архивлар бўйича олинади
+        last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {source}").fetchone()[0]
+        conn.execute("DELETE FROM cohort_cube")
+        _cube_upsert(conn, source, -1, last_id)
+        _cube_set_watermark(conn, last_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return last_id
+
+def query_cohort_cube(conn, dimensions: List[str], parameters=None, genders=None,
+                      age_bands=None, month_from=None, month_to=None) -> pd.DataFrame:
+    """Кубдан танланган ўлчовлар бўйича патология улушини олиш"""
+    allowed = ['parameter_code', 'month', 'age_band', 'gender']
+    dimensions = [d for d in dimensions if d in allowed]
+    where, params = [], []
+    for column, values in (('parameter_code', parameters), ('gender', genders), ('age_band', age_bands)):
+        if values:
+            where.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+    if month_from:
+        where.append("month >= ?")
+        params.append(month_from)
+    if month_to:
+        where.append("month <= ?")
+        params.append(month_to)
+
+    select_dims = ', '.join(dimensions)
+    query = f"""
+        SELECT {select_dims + ',' if dimensions else ''}
+               SUM(total) AS total, SUM(abnormal) AS abnormal, SUM(low) AS low, SUM(high) AS high
+        FROM cohort_cube
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        {'GROUP BY ' + select_dims + ' ORDER BY ' + select_dims if dimensions else ''}
+    """
+    df = pd.read_sql_query(query, conn, params=params)
+    df['abnormal_rate'] = (df['abnormal'] / df['total'].where(df['total'] > 0) * 100).round(2)
+    return df
+
+# =================== ПОПУЛЯЦИОН НОРМА ИНТЕРВАЛЛАРИ ===================
+REFERENCE_MIN_SAMPLES = 120
+REFERENCE_BOOTSTRAP = 2000
+REFERENCE_CHUNK_SIZE = 200_000
+REFERENCE_DEFAULT_BANDS = [(0, 17), (18, 30), (31, 45), (46, 60), (61, 120)]
+GENDER_CODES = {'Эркак': 1, 'Аёл': 2}
+
+class ReferenceIntervalEstimator:
+    """Натижалар тарихидан 2.5/97.5 перцентиль интервалларини баҳолаш (CLSI EP28 усулида)"""
+
+    def __init__(self, conn, bootstrap: int = REFERENCE_BOOTSTRAP, chunk_size: int = REFERENCE_CHUNK_SIZE,
+                 confidence: float = 0.90, seed: Optional[int] = None):
+        self.conn = conn
+        self.bootstrap = bootstrap
+        self.chunk_size = chunk_size
+        self.confidence = confidence
+        self.rng = np.random.default_rng(seed)
+        self.phase_codes: Dict[str, int] = {}
+
+    def load(self, parameter_code: str, source: str = 'test_results') -> Dict[str, np.ndarray]:
+        """Параметр қийматларини бўлаклаб ўқиб, ихчам массивларга йиғиш"""
+        query = f'''
+            SELECT tr.result_value AS value,
+                   CAST((julianday(tr.test_date) - julianday(p.birth_date)) / 365.25 AS INTEGER) AS age,
+                   p.gender AS gender,
+                   tr.menstrual_phase AS phase
+            FROM {source} tr
+            JOIN patients p ON p.id = tr.patient_id
+            WHERE tr.parameter_code = ? AND tr.result_value IS NOT NULL
+        '''
+        parts = {'value': [], 'age': [], 'gender': [], 'phase': []}
+        for chunk in pd.read_sql_query(query, self.conn, params=(parameter_code,), chunksize=self.chunk_size):
+            parts['value'].append(chunk['value'].to_numpy(dtype=np.float32))
+            parts['age'].append(chunk['age'].fillna(-1).to_numpy(dtype=np.int16))
+            parts['gender'].append(chunk['gender'].map(GENDER_CODES).fillna(0).to_numpy(dtype=np.int8))
+            phases = chunk['phase'].fillna('')
+            for phase in phases.unique():
+                if phase and phase not in self.phase_codes:
+                    self.phase_codes[phase] = len(self.phase_codes) + 1
+            parts['phase'].append(phases.map(self.phase_codes).fillna(0).to_numpy(dtype=np.int8))
+        if not parts['value']:
+            return {key: np.empty(0) for key in parts}
+        return {key: np.concatenate(arrays) for key, arrays in parts.items()}
+
+    @staticmethod
+    def exclude_outliers(values: np.ndarray) -> np.ndarray:
+        """Тьюки чегаралари; қийшиқ тақсимотда логарифм шкаласида (Хорн усули)"""
+        if values.size < 4:
+            return values
+        scale = values
+        if values.min() > 0:
+            mean, std = values.mean(), values.std()
+            skew = ((values - mean) ** 3).mean() / std ** 3 if std > 0 else 0
+            if skew > 1:
+                scale = np.log(values)
+        q1, q3 = np.percentile(scale, [25, 75])
+        iqr = q3 - q1
+        mask = (scale >= q1 - 1.5 * iqr) & (scale <= q3 + 1.5 * iqr)
+        return values[mask]
+
+    def _order_statistic_bootstrap(self, sorted_values: np.ndarray, p: float) -> Tuple[float, float]:
+        # Бутстреп танламадаги k-тартиб статистикаси = sorted[floor(U_(k) * n)],
+        # бунда U_(k) ~ Beta(k, n - k + 1): бутун танламани қайта ясаш шарт эмас
+        n = sorted_values.size
+        k = min(max(int(np.ceil(p * n)), 1), n)
+        u = self.rng.beta(k, n - k + 1, size=self.bootstrap)
+        replicates = sorted_values[np.minimum((u * n).astype(np.int64), n - 1)]
+        alpha = (1 - self.confidence) / 2
+        low, high = np.quantile(replicates, [alpha, 1 - alpha])
+        return float(low), float(high)
+
+    def estimate(self, values: np.ndarray) -> Dict:
+        """Битта гуруҳ учун интервал ва унинг ишонч оралиқлари"""
+        values = values[np.isfinite(values)].astype(np.float64)
+        kept = self.exclude_outliers(values)
+        result = {'n': int(values.size), 'excluded': int(values.size - kept.size),
+                  'lower': None, 'upper': None, 'lower_ci': (None, None), 'upper_ci': (None, None),
+                  'sufficient': kept.size >= REFERENCE_MIN_SAMPLES}
+        if kept.size < 2:
+            return result
+        kept.sort()
+        result['lower'], result['upper'] = (float(v) for v in np.percentile(kept, [2.5, 97.5]))
+        result['lower_ci'] = self._order_statistic_bootstrap(kept, 0.025)
+        result['upper_ci'] = self._order_statistic_bootstrap(kept, 0.975)
+        return result
+
+    def partitions(self, parameter_code: str) -> List[Dict]:
+        """Ҳисоблаш гуруҳлари: созланган нормалар, улар бўлмаса стандарт ёш гуруҳлари × жинс"""
+        norms = self.conn.execute('''
+            SELECT DISTINCT age_min, age_max, gender, menstrual_phase, min_value, max_value
+            FROM age_gender_norms WHERE parameter_code = ?
+            ORDER BY age_min, gender, menstrual_phase
+        ''', (parameter_code,)).fetchall()
+        if norms:
+            return [{'age_min': n[0] or 0, 'age_max': n[1] if n[1] is not None else 120,
+                     'gender': n[2], 'phase': n[3], 'configured': (n[4], n[5])} for n in norms]
+        default = self.conn.execute('''
+            SELECT default_min_value, default_max_value FROM test_parameters WHERE parameter_code = ?
+        ''', (parameter_code,)).fetchone()
+        configured = default if default else (None, None)
+        return [{'age_min': low, 'age_max': high, 'gender': gender, 'phase': None, 'configured': configured}
+                for low, high in REFERENCE_DEFAULT_BANDS for gender in ('Эркак', 'Аёл')]
+
+    def run(self, parameter_code: str, source: str = 'test_results') -> pd.DataFrame:
+        """Параметрнинг барча гуруҳлари учун таклиф этилган интерваллар жадвали"""
+        data = self.load(parameter_code, source)
+        rows = []
+        for part in self.partitions(parameter_code):
+            mask = (data['age'] >= part['age_min']) & (data['age'] <= part['age_max'])
+            if part['gender']:
+                mask &= data['gender'] == GENDER_CODES.get(part['gender'], -1)
+            if part['phase']:
+                mask &= data['phase'] == self.phase_codes.get(part['phase'], -1)
+            estimate = self.estimate(data['value'][mask])
+            configured_min, configured_max = part['configured']
+            agrees = None
+            if estimate['lower'] is not None and configured_min is not None and configured_max is not None:
+                agrees = bool(estimate['lower_ci'][0] <= configured_min <= estimate['lower_ci'][1]
+                              and estimate['upper_ci'][0] <= configured_max <= estimate['upper_ci'][1])
+            rows.append({
+                'age': f"{part['age_min']}-{part['age_max']}",
+                'gender': part['gender'] or 'Ҳар қандай',
+                'phase': part['phase'] or '',
+                'n': estimate['n'],
+                'excluded': estimate['excluded'],
+                'lower': estimate['lower'],
+                'lower_ci': estimate['lower_ci'],
+                'upper': estimate['upper'],
+                'upper_ci': estimate['upper_ci'],
+                'configured_min': configured_min,
+                'configured_max': configured_max,
+                'sufficient': estimate['sufficient'],
+                'agrees': agrees,
+            })
+        df = pd.DataFrame(rows)
+        # Маълумоти кам гуруҳларда чегаралар None — устунлар доим сон (NaN) бўлиши керак
+        for column in ('lower', 'upper'):
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+        return df
+
+# =================== ДЕЛЬТА-ТЕКШИРУВ ===================
+def fetch_delta_baselines(conn, pairs: List[Tuple[int, str]]) -> Dict[Tuple[int, str], Tuple]:
+    """Бемор/параметр жуфтлари учун охирги қиймат ва қоидаларни битта сўровда олиш"""
+    if not pairs:
+        return {}
+    patient_ids = sorted({p for p, _ in pairs})
+    codes = sorted({c for _, c in pairs})
+    wanted = set(pairs)
+    baselines = {}
+    # Битта панел — битта сўров; оммавий юклашда беморлар 500 тадан бўлинади
+    for start in range(0, len(patient_ids), 500):
+        chunk = patient_ids[start:start + 500]
+        rows = conn.execute(f'''
+            SELECT lr.patient_id, lr.parameter_code, lr.result_value, lr.test_date,
+                   r.abs_threshold, r.pct_threshold, r.rate_threshold, r.max_interval_days
+            FROM latest_results lr
+            JOIN delta_check_rules r ON r.parameter_code = lr.parameter_code
+            WHERE lr.patient_id IN ({','.join('?' * len(chunk))})
+            AND lr.parameter_code IN ({','.join('?' * len(codes))})
+        ''', chunk + codes).fetchall()
+        baselines.update({(row[0], row[1]): row[2:] for row in rows if (row[0], row[1]) in wanted})
+    return baselines
+
+def evaluate_delta(baseline: Optional[Tuple], value: float, test_date) -> Optional[str]:
+    """Олдинги қийматдан кескин фарқни аниқлаш; фарқ бўлса изоҳ матнини қайтариш"""
+    if baseline is None:
+        return None
+    prev_value, prev_date, abs_threshold, pct_threshold, rate_threshold, max_interval_days = baseline
+    if isinstance(prev_date, str):
+        prev_date = datetime.strptime(prev_date[:10], '%Y-%m-%d').date()
+    if isinstance(test_date, str):
+        test_date = datetime.strptime(test_date[:10], '%Y-%m-%d').date()
+    elif isinstance(test_date, datetime):
+        test_date = test_date.date()
+    days = (test_date - prev_date).days
+    if days < 0 or (max_interval_days is not None and days > max_interval_days):
+        return None
+
+    diff = value - prev_value
+    reasons = []
+    if abs_threshold is not None and abs(diff) > abs_threshold:
+        reasons.append(f"Δ {diff:+.2f}")
+    if pct_threshold is not None and prev_value:
+        pct = diff / abs(prev_value) * 100
+        if abs(pct) > pct_threshold:
+            reasons.append(f"Δ {pct:+.0f}%")
+    if rate_threshold is not None and abs(diff) / max(days, 1) > rate_threshold:
+        reasons.append(f"{diff / max(days, 1):+.2f}/кун")
+    if not reasons:
+        return None
+    return f"{', '.join(reasons)} ({prev_value:g} → {value:g}, {days} кун)"
+
+def annotate_delta_flags(conn, rows: List[Dict]) -> int:
+    """Натижалар рўйхатига delta_flag майдонини қўшиш; белгиланганлар сонини қайтариш"""
+    baselines = fetch_delta_baselines(conn, [(r['patient_id'], r['parameter_code']) for r in rows])
+    flagged = 0
+    for row in rows:
+        if 'delta_flag' in row:
+            flagged += bool(row['delta_flag'])
+            continue
+        row['delta_flag'] = evaluate_delta(
+            baselines.get((row['patient_id'], row['parameter_code'])), row['result_value'], row['test_date'])
+        flagged += bool(row['delta_flag'])
+    return flagged
+
+# =================== ҲИСОБЛАНАДИГАН ПАРАМЕТРЛАР ===================
+FORMULA_FUNCTIONS = {
+    'min': np.minimum,
+    'max': np.maximum,
+    'abs': np.abs,
+    'log': np.log,
+    'log10': np.log10,
+    'exp': np.exp,
+    'sqrt': np.sqrt,
+    'where': np.where,
+}
+FORMULA_CONSTANTS = {'nan': np.nan, 'pi': np.pi}
+FORMULA_VARIABLES = {'AGE', 'FEMALE'}
+# ** ҳар доим float64 да ҳисобланади: бутун сонлар даражаси (9**9**9**9) оқимни осиб қўймайди
+FORMULA_POWER = '_float_power'
+FORMULA_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Constant, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd,
+    ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq,
+)
+
+def normalize_formula(formula: str) -> str:
+    """Параметр кодлари ва AGE/FEMALE катта ҳарфга, функция ва константалар кичик ҳарфга"""
+    def name(match):
+        word = match.group(0)
+        return word.lower() if word.lower() in FORMULA_FUNCTIONS or word.lower() in FORMULA_CONSTANTS \
+            else word.upper()
+    # Сонлардаги даража белгиси (1e5) ном эмас
+    return re.sub(r'(?<![\w.])[A-Za-z_]\w*', name, formula.strip())
+
+class _FloatPower(ast.NodeTransformer):
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Pow):
+            return ast.copy_location(ast.Call(func=ast.Name(id=FORMULA_POWER, ctx=ast.Load()),
+                                              args=[node.left, node.right], keywords=[]), node)
+        return node
+
+@functools.lru_cache(maxsize=256)
+def compile_formula(formula: str):
+    """Формулани текшириб, бир марта компиляция қилиш; (код, боғлиқ параметрлар) қайтаради"""
+    try:
+        tree = ast.parse(formula.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Формулада синтаксис хатоси: {e.msg}")
+    dependencies = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, FORMULA_NODES):
+            raise ValueError(f"Формулада рухсат этилмаган ифода: {type(node).__name__}")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FORMULA_FUNCTIONS or node.keywords:
+                raise ValueError("Формулада фақат min, max, abs, log, log10, exp, sqrt, where функциялари мумкин")
+        elif isinstance(node, ast.Name):
+            if node.id not in FORMULA_FUNCTIONS and node.id not in FORMULA_CONSTANTS \
+                    and node.id not in FORMULA_VARIABLES:
+                dependencies.add(node.id)
+        elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("Формулада фақат сонли қийматлар мумкин")
+    tree = ast.fix_missing_locations(_FloatPower().visit(tree))
+    return compile(tree, '<formula>', 'eval'), frozenset(dependencies)
+
+class FormulaEngine:
+    """Ҳисобланадиган параметрларни боғлиқлик графи тартибида баҳолаш"""
+
+    def __init__(self, conn):
+        self.parameters = {r[0]: {'formula': r[6], 'name': r[1], 'unit': r[2], 'category': r[5],
+                                  'default_min': r[3], 'default_max': r[4]}
+                           for r in cached_parameters(conn) if r[6] and r[6].strip()}
+        self.compiled = {}
+        self.dependencies = {}
+        for code, info in self.parameters.items():
+            self.compiled[code], self.dependencies[code] = compile_formula(info['formula'])
+        self.order = self._topological_order(self.dependencies)
+
+    @staticmethod
+    def _topological_order(dependencies: Dict[str, frozenset]) -> List[str]:
+        sorter = graphlib.TopologicalSorter({code: deps & dependencies.keys() for code, deps in dependencies.items()})
+        try:
+            return list(sorter.static_order())
+        except graphlib.CycleError as e:
+            raise ValueError(f"Формулалар орасида айланма боғлиқлик: {' → '.join(e.args[1])}")
+
+    @classmethod
+    def validate(cls, conn, code: str, formula: str):
+        """Янги формула синтаксисини ва графда айланма йўқлигини текшириш"""
+        _, dependencies = compile_formula(formula)
+        known = {r[0] for r in conn.execute("SELECT parameter_code FROM test_parameters")}
+        unknown = dependencies - known
+        if unknown:
+            raise ValueError(f"Номаълум параметрлар: {', '.join(sorted(unknown))}")
+        graph = {r[0]: compile_formula(r[1])[1] for r in conn.execute(
+            "SELECT parameter_code, formula FROM test_parameters WHERE formula IS NOT NULL AND TRIM(formula) != ''")}
+        graph[code] = dependencies
+        cls._topological_order(graph)
+
+    def inputs_for(self, codes) -> set:
+        """Берилган ҳисобланадиган параметрлар учун керакли ўлчанган параметрлар"""
+        needed, stack = set(), list(codes)
+        while stack:
+            code = stack.pop()
+            for dep in self.dependencies.get(code, ()):
+                if dep in self.parameters:
+                    stack.append(dep)
+                else:
+                    needed.add(dep)
+        return needed
+
+    def evaluate(self, values: Dict, age, female, only=None) -> Dict:
+        """Скаляр (битта панел) ёки numpy массивлари (бутун тўплам) учун баҳолаш"""
+        env = {**FORMULA_FUNCTIONS, **FORMULA_CONSTANTS, **values, 'AGE': age, 'FEMALE': female,
+               FORMULA_POWER: np.float_power}
+        results = {}
+        with np.errstate(all='ignore'):
+            for code in self.order:
+                if code not in self.parameters or (only is not None and code not in only):
+                    continue
+                if not self.dependencies[code] <= env.keys():
+                    continue
+                value = eval(self.compiled[code], {'__builtins__': {}}, env)
+                env[code] = value
+                results[code] = value
+        return results
+
+def resolve_references_vectorized(conn, parameter_code: str, ages, genders, phases=None,
+                                  default_min=None, default_max=None) -> Tuple[np.ndarray, np.ndarray]:
+    """find_reference нинг вектор шакли: ҳар бир қатор учун биринчи мос норма"""
+    ages = np.asarray(ages)
+    genders = np.asarray(genders, dtype=object)
+    phases = np.asarray(phases if phases is not None else [None] * len(ages), dtype=object)
+    ref_min = np.full(len(ages), np.nan)
+    ref_max = np.full(len(ages), np.nan)
+    assigned = np.zeros(len(ages), dtype=bool)
+    norms = conn.execute('''
+        SELECT age_min, age_max, gender, menstrual_phase, min_value, max_value
+        FROM age_gender_norms WHERE parameter_code = ? ORDER BY id
+    ''', (parameter_code,)).fetchall()
+    for age_min, age_max, gender, phase, min_value, max_value in norms:
+        if min_value is None or max_value is None:
+            continue
+        mask = ~assigned
+        if age_min is not None:
+            mask &= ages >= age_min
+        if age_max is not None:
+            mask &= ages <= age_max
+        if gender is not None:
+            mask &= genders == gender
+        if phase is not None:
+            mask &= phases == phase
+        ref_min[mask], ref_max[mask] = min_value, max_value
+        assigned |= mask
+    if default_min is not None and default_max is not None:
+        ref_min[~assigned], ref_max[~assigned] = default_min, default_max
+    return ref_min, ref_max
+
+def classify_results_vectorized(values, ref_min, ref_max) -> np.ndarray:
+    """classify_result нинг вектор шакли"""
+    values = np.asarray(values, dtype=float)
+    known = ~(np.isnan(ref_min) | np.isnan(ref_max))
+    return np.select(
+        [~known, values < ref_min, values > ref_max],
+        ['unknown', 'low', 'high'],
+        default='normal'
+    )
+
+def backfill_calculated(db_manager, conn, codes: Optional[List[str]] = None, source: str = 'test_results') -> Dict:
+    """Ҳисобланадиган параметрларни мавжуд натижалар тўплами бўйича вектор усулда тўлдириш"""
+    engine = FormulaEngine(conn)
+    codes = [c for c in engine.order if c in engine.parameters and (codes is None or c in codes)]
+    if not codes:
+        return {}
+    inputs = sorted(engine.inputs_for(codes))
+    placeholders = ','.join('?' * len(inputs))
+    df = pd.read_sql_query(f'''
+        SELECT tr.patient_id, tr.test_date, tr.parameter_code, tr.result_value,
+               p.birth_date, p.gender
+        FROM {source} tr
+        JOIN patients p ON p.id = tr.patient_id
+        WHERE tr.parameter_code IN ({placeholders})
+        ORDER BY tr.id
+    ''', conn, params=inputs)
+    if df.empty:
+        return {code: 0 for code in codes}
+
+    # Бемор ва сана бўйича кенг жадвал (охирги қиймат олинади)
+    wide = df.pivot_table(index=['patient_id', 'test_date'], columns='parameter_code',
+                          values='result_value', aggfunc='last')
+    meta = df.drop_duplicates(['patient_id', 'test_date']).set_index(['patient_id', 'test_date'])
+    meta = meta.loc[wide.index]
+    test_dates = pd.to_datetime(wide.index.get_level_values('test_date'))
+    ages = ((test_dates - pd.to_datetime(meta['birth_date'].to_numpy())).days // 365).to_numpy()
+    female = (meta['gender'].to_numpy() == 'Аёл').astype(float)
+
+    values = {code: wide[code].to_numpy(dtype=float) for code in wide.columns}
+    computed = engine.evaluate(values, ages, female, only=set(codes))
+
+    summary = {}
+    for code in codes:
+        if code not in computed:
+            summary[code] = 0
+            continue
+        existing = pd.read_sql_query(f'''
+            SELECT DISTINCT patient_id, test_date FROM {source} WHERE parameter_code = ?
+        ''', conn, params=(code,))
+        existing_keys = pd.MultiIndex.from_frame(existing) if not existing.empty else pd.MultiIndex.from_tuples(
+            [], names=['patient_id', 'test_date'])
+        result = np.broadcast_to(np.asarray(computed[code], dtype=float), len(wide))
+        mask = np.isfinite(result) & ~wide.index.isin(existing_keys)
+        if not mask.any():
+            summary[code] = 0
+            continue
+        info = engine.parameters[code]
+        ref_min, ref_max = resolve_references_vectorized(
+            conn, code, ages[mask], meta['gender'].to_numpy()[mask],
+            default_min=info['default_min'], default_max=info['default_max'])
+        statuses = classify_results_vectorized(result[mask], ref_min, ref_max)
+        index = wide.index[mask]
+        rows = [{
+            'patient_id': int(patient_id),
+            'test_type': info['category'],
+            'parameter_code': code,
+            'result_value': round(float(value), 3),
+            'unit': info['unit'],
+            'reference_min': None if np.isnan(lo) else float(lo),
+            'reference_max': None if np.isnan(hi) else float(hi),
+            'status': status,
+            'test_date': test_date,
+            'notes': 'Ҳисобланган',
+            'delta_flag': None,
+        } for (patient_id, test_date), value, lo, hi, status
+            in zip(index, result[mask], ref_min, ref_max, statuses)]
+        db_manager.insert_test_results(rows, conn, check_qc=False)
+        summary[code] = len(rows)
+    return summary
+
+# =================== СИФАТ НАЗОРАТИ (WESTGARD) ===================
+QC_MIN_BASELINE = 20
+QC_WINDOW = 10
+QC_REJECT_RULES = ('1-3s', '2-2s', 'R-4s', '4-1s', '10x')
+QC_STATUS_LABELS = {
+    'accept': "✅ Қабул",
+    'warning': "⚠️ Огоҳлантириш",
+    'reject': "⛔ Рад этилди",
+}
+
+class QCReleaseBlocked(Exception):
+    """Сифат назорати муваффақиятсиз бўлган параметр натижаларини чиқариш тақиқланган"""
+
+    def __init__(self, blocked: Dict[str, str]):
+        self.blocked = blocked
+        super().__init__("Сифат назорати ўтмаган: " + ", ".join(
+            f"{code} ({rules})" for code, rules in sorted(blocked.items())))
+
+def westgard_evaluate(window: List[float]) -> Tuple[str, List[str]]:
+    """Охирги z-қийматлар ойнаси бўйича Westgard қоидалари (энг янгиси охирида)"""
+    if not window:
+        return 'accept', []
+    z = window[-1]
+    violated = []
+    if abs(z) > 3:
+        violated.append('1-3s')
+    last2 = window[-2:]
+    if len(last2) == 2:
+        if all(v > 2 for v in last2) or all(v < -2 for v in last2):
+            violated.append('2-2s')
+        if max(last2) > 2 and min(last2) < -2:
+            violated.append('R-4s')
+    last4 = window[-4:]
+    if len(last4) == 4 and (all(v > 1 for v in last4) or all(v < -1 for v in last4)):
+        violated.append('4-1s')
+    last10 = window[-10:]
+    if len(last10) == 10 and (all(v > 0 for v in last10) or all(v < 0 for v in last10)):
+        violated.append('10x')
+    # Рад этувчи қоидалар QC_REJECT_RULES да; қолган бузилишлар огоҳлантириш
+    if any(rule in QC_REJECT_RULES for rule in violated):
+        return 'reject', violated
+    if violated:
+        return 'warning', violated
+    if abs(z) > 2:
+        return 'warning', ['1-2s']
+    return 'accept', []
+
+def _qc_reference(state: Dict) -> Tuple[Optional[float], Optional[float]]:
+    """Белгиланган мақсад, бўлмаса етарли тўпланган жорий ўртача ва SD"""
+    if state['target_mean'] is not None and state['target_sd']:
+        return state['target_mean'], state['target_sd']
+    if state['n'] >= QC_MIN_BASELINE and state['m2'] > 0:
+        return state['mean'], (state['m2'] / (state['n'] - 1)) ** 0.5
+    return None, None
+
+def load_qc_state(conn, parameter_code: str, level: str) -> Dict:
+    row = conn.execute('''
+        SELECT target_mean, target_sd, n, mean, m2, window, status, last_rules
+        FROM qc_state WHERE parameter_code = ? AND level = ?
+    ''', (parameter_code, level)).fetchone()
+    if row is None:
+        return {'target_mean': None, 'target_sd': None, 'n': 0, 'mean': 0.0, 'm2': 0.0,
+                'window': [], 'status': 'accept', 'last_rules': None}
+    return {'target_mean': row[0], 'target_sd': row[1], 'n': row[2], 'mean': row[3], 'm2': row[4],
+            'window': json.loads(row[5]), 'status': row[6], 'last_rules': row[7]}
+
+def _save_qc_state(conn, parameter_code: str, level: str, state: Dict):
+    conn.execute('''
+        INSERT INTO qc_state (parameter_code, level, target_mean, target_sd, n, mean, m2,
+                              window, status, last_rules, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (parameter_code, level) DO UPDATE SET
+            target_mean = excluded.target_mean, target_sd = excluded.target_sd,
+            n = excluded.n, mean = excluded.mean, m2 = excluded.m2,
+            window = excluded.window, status = excluded.status,
+            last_rules = excluded.last_rules, updated_at = CURRENT_TIMESTAMP
+    ''', (parameter_code, level, state['target_mean'], state['target_sd'], state['n'],
+          state['mean'], state['m2'], json.dumps(state['window']), state['status'], state['last_rules']))
+
+def record_qc_result(conn, parameter_code: str, level: str, value: float,
+                     lot_number: Optional[str] = None, source: str = 'қўлда', commit: bool = True) -> Dict:
+    """Назорат қийматини ёзиш ва қоидаларни O(1) да текшириш"""
+    if commit:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        state = load_qc_state(conn, parameter_code, level)
+        mean, sd = _qc_reference(state)
+        z_score = None
+        status, rules = 'accept', []
+        if sd:
+            z_score = (value - mean) / sd
+            state['window'] = (state['window'] + [round(z_score, 4)])[-QC_WINDOW:]
+            status, rules = westgard_evaluate(state['window'])
+
+        # Рад этилган қийматлар жорий статистикага қўшилмайди
+        if status != 'reject':
+            state['n'] += 1
+            delta = value - state['mean']
+            state['mean'] += delta / state['n']
+            state['m2'] += delta * (value - state['mean'])
+        state['status'] = status
+        state['last_rules'] = ','.join(rules) or None
+        _save_qc_state(conn, parameter_code, level, state)
+        conn.execute('''
+            INSERT INTO qc_results (parameter_code, level, lot_number, value, z_score, rules, status, source)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (parameter_code, level, lot_number, value, z_score, state['last_rules'], status, source))
+        if commit:
+            conn.commit()
+    except Exception:
+        if commit:
+            conn.rollback()
+        raise
+    return {'z_score': z_score, 'status': status, 'rules': rules, 'mean': mean, 'sd': sd}
+
+def set_qc_target(conn, parameter_code: str, level: str, target_mean: Optional[float],
+                  target_sd: Optional[float]):
+    """Назорат материалининг паспорт қийматларини белгилаш"""
+    state = load_qc_state(conn, parameter_code, level)
+    state['target_mean'], state['target_sd'] = target_mean, target_sd
+    _save_qc_state(conn, parameter_code, level, state)
+    conn.commit()
+
+def reset_qc_run(conn, parameter_code: str, level: Optional[str] = None):
+    """Тузатиш чорасидан кейин қоидалар ойнасини тозалаш ва блокни олиш"""
+    query = "UPDATE qc_state SET window = '[]', status = 'accept', last_rules = NULL, updated_at = CURRENT_TIMESTAMP WHERE parameter_code = ?"
+    params = [parameter_code]
+    if level is not None:
+        query += " AND level = ?"
+        params.append(level)
+    conn.execute(query, params)
+    conn.commit()
+
+def release_held_results(db_manager, conn) -> int:
+    """Назорати қайта ўтган параметрларнинг ушлаб қолинган натижаларини ёзиш"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        held = conn.execute("SELECT id, parameter_code, patient_id, row_data FROM held_results ORDER BY id").fetchall()
+        blocked = {}
+        if held and db_manager.get_config('qc_block_release', True, conn):
+            blocked = qc_release_blocked(conn, {row[1] for row in held})
+        ready = [row for row in held if row[1] not in blocked]
+        if not ready:
+            conn.rollback()
+            return 0
+        # Ўчириш ва ёзиш битта транзакцияда: натижа икки марта чиқарилмайди
+        conn.executemany("DELETE FROM held_results WHERE id = ?", [(row[0],) for row in ready])
+        # Бемор ушлаб турилганда бирлаштирилган бўлиши мумкин — жадвалдаги patient_id асосий
+        db_manager.insert_test_results([{**json.loads(row[3]), 'patient_id': row[2]} for row in ready],
+                                       conn, check_qc=False)
+    except Exception:
+        conn.rollback()
+        raise
+    return len(ready)
+
+def discard_held_results(conn, held_ids: List[int]) -> int:
+    """Қайта ўлчанадиган намуналарнинг ушлаб қолинган натижаларини бекор қилиш"""
+    deleted = conn.executemany("DELETE FROM held_results WHERE id = ?", [(i,) for i in held_ids]).rowcount
+    conn.commit()
+    return deleted
+
+def qc_release_blocked(conn, parameter_codes=None) -> Dict[str, str]:
+    """Назорати рад этилган параметрлар: {код: бузилган қоидалар}"""
+    rows = conn.execute(
+        "SELECT parameter_code, level, last_rules FROM qc_state WHERE status = 'reject'").fetchall()
+    blocked = {}
+    for code, level, rules in rows:
+        if parameter_codes is None or code in parameter_codes:
+            blocked[code] = f"{level}: {rules}" if code not in blocked else f"{blocked[code]}; {level}: {rules}"
+    return blocked
+
+# =================== КРИТИК ҚИЙМАТЛАР ОГОҲЛАНТИРИШИ ===================
+ALERT_BATCH_SIZE = 50
+ALERT_MAX_ATTEMPTS = 8
+ALERT_BACKOFF_BASE = 5
+ALERT_BACKOFF_MAX = 900
+ALERT_POLL_SECONDS = 10
+ALERT_WAKEUP = threading.Event()
+EMAIL_DEFAULTS = {
+    'smtp_server': 'smtp.gmail.com',
+    'smtp_port': 587,
+    'email_username': '',
+    'email_from': 'Шифохона тахлил маркази',
+    'email_ssl': True,
+    'alert_recipients': '',
+}
+# SMTP пароли базада сақланмайди: у тўлиқ нусхалар ва ҳисобот нусхасига тушиб қоларди
+SMTP_PASSWORD_ENV = 'MEDICAL_LAB_SMTP_PASSWORD'
+
+def smtp_password() -> str:
+    """SMTP пароли муҳит ўзгарувчисидан ёки .streamlit/secrets.toml даги smtp_password дан"""
+    password = os.environ.get(SMTP_PASSWORD_ENV)
+    if password:
+        return password
+    try:
+        return str(st.secrets.get('smtp_password', ''))
+    except FileNotFoundError:
+        return ''
+
+def critical_kind(value, low_critical, high_critical) -> Optional[Tuple[str, float]]:
+    """Қиймат критик чегарадан чиққанини аниқлаш: ('low'|'high', чегара)"""
+    if value is None:
+        return None
+    if low_critical is not None and value < low_critical:
+        return 'low', low_critical
+    if high_critical is not None and value > high_critical:
+        return 'high', high_critical
+    return None
+
+def load_critical_limits(conn, parameter_codes) -> Dict[str, Tuple]:
+    codes = sorted(parameter_codes)
+    if not codes:
+        return {}
+    if not conn.in_transaction:
+        limits = cached_critical_limits(conn)
+        return {code: limits[code] for code in codes if code in limits}
+    placeholders = ','.join('?' * len(codes))
+    rows = conn.execute(f'''
+        SELECT parameter_code, low_critical, high_critical FROM critical_limits
+        WHERE parameter_code IN ({placeholders})
+    ''', codes).fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+def enqueue_critical_alerts(db_manager, conn, rows: List[Dict]) -> int:
+    """Критик натижаларни навбатга қўшиш (коммит чақирувчида)"""
+    system = db_manager.get_config('system_settings', {}, conn)
+    if not system.get('enable_notifications', True):
+        return 0
+    limits = load_critical_limits(conn, {row['parameter_code'] for row in rows})
+    alerts = []
+    for row in rows:
+        if row['parameter_code'] not in limits:
+            continue
+        hit = critical_kind(row['result_value'], *limits[row['parameter_code']])
+        if hit:
+            alerts.append((row['patient_id'], row['parameter_code'], row['result_value'],
+                           hit[0], hit[1], str(row['test_date'])))
+    if alerts:
+        conn.executemany('''
+            INSERT INTO alert_outbox (patient_id, parameter_code, result_value, limit_kind, limit_value, test_date)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', alerts)
+    return len(alerts)
+
+def alert_backoff(attempts: int) -> float:
+    """Экспоненциал кутиш (тасодифий силжиш билан)"""
+    delay = min(ALERT_BACKOFF_BASE * 2 ** (attempts - 1), ALERT_BACKOFF_MAX)
+    return delay * (0.8 + 0.4 * np.random.random())
+
+def send_alert_email(settings: Dict, recipients: List[str], subject: str, body: str):
+    """Битта SMTP сеанс орқали хат юбориш (блокловчи, алоҳида оқимда чақирилади)"""
+    import smtplib
+    from email.message import EmailMessage
+    from email.utils import formataddr
+    message = EmailMessage()
+    sender = settings.get('email_username') or 'lab@localhost'
+    message['From'] = formataddr((settings.get('email_from') or '', sender))
+    message['To'] = ', '.join(recipients)
+    message['Subject'] = subject
+    message.set_content(body)
+    port = int(settings.get('smtp_port') or 25)
+    if settings.get('email_ssl') and port == 465:
+        client = smtplib.SMTP_SSL(settings['smtp_server'], port, timeout=30)
+    else:
+        client = smtplib.SMTP(settings['smtp_server'], port, timeout=30)
+    with client:
+        if settings.get('email_ssl') and port != 465:
+            client.starttls()
+        if settings.get('email_username') and settings.get('email_password'):
+            client.login(settings['email_username'], settings['email_password'])
+        client.send_message(message)
+
+class AlertDispatcher:
+    """Огоҳлантиришлар навбатини фон asyncio циклида бўлаклаб юбориш"""
+
+    def __init__(self, db_manager, sender=send_alert_email):
+        self.db = db_manager
+        self.sender = sender
+        self.stats = {'sent': 0, 'batches': 0, 'retries': 0, 'failed': 0}
+        self.last_error = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._run()),
+                                        name="alert-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        ALERT_WAKEUP.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self._thread = None
+
+    async def _run(self):
+        conn = self.db.connect()
+        try:
+            while not self._stop.is_set():
+                try:
+                    delivered = await self.drain_once(conn)
+                except Exception as e:
+                    self.last_error = e
+                    delivered = 0
+                if not delivered:
+                    # Кейинги қайта уриниш муддатигача ёки янги огоҳлантиришгача кутиш
+                    next_due = conn.execute(
+                        "SELECT MIN(next_attempt_at) FROM alert_outbox WHERE status = 'pending'").fetchone()[0]
+                    timeout = ALERT_POLL_SECONDS if next_due is None else \
+                        min(max(next_due - time.time(), 0.05), ALERT_POLL_SECONDS)
+                    await asyncio.to_thread(ALERT_WAKEUP.wait, timeout)
+                    ALERT_WAKEUP.clear()
+        finally:
+            conn.close()
+
+    async def drain_once(self, conn) -> int:
+        """Муддати келган огоҳлантиришларни битта хатда юбориш; юборилганлар сони"""
+        settings = {**EMAIL_DEFAULTS, **self.db.get_config('email_settings', {}, conn),
+                    'email_password': smtp_password()}
+        recipients = [r.strip() for r in settings.get('alert_recipients', '').replace(';', ',').split(',') if r.strip()]
+        if not recipients or not self.db.get_config('system_settings', {}, conn).get('enable_notifications', True):
+            return 0
+        rows = conn.execute('''
+            SELECT a.id, a.parameter_code, a.result_value, a.limit_kind, a.limit_value, a.test_date,
+                   a.attempts, p.full_name, p.patient_id
+            FROM alert_outbox a
+            LEFT JOIN patients p ON p.id = a.patient_id
+            WHERE a.status = 'pending' AND a.next_attempt_at <= ?
+            ORDER BY a.id
+            LIMIT ?
+        ''', (time.time(), ALERT_BATCH_SIZE)).fetchall()
+        if not rows:
+            return 0
+
+        lines = [
+            f"{'⬇️' if kind == 'low' else '⬆️'} {name or '—'} ({code_id or '—'}): {param} = {value} "
+            f"({'<' if kind == 'low' else '>'} {limit}), {test_date}"
+            for _, param, value, kind, limit, test_date, _, name, code_id in rows
+        ]
+        subject = f"🚨 Критик натижалар: {len(rows)} та"
+        body = "Қуйидаги натижалар критик чегарадан чиқди:\n\n" + "\n".join(lines)
+        ids = [(row[0],) for row in rows]
+        try:
+            await asyncio.to_thread(self.sender, settings, recipients, subject, body)
+        except Exception as e:
+            self.last_error = e
+            updates = []
+            for row in rows:
+                attempts = row[6] + 1
+                status = 'failed' if attempts >= ALERT_MAX_ATTEMPTS else 'pending'
+                self.stats['failed' if status == 'failed' else 'retries'] += 1
+                updates.append((status, attempts, time.time() + alert_backoff(attempts), str(e)[:500], row[0]))
+            conn.executemany('''
+                UPDATE alert_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+                WHERE id = ?
+            ''', updates)
+            conn.commit()
+            return 0
+        conn.executemany('''
+            UPDATE alert_outbox SET status = 'sent', attempts = attempts + 1,
+                   sent_at = CURRENT_TIMESTAMP, last_error = NULL
+            WHERE id = ?
+        ''', ids)
+        conn.commit()
+        self.stats['sent'] += len(rows)
+        self.stats['batches'] += 1
+        return len(rows)
+
+@st.cache_resource
+def get_alert_dispatcher():
+    return AlertDispatcher(db)
+
+class LocalSMTPServer:
+    """Синов учун оддий SMTP қабул қилувчи: хатларни хотирада ва mbox файлида сақлайди"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8025, mbox_path: Optional[str] = None,
+                 fail_first: int = 0):
+        self.host = host
+        self.port = port
+        self.mbox_path = mbox_path
+        self.fail_first = fail_first
+        self.messages = []
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    async def _handle(self, reader, writer):
+        async def reply(line: str):
+            writer.write((line + '\r\n').encode())
+            await writer.drain()
+
+        await reply(f"220 {socket.gethostname()} LocalSMTP")
+        sender, recipients = None, []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode('utf-8', 'replace').strip()
+                verb = command[:4].upper()
+                if verb in ('HELO', 'EHLO'):
+                    await reply("250 OK")
+                elif verb == 'MAIL':
+                    if self.fail_first > 0:
+                        self.fail_first -= 1
+                        await reply("451 Temporary failure")
+                        continue
+                    sender, recipients = command[10:].strip(' <>'), []
+                    await reply("250 OK")
+                elif verb == 'RCPT':
+                    recipients.append(command[8:].strip(' <>'))
+                    await reply("250 OK")
+                elif verb == 'DATA':
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    data = []
+                    while True:
+                        chunk = await reader.readline()
+                        if not chunk or chunk in (b'.\r\n', b'.\n'):
+                            break
+                        data.append(chunk[1:] if chunk.startswith(b'..') else chunk)
+                    raw = b''.join(data).decode('utf-8', 'replace')
+                    self.messages.append({'from': sender, 'to': recipients, 'data': raw})
+                    if self.mbox_path:
+                        with open(self.mbox_path, 'a', encoding='utf-8') as mbox:
+                            mbox.write(f"From {sender} {time.asctime()}\n{raw}\n")
+                    await reply("250 Queued")
+                elif verb == 'RSET':
+                    sender, recipients = None, []
+                    await reply("250 OK")
+                elif verb == 'NOOP':
+                    await reply("250 OK")
+                elif verb == 'QUIT':
+                    await reply("221 Bye")
+                    break
+                else:
+                    await reply("502 Command not implemented")
+        finally:
+            writer.close()
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="smtp-standin", daemon=True)
+        self._thread.start()
+        ready.wait(5)
+        return self
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+# =================== НОРМАЛАР ТЕКШИРУВИ ===================
+NORM_AGE_LIMIT = 120
+NORM_FIELDS = ['parameter_code', 'age_min', 'age_max', 'gender', 'menstrual_phase', 'min_value', 'max_value']
+NORM_ISSUE_LABELS = {
+    'invalid': "❌ Нотўғри ёзув",
+    'overlap': "❌ Устма-уст тушиш",
+    'gap': "⚠️ Қамралмаган ёш",
+    'fractional_gap': "ℹ️ Бутун бўлмаган ёшда бўшлиқ",
+}
+NORM_BLOCKING_ISSUES = ('invalid', 'overlap')
+
+def _norm_label(norm: Dict) -> str:
+    return f"#{norm['id']}" if norm.get('id') is not None else norm.get('label', 'янги')
+
+def _norm_contexts(norms: List[Dict]) -> List[Tuple[str, Optional[str]]]:
+    """Қидирувда учрайдиган (жинс, фаза) жуфтлари"""
+    phases = sorted({n['menstrual_phase'] for n in norms if n['menstrual_phase']})
+    genders = ['Эркак', 'Аёл'] if any(n['gender'] for n in norms) else [None]
+    contexts = [(gender, None) for gender in genders]
+    contexts += [('Аёл' if genders[0] else None, phase) for phase in phases]
+    return contexts
+
+def validate_norms(norms: List[Dict]) -> List[Dict]:
+    """Ҳар бир параметр/жинс/фаза гуруҳида ёш оралиқларини саралаб, устма-уст тушиш ва бўшлиқларни топиш"""
+    issues = []
+    by_parameter = {}
+    for norm in norms:
+        label = _norm_label(norm)
+        problems = []
+        if norm['age_min'] is not None and norm['age_max'] is not None and norm['age_min'] > norm['age_max']:
+            problems.append("ёш мин > ёш макс")
+        if (norm['age_min'] or 0) < 0 or (norm['age_max'] if norm['age_max'] is not None else 0) > NORM_AGE_LIMIT:
+            problems.append(f"ёш 0–{NORM_AGE_LIMIT} оралиғидан ташқарида")
+        if norm['min_value'] is None or norm['max_value'] is None:
+            problems.append("норма қийматлари бўш")
+        elif norm['min_value'] > norm['max_value']:
+            problems.append("мин қиймат > макс қиймат")
+        if norm['menstrual_phase'] and norm['gender'] == 'Эркак':
+            problems.append("эркак учун менструация фазаси")
+        if problems:
+            issues.append({'parameter_code': norm['parameter_code'], 'gender': norm['gender'],
+                           'phase': norm['menstrual_phase'], 'kind': 'invalid',
+                           'age_from': norm['age_min'], 'age_to': norm['age_max'],
+                           'norms': [label], 'message': ", ".join(problems)})
+            continue
+        by_parameter.setdefault(norm['parameter_code'], []).append(norm)
+
+    seen_overlaps = set()
+    for code, rows in by_parameter.items():
+        for gender, phase in _norm_contexts(rows):
+            # Шу контекстда қидирув мос келадиган ёзувлар (NULL — ҳар қандай)
+            applicable = [n for n in rows
+                          if n['gender'] in (None, gender)
+                          and (n['menstrual_phase'] is None or n['menstrual_phase'] == phase)]
+            intervals = sorted(
+                ((n['age_min'] if n['age_min'] is not None else 0,
+                  n['age_max'] if n['age_max'] is not None else NORM_AGE_LIMIT, n) for n in applicable),
+                key=lambda item: (item[0], item[1])
+            )
+            context = {'parameter_code': code, 'gender': gender, 'phase': phase}
+            reach, reach_norm = -1, None
+            for start, end, norm in intervals:
+                if reach_norm is not None and start <= reach:
+                    key = tuple(sorted((_norm_label(reach_norm), _norm_label(norm))))
+                    if key not in seen_overlaps:
+                        seen_overlaps.add(key)
+                        issues.append({**context, 'kind': 'overlap', 'age_from': start, 'age_to': min(end, reach),
+                                       'norms': list(key),
+                                       'message': f"{start}–{min(end, reach)} ёшда иккала норма мос келади"})
+                elif start > reach + 1:
+                    issues.append({**context, 'kind': 'gap', 'age_from': reach + 1, 'age_to': start - 1,
+                                   'norms': [], 'message': "стандарт қиймат ишлатилади"})
+                elif reach_norm is not None and start == reach + 1:
+                    issues.append({**context, 'kind': 'fractional_gap', 'age_from': reach, 'age_to': start,
+                                   'norms': [_norm_label(reach_norm), _norm_label(norm)],
+                                   'message': f"{reach} ва {start} ёш орасида ({reach}.x ёш)"})
+                if end > reach:
+                    reach, reach_norm = end, norm
+            if intervals and reach < NORM_AGE_LIMIT:
+                issues.append({**context, 'kind': 'gap', 'age_from': reach + 1, 'age_to': NORM_AGE_LIMIT,
+                               'norms': [], 'message': "стандарт қиймат ишлатилади"})
+    return issues
+
+def load_norms(conn, parameter_codes=None) -> List[Dict]:
+    query = f"SELECT id, {', '.join(NORM_FIELDS)} FROM age_gender_norms"
+    params = []
+    if parameter_codes is not None:
+        codes = sorted(parameter_codes)
+        query += f" WHERE parameter_code IN ({','.join('?' * len(codes))})"
+        params = codes
+    rows = conn.execute(query + " ORDER BY id", params).fetchall()
+    return [dict(zip(['id'] + NORM_FIELDS, row)) for row in rows]
+
+def audit_norms(conn, parameter_codes=None) -> List[Dict]:
+    """Бутун каталог (ёки танланган параметрлар) бўйича текширув"""
+    return validate_norms(load_norms(conn, parameter_codes))
+
+def check_new_norms(conn, new_norms: List[Dict], replace: bool = False) -> List[Dict]:
+    """Янги ёзувларни мавжудлари билан бирга текшириш; фақат янгиларга тегишли муаммолар"""
+    codes = {n['parameter_code'] for n in new_norms}
+    existing = [] if replace else load_norms(conn, codes)
+    labelled = [{**n, 'id': None, 'label': n.get('label') or f"янги {i + 1}"} for i, n in enumerate(new_norms)]
+    new_labels = {n['label'] for n in labelled}
+    issues = validate_norms(existing + labelled)
+    return [i for i in issues if i['kind'] in ('gap', 'fractional_gap') or new_labels & set(i['norms'])]
+
+def norms_to_yaml(norms: List[Dict]) -> str:
+    """Нормаларни параметр бўйича гуруҳланган YAML кўринишида"""
+    catalog = {}
+    for n in norms:
+        entry = {'age': [n['age_min'], n['age_max']], 'range': [n['min_value'], n['max_value']]}
+        if n['gender']:
+            entry['gender'] = n['gender']
+        if n['menstrual_phase']:
+            entry['phase'] = n['menstrual_phase']
+        catalog.setdefault(n['parameter_code'], []).append(entry)
+    return yaml.safe_dump({'norms': catalog}, allow_unicode=True, sort_keys=False, default_flow_style=None)
+
+def norms_from_yaml(text: str) -> List[Dict]:
+    data = yaml.safe_load(text) or {}
+    catalog = data.get('norms', data)
+    if not isinstance(catalog, dict):
+        raise ValueError("YAML да 'norms: {ПАРАМЕТР: [...]}' тузилмаси кутилади")
+    norms = []
+    for code, entries in catalog.items():
+        for i, entry in enumerate(entries or [], 1):
+            try:
+                age_min, age_max = entry.get('age', [0, NORM_AGE_LIMIT])
+                min_value, max_value = entry['range']
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"{code} #{i}: 'age: [мин, макс]' ва 'range: [мин, макс]' керак")
+            norms.append({
+                'parameter_code': str(code).upper(), 'age_min': age_min, 'age_max': age_max,
+                'gender': entry.get('gender'), 'menstrual_phase': entry.get('phase'),
+                'min_value': min_value, 'max_value': max_value, 'label': f"{code} #{i}",
+            })
+    return norms
+
+def import_norms(conn, norms: List[Dict], replace: bool = True) -> Dict:
+    """Нормаларни битта ўтишда текшириб, битта транзакцияда ёзиш"""
+    codes = {n['parameter_code'] for n in norms}
+    known = {r[0] for r in conn.execute("SELECT parameter_code FROM test_parameters")}
+    unknown = sorted(codes - known)
+    issues = check_new_norms(conn, norms, replace=replace)
+    blocking = [i for i in issues if i['kind'] in NORM_BLOCKING_ISSUES]
+    if unknown or blocking:
+        return {'imported': 0, 'unknown': unknown, 'issues': issues}
+    try:
+        if replace:
+            conn.executemany("DELETE FROM age_gender_norms WHERE parameter_code = ?", [(c,) for c in codes])
+        conn.executemany(f'''
+            INSERT INTO age_gender_norms ({', '.join(NORM_FIELDS)})
+            VALUES ({', '.join(':' + f for f in NORM_FIELDS)})
+        ''', norms)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    audit = get_audit_log()
+    for code in sorted(codes):
+        audit.record('import', 'norms', code, changes={
+            'replace': replace, 'norms': [{f: n[f] for f in NORM_FIELDS} for n in norms if n['parameter_code'] == code]})
+    return {'imported': len(norms), 'unknown': [], 'issues': issues}
+
+def norms_round_trip_issues(conn, parameter_codes=None) -> List[Dict]:
+    """Каталогни YAML га ёзиб, қайта ўқиб импорт қилганда уни тўсадиган муаммолар (базага ёзилмайди)"""
+    norms = norms_from_yaml(norms_to_yaml(load_norms(conn, parameter_codes)))
+    return [i for i in check_new_norms(conn, norms, replace=True) if i['kind'] in NORM_BLOCKING_ISSUES]
+
+def norm_issues_frame(issues: List[Dict]) -> pd.DataFrame:
+    return pd.DataFrame([{
+        'Параметр': i['parameter_code'],
+        'Жинси': i['gender'] or 'Ҳар қандай',
+        'Фаза': i['phase'] or '',
+        'Муаммо': NORM_ISSUE_LABELS[i['kind']],
+        'Ёш': f"{i['age_from']}–{i['age_to']}",
+        'Нормалар': ', '.join(i['norms']),
+        'Изоҳ': i['message'],
+    } for i in issues])
+
+# =================== БУЮРТМАЛАР ВА ИШ РЎЙХАТИ ===================
+ORDER_PRIORITIES = {'STAT': 0, 'routine': 1}
+ORDER_PRIORITY_LABELS = {'STAT': "🚨 STAT", 'routine': "🕒 Режали"}
+ORDER_STATUS_LABELS = {
+    'pending': "⏳ Кутилмоқда",
+    'in_progress': "🔬 Бажарилмоқда",
+    'validated': "✅ Тасдиқланган",
+    'cancelled': "🚫 Бекор қилинган",
+}
+ORDER_OPEN_STATUSES = ('pending', 'in_progress')
+
+def create_order(conn, patient_id: int, category: str, parameter_codes: List[str],
+                 priority: str = 'routine', doctor_id: Optional[int] = None, notes: Optional[str] = None) -> int:
+    """Янги буюртма яратиш"""
+    cursor = conn.execute('''
+        INSERT INTO orders (patient_id, doctor_id, category, parameter_codes, priority, priority_rank,
+                            notes, change_seq)
+        VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(change_seq), 0) + 1 FROM orders))
+    ''', (patient_id, doctor_id, category, json.dumps(parameter_codes), priority,
+          ORDER_PRIORITIES[priority], notes))
+    conn.commit()
+    return cursor.lastrowid
+
+def advance_orders(conn, order_ids: List[int], status: str, from_statuses=None) -> int:
+    """Буюртмалар ҳолатини ўзгартириш (коммит чақирувчида); ҳар бир ўзгариш янги тартиб рақами олади"""
+    query = f"SELECT id FROM orders WHERE id IN ({','.join('?' * len(order_ids))})"
+    params = list(order_ids)
+    if from_statuses:
+        query += f" AND status IN ({','.join('?' * len(from_statuses))})"
+        params += list(from_statuses)
+    eligible = [row[0] for row in conn.execute(query, params)]
+    if not eligible:
+        return 0
+    conn.execute(f'''
+        UPDATE orders
+        SET status = ?, updated_at = CURRENT_TIMESTAMP,
+            change_seq = (SELECT COALESCE(MAX(change_seq), 0) FROM orders) + 1
+        WHERE id IN ({','.join('?' * len(eligible))})
+    ''', [status, *eligible])
+    if status == 'validated':
+        record_order_stage(conn, eligible, 'validated')
+    return len(eligible)
+
+class Worklist:
+    """Категория бўйича очиқ буюртмалар навбати: STAT олдин, кейин келиш тартибида.
+
+    Бошида индекс бўйича бир марта юкланади, кейин фақат change_seq ошган
+    буюртмалар ўқилади; ўчирилган ёки ўзгарган ёзувлар уюмда ялқов олиб ташланади.
+    """
+
+    def __init__(self, category: str):
+        self.category = category
+        self.heap = []
+        self.entries = {}
+        self.last_seq = None
+
+    def _apply(self, row):
+        order_id, change_seq, status, priority_rank = row[0], row[1], row[2], row[3]
+        if status in ORDER_OPEN_STATUSES:
+            self.entries[order_id] = row
+            heapq.heappush(self.heap, (priority_rank, order_id, change_seq))
+        else:
+            self.entries.pop(order_id, None)
+
+    def refresh(self, conn) -> int:
+        """Охирги янгиланишдан бери ўзгарган буюртмаларни қўллаш; ўзгаришлар сони"""
+        columns = '''
+            SELECT o.id, o.change_seq, o.status, o.priority_rank, o.priority, o.created_at,
+                   o.parameter_codes, o.notes, p.full_name, p.patient_id
+            FROM orders o JOIN patients p ON p.id = o.patient_id
+        '''
+        if self.last_seq is None:
+            self.last_seq = conn.execute("SELECT COALESCE(MAX(change_seq), 0) FROM orders").fetchone()[0]
+            rows = conn.execute(columns + f'''
+                WHERE o.category = ? AND o.status IN ({','.join('?' * len(ORDER_OPEN_STATUSES))})
+                  AND o.change_seq <= ?
+            ''', (self.category, *ORDER_OPEN_STATUSES, self.last_seq)).fetchall()
+        else:
+            rows = conn.execute(columns + '''
+                WHERE o.category = ? AND o.change_seq > ?
+                ORDER BY o.change_seq
+            ''', (self.category, self.last_seq)).fetchall()
+        for row in rows:
+            self._apply(row)
+            self.last_seq = max(self.last_seq, row[1])
+        # Эскирган ёзувлар кўпайиб кетса, уюмни қайта қуриш
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(row[3], order_id, row[1]) for order_id, row in self.entries.items()]
+            heapq.heapify(self.heap)
+        return len(rows)
+
+    def _valid(self, item) -> bool:
+        row = self.entries.get(item[1])
+        return row is not None and row[1] == item[2]
+
+    def top(self, limit: int) -> List[tuple]:
+        """Навбатдаги биринчи limit та буюртма"""
+        result = []
+        for item in heapq.nsmallest(limit + len(self.heap) - len(self.entries), self.heap):
+            if self._valid(item):
+                result.append(self.entries[item[1]])
+                if len(result) == limit:
+                    break
+        return result
+
+    def __len__(self):
+        return len(self.entries)
+
+    def counts(self) -> Dict[str, int]:
+        counts = {}
+        for row in self.entries.values():
+            key = (row[4], row[2])
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+def render_order_blank(conn, order_id: int) -> str:
+    """Буюртма натижалари бланкаси (HTML)"""
+    order = conn.execute('''
+        SELECT o.id, o.category, o.validated_at, p.full_name, p.patient_id, p.birth_date, p.gender
+        FROM orders o JOIN patients p ON p.id = o.patient_id WHERE o.id = ?
+    ''', (order_id,)).fetchone()
+    results = conn.execute('''
+        SELECT COALESCE(tp.parameter_name, tr.parameter_code), tr.result_value, tr.unit,
+               tr.reference_min, tr.reference_max, tr.status
+        FROM test_results tr LEFT JOIN test_parameters tp ON tp.parameter_code = tr.parameter_code
+        WHERE tr.order_id = ? ORDER BY tr.id
+    ''', (order_id,)).fetchall()
+    rows = "".join(
+        f"<tr><td>{name}</td><td><b>{value}</b></td><td>{unit or ''}</td>"
+        f"<td>{'' if low is None else f'{low} – {high}'}</td><td>{STATUS_LABELS.get(status, status)}</td></tr>"
+        for name, value, unit, low, high, status in results
+    )
+    specimen = conn.execute("SELECT MIN(barcode) FROM specimens WHERE order_id = ?", (order_id,)).fetchone()[0]
+    qr = f'<div style="float: right;">{qr_svg(specimen_link(specimen, conn))}</div>' if specimen else ''
+    return f"""<html><head><meta charset="utf-8"><title>Буюртма #{order[0]}</title></head>
+<body style="font-family: Arial, sans-serif;">
+{qr}<h2>{order[1]} тахлили — буюртма #{order[0]}</h2>
+<p><b>Бемор:</b> {order[3]} ({order[4]}), {order[5]}, {order[6]}<br>
+<b>Тасдиқланган:</b> {order[2] or '—'}</p>
+<table border="1" cellpadding="6" cellspacing="0" style="border-collapse: collapse; width: 100%;">
+<tr><th>Параметр</th><th>Натижа</th><th>Бирлик</th><th>Норма</th><th>Холат</th></tr>{rows}</table>
+</body></html>"""
+
+def mark_order_printed(order_id: int):
+    record_order_stage(db.conn, [order_id], 'printed')
+    db.conn.commit()
+
+def get_worklist(category: str) -> Worklist:
+    """Сессия учун категория иш рўйхати (қайта юкланмасдан янгиланади)"""
+    worklists = st.session_state.setdefault('worklists', {})
+    if category not in worklists:
+        worklists[category] = Worklist(category)
+    worklist = worklists[category]
+    worklist.refresh(db.conn)
+    return worklist
+
+# =================== БАЖАРИЛИШ ВАҚТИ (TAT) ===================
+ORDER_STAGES = ['ordered', 'collected', 'received', 'resulted', 'validated', 'printed']
+ORDER_STAGE_COLUMNS = {
+    'ordered': 'created_at',
+    'collected': 'collected_at',
+    'received': 'received_at',
+    'resulted': 'resulted_at',
+    'validated': 'validated_at',
+    'printed': 'printed_at',
+}
+ORDER_STAGE_LABELS = {
+    'ordered': "📝 Буюртма",
+    'collected': "🩸 Намуна олинди",
+    'received': "📥 Қабул қилинди",
+    'resulted': "🔬 Натижа",
+    'validated': "✅ Тасдиқланди",
+    'printed': "🖨️ Чоп этилди",
+}
+# Кўрсаткич: (бошланиш босқичи, тугаш босқичи)
+TAT_METRICS = {
+    'order_to_result': ('ordered', 'resulted'),
+    'receive_to_result': ('received', 'resulted'),
+    'collect_to_receive': ('collected', 'received'),
+    'result_to_validate': ('resulted', 'validated'),
+    'order_to_validate': ('ordered', 'validated'),
+    'validate_to_print': ('validated', 'printed'),
+}
+TAT_METRIC_LABELS = {
+    'order_to_result': "Буюртма → натижа",
+    'receive_to_result': "Қабул → натижа (лаборатория)",
+    'collect_to_receive': "Намуна → қабул (етказиш)",
+    'result_to_validate': "Натижа → тасдиқ",
+    'order_to_validate': "Буюртма → тасдиқ (умумий)",
+    'validate_to_print': "Тасдиқ → чоп",
+}
+TAT_SHIFTS = [(0, 8, "🌙 Тунги"), (8, 16, "☀️ Кундузги"), (16, 24, "🌆 Кечки")]
+TAT_RELATIVE_ACCURACY = 0.02
+TAT_GAMMA = (1 + TAT_RELATIVE_ACCURACY) / (1 - TAT_RELATIVE_ACCURACY)
+TAT_MIN_MINUTES = 0.1
+
+def tat_shift(hour: int) -> str:
+    return next(label for start, end, label in TAT_SHIFTS if start <= hour < end)
+
+def tat_bucket(minutes: float) -> int:
+    """Логарифмик бакет: қиймат бакет вакилидан 2% дан ортиқ фарқ қилмайди"""
+    return int(np.ceil(np.log(max(minutes, TAT_MIN_MINUTES)) / np.log(TAT_GAMMA)))
+
+def tat_bucket_value(bucket) -> float:
+    return 2 * TAT_GAMMA ** bucket / (TAT_GAMMA + 1)
+
+def sketch_quantiles(buckets: np.ndarray, counts: np.ndarray, quantiles=(0.5, 0.9, 0.99)) -> List[float]:
+    """Тартибланган бакетлар гистограммасидан квантилларни олиш"""
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    positions = np.searchsorted(cumulative, [q * (total - 1) + 1 for q in quantiles])
+    return [float(tat_bucket_value(buckets[min(p, len(buckets) - 1)])) for p in positions]
+
+def _tat_sketch_rows(conn, order_ids: List[int], metrics: List[str]) -> List[Tuple]:
+    placeholders = ','.join('?' * len(order_ids))
+    sketch_rows = {}
+    for metric in metrics:
+        start_col = ORDER_STAGE_COLUMNS[TAT_METRICS[metric][0]]
+        end_col = ORDER_STAGE_COLUMNS[TAT_METRICS[metric][1]]
+        rows = conn.execute(f'''
+            SELECT category,
+                   DATE({start_col}, 'localtime'),
+                   CAST(strftime('%H', {start_col}, 'localtime') AS INTEGER),
+                   (julianday({end_col}) - julianday({start_col})) * 1440
+            FROM orders
+            WHERE id IN ({placeholders}) AND {start_col} IS NOT NULL AND {end_col} IS NOT NULL
+        ''', order_ids).fetchall()
+        for category, day, hour, minutes in rows:
+            key = (metric, category, day, tat_shift(hour), tat_bucket(minutes))
+            sketch_rows[key] = sketch_rows.get(key, 0) + 1
+    return [(*key, count) for key, count in sketch_rows.items()]
+
+def _tat_upsert(conn, sketch_rows: List[Tuple]):
+    conn.executemany('''
+        INSERT INTO tat_sketch (metric, category, day, shift, bucket, count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (metric, category, day, shift, bucket) DO UPDATE SET count = count + excluded.count
+    ''', sketch_rows)
+
+def record_order_stage(conn, order_ids: List[int], stage: str) -> int:
+    """Босқич вақтини биринчи марта ёзиш ва шу босқичда тугайдиган TAT скетчларини янгилаш (коммит чақирувчида)"""
+    column = ORDER_STAGE_COLUMNS[stage]
+    placeholders = ','.join('?' * len(order_ids))
+    stamped = [row[0] for row in conn.execute(
+        f"SELECT id FROM orders WHERE id IN ({placeholders}) AND {column} IS NULL", order_ids)]
+    if not stamped:
+        return 0
+    conn.execute(f'''
+        UPDATE orders SET {column} = CURRENT_TIMESTAMP
+        WHERE id IN ({','.join('?' * len(stamped))})
+    ''', stamped)
+    metrics = [m for m, (_, end) in TAT_METRICS.items() if end == stage]
+    _tat_upsert(conn, _tat_sketch_rows(conn, stamped, metrics))
+    return len(stamped)
+
+def rebuild_tat_sketch(conn) -> int:
+    """Скетчларни бутун буюртмалар тарихидан қайта қуриш"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM tat_sketch")
+        order_ids = [row[0] for row in conn.execute("SELECT id FROM orders")]
+        total = 0
+        for start in range(0, len(order_ids), 500):
+            rows = _tat_sketch_rows(conn, order_ids[start:start + 500], list(TAT_METRICS))
+            _tat_upsert(conn, rows)
+            total += sum(row[-1] for row in rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return total
+
+def tat_percentiles(conn, metric: str, group_by: str, date_from, date_to, categories=None) -> pd.DataFrame:
+    """Гуруҳ бўйича p50/p90/p99 (дақиқа); фақат бакетлар жамланади, тарих сараланмайди"""
+    query = f'''
+        SELECT {group_by} AS grp, bucket, SUM(count) AS count
+        FROM tat_sketch
+        WHERE metric = ? AND day BETWEEN ? AND ?
+    '''
+    params = [metric, str(date_from), str(date_to)]
+    if categories:
+        query += f" AND category IN ({','.join('?' * len(categories))})"
+        params += list(categories)
+    df = pd.read_sql_query(query + " GROUP BY grp, bucket ORDER BY grp, bucket", conn, params=params)
+    rows = []
+    for group, part in df.groupby('grp', sort=True):
+        p50, p90, p99 = sketch_quantiles(part['bucket'].to_numpy(), part['count'].to_numpy())
+        rows.append({'group': group, 'n': int(part['count'].sum()), 'p50': p50, 'p90': p90, 'p99': p99})
+    return pd.DataFrame(rows, columns=['group', 'n', 'p50', 'p90', 'p99'])
+
+# =================== ШТРИХ-КОД ВА QR ===================
+CODE128_PATTERNS = [
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312", "132212", "221213",
+    "221312", "231212", "112232", "122132", "122231", "113222", "123122", "123221", "223211", "221132",
+    "221231", "213212", "223112", "312131", "311222", "321122", "321221", "312212", "322112", "322211",
+    "212123", "212321", "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121", "313121", "211331",
+    "231131", "213113", "213311", "213131", "311123", "311321", "331121", "312113", "312311", "332111",
+    "314111", "221411", "431111", "111224", "111422", "121124", "121421", "141122", "141221", "112214",
+    "112412", "122114", "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112", "421211", "212141",
+    "214121", "412121", "111143", "111341", "131141", "114113", "114311", "411113", "411311", "113141",
+    "114131", "311141", "411131", "211412", "211214", "211232", "2331112",
+]
+CODE128_START_B, CODE128_START_C, CODE128_CODE_B, CODE128_CODE_C, CODE128_STOP = 104, 105, 100, 99, 106
+
+def code128_values(text: str) -> List[int]:
+    """Матнни Code 128 қийматларига айлантириш: рақам жуфтлари C тўпламида, қолгани B да"""
+    if not text or any(not 32 <= ord(ch) < 127 for ch in text):
+        raise ValueError("Code 128 учун фақат ASCII белгилар мумкин")
+    values = []
+    current = None
+    i = 0
+    while i < len(text):
+        digits = 0
+        while i + digits < len(text) and text[i + digits].isdigit():
+            digits += 1
+        if digits >= 4 or (digits >= 2 and current == 'C'):
+            if digits % 2:
+                # Тоқ рақам B тўпламида кодланади
+                if current is None:
+                    values.append(CODE128_START_B)
+                elif current != 'B':
+                    values.append(CODE128_CODE_B)
+                current = 'B'
+                values.append(ord(text[i]) - 32)
+                i += 1
+                digits -= 1
+            if current is None:
+                values.append(CODE128_START_C)
+            elif current != 'C':
+                values.append(CODE128_CODE_C)
+            current = 'C'
+            for j in range(i, i + digits, 2):
+                values.append(int(text[j:j + 2]))
+            i += digits
+        else:
+            if current is None:
+                values.append(CODE128_START_B)
+            elif current != 'B':
+                values.append(CODE128_CODE_B)
+            current = 'B'
+            values.append(ord(text[i]) - 32)
+            i += 1
+    checksum = (values[0] + sum(position * value for position, value in enumerate(values[1:], 1))) % 103
+    return values + [checksum, CODE128_STOP]
+
+@functools.lru_cache(maxsize=4096)
+def code128_svg(text: str, module: float = 1.5, height: int = 50, show_text: bool = True) -> str:
+    """Code 128 штрих-кодини SVG кўринишида чизиш (натижа кешланади)"""
+    x = 10 * module
+    bars = []
+    for value in code128_values(text):
+        for index, width in enumerate(CODE128_PATTERNS[value]):
+            width = int(width) * module
+            if index % 2 == 0:
+                bars.append(f'<rect x="{x:g}" y="0" width="{width:g}" height="{height}"/>')
+            x += width
+    total_width = x + 10 * module
+    label = (f'<text x="{total_width / 2:g}" y="{height + 12}" font-family="monospace" font-size="11" '
+             f'text-anchor="middle">{text}</text>') if show_text else ''
+    total_height = height + (14 if show_text else 0)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{total_width:g}" height="{total_height}" '
+            f'viewBox="0 0 {total_width:g} {total_height}"><rect width="100%" height="100%" fill="white"/>'
+            f'<g fill="black">{"".join(bars)}</g>{label}</svg>')
+
+# QR: байт режими, M тузатиш даражаси, 1–10 версиялар
+QR_EC_BLOCKS_M = {
+    1: (10, [(1, 16)]), 2: (16, [(1, 28)]), 3: (26, [(1, 44)]), 4: (18, [(2, 32)]),
+    5: (24, [(2, 43)]), 6: (16, [(4, 27)]), 7: (18, [(4, 31)]), 8: (22, [(2, 38), (2, 39)]),
+    9: (22, [(3, 36), (2, 37)]), 10: (26, [(4, 43), (1, 44)]),
+}
+QR_ALIGNMENT = {
+    1: [], 2: [6, 18], 3: [6, 22], 4: [6, 26], 5: [6, 30], 6: [6, 34],
+    7: [6, 22, 38], 8: [6, 24, 42], 9: [6, 26, 46], 10: [6, 28, 50],
+}
+QR_EC_LEVEL_M = 0b00
+
+def _gf_tables():
+    exp, log = [0] * 512, [0] * 256
+    value = 1
+    for i in range(255):
+        exp[i] = value
+        log[value] = i
+        value <<= 1
+        if value & 0x100:
+            value ^= 0x11D
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+    return exp, log
+
+QR_GF_EXP, QR_GF_LOG = _gf_tables()
+
+def _gf_mul(a: int, b: int) -> int:
+    return 0 if a == 0 or b == 0 else QR_GF_EXP[QR_GF_LOG[a] + QR_GF_LOG[b]]
+
+@functools.lru_cache(maxsize=None)
+def _rs_generator(degree: int) -> Tuple[int, ...]:
+    poly = [1]
+    for i in range(degree):
+        poly = [p ^ _gf_mul(c, QR_GF_EXP[i]) for p, c in zip(poly + [0], [0] + poly)]
+    return tuple(poly)
+
+def _rs_remainder(data: List[int], degree: int) -> List[int]:
+    generator = _rs_generator(degree)
+    remainder = [0] * degree
+    for byte in data:
+        factor = byte ^ remainder[0]
+        remainder = remainder[1:] + [0]
+        for i in range(degree):
+            remainder[i] ^= _gf_mul(generator[i + 1], factor)
+    return remainder
+
+def _bch_bits(value: int, generator: int, shift: int) -> int:
+    remainder = value << shift
+    for bit in range(remainder.bit_length() - 1, shift - 1, -1):
+        if remainder >> bit & 1:
+            remainder ^= generator << (bit - shift)
+    return (value << shift) | remainder
+
+def _qr_codewords(payload: bytes, version: int) -> List[int]:
+    ec_len, groups = QR_EC_BLOCKS_M[version]
+    capacity = sum(count * size for count, size in groups)
+    bits = [0, 1, 0, 0]
+    count_bits = 8 if version < 10 else 16
+    bits += [len(payload) >> i & 1 for i in range(count_bits - 1, -1, -1)]
+    for byte in payload:
+        bits += [byte >> i & 1 for i in range(7, -1, -1)]
+    bits += [0] * min(4, capacity * 8 - len(bits))
+    bits += [0] * (-len(bits) % 8)
+    data = [int(''.join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8)]
+    pad = [0xEC, 0x11]
+    data += [pad[i % 2] for i in range(capacity - len(data))]
+
+    blocks, ec_blocks, offset = [], [], 0
+    for count, size in groups:
+        for _ in range(count):
+            block = data[offset:offset + size]
+            offset += size
+            blocks.append(block)
+            ec_blocks.append(_rs_remainder(block, ec_len))
+    result = []
+    for i in range(max(len(b) for b in blocks)):
+        result += [b[i] for b in blocks if i < len(b)]
+    for i in range(ec_len):
+        result += [b[i] for b in ec_blocks]
+    return result
+
+def _qr_function_patterns(version: int):
+    size = version * 4 + 17
+    modules = [[False] * size for _ in range(size)]
+    reserved = [[False] * size for _ in range(size)]
+
+    def put(r, c, dark):
+        modules[r][c] = dark
+        reserved[r][c] = True
+
+    for i in range(size):
+        put(6, i, i % 2 == 0)
+        put(i, 6, i % 2 == 0)
+    for cr, cc in ((3, 3), (3, size - 4), (size - 4, 3)):
+        for dr in range(-4, 5):
+            for dc in range(-4, 5):
+                r, c = cr + dr, cc + dc
+                if 0 <= r < size and 0 <= c < size:
+                    put(r, c, max(abs(dr), abs(dc)) not in (2, 4))
+    positions = QR_ALIGNMENT[version]
+    for r in positions:
+        for c in positions:
+            if (r, c) in ((6, 6), (6, positions[-1]), (positions[-1], 6)):
+                continue
+            for dr in range(-2, 3):
+                for dc in range(-2, 3):
+                    put(r + dr, c + dc, max(abs(dr), abs(dc)) != 1)
+    # Формат ва версия учун жой
+    for i in range(9):
+        reserved[8][i] = reserved[i][8] = True
+    for i in range(8):
+        reserved[8][size - 1 - i] = reserved[size - 1 - i][8] = True
+    put(size - 8, 8, True)
+    if version >= 7:
+        bits = _bch_bits(version, 0x1F25, 12)
+        for i in range(18):
+            dark = bool(bits >> i & 1)
+            put(size - 11 + i % 3, i // 3, dark)
+            put(i // 3, size - 11 + i % 3, dark)
+    return modules, reserved
+
+def _qr_format(modules, mask: int):
+    size = len(modules)
+    bits = _bch_bits(QR_EC_LEVEL_M << 3 | mask, 0x537, 10) ^ 0x5412
+    for i in range(15):
+        dark = bool(bits >> i & 1)
+        # Юқори чап бурчак атрофи
+        if i < 6:
+            modules[i][8] = dark
+        elif i < 8:
+            modules[i + 1][8] = dark
+        else:
+            modules[size - 15 + i][8] = dark
+        # Иккинчи нусха
+        if i < 8:
+            modules[8][size - 1 - i] = dark
+        elif i < 9:
+            modules[8][7] = dark
+        else:
+            modules[8][14 - i] = dark
+    modules[size - 8][8] = True
+
+QR_MASKS = [
+    lambda r, c: (r + c) % 2 == 0,
+    lambda r, c: r % 2 == 0,
+    lambda r, c: c % 3 == 0,
+    lambda r, c: (r + c) % 3 == 0,
+    lambda r, c: (r // 2 + c // 3) % 2 == 0,
+    lambda r, c: r * c % 2 + r * c % 3 == 0,
+    lambda r, c: (r * c % 2 + r * c % 3) % 2 == 0,
+    lambda r, c: ((r + c) % 2 + r * c % 3) % 2 == 0,
+]
+
+def _qr_penalty(modules) -> int:
+    grid = np.array(modules, dtype=np.int8)
+    size = len(grid)
+    penalty = 0
+    for lines in (grid, grid.T):
+        for line in lines:
+            run, previous = 0, -1
+            for value in line:
+                if value == previous:
+                    run += 1
+                else:
+                    if run >= 5:
+                        penalty += run - 2
+                    run, previous = 1, value
+            if run >= 5:
+                penalty += run - 2
+            text = ''.join(map(str, line))
+            penalty += 40 * (text.count('10111010000') + text.count('00001011101'))
+    blocks = grid[:-1, :-1] + grid[1:, :-1] + grid[:-1, 1:] + grid[1:, 1:]
+    penalty += 3 * int(((blocks == 0) | (blocks == 4)).sum())
+    dark_percent = grid.sum() * 100 / (size * size)
+    penalty += 10 * int(abs(dark_percent - 50) // 5)
+    return penalty
+
+@functools.lru_cache(maxsize=1024)
+def qr_matrix(text: str) -> Tuple[Tuple[bool, ...], ...]:
+    """Матнни QR матрицасига кодлаш (байт режими, M даража, энг кичик мос версия)"""
+    payload = text.encode('utf-8')
+    version = next((v for v, (_, groups) in QR_EC_BLOCKS_M.items()
+                    if len(payload) + (2 if v < 10 else 3) <= sum(c * s for c, s in groups)), None)
+    if version is None:
+        raise ValueError("QR учун матн жуда узун")
+    base, reserved = _qr_function_patterns(version)
+    size = len(base)
+    codewords = _qr_codewords(payload, version)
+    bits = [byte >> i & 1 for byte in codewords for i in range(7, -1, -1)]
+
+    # Зигзаг бўйлаб маълумот жойлаш
+    data = [row[:] for row in base]
+    index = 0
+    right = size - 1
+    while right >= 1:
+        if right == 6:
+            right = 5
+        for vertical in range(size):
+            for j in range(2):
+                c = right - j
+                upward = (right + 1) & 2 == 0
+                r = size - 1 - vertical if upward else vertical
+                if not reserved[r][c] and index < len(bits):
+                    data[r][c] = bool(bits[index])
+                    index += 1
+        right -= 2
+
+    best = None
+    for mask, condition in enumerate(QR_MASKS):
+        candidate = [[data[r][c] ^ (not reserved[r][c] and condition(r, c)) for c in range(size)]
+                     for r in range(size)]
+        _qr_format(candidate, mask)
+        score = _qr_penalty(candidate)
+        if best is None or score < best[0]:
+            best = (score, candidate)
+    return tuple(tuple(row) for row in best[1])
+
+@functools.lru_cache(maxsize=4096)
+def qr_svg(text: str, module: int = 3) -> str:
+    """QR кодни SVG кўринишида чизиш (натижа кешланади)"""
+    matrix = qr_matrix(text)
+    size = len(matrix) + 8
+    path = ''.join(f"M{c + 4},{r + 4}h1v1h-1z" for r, row in enumerate(matrix) for c, dark in enumerate(row) if dark)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size * module}" height="{size * module}" '
+            f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+            f'<rect width="100%" height="100%" fill="white"/><path d="{path}" fill="black"/></svg>')
+
+# =================== НАМУНАЛАР РЕЕСТРИ ===================
+SPECIMEN_TYPES = ["Қон (EDTA)", "Зардоб", "Плазма (цитрат)", "Сийдик", "Бошқа"]
+SPECIMEN_STATUS_LABELS = {
+    'labelled': "🏷️ Ёрлиқланган",
+    'collected': "🩸 Олинган",
+    'received': "📥 Қабул қилинган",
+}
+SPECIMEN_DAILY_LIMIT = 99999
+
+def luhn_digit(digits: str) -> str:
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        value = int(ch) * (2 if i % 2 == 0 else 1)
+        total += value - 9 if value > 9 else value
+    return str((10 - total % 10) % 10)
+
+def specimen_link(barcode: str, conn=None) -> str:
+    """QR ичига ёзиладиган ҳавола (созламадаги манзил + штрих-код)"""
+    return f"{db.get_config('specimen_link_base', 'specimen:', conn)}{barcode}"
+
+def create_specimens(conn, patient_id: int, specimen_types: List[str], order_id: Optional[int] = None) -> List[str]:
+    """Кунлик тартиб рақами асосида ноёб штрих-кодлар (ЙЙООКК + 5 рақам + назорат рақами) яратиш"""
+    prefix = date.today().strftime('%y%m%d')
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        last = conn.execute('''
+            SELECT MAX(barcode) FROM specimens WHERE barcode >= ? AND barcode < ?
+        ''', (prefix, prefix + ':')).fetchone()[0]
+        start = int(last[6:11]) + 1 if last else 1
+        if start + len(specimen_types) - 1 > SPECIMEN_DAILY_LIMIT:
+            raise ValueError("Бугунги штрих-кодлар чегарасига етилди")
+        barcodes = []
+        for offset in range(len(specimen_types)):
+            body = f"{prefix}{start + offset:05d}"
+            barcodes.append(body + luhn_digit(body))
+        conn.executemany('''
+            INSERT INTO specimens (barcode, patient_id, order_id, specimen_type) VALUES (?, ?, ?, ?)
+        ''', [(code, patient_id, order_id, kind) for code, kind in zip(barcodes, specimen_types)])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return barcodes
+
+def lookup_specimen(conn, barcode: str) -> Optional[Dict]:
+    """Сканерланган штрих-код бўйича битта индексли қидирув"""
+    row = conn.execute('''
+        SELECT s.id, s.barcode, s.specimen_type, s.status, s.order_id, s.created_at,
+               p.id, p.patient_id, p.full_name, p.birth_date, p.gender,
+               o.category, o.priority, o.status
+        FROM specimens s
+        JOIN patients p ON p.id = s.patient_id
+        LEFT JOIN orders o ON o.id = s.order_id
+        WHERE s.barcode = ?
+    ''', (barcode.strip(),)).fetchone()
+    if row is None:
+        return None
+    keys = ['id', 'barcode', 'specimen_type', 'status', 'order_id', 'created_at',
+            'patient_db_id', 'patient_code', 'full_name', 'birth_date', 'gender',
+            'order_category', 'order_priority', 'order_status']
+    return dict(zip(keys, row))
+
+def mark_specimen(conn, barcode: str, status: str) -> Optional[Dict]:
+    """Намуна ҳолатини белгилаш; боғланган буюртма босқичи ҳам ёзилади"""
+    specimen = lookup_specimen(conn, barcode)
+    if specimen is None:
+        return None
+    conn.execute(f'''
+        UPDATE specimens SET status = ?, {status}_at = COALESCE({status}_at, CURRENT_TIMESTAMP)
+        WHERE id = ?
+    ''', (status, specimen['id']))
+    if specimen['order_id']:
+        record_order_stage(conn, [specimen['order_id']], status)
+    conn.commit()
+    return {**specimen, 'status': status}
+
+def render_label_sheet(conn, barcodes: List[str], columns: int = 3, include_qr: bool = False) -> str:
+    """Пробиркалар учун ёрлиқлар варағи (HTML, чоп этиш учун)"""
+    placeholders = ','.join('?' * len(barcodes))
+    rows = conn.execute(f'''
+        SELECT s.barcode, s.specimen_type, s.created_at, p.full_name, p.patient_id, p.birth_date
+        FROM specimens s JOIN patients p ON p.id = s.patient_id
+        WHERE s.barcode IN ({placeholders}) ORDER BY s.barcode
+    ''', barcodes).fetchall()
+    labels = []
+    for barcode, kind, created_at, name, patient_code, birth_date in rows:
+        qr = f'<div style="float: right;">{qr_svg(specimen_link(barcode, conn), 2)}</div>' if include_qr else ''
+        labels.append(f'''<div class="label">{qr}<b>{name}</b><br>{patient_code} • {birth_date}<br>
+<small>{kind} • {str(created_at)[:10]}</small><div>{code128_svg(barcode, 1.2, 34)}</div></div>''')
+    return f"""<html><head><meta charset="utf-8"><title>Ёрлиқлар</title><style>
+body {{ font-family: Arial, sans-serif; font-size: 10px; margin: 0; }}
+.sheet {{ display: grid; grid-template-columns: repeat({columns}, 1fr); gap: 4mm; padding: 6mm; }}
+.label {{ border: 1px dashed #BBB; padding: 2mm; height: 27mm; overflow: hidden; page-break-inside: avoid; }}
+</style></head><body><div class="sheet">{''.join(labels)}</div></body></html>"""
+
+# =================== БЕМОР ИДЕНТИФИКАТОРЛАРИ ===================
+PATIENT_ID_PREFIX = "P"
+
+def patient_id_prefix(day: Optional[date] = None) -> str:
+    return f"{PATIENT_ID_PREFIX}-{(day or date.today()).strftime('%Y%m%d')}-"
+
+def allocate_patient_ids(conn, count: int = 1, day: Optional[date] = None) -> List[str]:
+    """Кунлик кетма-кетликдан ID лар блокини ажратиш (транзакция чақирувчида)"""
+    day = day or date.today()
+    prefix = patient_id_prefix(day)
+    # Кун биринчи марта очилганда кетма-кетлик мавжуд ID лардан давом этади
+    last = conn.execute('''
+        INSERT INTO id_sequences (name, day, last_value)
+        SELECT 'patient', ?, COALESCE(MAX(CAST(SUBSTR(patient_id, ?) AS INTEGER)), 0) + ?
+        FROM patients WHERE patient_id GLOB ?
+        ON CONFLICT (name, day) DO UPDATE SET last_value = last_value + ?
+        RETURNING last_value
+    ''', (day.isoformat(), len(prefix) + 1, count, prefix + '[0-9]*', count)).fetchone()[0]
+    return [f"{prefix}{n:04d}" for n in range(last - count + 1, last + 1)]
+
+def register_patient(conn, full_name: str, birth_date, gender: str, phone: Optional[str] = None,
+                     address: Optional[str] = None, patient_id: Optional[str] = None) -> str:
+    """Беморни сақлаш; ID берилмаса кетма-кетликдан ажратилади"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if patient_id:
+            prefix = patient_id_prefix()
+            suffix = patient_id[len(prefix):]
+            # Қўлда киритилган бугунги ID кетма-кетликни орқада қолдирмаслиги керак
+            if patient_id.startswith(prefix) and suffix.isdigit():
+                conn.execute('''
+                    UPDATE id_sequences SET last_value = MAX(last_value, ?)
+                    WHERE name = 'patient' AND day = ?
+                ''', (int(suffix), date.today().isoformat()))
+        else:
+            patient_id = allocate_patient_ids(conn)[0]
+        row_id = conn.execute('''
+            INSERT INTO patients (patient_id, full_name, birth_date, gender, phone, address)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (patient_id, full_name, birth_date, gender, phone, address)).lastrowid
+        index_patient_keys(conn, [row_id])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return patient_id
+
+def _id_stress_worker(db_manager, count: int) -> Tuple[List[str], int, int]:
+    # Сессия оқими каби: ҳар бир рўйхатга олиш илованинг ўз ёзув уланишида
+    ids, conflicts, errors = [], 0, 0
+    for i in range(count):
+        try:
+            with db_manager.write_connection() as writer:
+                ids.append(register_patient(writer, f"Стресс {threading.get_ident()}-{i}", "1990-01-01", "Эркак"))
+        except sqlite3.IntegrityError:
+            conflicts += 1
+        except sqlite3.Error:
+            errors += 1
+    return ids, conflicts, errors
+
+# =================== ТАКРОРИЙ БЕМОРЛАР ===================
+DUPLICATE_THRESHOLD = 0.85
+DUPLICATE_MAX_BLOCK = 200
+# Кирилл ёзувини лотинчага ўгириш (исмлар иккала ёзувда ҳам киритилади)
+NAME_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'ғ': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'j',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'қ': 'q', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ў': 'o', 'ф': 'f', 'х': 'x', 'ҳ': 'h',
+    'ц': 's', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh', 'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya', "'": '', 'ʻ': '', 'ʼ': '', '`': '', '’': '', '‘': '',
+})
+# Бир хил талаффуз қилинадиган ҳарфлар бирлаштирилади
+NAME_FOLDS = [('kh', 'x'), ('h', 'x'), ('q', 'k'), ('ts', 's'), ('iy', 'i'), ('yi', 'i')]
+
+def name_tokens(full_name: str) -> List[str]:
+    text = full_name.lower().translate(NAME_TRANSLIT)
+    for old, new in NAME_FOLDS:
+        text = text.replace(old, new)
+    return sorted(re.findall(r'[^\W_]+', text))
+
+def phone_key(phone: Optional[str]) -> str:
+    digits = ''.join(ch for ch in (phone or '') if ch.isdigit())
+    return digits[-9:] if len(digits) >= 7 else ''
+
+def patient_blocks(tokens: List[str], birth_date: str, phone: str) -> List[str]:
+    """Номзодларни гуруҳлаш калитлари: исм + туғилган йил, икки исм бўлаги + туғилган сана, телефон"""
+    blocks = {f"n:{' '.join(tokens)}:{birth_date[:4]}"}
+    # Бўлак жуфтликлари отасининг исми тушиб қолганда ёки битта бўлакдаги хатода ҳам мос келади
+    prefixes = sorted({token[:4] for token in tokens})
+    blocks.update(f"t:{a} {b}:{birth_date}" for i, a in enumerate(prefixes) for b in prefixes[i + 1:])
+    if len(prefixes) == 1:
+        blocks.add(f"t:{prefixes[0]}:{birth_date}")
+    if phone:
+        blocks.add(f"p:{phone}")
+    return sorted(blocks)
+
+def _key_blocks(rows) -> List[Tuple[str, int]]:
+    """(id, нормалланган исм, туғилган сана, телефон) ёзувларидан тартибланган (блок, id) жуфтликлари"""
+    return sorted((block, patient_id) for patient_id, name_key, birth_date, phone in rows
+                  for block in patient_blocks(name_key.split(), str(birth_date), phone_key(phone)))
+
+def drop_patient_keys(conn, patient_ids: List[int]):
+    """Калитларни ўчириш; эски блоклар сақланган суратдан ҳисобланиб, бирламчи калит бўйича ўчирилади"""
+    for start in range(0, len(patient_ids), 900):
+        chunk = patient_ids[start:start + 900]
+        snapshot = conn.execute(f'''
+            SELECT patient_id, name_key, birth_date, phone FROM patient_keys
+            WHERE patient_id IN ({','.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+        conn.executemany("DELETE FROM patient_blocks WHERE block = ? AND patient_id = ?", _key_blocks(snapshot))
+        conn.executemany("DELETE FROM patient_keys WHERE patient_id = ?", [(row[0],) for row in snapshot])
+
+def index_patient_keys(conn, patient_ids: Optional[List[int]] = None) -> int:
+    """Беморлар калитларини янгилаш; ID берилмаса, ўзгарган ёки индексланмаганлар (транзакция чақирувчида)"""
+    if patient_ids is None:
+        orphans = [row[0] for row in conn.execute(
+            "SELECT patient_id FROM patient_keys WHERE patient_id NOT IN (SELECT id FROM patients)")]
+        drop_patient_keys(conn, orphans)
+        rows = conn.execute('''
+            SELECT p.id, p.full_name, p.birth_date, p.phone, k.patient_id IS NOT NULL FROM patients p
+            LEFT JOIN patient_keys k ON k.patient_id = p.id
+            WHERE k.patient_id IS NULL OR k.full_name IS NOT p.full_name
+               OR k.birth_date IS NOT p.birth_date OR k.phone IS NOT p.phone
+        ''').fetchall()
+    else:
+        placeholders = ','.join('?' * len(patient_ids))
+        rows = conn.execute(f"SELECT id, full_name, birth_date, phone, 1 FROM patients WHERE id IN ({placeholders})",
+                            patient_ids).fetchall()
+    if not rows:
+        return 0
+    drop_patient_keys(conn, [row[0] for row in rows if row[4]])
+    keys = [(row[0], ' '.join(name_tokens(row[1])), row[2], row[3]) for row in rows]
+    conn.executemany('''
+        INSERT INTO patient_keys (patient_id, name_key, birth_date, phone, full_name)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(*key, row[1]) for key, row in zip(keys, rows)])
+    conn.executemany("INSERT OR IGNORE INTO patient_blocks (block, patient_id) VALUES (?, ?)", _key_blocks(keys))
+    return len(rows)
+
+def _date_similarity(a: str, b: str) -> float:
+    if a == b:
+        return 1.0
+    if len(a) != len(b):
+        return 0.0
+    # Битта рақамдаги хато ёки кун/ой алмашиши
+    if sum(x != y for x, y in zip(a, b)) == 1 or (a[:4] == b[:4] and a[5:7] == b[8:10] and a[8:10] == b[5:7]):
+        return 0.7
+    return 0.0
+
+def patient_similarity(a: Tuple, b: Tuple) -> float:
+    """Икки бемор ёзуви ўхшашлиги (0..1); ёзув: (name_key, birth_date, phone_key, gender)"""
+    name_a, name_b = a[0], b[0]
+    tokens_a, tokens_b = set(name_a.split()), set(name_b.split())
+    if tokens_a and tokens_b and (tokens_a <= tokens_b or tokens_b <= tokens_a):
+        # Отасининг исми тушириб қолдирилган ҳол
+        name = 1.0 if tokens_a == tokens_b else 0.95
+    else:
+        name = difflib.SequenceMatcher(None, name_a, name_b).ratio()
+    score, weight = 0.6 * name + 0.3 * _date_similarity(a[1], b[1]), 0.9
+    if a[2] and b[2]:
+        score, weight = score + 0.1 * (a[2] == b[2]), 1.0
+    score /= weight
+    if a[3] != b[3]:
+        score *= 0.85
+    return round(score, 3)
+
+def find_duplicate_patients(conn, threshold: float = DUPLICATE_THRESHOLD,
+                            max_block: int = DUPLICATE_MAX_BLOCK) -> pd.DataFrame:
+    """Блоклаш индекси орқали номзод жуфтликларни топиб, ўхшашлик бўйича баҳолаш"""
+    index_patient_keys(conn)
+    conn.commit()
+    pairs = conn.execute('''
+        SELECT DISTINCT a.patient_id, b.patient_id
+        FROM (SELECT block FROM patient_blocks GROUP BY block HAVING COUNT(*) BETWEEN 2 AND ?) g
+        JOIN patient_blocks a ON a.block = g.block
+        JOIN patient_blocks b ON b.block = g.block AND b.patient_id > a.patient_id
+    ''', (max_block,)).fetchall()
+    columns = ['keep_id', 'merge_id', 'score']
+    if not pairs:
+        return pd.DataFrame(columns=columns)
+    ids = sorted({patient_id for pair in pairs for patient_id in pair})
+    records = {}
+    for start in range(0, len(ids), 900):
+        chunk = ids[start:start + 900]
+        records.update((row[0], (row[1], str(row[2]), phone_key(row[3]), row[4])) for row in conn.execute(f'''
+            SELECT k.patient_id, k.name_key, p.birth_date, p.phone, p.gender
+            FROM patient_keys k JOIN patients p ON p.id = k.patient_id
+            WHERE k.patient_id IN ({','.join('?' * len(chunk))})
+        ''', chunk))
+    found = [(a, b, score) for a, b in pairs
+             if (score := patient_similarity(records[a], records[b])) >= threshold]
+    return pd.DataFrame(found, columns=columns).sort_values('score', ascending=False, ignore_index=True)
+
+def match_new_patient(conn, full_name: str, birth_date, phone: Optional[str], gender: str,
+                      threshold: float = DUPLICATE_THRESHOLD) -> List[Tuple]:
+    """Янги рўйхатга олинаётган бемор учун мавжуд ўхшаш беморлар (индекс бўйича)"""
+    tokens = name_tokens(full_name)
+    blocks = patient_blocks(tokens, str(birth_date), phone_key(phone))
+    placeholders = ','.join('?' * len(blocks))
+    rows = conn.execute(f'''
+        SELECT p.id, p.patient_id, p.full_name, p.birth_date, p.phone, p.gender, k.name_key
+        FROM patients p JOIN patient_keys k ON k.patient_id = p.id
+        WHERE p.id IN (SELECT patient_id FROM patient_blocks WHERE block IN ({placeholders}))
+    ''', blocks).fetchall()
+    new = (' '.join(tokens), str(birth_date), phone_key(phone), gender)
+    matches = [(row[:6], patient_similarity(new, (row[6], str(row[3]), phone_key(row[4]), row[5])))
+               for row in rows]
+    return sorted([(*row, score) for row, score in matches if score >= threshold], key=lambda m: -m[-1])
+
+def merge_patients(conn, keep_id: int, merge_id: int, merged_by: Optional[str] = None) -> Dict[str, int]:
+    """Такрорий беморни асосийсига қўшиш: барча боғланган ёзувлар битта транзакцияда кўчирилади"""
+    if keep_id == merge_id:
+        raise ValueError("Бемор ўзига қўшилмайди")
+    keep = conn.execute("SELECT birth_date, gender FROM patients WHERE id = ?", (keep_id,)).fetchone()
+    merged = conn.execute("SELECT patient_id, birth_date, gender FROM patients WHERE id = ?", (merge_id,)).fetchone()
+    if keep is None or merged is None:
+        raise ValueError("Бемор топилмади")
+    # Архив файллари транзакциядан олдин уланади
+    get_archive_manager().results_source(conn)
+    archives = [row[1] for row in conn.execute("PRAGMA database_list") if row[1].startswith('arch_')]
+    moved = {}
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table in ['test_results', 'orders', 'specimens', 'alert_outbox', 'held_results'] + \
+                [f"{a}.test_results" for a in archives]:
+            moved[table] = conn.execute(f"UPDATE {table} SET patient_id = ? WHERE patient_id = ?",
+                                        (keep_id, merge_id)).rowcount
+        conn.execute('''
+            INSERT INTO latest_results (patient_id, parameter_code, result_value, test_date)
+            SELECT ?, parameter_code, result_value, test_date FROM latest_results WHERE patient_id = ?
+            ON CONFLICT (patient_id, parameter_code) DO UPDATE SET
+                result_value = excluded.result_value,
+                test_date = excluded.test_date
+            WHERE excluded.test_date >= latest_results.test_date
+        ''', (keep_id, merge_id))
+        conn.execute("DELETE FROM latest_results WHERE patient_id = ?", (merge_id,))
+        # Асосий ёзувда бўш майдонлар иккинчисидан тўлдирилади
+        conn.execute('''
+            UPDATE patients SET
+                phone = COALESCE(NULLIF(phone, ''), (SELECT phone FROM patients WHERE id = ?)),
+                address = COALESCE(NULLIF(address, ''), (SELECT address FROM patients WHERE id = ?))
+            WHERE id = ?
+        ''', (merge_id, merge_id, keep_id))
+        drop_patient_keys(conn, [merge_id])
+        conn.execute("DELETE FROM patients WHERE id = ?", (merge_id,))
+        conn.execute('''
+            INSERT INTO patient_merges (keep_id, merged_id, merged_patient_code, moved, merged_by)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (keep_id, merge_id, merged[0], json.dumps(moved), merged_by))
+        index_patient_keys(conn, [keep_id])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    get_audit_log().record('merge', 'patient', keep_id, actor=merged_by,
+                           changes={'merged_id': merge_id, 'merged_patient_code': merged[0], 'moved': moved})
+    # Когорта кубидаги ёш/жинс гуруҳлари ўзгарган бўлса, куб қайта қурилади
+    if tuple(keep) != tuple(merged[1:]) and sum(moved.values()):
+        rebuild_cohort_cube(conn)
+    return moved
+
+# =================== ЎЧИРИШ ВА ТЕХНИК ХИЗМАТ ===================
+DELETE_MODES = {
+    'soft': "♻️ Саватга ўтказиш (қайта тиклаш мумкин)",
+    'cascade': "🗑️ Боғланган ёзувлар билан бирга ўчириш",
+    'restrict': "🔒 Боғланган ёзувлар бўлса, ўчирмаслик",
+}
+# Бемор ёзувига боғланган жадваллар (ўчириш тартибида)
+PATIENT_CHILD_TABLES = ['test_results', 'latest_results', 'specimens', 'alert_outbox', 'held_results', 'orders']
+MAINTENANCE_TASKS = {
+    'purge_orphans': "🧹 Етим ёзувларни тозалаш",
+    'cohort_cube': "🧊 Когорта кубини қайта қуриш",
+    'optimize': "📊 ANALYZE / PRAGMA optimize",
+    'incremental_vacuum': "🗜️ Бўш саҳифаларни қайтариш",
+    'checkpoint': "📝 WAL чекпоинт",
+    'integrity_check': "🩺 Яхлитлик текшируви",
+    'incremental_backup': "💾 Инкрементал резерв нусха",
+}
+MAINTENANCE_DEFAULTS = {'enabled': True, 'start': '02:00', 'end': '05:00'}
+MAINTENANCE_BATCH = 5000
+MAINTENANCE_POLL_SECONDS = 300
+
+def _cube_adjust_patient(conn, patient_id: int, sign: int):
+    """Бемор натижаларининг кубдаги ҳиссасини айириш (-1) ёки қайта қўшиш (+1)"""
+    row = conn.execute("SELECT value FROM app_config WHERE key = 'cohort_cube_watermark'").fetchone()
+    if row is None:
+        return
+    watermark = json.loads(row[0])
+    conn.execute("DROP TABLE IF EXISTS temp.cube_patient_results")
+    conn.execute("CREATE TEMP TABLE cube_patient_results AS SELECT * FROM main.test_results WHERE patient_id = ?",
+                 (patient_id,))
+    updates = [(sign * total, sign * abnormal, sign * low, sign * high, code, month, band, gender)
+               for code, month, band, gender, total, abnormal, low, high in conn.execute(
+                   COHORT_CUBE_SELECT.format(source='temp.cube_patient_results'), (-1, watermark))]
+    conn.executemany('''
+        UPDATE cohort_cube SET total = total + ?, abnormal = abnormal + ?, low = low + ?, high = high + ?
+        WHERE parameter_code = ? AND month = ? AND age_band = ? AND gender = ?
+    ''', updates)
+    conn.execute("DROP TABLE temp.cube_patient_results")
+
+def _table_rows(conn, table: str, where: str, params) -> Dict:
+    cursor = conn.execute(f"SELECT * FROM {table} WHERE {where}", params)
+    return {'columns': [d[0] for d in cursor.description], 'rows': cursor.fetchall()}
+
+def patient_dependents(conn, patient_id: int) -> Dict[str, int]:
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table} WHERE patient_id = ?", (patient_id,)).fetchone()[0]
+              for table in PATIENT_CHILD_TABLES}
+    return {table: count for table, count in counts.items() if count}
+
+def delete_patient(conn, patient_id: int, mode: Optional[str] = None, deleted_by: Optional[str] = None) -> Dict[str, int]:
+    """Беморни созламадаги усулда ўчириш (сават, каскад ёки тақиқ); ўчирилган боғланган ёзувлар сони"""
+    mode = mode or db.get_config('delete_mode', 'soft', conn)
+    dependents = patient_dependents(conn, patient_id)
+    if mode == 'restrict' and dependents:
+        raise ValueError("Боғланган ёзувлар мавжуд: " + ", ".join(f"{t} ({n})" for t, n in dependents.items()))
+    archives = []
+    if mode == 'cascade':
+        get_archive_manager().results_source(conn)
+        archives = [row[1] for row in conn.execute("PRAGMA database_list") if row[1].startswith('arch_')]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        patient = _table_rows(conn, 'patients', 'id = ?', (patient_id,))
+        if not patient['rows']:
+            raise ValueError("Бемор топилмади")
+        if mode == 'soft':
+            payload = {'patients': patient}
+            payload.update((table, _table_rows(conn, table, 'patient_id = ?', (patient_id,))) for table in dependents)
+            conn.execute('''
+                INSERT INTO recycle_bin (entity, entity_id, label, payload, deleted_by) VALUES ('patient', ?, ?, ?, ?)
+            ''', (patient_id, f"{patient['rows'][0][2]} ({patient['rows'][0][1]})",
+                  json.dumps(payload, default=str), deleted_by))
+        _cube_adjust_patient(conn, patient_id, -1)
+        for table in PATIENT_CHILD_TABLES:
+            if table in dependents:
+                conn.execute(f"DELETE FROM {table} WHERE patient_id = ?", (patient_id,))
+        for alias in archives:
+            dependents[f"{alias}.test_results"] = conn.execute(
+                f"DELETE FROM {alias}.test_results WHERE patient_id = ?", (patient_id,)).rowcount
+        drop_patient_keys(conn, [patient_id])
+        conn.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    before = dict(zip(patient['columns'], patient['rows'][0]))
+    get_audit_log().record('delete', 'patient', patient_id, before=before, actor=deleted_by)
+    return dependents
+
+def delete_doctor(conn, doctor_id: int, mode: Optional[str] = None, deleted_by: Optional[str] = None) -> int:
+    """Шифокорни ўчириш; буюртмалардаги ҳавола бўшатилади (натижалар ўчирилмайди)"""
+    mode = mode or db.get_config('delete_mode', 'soft', conn)
+    orders = [row[0] for row in conn.execute("SELECT id FROM orders WHERE doctor_id = ?", (doctor_id,))]
+    if mode == 'restrict' and orders:
+        raise ValueError(f"Шифокорга {len(orders)} та буюртма боғланган")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        doctor = _table_rows(conn, 'doctors', 'id = ?', (doctor_id,))
+        if not doctor['rows']:
+            raise ValueError("Шифокор топилмади")
+        if mode == 'soft':
+            conn.execute('''
+                INSERT INTO recycle_bin (entity, entity_id, label, payload, deleted_by) VALUES ('doctor', ?, ?, ?, ?)
+            ''', (doctor_id, doctor['rows'][0][1], json.dumps({'doctors': doctor, 'order_ids': orders}, default=str),
+                  deleted_by))
+        conn.execute("UPDATE orders SET doctor_id = NULL WHERE doctor_id = ?", (doctor_id,))
+        conn.execute("DELETE FROM doctors WHERE id = ?", (doctor_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    get_audit_log().record('delete', 'doctor', doctor_id, before=dict(zip(doctor['columns'], doctor['rows'][0])),
+                           actor=deleted_by)
+    return len(orders)
+
+def restore_deleted(conn, bin_id: int) -> str:
+    """Саватдаги ёзувни асл ID лари билан қайта тиклаш"""
+    row = conn.execute("SELECT entity, entity_id, label, payload FROM recycle_bin WHERE id = ?", (bin_id,)).fetchone()
+    if row is None:
+        raise ValueError("Саватда бундай ёзув йўқ")
+    entity, entity_id, label, payload = row[0], row[1], row[2], json.loads(row[3])
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Ота жадваллар биринчи тикланади (ташқи калитлар учун)
+        order = ['patients', 'doctors', 'orders'] + [t for t in PATIENT_CHILD_TABLES if t != 'orders']
+        for table in [t for t in order if t in payload]:
+            data = payload[table]
+            conn.executemany(
+                f"INSERT INTO {table} ({', '.join(data['columns'])}) VALUES ({', '.join('?' * len(data['columns']))})",
+                data['rows'])
+        if entity == 'patient':
+            index_patient_keys(conn, [entity_id])
+            _cube_adjust_patient(conn, entity_id, +1)
+        elif payload.get('order_ids'):
+            conn.executemany("UPDATE orders SET doctor_id = ? WHERE id = ?",
+                             [(entity_id, order_id) for order_id in payload['order_ids']])
+        conn.execute("DELETE FROM recycle_bin WHERE id = ?", (bin_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    table = 'patients' if entity == 'patient' else 'doctors'
+    get_audit_log().record('restore', entity, entity_id,
+                           after=dict(zip(payload[table]['columns'], payload[table]['rows'][0])))
+    return label
+
+def purge_orphans(conn, batch_size: int = MAINTENANCE_BATCH) -> Dict[str, int]:
+    """Ота ёзуви йўқ қаторларни бўлиб-бўлиб ўчириш (ҳар бир бўлак алоҳида транзакция)"""
+    purged = {}
+    for table in PATIENT_CHILD_TABLES:
+        orphan_ids = [row[0] for row in conn.execute(f'''
+            SELECT DISTINCT patient_id FROM {table} WHERE patient_id NOT IN (SELECT id FROM patients)
+        ''')]
+        total = 0
+        for start in range(0, len(orphan_ids), batch_size):
+            chunk = orphan_ids[start:start + batch_size]
+            placeholders = ','.join('?' * len(chunk))
+            while True:
+                if table == 'latest_results':
+                    deleted = conn.execute(f"DELETE FROM latest_results WHERE patient_id IN ({placeholders})",
+                                           chunk).rowcount
+                else:
+                    deleted = conn.execute(f'''
+                        DELETE FROM {table} WHERE rowid IN (
+                            SELECT rowid FROM {table} WHERE patient_id IN ({placeholders}) LIMIT ?)
+                    ''', chunk + [batch_size]).rowcount
+                conn.commit()
+                total += deleted
+                if table == 'latest_results' or deleted < batch_size:
+                    break
+        if total:
+            purged[table] = total
+    cleared = conn.execute("UPDATE orders SET doctor_id = NULL WHERE doctor_id NOT IN (SELECT id FROM doctors)").rowcount
+    if cleared:
+        purged['orders.doctor_id'] = cleared
+    index_patient_keys(conn)
+    conn.commit()
+    if purged.get('test_results'):
+        rebuild_cohort_cube(conn)
+    return purged
+
+def _maintenance_task(conn, task: str) -> Tuple[str, str]:
+    if task == 'purge_orphans':
+        purged = purge_orphans(conn)
+        return 'ok', json.dumps(purged, ensure_ascii=False) if purged else "етим ёзувлар йўқ"
+    if task == 'cohort_cube':
+        # Инкрементал янгиланиш кўрмайдиган таҳрир ва кўчиришлар шу ерда тўғриланади
+        last_id = rebuild_cohort_cube(conn)
+        cells = conn.execute("SELECT COUNT(*) FROM cohort_cube").fetchone()[0]
+        return 'ok', f"{cells} та катак, натижа ID {last_id} гача"
+    if task == 'optimize':
+        analyzed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+        conn.execute("PRAGMA optimize" if analyzed else "ANALYZE")
+        return 'ok', "PRAGMA optimize" if analyzed else "ANALYZE (биринчи марта)"
+    if task == 'incremental_vacuum':
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Режим фақат тўлиқ VACUUM дан кейин ўзгаради (бир марта)
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            return 'ok', "auto_vacuum = INCREMENTAL ёқилди (тўлиқ VACUUM)"
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+        return 'ok', f"{free} та бўш саҳифа қайтарилди"
+    if task == 'checkpoint':
+        busy, log, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        return ('ok' if not busy else 'warning'), f"{checkpointed}/{log} саҳифа"
+    if task == 'integrity_check':
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check(20)")]
+        return ('ok', "ok") if problems == ['ok'] else ('error', "; ".join(problems))
+    if task == 'incremental_backup':
+        db_path = next(row[2] for row in conn.execute("PRAGMA database_list") if row[1] == 'main')
+        summary = incremental_backup(conn, backup_directory(db_path))
+        details = f"{summary['rows']} та ўзгариш, {summary['segments']} та сегмент"
+        if 'full' in summary:
+            details += f", тўлиқ нусха {summary['full']['bytes'] / 1024 / 1024:.1f} МБ"
+        return 'ok', details
+    raise ValueError(f"Номаълум вазифа: {task}")
+
+def run_maintenance(db_manager, tasks: Optional[List[str]] = None, conn=None) -> List[Dict]:
+    """Техник хизмат вазифаларини кетма-кет бажариб, давомийлигини maintenance_runs га ёзиш"""
+    own_conn = conn is None
+    conn = conn or db_manager.connect()
+    run_id = uuid.uuid4().hex[:12]
+    results = []
+    try:
+        for task in tasks or list(MAINTENANCE_TASKS):
+            started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            started = time.perf_counter()
+            try:
+                status, details = _maintenance_task(conn, task)
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                status, details = 'error', str(e)
+            duration_ms = (time.perf_counter() - started) * 1000
+            conn.execute('''
+                INSERT INTO maintenance_runs (run_id, task, started_at, duration_ms, status, details)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (run_id, task, started_at, duration_ms, status, details))
+            conn.commit()
+            results.append({'task': task, 'status': status, 'duration_ms': duration_ms, 'details': details})
+    finally:
+        if own_conn:
+            conn.close()
+    return results
+
+class MaintenanceScheduler:
+    """Тунги ойнада кунига бир марта техник хизматни ишга туширувчи фон оқими"""
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.last_results = []
+        self.last_error = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self._thread = None
+
+    @staticmethod
+    def in_window(settings: Dict, now: Optional[datetime] = None) -> bool:
+        current = (now or datetime.now()).strftime('%H:%M')
+        start, end = settings['start'], settings['end']
+        return start <= current < end if start <= end else (current >= start or current < end)
+
+    def claim(self, conn, day: str) -> bool:
+        """Шу кунги ишга туширишни эгаллаш (бир нечта жараён ишлаганда фақат биттаси бажаради)"""
+        cursor = conn.execute('''
+            INSERT INTO app_config (key, value, updated_at) VALUES ('maintenance_last_run', ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+            WHERE value <> excluded.value
+        ''', (json.dumps(day),))
+        conn.commit()
+        return cursor.rowcount == 1
+
+    def _run(self):
+        conn = self.db.connect()
+        try:
+            while not self._stop.is_set():
+                try:
+                    settings = {**MAINTENANCE_DEFAULTS, **self.db.get_config('maintenance_settings', {}, conn)}
+                    if settings['enabled'] and self.in_window(settings) and \
+                            self.claim(conn, date.today().isoformat()):
+                        self.last_results = run_maintenance(self.db, conn=conn)
+                except Exception as e:
+                    self.last_error = e
+                self._stop.wait(MAINTENANCE_POLL_SECONDS)
+        finally:
+            conn.close()
+
+@st.cache_resource
+def get_maintenance_scheduler():
+    return MaintenanceScheduler(db)
+
+# =================== СЕССИЯЛАР РЕЕСТРИ ===================
+SESSION_REAP_SECONDS = 30
+SESSION_ACTIVE_GRACE = 60
+SESSION_MEMORY_BUDGET_MB = 512
+
+def estimate_size(value, depth: int = 0) -> int:
+    """Қийматнинг хотирадаги тахминий ҳажми (байт)"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    size = sys.getsizeof(value, 0)
+    if depth >= 4:
+        return size
+    if isinstance(value, dict):
+        return size + sum(estimate_size(k, depth + 1) + estimate_size(v, depth + 1) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(estimate_size(v, depth + 1) for v in value)
+    if hasattr(value, '__dict__') and not isinstance(value, type):
+        return size + estimate_size(vars(value), depth + 1)
+    return size
+
+class SessionRegistry:
+    """Жараёндаги браузер сессиялари: охирги фаоллик, хотира баҳоси ва муддати ўтганларни чиқариш"""
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.stats = {'reaped': 0, 'freed_bytes': 0, 'passes': 0}
+        self.last_error = None
+        self._sessions = {}
+        # Реапер чиқарган сессиялар: кейинги ишга тушишда сабаби кўрсатилади
+        self._expired = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="session-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self._thread = None
+
+    def limits(self, conn=None) -> Tuple[float, float]:
+        """(фаолсизлик чегараси, сессиянинг энг узоқ муддати) сонияларда"""
+        auto_logout = self.db.get_config('system_settings', {}, conn).get('auto_logout', 30)
+        session_timeout = self.db.get_config('security_settings', {}, conn).get('session_timeout', 8)
+        return float(auto_logout) * 60, float(session_timeout) * 3600
+
+    @staticmethod
+    def expiry_reason(entry: Dict, now: float, limits: Tuple[float, float]) -> Optional[str]:
+        idle_limit, age_limit = limits
+        if now - entry['last_activity'] > idle_limit:
+            return 'idle'
+        if entry['login_at'] and now - entry['login_at'] > age_limit:
+            return 'timeout'
+        return None
+
+    def touch(self, session_id: str, state, username: Optional[str], login_at: Optional[float]) -> Optional[str]:
+        """Сессия фаоллигини ёзиш; муддати аввалроқ тугаган бўлса, сабабини қайтаради"""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            reason = self._expired.pop(session_id, None)
+            if entry and entry['login_at'] and reason is None:
+                reason = self.expiry_reason(entry, now, self.limits())
+            if entry is None:
+                entry = self._sessions[session_id] = {'started_at': now, 'runs': 0, 'bytes': 0,
+                                                      'measured_runs': -1, 'page': None}
+            entry.update(state=state, username=username, login_at=login_at, last_activity=now)
+            entry['runs'] += 1
+        return reason
+
+    def set_page(self, session_id: str, page: str):
+        with self._lock:
+            if session_id in self._sessions:
+                self._sessions[session_id]['page'] = page
+
+    def end(self, session_id: str, reason: str = 'admin') -> int:
+        """Сессияни тизимдан чиқариб, ҳолатини бўшатиш; бўшатилган тахминий байтлар"""
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None and entry['login_at']:
+                self._expired[session_id] = reason
+        if entry is None:
+            return 0
+        state = entry['state']
+        freed = estimate_size({key: state[key] for key in list(state.filtered_state)})
+        for key in list(state.filtered_state):
+            try:
+                del state[key]
+            except KeyError:
+                pass
+        self.stats['reaped'] += 1
+        self.stats['freed_bytes'] += freed
+        return freed
+
+    def reap(self, conn=None) -> List[Tuple[str, str]]:
+        """Ёпилган сессияларни унутиш, муддати ўтганларини ва хотира чегарасидан ортганларини чиқариш"""
+        now = time.time()
+        limits = self.limits(conn)
+        budget = float(self.db.get_config('session_memory_budget_mb', SESSION_MEMORY_BUDGET_MB, conn)) * 1024 ** 2
+        runtime = Runtime.instance() if Runtime.exists() else None
+        with self._lock:
+            entries = list(self._sessions.items())
+        reaped = []
+        for session_id, entry in entries:
+            if runtime is not None and not runtime.is_active_session(session_id):
+                # Браузер ёпилган — ҳолатни Streamlit ўзи бўшатади
+                with self._lock:
+                    self._sessions.pop(session_id, None)
+                    self._expired.pop(session_id, None)
+                continue
+            if entry['measured_runs'] != entry['runs']:
+                state = entry['state']
+                entry['bytes'] = estimate_size({key: state[key] for key in list(state.filtered_state)})
+                entry['measured_runs'] = entry['runs']
+            reason = self.expiry_reason(entry, now, limits)
+            if reason:
+                self.end(session_id, reason)
+                reaped.append((session_id, reason))
+        # Хотира чегарасидан ошса, энг узоқ фаол бўлмаган сессиялар чиқарилади
+        with self._lock:
+            live = sorted(self._sessions.items(), key=lambda item: item[1]['last_activity'])
+        total = sum(entry['bytes'] for _, entry in live)
+        for session_id, entry in live:
+            if total <= budget or now - entry['last_activity'] < SESSION_ACTIVE_GRACE:
+                break
+            total -= entry['bytes']
+            self.end(session_id, 'memory')
+            reaped.append((session_id, 'memory'))
+        self.stats['passes'] += 1
+        return reaped
+
+    def snapshot(self) -> pd.DataFrame:
+        now = time.time()
+        with self._lock:
+            rows = [{
+                'session_id': session_id,
+                'username': entry['username'] or '—',
+                'page': entry['page'] or '—',
+                'started_at': datetime.fromtimestamp(entry['started_at']).strftime('%H:%M:%S'),
+                'idle_min': round((now - entry['last_activity']) / 60, 1),
+                'runs': entry['runs'],
+                'memory_mb': round(entry['bytes'] / 1024 ** 2, 2),
+            } for session_id, entry in self._sessions.items()]
+        return pd.DataFrame(rows, columns=['session_id', 'username', 'page', 'started_at', 'idle_min',
+                                           'runs', 'memory_mb'])
+
+    def _run(self):
+        conn = self.db.connect()
+        try:
+            while not self._stop.wait(SESSION_REAP_SECONDS):
+                try:
+                    self.reap(conn)
+                except Exception as e:
+                    self.last_error = e
+        finally:
+            conn.close()
+
+@st.cache_resource
+def get_session_registry():
+    return SessionRegistry(db)
+
+SESSION_EXPIRY_MESSAGES = {
+    'idle': "⏱️ Узоқ вақт фаол бўлмаганингиз учун тизимдан чиқарилдингиз",
+    'timeout': "⏱️ Сессия муддати тугади, қайта киринг",
+    'memory': "⏱️ Сервер хотирасини бўшатиш учун фаол бўлмаган сессия ёпилди, қайта киринг",
+    'admin': "🚪 Сессия администратор томонидан якунланди",
+}
+
+def track_session() -> Optional[str]:
+    """Жорий сессияни реестрда белгилаш; муддати тугаган бўлса, тизимдан чиқариш"""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return None
+    registry = get_session_registry()
+    reason = registry.touch(ctx.session_id, ctx.session_state,
+                            st.session_state.get('username') or None, st.session_state.get('login_at'))
+    if reason and st.session_state.get('logged_in'):
+        for key in list(st.session_state.keys()):
+            del st.session_state[key]
+        st.session_state.logged_in = False
+        st.session_state.username = ""
+        registry.touch(ctx.session_id, ctx.session_state, None, None)
+    return reason
+
+# =================== ПРОФИЛЛАШ ===================
+PROFILE_RING_SIZE = 20
+PROFILE_TOP_ROWS = 25
+PROFILE_TRACE_FRAMES = 10
+PROFILE_STACK_DEPTH = 64
+PROFILE_STACK_MIN_SHARE = 0.001
+
+def _func_label(func: Tuple) -> str:
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+def pstats_to_collapsed(stats: Dict) -> str:
+    """cProfile статистикасидан flamegraph учун йиғилган стеклар (вақт микросекундда)"""
+    callees = collections.defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    roots = [func for func, entry in stats.items() if not any(caller in stats for caller in entry[4])]
+    lines = collections.Counter()
+    # Умумий вақтнинг 0.1% дан кам улушли йўллар ота кадрга қўшилади — чақирувлар графидаги
+    # йўллар сони экспоненциал ўсиши мумкин
+    min_time = sum(entry[2] for entry in stats.values()) * PROFILE_STACK_MIN_SHARE
+
+    def walk(func, stack, share, seen):
+        _, _, tottime, cumtime, _ = stats[func]
+        path = stack + (_func_label(func),)
+        if len(path) >= PROFILE_STACK_DEPTH:
+            lines[';'.join(path)] += int(cumtime * share * 1e6)
+            return
+        own = tottime * share
+        for child, edge_time in callees.get(func, {}).items():
+            child_cumtime = stats[child][3]
+            if child in seen or not child_cumtime or not edge_time:
+                continue
+            edge_time = min(edge_time, child_cumtime)
+            if share * edge_time < min_time:
+                own += share * edge_time
+                continue
+            # Боланинг вақти чақирувчилар орасида қирра улушига мутаносиб тақсимланади
+            walk(child, path, share * edge_time / child_cumtime, seen | {child})
+        if int(own * 1e6):
+            lines[';'.join(path)] += int(own * 1e6)
+
+    for root in roots:
+        walk(root, (), 1.0, frozenset((root,)))
+    return '\n'.join(f"{stack} {value}" for stack, value in lines.items())
+
+class ProfileStore:
+    """Охирги саҳифа профилларининг ҳалқа буфери (жараён учун битта)"""
+
+    def __init__(self, size: int = PROFILE_RING_SIZE):
+        self.profiles = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._tracers = 0
+        self._owns_tracing = False
+        self._ids = itertools.count(1)
+
+    def begin_tracing(self):
+        with self._lock:
+            if self._tracers == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(PROFILE_TRACE_FRAMES)
+                self._owns_tracing = True
+            self._tracers += 1
+
+    def end_tracing(self):
+        # Охирги профилловчи тугагач, tracemalloc тўхтатилади (ўчиқ режимда қўшимча юк йўқ)
+        with self._lock:
+            self._tracers -= 1
+            if self._tracers == 0 and self._owns_tracing:
+                tracemalloc.stop()
+                self._owns_tracing = False
+
+    def add(self, profile: Dict) -> Dict:
+        with self._lock:
+            profile['id'] = next(self._ids)
+            self.profiles.append(profile)
+        return profile
+
+    def get(self, profile_id: int) -> Optional[Dict]:
+        with self._lock:
+            return next((p for p in self.profiles if p['id'] == profile_id), None)
+
+    def summary(self) -> pd.DataFrame:
+        with self._lock:
+            rows = [{key: p[key] for key in ('id', 'started_at', 'username', 'page', 'wall_ms', 'cpu_ms',
+                                               'peak_mb', 'retained_kb', 'status')} for p in self.profiles]
+        return pd.DataFrame(rows, columns=['id', 'started_at', 'username', 'page', 'wall_ms', 'cpu_ms',
+                                           'peak_mb', 'retained_kb', 'status'])
+
+    def clear(self):
+        with self._lock:
+            self.profiles.clear()
+
+@st.cache_resource
+def get_profile_store():
+    return ProfileStore()
+
+def run_profiled(page_func, page: str) -> Dict:
+    """Саҳифа функциясини cProfile ва tracemalloc остида бажариб, профилни буферга қўшиш"""
+    store = get_profile_store()
+    store.begin_tracing()
+    snapshot_filters = (tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"))
+    before = tracemalloc.take_snapshot().filter_traces(snapshot_filters)
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    started_at = datetime.now().strftime('%H:%M:%S')
+    profiler = cProfile.Profile()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    status = 'ok'
+    profiler.enable()
+    try:
+        page_func()
+    except BaseException as e:
+        # st.rerun() ҳам истисно орқали ишлайди — профил барибир сақланади
+        status = type(e).__name__
+        raise
+    finally:
+        profiler.disable()
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        peak = tracemalloc.get_traced_memory()[1]
+        growth = tracemalloc.take_snapshot().filter_traces(snapshot_filters).compare_to(before, 'lineno')
+        store.end_tracing()
+        stats = pstats.Stats(profiler).stats
+        top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_ROWS]
+        ctx = get_script_run_ctx()
+        store.add({
+            'started_at': started_at,
+            'session_id': ctx.session_id if ctx else None,
+            'username': st.session_state.get('username'),
+            'page': page,
+            'status': status,
+            'wall_ms': round(wall * 1000, 1),
+            'cpu_ms': round(cpu * 1000, 1),
+            'peak_mb': round((peak - start_memory) / 1024 ** 2, 2),
+            'retained_kb': round(sum(stat.size_diff for stat in growth) / 1024, 1),
+            'functions': [(_func_label(func), entry[1], round(entry[2] * 1000, 2), round(entry[3] * 1000, 2))
+                          for func, entry in top],
+            'allocations': [(str(stat.traceback[0]), round(stat.size_diff / 1024, 1), stat.count_diff)
+                            for stat in growth[:PROFILE_TOP_ROWS] if stat.size_diff],
+            'pstats': marshal.dumps(stats),
+            'collapsed': pstats_to_collapsed(stats),
+        })
+
+# =================== МЕТРИКАЛАР СЕРВЕРИ ===================
+class MetricsServer:
+    """Prometheus учун /metrics манзилини берувчи енгил HTTP оқими"""
+
+    def __init__(self, db_manager, registry: MetricsRegistry):
+        self.db = db_manager
+        self.registry = registry
+        self.address = None
+        self.last_error = None
+        self._server = None
+        self._thread = None
+        self._attempted = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        # Ҳар қайта юклашда чақирилади — ўчирилган ёки банд порт қайта текширилмайди
+        if self.running or self._attempted:
+            return
+        self._attempted = True
+        settings = {**METRICS_DEFAULTS, **self.db.get_config('metrics_settings', {})}
+        if not settings['enabled']:
+            return
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = http.server.ThreadingHTTPServer((settings['host'], int(settings['port'])), Handler)
+        except OSError as e:
+            # Порт банд (масалан, бир нечта жараён ишлаганда) — илова ишлашда давом этади
+            self.last_error = e
+            return
+        self._server.daemon_threads = True
+        self.address = self._server.server_address[:2]
+        self.last_error = None
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self._server = None
+        self._thread = None
+        self._attempted = False
+        self.address = None
+        self.last_error = None
+
+@st.cache_resource
+def get_metrics_server():
+    return MetricsServer(db, get_metrics())
+
+# =================== ЮКЛАМА СИНОВИ ===================
+LOADTEST_USER = 'loadtest'
+LOADTEST_STEPS = ('login', 'search', 'panel', 'report')
+LOADTEST_LOCK_MARKERS = ('database is locked', 'database table is locked', 'database is busy')
+LOADTEST_FIRST_NAMES = ('Алишер', 'Дилноза', 'Жасур', 'Малика', 'Бобур', 'Нилуфар', 'Шерзод', 'Гулнора',
+                        'Отабек', 'Мадина', 'Сардор', 'Зарина')
+LOADTEST_LAST_NAMES = ('Каримов', 'Юсупова', 'Рахимов', 'Тошматова', 'Исмоилов', 'Эргашева', 'Назаров',
+                       'Абдуллаева', 'Холматов', 'Саидова')
+
+def seed_loadtest_database(path: str, patients: int, password: str) -> int:
+    """Юклама синови базаси: синов фойдаланувчиси, беморлар, ташқи юборишлар ўчирилган"""
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    try:
+        conn.execute('''
+            INSERT INTO users (username, password_hash, full_name, role) VALUES (?, ?, ?, 'Лаборант')
+            ON CONFLICT(username) DO UPDATE SET password_hash = excluded.password_hash
+        ''', (LOADTEST_USER, hashlib.sha256(password.encode()).hexdigest(), 'Юклама синови'))
+        # Нусха ишлаётган жараён портини эгалламайди, хат юбормайди ва техник хизмат бошламайди
+        db.set_config('metrics_settings', {**METRICS_DEFAULTS, 'enabled': False}, conn)
+        db.set_config('maintenance_settings', {**MAINTENANCE_DEFAULTS, 'enabled': False}, conn)
+        db.set_config('system_settings', {**db.get_config('system_settings', {}, conn),
+                                          'enable_notifications': False}, conn)
+        rng = np.random.default_rng(0)
+        missing = patients - conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+        for _ in range(max(missing, 0)):
+            register_patient(conn, f"{rng.choice(LOADTEST_LAST_NAMES)} {rng.choice(LOADTEST_FIRST_NAMES)}",
+                             (date(1950, 1, 1) + timedelta(days=int(rng.integers(0, 25000)))).isoformat(),
+                             str(rng.choice(["Эркак", "Аёл"])))
+        return max(missing, 0)
+    finally:
+        conn.close()
+
+def _loadtest_session(script: str, password: str, iterations: int, seed: int,
+                      timeout: float) -> List[Tuple[str, float, Optional[str], Optional[str]]]:
+    """Битта лаборантнинг сценарийси: кириш, беморни излаш, панел киритиш, кунлик ҳисобот"""
+    from streamlit.testing.v1 import AppTest
+    rng = np.random.default_rng(seed)
+    at = AppTest.from_file(script, default_timeout=timeout)
+    samples = []
+
+    def widget(elements, label):
+        return next(element for element in elements if element.label == label)
+
+    def step(name, action):
+        started = time.perf_counter()
+        try:
+            action()
+            messages = [str(e.value) for e in at.exception] + [str(e.value) for e in at.error]
+        except Exception as e:
+            messages = [f"{type(e).__name__}: {e}"]
+        elapsed = time.perf_counter() - started
+        kind = None
+        if messages:
+            text = ' '.join(messages).lower()
+            kind = 'lock' if any(marker in text for marker in LOADTEST_LOCK_MARKERS) else 'error'
+        samples.append((name, elapsed, kind, messages[0][:200] if messages else None))
+        return kind is None
+
+    def login():
+        at.run()
+        at.text_input(key="login_username").input(LOADTEST_USER)
+        at.text_input(key="login_password").input(password)
+        widget(at.button, "🚪 Тизимга кириш").click().run()
+        if not at.session_state.logged_in:
+            raise RuntimeError("login failed")
+
+    def search():
+        at.selectbox(key="main_menu").set_value("👥 Беморлар бошқаруви").run()
+        widget(at.radio, "Излаш усули").set_value("Исм буйича")
+        widget(at.text_input, "Қидирув қиймати").input(str(rng.choice(LOADTEST_LAST_NAMES))[:5])
+        widget(at.button, "🔍 Излаш").click().run()
+
+    def panel():
+        at.selectbox(key="main_menu").set_value("📊 Тахлил натижалари").run()
+        patient = widget(at.selectbox, "👤 Беморни танланг*")
+        patient.set_value(patient.options[int(rng.integers(len(patient.options)))])
+        widget(at.selectbox, "🔬 Тахлил тури*").set_value("Биохимик").run()
+        for field in at.number_input:
+            if field.key and field.key.startswith("value_"):
+                field.set_value(round(float(rng.uniform(1, 150)), 1))
+        widget(at.button, "💾 Тахлил натижаларини сақлаш").click().run()
+
+    def report():
+        at.selectbox(key="main_menu").set_value("📈 Ҳисоботлар").run()
+        at.button(key="daily_report_btn").click().run()
+
+    if step('login', login):
+        for _ in range(iterations):
+            step('search', search)
+            step('panel', panel)
+            step('report', report)
+    return samples
+
+def _loadtest_worker(script: str, db_path: str, seed: int, password: str, iterations: int,
+                     timeout: float) -> List[Tuple[str, float, Optional[str], Optional[str]]]:
+    # AppTest жараён бўйича глобал ҳолатдан фойдаланади — ҳар бир сессия алоҳида жараёнда
+    os.environ['MEDICAL_LAB_DB'] = db_path
+    # Ота жараёндан мерос қолган кешланган уланишлар асосий базага қарайди
+    st.cache_resource.clear()
+    return _loadtest_session(script, password, iterations, seed, timeout)
+
+# =================== ТУРЛАНГАН ЖАДВАЛЛАР ===================
+FRAME_CHUNK_ROWS = 50000
+# Саҳифалар учун умумий устунлар реестри: майдон -> (сарлавҳа, тур)
+FRAME_SCHEMA = {
+    'full_name': ('Бемор', 'category'),
+    'test_type': ('Тахлил тури', 'category'),
+    'parameter_code': ('Параметр', 'category'),
+    'result_value': ('Қиймат', 'float32'),
+    'unit': ('Ўлчов бирлиги', 'category'),
+    'status': ('Холат', 'status'),
+    'test_date': ('Сана', 'date'),
+    'delta_flag': ('Дельта', 'category'),
+}
+STATUS_STYLES = {
+    'normal': 'background-color: #E8F8F5; color: #27AE60; font-weight: bold;',
+    'low': 'background-color: #FFF3CD; color: #856404; font-weight: bold;',
+}
+STATUS_STYLE_DEFAULT = 'background-color: #F8D7DA; color: #721C24; font-weight: bold;'
+
+def _typed_column(values: pd.Series, kind: str) -> pd.Series:
+    if kind == 'category':
+        return values.astype('category')
+    if kind == 'status':
+        extra = sorted(set(values.dropna().unique()) - STATUS_LABELS.keys())
+        return pd.Series(pd.Categorical(values, categories=list(STATUS_LABELS) + extra), index=values.index)
+    if kind == 'float32':
+        numbers = pd.to_numeric(values, errors='coerce').astype('float64')
+        compact = numbers.astype('float32')
+        # float32 6 та аҳамиятли рақамни сақлайди — ундан аниқроқ қийматлар float64 да қолади
+        if np.allclose(compact, numbers, rtol=1e-6, atol=0, equal_nan=True):
+            return compact
+        return numbers
+    if kind == 'date':
+        return pd.to_datetime(values, errors='coerce', format='ISO8601')
+    return values
+
+def _concat_typed(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    if len(chunks) == 1:
+        return chunks[0]
+    columns = {}
+    for name in chunks[0].columns:
+        parts = [chunk[name] for chunk in chunks]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            # Бўлаклар категориялари турлича — бирлаштирилмаса object га қайтади
+            arrays = [part.array for part in parts]
+            dtypes = {array.categories.dtype for array in arrays if len(array.categories)}
+            # Бўш бўлак категорияларининг тури бошқаларникидан фарқ қилиши мумкин
+            target = dtypes.pop() if len(dtypes) == 1 else object
+            arrays = [array if array.categories.dtype == target else
+                      array.set_categories(array.categories.astype(target), rename=True) for array in arrays]
+            columns[name] = pd.Series(pd.api.types.union_categoricals(arrays))
+        else:
+            columns[name] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+def read_typed_frame(conn, query: str, params, fields: List[str],
+                     chunk_rows: int = FRAME_CHUNK_ROWS) -> pd.DataFrame:
+    """Сўров натижасини бўлаклаб ўқиб, FRAME_SCHEMA бўйича ихчам турларга ўгириш"""
+    cursor = conn.execute(query, params)
+    chunks, object_bytes = [], 0
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows and chunks:
+            break
+        raw = pd.DataFrame.from_records(rows, columns=fields)
+        object_bytes += int(raw.memory_usage(deep=True, index=False).sum())
+        chunks.append(pd.DataFrame({FRAME_SCHEMA[field][0]: _typed_column(raw[field], FRAME_SCHEMA[field][1])
+                                    for field in fields}))
+        if len(rows) < chunk_rows:
+            break
+    df = _concat_typed(chunks)
+    # Шу маълумот оддий сатрли жадвалда эгаллайдиган хотира (ҳисобот учун)
+    df.attrs['object_bytes'] = object_bytes
+    return df
+
+def frame_column_config(df: pd.DataFrame) -> Dict:
+    """Сана устунлари вақтсиз кўрсатилади"""
+    return {name: st.column_config.DateColumn(name, format="YYYY-MM-DD")
+            for name in df.columns if pd.api.types.is_datetime64_any_dtype(df[name])}
+
+def frame_memory_caption(df: pd.DataFrame) -> str:
+    typed = int(df.memory_usage(deep=True, index=False).sum())
+    plain = df.attrs.get('object_bytes') or typed
+    saved = (1 - typed / plain) * 100 if plain else 0
+    return f"💾 {len(df):,} қатор: {typed / 1024:,.0f} КБ (сатрли жадвалда {plain / 1024:,.0f} КБ, −{saved:.0f}%)"
+
+def status_styles(column: pd.Series) -> np.ndarray:
+    """Холат устуни учун CSS: услуб ҳар бир категорияга бир марта ҳисобланади"""
+    column = column if isinstance(column.dtype, pd.CategoricalDtype) else column.astype('category')
+    styles = np.array([STATUS_STYLES.get(status, STATUS_STYLE_DEFAULT) for status in column.cat.categories]
+                      + [STATUS_STYLE_DEFAULT], dtype=object)
+    # Бўш қийматлар коди -1 — охирги (стандарт) услуб
+    return styles[column.cat.codes.to_numpy()]
+
+# =================== ҲИСОБОТ СУРАТИ ===================
+SNAPSHOT_DEFAULTS = {'enabled': True, 'interval_minutes': 10}
+SNAPSHOT_POLL_SECONDS = 30
+SNAPSHOT_SUFFIX = '.snapshot'
+
+class SnapshotManager:
+    """Ҳисоботлар учун базанинг фақат ўқиладиган нусхаси (online backup API орқали)"""
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.path = db_manager.db_path + SNAPSHOT_SUFFIX
+        self.last_duration_ms = None
+        self.last_error = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def created_at(self) -> Optional[datetime]:
+        try:
+            return datetime.fromtimestamp(os.stat(self.path).st_mtime)
+        except FileNotFoundError:
+            return None
+
+    def age_seconds(self) -> Optional[float]:
+        created = self.created_at()
+        return None if created is None else max((datetime.now() - created).total_seconds(), 0.0)
+
+    def refresh(self) -> float:
+        """Янги нусха ёзиб, уни атомар алмаштириш; давомийлик (мс) қайтарилади"""
+        started = time.perf_counter()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                   prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+        os.close(fd)
+        source = self.db.connect()
+        try:
+            target = sqlite3.connect(tmp)
+            try:
+                # Бир қадамда нусха: WAL да бу фақат ўқиш транзакцияси, ёзувчилар кутмайди
+                source.backup(target)
+                target.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                target.close()
+            os.replace(tmp, self.path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            source.close()
+        self.last_duration_ms = (time.perf_counter() - started) * 1000
+        return self.last_duration_ms
+
+    def connection(self):
+        """Энг сўнгги нусхага оқимнинг ўз фақат ўқиш уланиши (бошқа жараён янгиласа, қайта очилади)"""
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.refresh()
+                stat = os.stat(self.path)
+        identity = (stat.st_ino, stat.st_mtime_ns)
+        local = self._local
+        if getattr(local, 'identity', None) != identity:
+            # Уланиш сессиялар орасида бўлинмайди: архивларни ATTACH қилиш ва test_results_all
+            # кўриниши бошқа сессиянинг сўрови остида алмашмайди
+            previous = getattr(local, 'conn', None)
+            local.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False,
+                                         timeout=30, factory=MeteredConnection)
+            local.conn.metrics = get_metrics()
+            local.identity = identity
+            if previous is not None:
+                previous.close()
+        return local.conn
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="snapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self._thread = None
+
+    def _run(self):
+        conn = self.db.connect()
+        try:
+            while not self._stop.is_set():
+                try:
+                    settings = {**SNAPSHOT_DEFAULTS, **self.db.get_config('snapshot_settings', {}, conn)}
+                    age = self.age_seconds()
+                    # Файл вақти жараёнлар орасида умумий: бошқа реплика янгилаган бўлса, такрорланмайди
+                    if settings['enabled'] and (age is None or age >= settings['interval_minutes'] * 60):
+                        self.refresh()
+                        self.last_error = None
+                except Exception as e:
+                    self.last_error = e
+                self._stop.wait(SNAPSHOT_POLL_SECONDS)
+        finally:
+            conn.close()
+
+@st.cache_resource
+def get_snapshot_manager():
+    return SnapshotManager(db)
+
+def snapshot_freshness(manager: SnapshotManager) -> str:
+    age = manager.age_seconds()
+    if age is None:
+        return "📸 Нусха ҳали яратилмаган"
+    created = manager.created_at().strftime('%H:%M:%S')
+    if age < 60:
+        return f"📸 Маълумотлар {created} ҳолатига ({age:.0f} с олдин)"
+    return f"📸 Маълумотлар {created} ҳолатига ({age / 60:.0f} дақ олдин)"
+
+def snapshot_banner(key: str):
+    """Ҳисобот саҳифаси тепасида нусханинг янгилиги ва қўлда янгилаш тугмаси"""
+    manager = get_snapshot_manager()
+    col1, col2 = st.columns([4, 1])
+    with col2:
+        if st.button("🔄 Янгилаш", use_container_width=True, key=key):
+            try:
+                manager.refresh()
+            except Exception as e:
+                st.error(f"❌ Нусха янгиланмади: {str(e)}")
+    conn = manager.connection()
+    with col1:
+        st.caption(snapshot_freshness(manager))
+    return conn
+
+# =================== ЎЗГАРИШЛАР ЖУРНАЛИ ===================
+JOURNAL_SEGMENT_ROWS = 50000
+BACKUP_KEEP_FULL = 4
+BACKUP_FULL_EVERY_DAYS = 7
+BACKUP_TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+def backup_directory(db_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'backups')
+
+def list_full_backups(directory: str) -> List[Dict]:
+    """Тўлиқ нусхалар (эскидан янгига): full-<вақт>-<журнал seq>.db"""
+    backups = []
+    for path in sorted(Path(directory).glob('full-*.db')) if os.path.isdir(directory) else []:
+        try:
+            _, day, clock, base_seq = path.stem.split('-')
+            created = datetime.strptime(f"{day}-{clock}", BACKUP_TIME_FORMAT)
+        except ValueError:
+            continue
+        backups.append({'path': str(path), 'created': created, 'base_seq': int(base_seq),
+                        'bytes': path.stat().st_size})
+    return sorted(backups, key=lambda b: b['created'])
+
+def list_journal_segments(directory: str) -> List[Dict]:
+    """Журнал сегментлари (seq бўйича): journal-<биринчи>-<охирги>.seg"""
+    segments = []
+    for path in Path(directory).glob('journal-*.seg') if os.path.isdir(directory) else []:
+        try:
+            _, first_seq, last_seq = path.stem.split('-')
+        except ValueError:
+            continue
+        segments.append({'path': str(path), 'first_seq': int(first_seq), 'last_seq': int(last_seq),
+                         'bytes': path.stat().st_size})
+    return sorted(segments, key=lambda s: s['first_seq'])
+
+def _write_atomic(directory: str, name: str, write) -> str:
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp)
+        path = os.path.join(directory, name)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path
+
+def _journal_sequence(conn) -> int:
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_journal'").fetchone()
+    return row[0] if row else 0
+
+def create_full_backup(conn, directory: str) -> Dict:
+    """Тўлиқ нусха (online backup API); номида нусхага кирган охирги журнал seq сақланади"""
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        target = sqlite3.connect(tmp)
+        try:
+            conn.backup(target)
+            target.execute("PRAGMA journal_mode=DELETE")
+            base_seq = _journal_sequence(target)
+        finally:
+            target.close()
+        # Вақт нусха тугагандан кейин олинади: ундан олдинги ҳар бир ўзгариш ё нусхада, ё журналда
+        path = os.path.join(directory, f"full-{datetime.now().strftime(BACKUP_TIME_FORMAT)}-{base_seq}.db")
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return {'path': path, 'base_seq': base_seq, 'bytes': os.path.getsize(path),
+            'duration_ms': (time.perf_counter() - started) * 1000}
+
+def compact_change_journal(conn, directory: str, segment_rows: int = JOURNAL_SEGMENT_ROWS) -> Dict:
+    """Журнал ёзувларини сиқилган сегментларга кўчириб, базадан ўчириш"""
+    summary = {'segments': 0, 'rows': 0, 'bytes': 0}
+    while True:
+        rows = conn.execute('''
+            SELECT seq, changed_at, table_name, op, row_id, row_data FROM change_journal
+            ORDER BY seq LIMIT ?
+        ''', (segment_rows,)).fetchall()
+        if not rows:
+            return summary
+        first_seq, last_seq = rows[0][0], rows[-1][0]
+        payload = json.dumps({'first_at': rows[0][1], 'last_at': rows[-1][1], 'entries': rows},
+                             ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(payload, 6))
+
+        path = _write_atomic(directory, f"journal-{first_seq:012d}-{last_seq:012d}.seg", write)
+        conn.execute("DELETE FROM change_journal WHERE seq <= ?", (last_seq,))
+        conn.commit()
+        summary['segments'] += 1
+        summary['rows'] += len(rows)
+        summary['bytes'] += os.path.getsize(path)
+
+def prune_backups(directory: str, keep_full: int = BACKUP_KEEP_FULL) -> int:
+    """Эски тўлиқ нусхаларни ва улардан олдинги сегментларни ўчириш"""
+    fulls = list_full_backups(directory)
+    if len(fulls) <= keep_full:
+        return 0
+    removed = fulls[:-keep_full]
+    oldest_base = fulls[-keep_full]['base_seq']
+    stale = [s for s in list_journal_segments(directory) if s['last_seq'] <= oldest_base]
+    for item in removed + stale:
+        os.remove(item['path'])
+    return len(removed) + len(stale)
+
+def incremental_backup(conn, directory: str, full: bool = False) -> Dict:
+    """Журнални сегментларга сиқиш; тўлиқ нусха фақат ҳафтада бир марта (ёки сўралганда)"""
+    summary = compact_change_journal(conn, directory)
+    fulls = list_full_backups(directory)
+    if full or not fulls or datetime.now() - fulls[-1]['created'] >= timedelta(days=BACKUP_FULL_EVERY_DAYS):
+        summary['full'] = create_full_backup(conn, directory)
+    summary['pruned'] = prune_backups(directory)
+    return summary
+
+def _journal_entries(directory: str, after_seq: int, until: str, conn=None):
+    """after_seq дан кейинги ёзувлар: аввал сегментлардан, кейин базадаги сиқилмаган қисмдан"""
+    last_seq = after_seq
+    for segment in list_journal_segments(directory):
+        if segment['last_seq'] <= last_seq:
+            continue
+        with open(segment['path'], 'rb') as f:
+            data = json.loads(zlib.decompress(f.read()))
+        if data['first_at'] > until:
+            return
+        for entry in data['entries']:
+            if entry[0] > last_seq:
+                yield entry
+                last_seq = entry[0]
+    if conn is not None:
+        yield from conn.execute('''
+            SELECT seq, changed_at, table_name, op, row_id, row_data FROM change_journal
+            WHERE seq > ? ORDER BY seq
+        ''', (last_seq,))
+
+def restore_point_in_time(directory: str, until: datetime, output_path: str, conn=None) -> Dict:
+    """Тўлиқ нусха + журнал сегментларини until вақтигача қайта ўйнаб, янги базага тиклаш"""
+    started = time.perf_counter()
+    candidates = [b for b in list_full_backups(directory) if b['created'] <= until]
+    if not candidates:
+        raise ValueError(f"{until:%Y-%m-%d %H:%M:%S} дан олдинги тўлиқ нусха топилмади")
+    base = candidates[-1]
+    until_text = until.strftime('%Y-%m-%d %H:%M:%S.999')
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    source = sqlite3.connect(f"file:{base['path']}?mode=ro", uri=True)
+    target = sqlite3.connect(output_path)
+    try:
+        source.backup(target)
+        source.close()
+        # Қайта ўйналаётган ўзгаришлар тикланган базанинг журналига қайта ёзилмаслиги учун
+        for (name,) in target.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' "
+                                      "AND name LIKE 'journal\\_%' ESCAPE '\\'").fetchall():
+            target.execute(f"DROP TRIGGER {name}")
+        columns = {table: [row[1] for row in target.execute(f"PRAGMA table_info({table})")]
+                   for table in CHANGE_JOURNAL_TABLES}
+        target.execute("CREATE TEMP TABLE replay (seq INTEGER PRIMARY KEY, table_name TEXT, op TEXT, "
+                       "row_id INTEGER, row_data TEXT)")
+        applied, expected = 0, base['base_seq'] + 1
+        pending = []
+        target.execute("BEGIN")
+        for seq, changed_at, table, op, row_id, row_data in _journal_entries(directory, base['base_seq'],
+                                                                            until_text, conn):
+            if seq != expected:
+                raise ValueError(f"Журналда узилиш: {expected} кутилган, {seq} топилди")
+            expected = seq + 1
+            if changed_at > until_text:
+                continue
+            pending.append((seq, table, op, row_id, row_data))
+            applied += 1
+            if len(pending) >= JOURNAL_SEGMENT_ROWS:
+                target.executemany("INSERT INTO temp.replay VALUES (?, ?, ?, ?, ?)", pending)
+                pending = []
+        target.executemany("INSERT INTO temp.replay VALUES (?, ?, ?, ?, ?)", pending)
+        # Қаторлар rowid бўйича мустақил: ҳар бирининг охирги ҳолатини қўллаш кетма-кет ўйнаш билан тенг
+        for table in CHANGE_JOURNAL_TABLES:
+            target.execute(f"DELETE FROM {table} WHERE rowid IN "
+                           f"(SELECT row_id FROM temp.replay WHERE table_name = ?)", (table,))
+            values = ', '.join(f"json_extract(row_data, '$.{name}')" for name in columns[table])
+            target.execute(f'''
+                INSERT OR REPLACE INTO {table} ({', '.join(columns[table])})
+                SELECT {values} FROM temp.replay
+                WHERE seq IN (SELECT MAX(seq) FROM temp.replay WHERE table_name = ? GROUP BY row_id)
+                AND op != 'D'
+                ORDER BY seq
+            ''', (table,))
+        # Ҳосила жадваллар кейинги ишга туширишда қайта қурилади, журнал янги нусхадан бошланади
+        target.execute("DELETE FROM change_journal")
+        target.execute("DELETE FROM latest_results")
+        target.execute("DELETE FROM app_config WHERE key IN ('latest_results_built', 'cohort_cube_watermark')")
+        target.commit()
+    except Exception:
+        target.close()
+        os.remove(output_path)
+        raise
+    target.close()
+    return {'path': output_path, 'base': os.path.basename(base['path']), 'applied': applied,
+            'last_seq': expected - 1, 'duration_ms': (time.perf_counter() - started) * 1000}
+
+def journal_table_checksums(conn) -> Dict[str, Tuple[int, str]]:
+    """Журналланадиган жадваллар учун (қаторлар сони, мазмун хеши) — тиклашни текшириш учун"""
+    checksums = {}
+    for table in CHANGE_JOURNAL_TABLES:
+        digest = hashlib.sha1()
+        count = 0
+        for row in conn.execute(f"SELECT * FROM {table} ORDER BY rowid"):
+            digest.update(repr(row).encode('utf-8'))
+            count += 1
+        checksums[table] = (count, digest.hexdigest())
+    return checksums
+
+# =================== АУДИТ ЖУРНАЛИ ===================
+AUDIT_FLUSH_SECONDS = 2.0
+AUDIT_BATCH_SIZE = 500
+AUDIT_ACTIONS = {
+    'create': "➕ Яратилди",
+    'update': "✏️ Ўзгартирилди",
+    'delete': "🗑️ Ўчирилди",
+    'restore': "♻️ Тикланди",
+    'merge': "🔗 Бирлаштирилди",
+    'import': "📥 Импорт",
+}
+
+def audit_actor() -> str:
+    """Жорий фойдаланувчи (сессиядан ташқарида — 'system')"""
+    try:
+        return st.session_state.get('username') or 'system'
+    except Exception:
+        return 'system'
+
+def audit_row(conn, table: str, row_id) -> Optional[Dict]:
+    cursor = conn.execute(f"SELECT * FROM {table} WHERE id = ?", (row_id,))
+    row = cursor.fetchone()
+    return None if row is None else dict(zip((d[0] for d in cursor.description), row))
+
+def audit_diff(before: Optional[Dict], after: Optional[Dict]) -> Dict[str, List]:
+    """Фақат ўзгарган майдонлар: {майдон: [олдин, кейин]} (санa ва сон матн сифатида солиштирилади)"""
+    before, after = before or {}, after or {}
+    changes = {}
+    for field in list(before) + [f for f in after if f not in before]:
+        old, new = before.get(field), after.get(field)
+        if (None if old is None else str(old)) != (None if new is None else str(new)):
+            changes[field] = [old, new]
+    return changes
+
+class AuditLog:
+    """Аудит ёзувлари хотирада тўпланиб, фон оқимида бўлаклаб базага ёзилади"""
+
+    def __init__(self, db_manager):
+        self.db = db_manager
+        self.stats = {'recorded': 0, 'flushed': 0, 'batches': 0}
+        self.last_error = None
+        self._buffer = collections.deque()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def record(self, action: str, entity: str, entity_id, before: Optional[Dict] = None,
+               after: Optional[Dict] = None, actor: Optional[str] = None, changes: Optional[Dict] = None):
+        """Ёзувни навбатга қўйиш (базага мурожаат йўқ — маълумот киритиш кечикмайди)"""
+        self._buffer.append((datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], actor or audit_actor(),
+                             action, entity, str(entity_id),
+                             json.dumps(changes if changes is not None else audit_diff(before, after),
+                                        ensure_ascii=False, default=str)))
+        self.stats['recorded'] += 1
+        if len(self._buffer) >= AUDIT_BATCH_SIZE:
+            self._wakeup.set()
+
+    def flush(self, conn=None) -> int:
+        """Навбатдаги ёзувларни битта транзакцияда ёзиш; ёзилганлар сони"""
+        with self._flush_lock:
+            batch = []
+            while self._buffer:
+                batch.append(self._buffer.popleft())
+            if not batch:
+                return 0
+            own_conn = conn is None
+            conn = conn or self.db.connect()
+            try:
+                conn.executemany('''
+                    INSERT INTO audit_log (logged_at, actor, action, entity, entity_id, changes)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', batch)
+                conn.commit()
+            except Exception:
+                if conn.in_transaction:
+                    conn.rollback()
+                # Аудит ёзувлари йўқолмаслиги керак: кейинги уринишда қайта ёзилади
+                self._buffer.extendleft(reversed(batch))
+                raise
+            finally:
+                if own_conn:
+                    conn.close()
+            self.stats['flushed'] += len(batch)
+            self.stats['batches'] += 1
+            return len(batch)
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self._thread = None
+
+    def _run(self):
+        conn = self.db.connect()
+        try:
+            while not self._stop.is_set():
+                self._wakeup.wait(AUDIT_FLUSH_SECONDS)
+                self._wakeup.clear()
+                try:
+                    self.flush(conn)
+                except Exception as e:
+                    self.last_error = e
+            self.flush(conn)
+        finally:
+            conn.close()
+
+@st.cache_resource
+def get_audit_log():
+    audit = AuditLog(db)
+    # Жараён тугаганда (CLI ёки сервер тўхтаганда) навбатдаги ёзувлар ҳам сақланади
+    atexit.register(audit.flush)
+    get_metrics().add(CallbackMetric(
+        'lab_audit_pending', 'Audit records buffered in memory', 'gauge', (), lambda: {(): audit.pending}))
+    return audit
+
+def query_audit_log(conn, entity: Optional[str] = None, entity_id=None, actor: Optional[str] = None,
+                    date_from=None, date_to=None, limit: int = 500) -> pd.DataFrame:
+    """Аудит ёзувлари (entity/actor индекслари орқали), янгидан эскига"""
+    where, params = [], []
+    for column, value in (('entity', entity), ('entity_id', entity_id), ('actor', actor)):
+        if value not in (None, ''):
+            where.append(f"{column} = ?")
+            params.append(str(value))
+    if date_from:
+        where.append("logged_at >= ?")
+        params.append(str(date_from))
+    if date_to:
+        where.append("logged_at < DATE(?, '+1 day')")
+        params.append(str(date_to))
+    return pd.read_sql_query(f'''
+        SELECT logged_at, actor, action, entity, entity_id, changes FROM audit_log
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY logged_at DESC LIMIT ?
+    ''', conn, params=params + [limit])
+
+# =================== ОММАВИЙ ИМПОРТ ===================
+IMPORT_CHUNK_ROWS = 50000
+IMPORT_PREVIEW_ROWS = 1000
+# Майдон: (сарлавҳа, мажбурийми, устун номлари учун тахминлар)
+IMPORT_FIELDS = {
+    'patients': {
+        'patient_id': ("Бемор ID", False, ('patient_id', 'id', 'бемор id', 'mrn', 'код')),
+        'full_name': ("Исми-шарифи", True, ('full_name', 'name', 'фио', 'исми-шарифи', 'исм', 'ф.и.ш')),
+        'birth_date': ("Туғилган сана", True, ('birth_date', 'dob', 'birthday', 'туғилган сана', 'дата рождения')),
+        'gender': ("Жинси", True, ('gender', 'sex', 'жинси', 'пол')),
+        'phone': ("Телефон", False, ('phone', 'телефон', 'tel')),
+        'address': ("Манзил", False, ('address', 'манзил', 'адрес')),
+    },
+    'results': {
+        'patient_id': ("Бемор ID", True, ('patient_id', 'бемор id', 'mrn', 'patient')),
+        'parameter_code': ("Параметр коди", True, ('parameter_code', 'code', 'test_code', 'параметр', 'код')),
+        'result_value': ("Қиймат", True, ('result_value', 'value', 'result', 'қиймат', 'результат')),
+        'test_date': ("Сана", True, ('test_date', 'date', 'сана', 'дата')),
+        'unit': ("Ўлчов бирлиги", False, ('unit', 'units', 'бирлик', 'ед')),
+        'notes': ("Изоҳ", False, ('notes', 'comment', 'изоҳ')),
+        'menstrual_phase': ("Менструация фазаси", False, ('menstrual_phase', 'phase', 'фаза')),
+    },
+}
+IMPORT_KIND_LABELS = {'patients': "👥 Беморлар", 'results': "🧪 Тахлил натижалари"}
+IMPORT_PROFILE_DEFAULTS = {'kind': 'results', 'columns': {}, 'delimiter': ',', 'encoding': 'utf-8-sig',
+                           'date_format': '', 'decimal': '.'}
+IMPORT_DATE_FORMATS = ['%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+IMPORT_GENDERS = {
+    'эркак': 'Эркак', 'erkak': 'Эркак', 'e': 'Эркак', 'м': 'Эркак', 'm': 'Эркак', 'male': 'Эркак',
+    'муж': 'Эркак', 'мужской': 'Эркак',
+    'аёл': 'Аёл', 'ayol': 'Аёл', 'а': 'Аёл', 'a': 'Аёл', 'ж': 'Аёл', 'f': 'Аёл', 'female': 'Аёл',
+    'жен': 'Аёл', 'женский': 'Аёл',
+}
+# Параметр нормасининг юқори чегарасидан шунча марта катта қиймат бирлик хатоси деб ҳисобланади
+IMPORT_VALUE_FACTOR = 1000
+
+def import_profiles(conn=None) -> Dict[str, Dict]:
+    return {name: {**IMPORT_PROFILE_DEFAULTS, **profile}
+            for name, profile in db.get_config('import_profiles', {}, conn).items()}
+
+def save_import_profile(name: str, profile: Dict, conn=None):
+    profiles = db.get_config('import_profiles', {}, conn)
+    profiles[name] = profile
+    db.set_config('import_profiles', profiles, conn)
+
+def guess_import_columns(header: List[str], kind: str) -> Dict[str, str]:
+    """Сарлавҳа номларидан майдонларни тахминлаш (ҳарф катталиги ва бўшлиқлар ҳисобга олинмайди)"""
+    normalized = {str(column).strip().lower(): column for column in header}
+    return {field: next((normalized[alias] for alias in aliases if alias in normalized), '')
+            for field, (_, _, aliases) in IMPORT_FIELDS[kind].items()}
+
+def read_import_chunks(source, file_name: str, profile: Dict, chunk_rows: int = IMPORT_CHUNK_ROWS):
+    """Файлни бўлаклаб ўқиш; барча устунлар матн, бўш катаклар — бўш қатор"""
+    if file_name.lower().endswith(('.xlsx', '.xlsm')):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError("XLSX файллар учун openpyxl кутубхонаси керак (pip install openpyxl) — "
+                             "ёки жадвални CSV сифатида сақланг")
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(cell).strip() if cell is not None else f"column_{i}"
+                      for i, cell in enumerate(next(rows, ()))]
+            while True:
+                batch = list(itertools.islice(rows, chunk_rows))
+                if not batch:
+                    return
+                yield pd.DataFrame(
+                    [['' if cell is None else cell.isoformat() if hasattr(cell, 'isoformat') else str(cell)
+                      for cell in row] for row in batch], columns=header, dtype=str)
+        finally:
+            workbook.close()
+    else:
+        reader = pd.read_csv(source, sep=profile['delimiter'] or ',', encoding=profile['encoding'] or 'utf-8-sig',
+                             dtype=str, keep_default_na=False, chunksize=chunk_rows)
+        for chunk in reader:
+            chunk.columns = [str(column).strip() for column in chunk.columns]
+            yield chunk
+
+def parse_import_dates(values: pd.Series, date_format: str = '') -> pd.Series:
+    """Саналарни форматлар бўйича кетма-кет (вектор шаклида) ажратиш"""
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in [date_format] if date_format else IMPORT_DATE_FORMATS:
+        pending = parsed.isna() & values.ne('')
+        if not pending.any():
+            break
+        parsed[pending] = pd.to_datetime(values[pending], format=fmt, errors='coerce')
+    return parsed
+
+def _import_field(frame: pd.DataFrame, columns: Dict[str, str], field: str) -> pd.Series:
+    source = columns.get(field)
+    if source and source in frame.columns:
+        return frame[source].astype(str).str.strip()
+    return pd.Series('', index=frame.index, dtype=str)
+
+def _first_error(checks: List[Tuple[pd.Series, str]], index) -> pd.Series:
+    """Ҳар бир қатор учун биринчи бажарилмаган текширув (бўлса)"""
+    if not checks:
+        return pd.Series('', index=index, dtype=str)
+    return pd.Series(np.select([mask.to_numpy(dtype=bool) for mask, _ in checks], [reason for _, reason in checks],
+                               default=''), index=index)
+
+def validate_patient_chunk(conn, frame: pd.DataFrame, profile: Dict) -> Tuple[pd.DataFrame, pd.Series]:
+    """Беморлар бўлагини текшириш: (тоза қийматлар, хатолик сабаби — тўғри қаторда бўш)"""
+    columns = profile['columns']
+    data = pd.DataFrame({field: _import_field(frame, columns, field) for field in IMPORT_FIELDS['patients']})
+    birth = parse_import_dates(data['birth_date'], profile['date_format'])
+    gender = data['gender'].str.lower().map(IMPORT_GENDERS)
+    existing = set()
+    codes = data.loc[data['patient_id'].ne(''), 'patient_id'].unique().tolist()
+    for start in range(0, len(codes), 900):
+        chunk = codes[start:start + 900]
+        existing.update(row[0] for row in conn.execute(
+            f"SELECT patient_id FROM patients WHERE patient_id IN ({','.join('?' * len(chunk))})", chunk))
+    errors = _first_error([
+        (data['full_name'].eq(''), "исм бўш"),
+        (birth.isna(), "туғилган сана нотўғри"),
+        ((birth < pd.Timestamp('1900-01-01')) | (birth > pd.Timestamp(date.today())), "туғилган сана оралиқдан ташқарида"),
+        (gender.isna(), "жинс номаълум"),
+        (data['patient_id'].ne('') & data['patient_id'].duplicated(keep='first'), "ID файлда такрорланган"),
+        (data['patient_id'].isin(existing), "ID базада мавжуд"),
+    ], frame.index)
+    data['birth_date'] = birth.dt.strftime('%Y-%m-%d')
+    data['gender'] = gender
+    return data, errors
+
+def load_patient_chunk(conn, data: pd.DataFrame) -> int:
+    """Беморларни битта транзакцияда ёзиш (такрорий-излаш калитлари импорт охирида қурилади)"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Файлдаги бугунги ID лар кетма-кетликни орқада қолдирмаслиги керак
+        prefix = patient_id_prefix()
+        today_ids = data['patient_id'].str.fullmatch(re.escape(prefix) + r'\d+')
+        if today_ids.any():
+            conn.execute('''
+                UPDATE id_sequences SET last_value = MAX(last_value, ?)
+                WHERE name = 'patient' AND day = ?
+            ''', (int(data.loc[today_ids, 'patient_id'].str[len(prefix):].astype(int).max()), date.today().isoformat()))
+        missing = data['patient_id'].eq('')
+        if missing.any():
+            data.loc[missing, 'patient_id'] = allocate_patient_ids(conn, int(missing.sum()))
+        conn.executemany('''
+            INSERT INTO patients (patient_id, full_name, birth_date, gender, phone, address)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', data[['patient_id', 'full_name', 'birth_date', 'gender', 'phone', 'address']]
+             .replace('', None).itertuples(index=False, name=None))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(data)
+
+def validate_result_chunk(conn, frame: pd.DataFrame, profile: Dict,
+                          patients: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Series]:
+    """Натижалар бўлагини текшириш ва норма/ҳолатни вектор шаклида ҳисоблаш"""
+    columns = profile['columns']
+    data = pd.DataFrame({field: _import_field(frame, columns, field) for field in IMPORT_FIELDS['results']})
+    data['parameter_code'] = data['parameter_code'].str.upper()
+    raw_values = data['result_value'].str.replace(',', '.', regex=False) if profile['decimal'] == ',' \
+        else data['result_value']
+    values = pd.to_numeric(raw_values, errors='coerce')
+    test_date = parse_import_dates(data['test_date'], profile['date_format'])
+    patient = patients.reindex(data['patient_id'].to_numpy())
+    patient.index = data.index
+    birth = pd.to_datetime(patient['birth_date'], format='%Y-%m-%d', errors='coerce')
+    parameters = pd.DataFrame(cached_parameters(conn), columns=['code', 'name', 'unit', 'default_min', 'default_max',
+                                                               'category', 'formula']).set_index('code')
+    parameter = parameters.reindex(data['parameter_code'].to_numpy())
+    parameter.index = data.index
+    upper = parameter['default_max'].fillna(1).clip(lower=1) * IMPORT_VALUE_FACTOR
+    errors = _first_error([
+        (patient['id'].isna(), "бемор топилмади"),
+        (parameter['name'].isna(), "параметр коди номаълум"),
+        (values.isna() | ~np.isfinite(values.fillna(0)), "қиймат сон эмас"),
+        ((values < 0) & (parameter['default_min'].fillna(0) >= 0), "манфий қиймат"),
+        (values > upper, "қиймат оралиқдан ташқарида"),
+        (test_date.isna(), "сана нотўғри"),
+        (test_date > pd.Timestamp(date.today() + timedelta(days=1)), "сана келажакда"),
+        (test_date < birth, "сана туғилишдан олдин"),
+    ], frame.index)
+
+    valid = errors.eq('')
+    data = data[valid].copy()
+    data['patient_id'] = patient.loc[valid, 'id'].astype('int64')
+    data['result_value'] = values[valid]
+    data['test_date'] = test_date[valid].dt.strftime('%Y-%m-%d')
+    data['test_type'] = parameter.loc[valid, 'category']
+    data['unit'] = data['unit'].where(data['unit'].ne(''), parameter.loc[valid, 'unit'])
+    ages = ((test_date[valid] - birth[valid]).dt.days // 365).to_numpy()
+    genders = patient.loc[valid, 'gender'].to_numpy(dtype=object)
+    phases = data['menstrual_phase'].replace('', None).to_numpy(dtype=object)
+    data['reference_min'] = np.nan
+    data['reference_max'] = np.nan
+    # Нормалар параметр бўйича бир марта олиниб, бутун гуруҳга қўлланади
+    for code, positions in data.groupby('parameter_code').indices.items():
+        ref_min, ref_max = resolve_references_vectorized(
+            conn, code, ages[positions], genders[positions], phases[positions],
+            parameters.at[code, 'default_min'], parameters.at[code, 'default_max'])
+        data.iloc[positions, data.columns.get_loc('reference_min')] = ref_min
+        data.iloc[positions, data.columns.get_loc('reference_max')] = ref_max
+    data['status'] = classify_results_vectorized(data['result_value'].to_numpy(), data['reference_min'].to_numpy(),
+                                                 data['reference_max'].to_numpy())
+    return data, errors
+
+def load_result_chunk(conn, data: pd.DataFrame) -> int:
+    """Тарихий натижаларни ёзиш: QC тўсиғи, огоҳлантиришлар ва дельта текширувисиз"""
+    rows = data.assign(
+        reference_min=data['reference_min'].astype(object).where(data['reference_min'].notna(), None),
+        reference_max=data['reference_max'].astype(object).where(data['reference_max'].notna(), None),
+        notes=data['notes'].replace('', None), menstrual_phase=data['menstrual_phase'].replace('', None),
+    )[['patient_id', 'test_type', 'parameter_code', 'result_value', 'unit', 'reference_min', 'reference_max',
+       'status', 'test_date', 'notes', 'menstrual_phase']]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany('''
+            INSERT INTO test_results
+            (patient_id, test_type, parameter_code, result_value, unit, reference_min, reference_max,
+             status, test_date, notes, menstrual_phase)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows.itertuples(index=False, name=None))
+        latest = data.sort_values('test_date').drop_duplicates(['patient_id', 'parameter_code'], keep='last')
+        conn.executemany('''
+            INSERT INTO latest_results (patient_id, parameter_code, result_value, test_date)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (patient_id, parameter_code) DO UPDATE SET
+                result_value = excluded.result_value,
+                test_date = excluded.test_date
+            WHERE excluded.test_date >= latest_results.test_date
+        ''', latest[['patient_id', 'parameter_code', 'result_value', 'test_date']].itertuples(index=False, name=None))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+def import_patient_lookup(conn) -> pd.DataFrame:
+    """Бемор ID → (ички id, туғилган сана, жинс) жадвали — натижалар импорти учун бир марта ўқилади"""
+    patients = pd.read_sql_query("SELECT patient_id, id, birth_date, gender FROM patients", conn)
+    return patients.drop_duplicates('patient_id').set_index('patient_id')
+
+def _defer_indexes(conn, table: str) -> List[str]:
+    """Иккиламчи индексларни ўчириб, уларни қайта яратиш SQL ларини қайтариш"""
+    # Индекслар бутун база учун ўчади: бу вақтда бошқа сессиялар сўровлари жадвални тўлиқ кўриб чиқади,
+    # шунинг учун фақат илова тўхтатилган техник хизмат режимида ишлатилади
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                           "AND sql IS NOT NULL", (table,)).fetchall()
+    for name, _ in indexes:
+        conn.execute(f"DROP INDEX {name}")
+    conn.commit()
+    return [sql for _, sql in indexes]
+
+def run_bulk_import(conn, source, file_name: str, profile: Dict, errors_path: Optional[str] = None,
+                    chunk_rows: int = IMPORT_CHUNK_ROWS, defer_indexes: bool = False, progress=None) -> Dict:
+    """Файлни бўлаклаб текшириш ва ёзиш; рад этилган қаторлар сабаби билан errors_path га ёзилади"""
+    kind = profile['kind']
+    summary = {'kind': kind, 'read': 0, 'imported': 0, 'rejected': 0, 'reasons': collections.Counter(),
+               'errors_path': errors_path}
+    started = time.perf_counter()
+    patients = import_patient_lookup(conn) if kind == 'results' else None
+    deferred = _defer_indexes(conn, 'test_results') if kind == 'results' and defer_indexes else []
+    errors_file = open(errors_path, 'w', encoding='utf-8-sig', newline='') if errors_path else None
+    try:
+        for frame in read_import_chunks(source, file_name, profile, chunk_rows):
+            # Манба қатор рақами (сарлавҳа 1-қатор)
+            frame.index = pd.RangeIndex(summary['read'] + 2, summary['read'] + 2 + len(frame))
+            if kind == 'patients':
+                data, errors = validate_patient_chunk(conn, frame, profile)
+                summary['imported'] += load_patient_chunk(conn, data[errors.eq('')].copy())
+            else:
+                data, errors = validate_result_chunk(conn, frame, profile, patients)
+                summary['imported'] += load_result_chunk(conn, data)
+            rejected = errors.ne('')
+            if rejected.any():
+                summary['rejected'] += int(rejected.sum())
+                summary['reasons'].update(errors[rejected].tolist())
+                if errors_file:
+                    # Тузатилган файлни ўша профиль билан қайта импорт қилиш мумкин
+                    frame[rejected].assign(_row=frame.index[rejected], _error=errors[rejected]).to_csv(
+                        errors_file, sep=profile['delimiter'] or ',', index=False, header=errors_file.tell() == 0)
+            summary['read'] += len(frame)
+            if progress:
+                progress(summary)
+    finally:
+        if errors_file:
+            errors_file.close()
+        for sql in deferred:
+            conn.execute(sql)
+        if deferred:
+            conn.commit()
+    if kind == 'patients' and summary['imported']:
+        conn.execute("BEGIN IMMEDIATE")
+        index_patient_keys(conn)
+        conn.commit()
+    elif kind == 'results' and summary['imported']:
+        refresh_cohort_cube(conn)
+    summary['seconds'] = time.perf_counter() - started
+    summary['rows_per_second'] = summary['read'] / summary['seconds'] if summary['seconds'] else 0.0
+    summary['reasons'] = dict(summary['reasons'])
+    get_audit_log().record('import', 'patients' if kind == 'patients' else 'test_results', file_name,
+                           changes={k: v for k, v in summary.items() if k != 'errors_path'})
+    return summary
+
+# =================== ТИЗИМГА КИРИШ ===================
+def login_page():
+    """Кириш саҳифаси"""
+    st.markdown('<h1 class="main-title">🔐 Тиббий тахлиллар тизимига кириш</h1>', unsafe_allow_html=True)
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    
+    with col2:
+        with st.container():
+            st.markdown('<div class="card">', unsafe_allow_html=True)
+            
+            username = st.text_input("👤 Фойдаланувчи номи", key="login_username")
+            password = st.text_input("🔑 Парол", type="password", key="login_password")
+            
+            col_a, col_b = st.columns(2)
+            with col_a:
+                login_btn = st.button("🚪 Тизимга кириш", use_container_width=True)
+                if login_btn:
+                    if username and password:
+                        if db.verify_password(username, password):
+                            st.session_state.logged_in = True
+                            st.session_state.username = username
+                            st.session_state.login_at = time.time()
+                            st.session_state.role = db.get_user(username)[4]
+                            st.success("✅ Муваффақиятли кирилди!")
+                            time.sleep(1)
                             st.rerun()
                         else:
                             st.error("❌ Нотўғри фойдаланувчи номи ёки парол")
@@ -407,25 +6069,35 @@ def main_page():
             "🏠 Асосий саҳифа",
             "👥 Беморлар бошқаруви",
             "📊 Тахлил натижалари",
+            "🗂️ Иш рўйхати",
+            "🧪 Намуналар",
             "⚙️ Созламалар",
             "📋 Бланка шаблонлари",
             "📈 Ҳисоботлар",
             "👨‍⚕️ Шифокорлар",
+            "🔌 Анализаторлар",
+            "🎯 Сифат назорати",
+            "📥 Оммавий импорт",
             "🔧 Система созламалари"
         ]
         
         menu_option = st.selectbox("📋 Меню", menu_options, key="main_menu")
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            get_session_registry().set_page(ctx.session_id, menu_option)
+        
+        # Профиллаш фақат администратор учун, сессия бўйича ёқилади
+        if st.session_state.get('role') == 'admin':
+            st.checkbox("🔬 Профиллаш", key="profiling",
+                        help="Ҳар бир саҳифа cProfile ва tracemalloc остида бажарилади")
         
         st.markdown("---")
         
         # Тезиклик статистика
-        cursor = db.get_cursor()
         try:
-            cursor.execute("SELECT COUNT(*) FROM patients")
-            patient_count = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM test_results WHERE DATE(test_date) = DATE('now')")
-            today_tests = cursor.fetchone()[0]
+            counts = cached_dashboard_counts()
+            patient_count = counts['patients']
+            today_tests = counts['today_tests']
         except:
             patient_count = 0
             today_tests = 0
@@ -454,22 +6126,33 @@ def main_page():
             st.rerun()
     
     # Асосий контент
-    if menu_option == "🏠 Асосий саҳифа":
-        show_dashboard()
-    elif menu_option == "👥 Беморлар бошқаруви":
-        manage_patients()
-    elif menu_option == "📊 Тахлил натижалари":
-        manage_test_results()
-    elif menu_option == "⚙️ Созламалар":
-        manage_settings()
-    elif menu_option == "📋 Бланка шаблонлари":
-        manage_templates()
-    elif menu_option == "📈 Ҳисоботлар":
-        show_reports()
-    elif menu_option == "👨‍⚕️ Шифокорлар":
-        manage_doctors()
-    elif menu_option == "🔧 Система созламалари":
-        system_settings()
+    pages = {
+        "🏠 Асосий саҳифа": show_dashboard,
+        "👥 Беморлар бошқаруви": manage_patients,
+        "📊 Тахлил натижалари": manage_test_results,
+        "🗂️ Иш рўйхати": manage_worklist,
+        "🧪 Намуналар": manage_specimens,
+        "⚙️ Созламалар": manage_settings,
+        "📋 Бланка шаблонлари": manage_templates,
+        "📈 Ҳисоботлар": show_reports,
+        "👨‍⚕️ Шифокорлар": manage_doctors,
+        "🔌 Анализаторлар": manage_analyzers,
+        "🎯 Сифат назорати": manage_quality_control,
+        "📥 Оммавий импорт": manage_bulk_import,
+        "🔧 Система созламалари": system_settings
+    }
+    get_metrics().page_renders.inc(1, menu_option)
+    if st.session_state.get('profiling') and st.session_state.get('role') == 'admin':
+        try:
+            run_profiled(pages[menu_option], menu_option)
+        finally:
+            store = get_profile_store()
+            if store.profiles:
+                last = store.profiles[-1]
+                st.sidebar.caption(f"🔬 #{last['id']}: {last['wall_ms']:.0f} мс, CPU {last['cpu_ms']:.0f} мс, "
+                                   f"{last['peak_mb']:.1f} МБ")
+    else:
+        pages[menu_option]()
 
 # =================== АСОСИЙ ПАНЕЛЬ ===================
 def show_dashboard():
@@ -480,10 +6163,10 @@ def show_dashboard():
     col1, col2, col3, col4 = st.columns(4)
     
     cursor = db.get_cursor()
+    counts = cached_dashboard_counts()
     
     with col1:
-        cursor.execute("SELECT COUNT(*) FROM patients")
-        total_patients = cursor.fetchone()[0]
+        total_patients = counts['patients']
         st.markdown(f"""
         <div class="metric-card">
             <h3>👥</h3>
@@ -493,8 +6176,7 @@ def show_dashboard():
         """, unsafe_allow_html=True)
     
     with col2:
-        cursor.execute("SELECT COUNT(*) FROM test_results")
-        total_tests = cursor.fetchone()[0]
+        total_tests = counts['tests'] + db.get_config('archived_results', 0)
         st.markdown(f"""
         <div class="metric-card" style="background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);">
             <h3>📊</h3>
@@ -504,9 +6186,7 @@ def show_dashboard():
         """, unsafe_allow_html=True)
     
     with col3:
-        cursor.execute("SELECT COUNT(DISTINCT patient_id) FROM test_results WHERE DATE(test_date) = DATE('now')")
-        result = cursor.fetchone()
-        today_patients = result[0] if result else 0
+        today_patients = counts['today_patients']
         st.markdown(f"""
         <div class="metric-card" style="background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%);">
             <h3>📅</h3>
@@ -516,13 +6196,7 @@ def show_dashboard():
         """, unsafe_allow_html=True)
     
     with col4:
-        cursor.execute("""
-            SELECT COUNT(*) FROM test_results 
-            WHERE status != 'normal' 
-            AND DATE(test_date) = DATE('now')
-        """)
-        result = cursor.fetchone()
-        abnormal_today = result[0] if result else 0
+        abnormal_today = counts['today_abnormal']
         st.markdown(f"""
         <div class="metric-card" style="background: linear-gradient(135deg, #43e97b 0%, #38f9d7 100%);">
             <h3>⚠️</h3>
@@ -536,34 +6210,19 @@ def show_dashboard():
     # Охирги тахлиллар
     st.markdown('<h3 class="section-title">🔄 Охирги тахлил натижалари</h3>', unsafe_allow_html=True)
     
-    cursor.execute("""
+    df = read_typed_frame(db.conn, """
         SELECT p.full_name, tr.test_type, tr.parameter_code, tr.result_value, 
                tr.unit, tr.status, tr.test_date
         FROM test_results tr
         JOIN patients p ON tr.patient_id = p.id
         ORDER BY tr.created_at DESC
         LIMIT 10
-    """)
-    
-    recent_tests = cursor.fetchall()
+    """, (), ['full_name', 'test_type', 'parameter_code', 'result_value', 'unit', 'status', 'test_date'])
     
-    if recent_tests:
-        df = pd.DataFrame(recent_tests, columns=[
-            'Бемор', 'Тахлил тури', 'Параметр', 'Қиймат', 
-            'Ўлчов бирлиги', 'Холат', 'Сана'
-        ])
-        
+    if not df.empty:
         # Холатга қараб ранг бериш
-        def color_status(val):
-            if val == 'normal':
-                return 'background-color: #E8F8F5; color: #27AE60; font-weight: bold;'
-            elif val == 'low':
-                return 'background-color: #FFF3CD; color: #856404; font-weight: bold;'
-            else:
-                return 'background-color: #F8D7DA; color: #721C24; font-weight: bold;'
-        
-        styled_df = df.style.applymap(color_status, subset=['Холат'])
-        st.dataframe(styled_df, use_container_width=True, height=400)
+        styled_df = df.style.apply(status_styles, subset=['Холат'])
+        st.dataframe(styled_df, use_container_width=True, height=400, column_config=frame_column_config(df))
     else:
         st.info("📭 Ҳали тахлил натижалари мавжуд эмас")
         
@@ -597,7 +6256,7 @@ def manage_patients():
     """Беморлар бошқаруви"""
     st.markdown('<h1 class="section-title">👥 Беморлар бошқаруви</h1>', unsafe_allow_html=True)
     
-    tab1, tab2, tab3 = st.tabs(["🎯 Янги бемор", "📋 Беморлар рўйхати", "🔍 Беморни излаш"])
+    tab1, tab2, tab3, tab4 = st.tabs(["🎯 Янги бемор", "📋 Беморлар рўйхати", "🔍 Беморни излаш", "🧬 Такрорийлар"])
     
     with tab1:
         st.markdown("### 🆕 Янги бемор қўшиш")
@@ -613,29 +6272,48 @@ def manage_patients():
             with col2:
                 phone = st.text_input("📞 Телефон рақами")
                 address = st.text_area("🏠 Манзил")
-                patient_id = st.text_input("🆔 Бемор ID", 
-                                         value=f"P-{datetime.now().strftime('%Y%m%d')}-{np.random.randint(1000,9999)}")
+                patient_id = st.text_input("🆔 Бемор ID", placeholder=f"{patient_id_prefix()}… (автоматик)",
+                                           help="Бўш қолдирилса, кунлик кетма-кетликдан берилади")
             
             submitted = st.form_submit_button("💾 Сақлаш", use_container_width=True)
             
             if submitted:
                 if full_name and birth_date and gender:
-                    cursor = db.get_cursor()
-                    try:
-                        cursor.execute('''
-                            INSERT INTO patients 
-                            (patient_id, full_name, birth_date, gender, phone, address)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        ''', (patient_id, full_name, birth_date, gender, phone, address))
-                        db.conn.commit()
-                        st.success(f"✅ Бемор {full_name} муваффақиятли қўшилди!")
-                        st.rerun()
-                    except sqlite3.IntegrityError:
-                        st.error("❌ Бундай Бемор ID аллақачон мавжуд")
-                    except Exception as e:
-                        st.error(f"❌ Хатолик: {str(e)}")
+                    st.session_state.pending_patient = {
+                        'full_name': full_name, 'birth_date': birth_date, 'gender': gender,
+                        'phone': phone, 'address': address, 'patient_id': patient_id.strip() or None,
+                    }
+                    st.session_state.pending_matches = match_new_patient(db.conn, full_name, birth_date, phone, gender)
                 else:
                     st.error("⚠️ * белгиланган майдонларни тўлдиринг")
+        
+        # Рўйхатга олишдан олдин индекс бўйича ўхшаш беморлар текширилади
+        pending = st.session_state.get('pending_patient')
+        if pending:
+            matches = st.session_state.get('pending_matches', [])
+            confirmed = False
+            if matches:
+                st.warning(f"⚠️ {pending['full_name']} га ўхшаш {len(matches)} та бемор мавжуд")
+                st.dataframe(pd.DataFrame([m[1:] for m in matches], columns=[
+                    'Бемор ID', 'Исми', 'Туғилган сана', 'Телефон', 'Жинси', 'Ўхшашлик'
+                ]), use_container_width=True, hide_index=True)
+                col_save, col_cancel = st.columns(2)
+                with col_save:
+                    confirmed = st.button("💾 Барибир янги бемор сифатида сақлаш", use_container_width=True)
+                with col_cancel:
+                    if st.button("❌ Бекор қилиш", use_container_width=True):
+                        del st.session_state.pending_patient
+                        st.rerun()
+            if not matches or confirmed:
+                del st.session_state.pending_patient
+                try:
+                    with db.write_connection() as writer:
+                        patient_id = register_patient(writer, **pending)
+                    st.success(f"✅ Бемор {pending['full_name']} муваффақиятли қўшилди! ID: {patient_id}")
+                except sqlite3.IntegrityError:
+                    st.error("❌ Бундай Бемор ID аллақачон мавжуд")
+                except Exception as e:
+                    st.error(f"❌ Хатолик: {str(e)}")
     
     with tab2:
         st.markdown("### 📋 Беморлар рўйхати")
@@ -706,38 +6384,37 @@ def manage_patients():
                         col_save, col_delete = st.columns(2)
                         with col_save:
                             if st.button("💾 Ўзгартиришларни сақлаш", use_container_width=True):
+                                before = audit_row(db.conn, 'patients', selected_id)
                                 cursor.execute('''
                                     UPDATE patients 
                                     SET full_name = ?, birth_date = ?, gender = ?, phone = ?, address = ?
                                     WHERE id = ?
                                 ''', (edit_name, edit_birth_date, edit_gender, edit_phone, edit_address, selected_id))
+                                index_patient_keys(db.conn, [selected_id])
                                 db.conn.commit()
+                                get_audit_log().record('update', 'patient', selected_id, before=before, after={
+                                    **before, 'full_name': edit_name, 'birth_date': edit_birth_date,
+                                    'gender': edit_gender, 'phone': edit_phone, 'address': edit_address})
                                 st.success("✅ Бемор маълумотлари янгиланди!")
                                 st.rerun()
                         
                         with col_delete:
                             if st.button("🗑️ Беморни ўчириш", use_container_width=True):
-                                cursor.execute("DELETE FROM patients WHERE id = ?", (selected_id,))
-                                db.conn.commit()
-                                st.success("✅ Бемор ўчирилди!")
-                                st.rerun()
+                                try:
+                                    with db.write_connection() as writer:
+                                        removed = delete_patient(writer, selected_id,
+                                                                 deleted_by=st.session_state.username)
+                                    st.success(f"✅ Бемор ўчирилди! Боғланган ёзувлар: {sum(removed.values())}")
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"❌ Хатолик: {str(e)}")
         else:
             st.info("📭 Ҳали беморлар мавжуд эмас")
             
             # Намуна бемор қўшиш
             if st.button("Намуна бемор қўшиш"):
-                cursor.execute('''
-                    INSERT INTO patients (patient_id, full_name, birth_date, gender, phone, address)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    f"P-{datetime.now().strftime('%Y%m%d')}-0001",
-                    "Намуна Бемор",
-                    "1990-01-01",
-                    "Эркак",
-                    "+99890 123-45-67",
-                    "Тошкент ш."
-                ))
-                db.conn.commit()
+                with db.write_connection() as writer:
+                    register_patient(writer, "Намуна Бемор", "1990-01-01", "Эркак", "+99890 123-45-67", "Тошкент ш.")
                 st.success("✅ Намуна бемор қўшилди!")
                 st.rerun()
     
@@ -786,6 +6463,52 @@ def manage_patients():
                     st.error(f"Хатолик: {str(e)}")
             else:
                 st.warning("Қидирув қийматини киритинг")
+    
+    with tab4:
+        st.markdown("### 🧬 Такрорий беморлар")
+        
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            threshold = st.slider("Ўхшашлик чегараси", 0.6, 1.0, DUPLICATE_THRESHOLD, 0.01)
+        with col2:
+            if st.button("🔍 Излаш", use_container_width=True, key="find_duplicates"):
+                started = time.perf_counter()
+                st.session_state.duplicate_pairs = find_duplicate_patients(db.conn, threshold)
+                st.session_state.duplicate_scan_time = time.perf_counter() - started
+        
+        pairs = st.session_state.get('duplicate_pairs')
+        if pairs is not None:
+            if pairs.empty:
+                st.success("✅ Такрорий беморлар топилмади")
+            else:
+                st.info(f"🧬 {len(pairs)} та жуфтлик топилди ({st.session_state.duplicate_scan_time:.2f} с)")
+                ids = pd.unique(pairs[['keep_id', 'merge_id']].values.ravel()).tolist()
+                names = pd.read_sql_query(
+                    f"SELECT id, patient_id, full_name, birth_date, phone FROM patients WHERE id IN ({','.join('?' * len(ids))})",
+                    db.conn, params=ids).set_index('id')
+                label = lambda i: (f"{names.at[i, 'full_name']} ({names.at[i, 'patient_id']}, {names.at[i, 'birth_date']})"
+                                   if i in names.index else f"#{i}")
+                pairs = pairs[pairs['keep_id'].isin(names.index) & pairs['merge_id'].isin(names.index)]
+                st.dataframe(pd.DataFrame({
+                    'Бемор 1': pairs['keep_id'].map(label),
+                    'Бемор 2': pairs['merge_id'].map(label),
+                    'Ўхшашлик': pairs['score'],
+                }), use_container_width=True, hide_index=True)
+                
+                if not pairs.empty:
+                    pair = st.selectbox("Жуфтлик", pairs.index.tolist(),
+                                        format_func=lambda i: f"{label(pairs.at[i, 'keep_id'])} ↔ {label(pairs.at[i, 'merge_id'])}")
+                    first, second = int(pairs.at[pair, 'keep_id']), int(pairs.at[pair, 'merge_id'])
+                    keep_id = st.radio("Сақланадиган бемор", [first, second], format_func=label, horizontal=True)
+                    merge_id = second if keep_id == first else first
+                    if st.button("🔗 Бирлаштириш", use_container_width=True):
+                        try:
+                            with db.write_connection() as writer:
+                                moved = merge_patients(writer, keep_id, merge_id, st.session_state.username)
+                            st.session_state.duplicate_pairs = pairs.drop(pair)
+                            st.success(f"✅ Беморлар бирлаштирилди: {sum(moved.values())} та ёзув кўчирилди")
+                        except Exception as e:
+                            st.error(f"❌ Хатолик: {str(e)}")
 
 # =================== ТАХЛИЛ НАТИЖАЛАРИ ===================
 def manage_test_results():
@@ -850,13 +6573,8 @@ def manage_test_results():
         )
         
         # Параметрларни танлаш
-        cursor.execute("""
-            SELECT parameter_code, parameter_name, unit, default_min_value, default_max_value
-            FROM test_parameters 
-            WHERE category = ? OR category = 'Бошқа'
-            ORDER BY parameter_name
-        """, (test_type,))
-        parameters = cursor.fetchall()
+        parameters = [p[:5] for p in cached_parameters()
+                      if p[5] in (test_type, 'Бошқа') and not (p[6] or '').strip()]
         
         if not parameters:
             st.warning("⚠️ Бу тахлил тури учун параметрлар мавжуд эмас")
@@ -882,6 +6600,21 @@ def manage_test_results():
                 st.rerun()
             return
         
+        # Беморнинг шу тур бўйича очиқ буюртмаси
+        cursor.execute(f'''
+            SELECT id, priority, parameter_codes, created_at FROM orders
+            WHERE patient_id = ? AND category = ? AND status IN ({','.join('?' * len(ORDER_OPEN_STATUSES))})
+            ORDER BY priority_rank, id
+        ''', (patient_id, test_type, *ORDER_OPEN_STATUSES))
+        open_orders = cursor.fetchall()
+        order_id = None
+        if open_orders:
+            order_options = {"": None, **{
+                f"#{o[0]} {ORDER_PRIORITY_LABELS[o[1]]} — {', '.join(json.loads(o[2]))} ({o[3]})": o[0]
+                for o in open_orders
+            }}
+            order_id = order_options[st.selectbox("📦 Буюртма", list(order_options.keys()), index=1)]
+        
         # Тахлил натижаларини киритиш
         st.markdown("### 📝 Натижаларни киритиш")
         
@@ -889,6 +6622,10 @@ def manage_test_results():
         test_date = st.date_input("📅 Тахлил санаси", value=date.today())
         notes = st.text_area("📝 Изохлар")
         
+        # Бутун панел учун олдинги қийматлар битта сўровда
+        delta_baselines = fetch_delta_baselines(db.conn, [(patient_id, p[0]) for p in parameters])
+        critical_limits = load_critical_limits(db.conn, {p[0] for p in parameters})
+        
         for param in parameters:
             param_code, param_name, unit, default_min, default_max = param
             
@@ -896,65 +6633,46 @@ def manage_test_results():
                 col1, col2, col3 = st.columns([2, 2, 1])
                 
                 with col1:
+                    # Бўш майдон киритилмаган ҳисобланади — 0.0 ҳақиқий (масалан, критик) қиймат бўлиши мумкин
                     result_value = st.number_input(
                         f"{param_name} ({unit})",
                         min_value=0.0,
                         max_value=10000.0,
-                        value=0.0,
+                        value=None,
                         step=0.1,
                         key=f"value_{param_code}_{patient_id}"
                     )
                 
                 with col2:
                     # Нормаларни олиш
-                    cursor.execute('''
-                        SELECT min_value, max_value FROM age_gender_norms
-                        WHERE parameter_code = ? 
-                        AND (age_min <= ? OR age_min IS NULL)
-                        AND (age_max >= ? OR age_max IS NULL)
-                        AND (gender = ? OR gender IS NULL)
-                        AND (menstrual_phase = ? OR menstrual_phase IS NULL)
-                        LIMIT 1
-                    ''', (param_code, age, age, gender, menstrual_phase))
-                    
-                    norm = cursor.fetchone()
-                    
-                    if norm and norm[0] is not None and norm[1] is not None:
-                        min_val, max_val = norm
+                    min_val, max_val = db.find_reference(
+                        cursor, param_code, age, gender, menstrual_phase, default_min, default_max)
+                    if min_val is not None:
                         st.info(f"**Норма:** {min_val:.2f} - {max_val:.2f} {unit}")
-                        
-                        # Холатни аниклаш
-                        if result_value < min_val:
-                            status = "low"
-                            status_text = "⬇️ Паст"
-                        elif result_value > max_val:
-                            status = "high"
-                            status_text = "⬆️ Юқори"
-                        else:
-                            status = "normal"
-                            status_text = "✅ Норма"
+                    
+                    # Холатни аниклаш
+                    if result_value is not None:
+                        status = classify_result(result_value, min_val, max_val)
+                        status_text = STATUS_LABELS[status]
                     else:
-                        if default_min is not None and default_max is not None:
-                            min_val, max_val = default_min, default_max
-                            st.info(f"**Норма:** {default_min:.2f} - {default_max:.2f} {unit}")
-                            
-                            if result_value < default_min:
-                                status = "low"
-                                status_text = "⬇️ Паст"
-                            elif result_value > default_max:
-                                status = "high"
-                                status_text = "⬆️ Юқори"
-                            else:
-                                status = "normal"
-                                status_text = "✅ Норма"
-                        else:
-                            min_val, max_val = None, None
-                            status = "unknown"
-                            status_text = "❓ Норма номаълум"
+                        status, status_text = None, "—"
+                
+                delta_flag = None
+                critical = None
+                if result_value is not None:
+                    delta_flag = evaluate_delta(delta_baselines.get((patient_id, param_code)), result_value, test_date)
+                    if param_code in critical_limits:
+                        critical = critical_kind(result_value, *critical_limits[param_code])
                 
                 with col3:
                     st.markdown(f"**Холат:**<br>{status_text}", unsafe_allow_html=True)
+                    if critical:
+                        st.markdown("🚨 <span style='color:#C0392B'><b>Критик қиймат</b></span>", unsafe_allow_html=True)
+                    if delta_flag:
+                        st.markdown(f"🔀 <span style='color:#E67E22'>{delta_flag}</span>", unsafe_allow_html=True)
                 
+                if result_value is None:
+                    continue
                 results.append({
                     'parameter_code': param_code,
                     'parameter_name': param_name,
@@ -962,34 +6680,88 @@ def manage_test_results():
                     'unit': unit,
                     'status': status,
                     'status_text': status_text,
-                    'min_value': min_val if 'min_val' in locals() and min_val is not None else default_min,
-                    'max_value': max_val if 'max_val' in locals() and max_val is not None else default_max
+                    'min_value': min_val,
+                    'max_value': max_val,
+                    'delta_flag': delta_flag
                 })
         
+        # Ҳисобланадиган кўрсаткичлар: панел қийматлари, етишмаганлари шу кунги охирги натижалардан
+        try:
+            formula_engine = FormulaEngine(db.conn)
+        except ValueError as e:
+            formula_engine = None
+            st.warning(f"⚠️ {str(e)}")
+        if formula_engine and formula_engine.parameters:
+            panel_values = {r['parameter_code']: r['result_value'] for r in results}
+            cursor.execute(
+                "SELECT parameter_code, result_value FROM latest_results WHERE patient_id = ? AND test_date = ?",
+                (patient_id, str(test_date))
+            )
+            same_day = {code: value for code, value in cursor.fetchall() if value is not None}
+            calculated = formula_engine.evaluate(
+                {**same_day, **panel_values}, age, 1.0 if gender == "Аёл" else 0.0)
+            calculated = {code: float(value) for code, value in calculated.items()
+                          if np.isfinite(value) and formula_engine.inputs_for([code]) & panel_values.keys()}
+            if calculated:
+                st.markdown("### 🧮 Ҳисобланган кўрсаткичлар")
+                for code, value in calculated.items():
+                    info = formula_engine.parameters[code]
+                    min_val, max_val = db.find_reference(
+                        cursor, code, age, gender, menstrual_phase, info['default_min'], info['default_max'])
+                    status = classify_result(value, min_val, max_val)
+                    col1, col2, col3 = st.columns([2, 2, 1])
+                    col1.metric(f"{info['name']} ({info['unit']})", f"{value:.2f}")
+                    if min_val is not None:
+                        col2.info(f"**Норма:** {min_val:.2f} - {max_val:.2f} {info['unit']}")
+                    col3.markdown(f"**Холат:**<br>{STATUS_LABELS[status]}", unsafe_allow_html=True)
+                    results.append({
+                        'parameter_code': code,
+                        'parameter_name': info['name'],
+                        'result_value': round(value, 3),
+                        'unit': info['unit'],
+                        'status': status,
+                        'status_text': STATUS_LABELS[status],
+                        'min_value': min_val,
+                        'max_value': max_val,
+                        'delta_flag': evaluate_delta(
+                            fetch_delta_baselines(db.conn, [(patient_id, code)]).get((patient_id, code)),
+                            value, test_date)
+                    })
+        
         # Сақлаш
         if st.button("💾 Тахлил натижаларини сақлаш", use_container_width=True):
-            success_count = 0
-            for result in results:
+            if not results:
+                st.warning("⚠️ Камида битта натижа киритинг")
+            else:
+                rows = [{
+                    'patient_id': patient_id,
+                    'test_type': test_type,
+                    'parameter_code': result['parameter_code'],
+                    'result_value': result['result_value'],
+                    'unit': result['unit'],
+                    'reference_min': result['min_value'],
+                    'reference_max': result['max_value'],
+                    'status': result['status'],
+                    'test_date': test_date,
+                    'notes': notes,
+                    'menstrual_phase': menstrual_phase,
+                    'delta_flag': result['delta_flag'],
+                    'order_id': order_id
+                } for result in results]
                 try:
-                    cursor.execute('''
-                        INSERT INTO test_results 
-                        (patient_id, test_type, parameter_code, result_value, 
-                         unit, reference_min, reference_max, status, test_date, notes)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        patient_id, test_type, result['parameter_code'], 
-                        result['result_value'], result['unit'],
-                        result['min_value'], result['max_value'],
-                        result['status'], test_date, notes
-                    ))
-                    success_count += 1
-                except Exception as e:
-                    st.error(f"Хатолик {result['parameter_name']} учун: {str(e)}")
-            
-            if success_count > 0:
-                db.conn.commit()
-                st.success(f"✅ {success_count} та тахлил натижалари муваффақиятли сақланди!")
-                st.rerun()
+                    success_count = db.insert_test_results(rows)
+                    get_audit_log().record('create', 'test_results', patient_id, changes={
+                        r['parameter_code']: [None, r['result_value']] for r in rows} | {'test_date': [None, test_date]})
+                    st.success(f"✅ {success_count} та тахлил натижалари муваффақиятли сақланди!")
+                    if any(critical_kind(r['result_value'], *critical_limits[r['parameter_code']])
+                           for r in results if r['parameter_code'] in critical_limits):
+                        st.warning("🚨 Критик натижалар огоҳлантириш навбатига қўшилди")
+                    st.rerun()
+                except QCReleaseBlocked as e:
+                    st.error(f"⛔ {str(e)}. Натижалар сақланмади — назорат материалини қайта ўлчанг.")
+                except sqlite3.Error as e:
+                    db.conn.rollback()
+                    st.error(f"Хатолик: {str(e)}")
     
     with tab2:
         st.markdown("### 📋 Тахлил натижалари рўйхати")
@@ -1011,10 +6783,11 @@ def manage_test_results():
         
         # Натижаларни олиш
         try:
-            query = """
+            source = get_archive_manager().results_source(db.conn, start_date)
+            query = f"""
                 SELECT p.full_name, tr.test_type, tr.parameter_code, 
-                       tr.result_value, tr.unit, tr.status, tr.test_date
-                FROM test_results tr
+                       tr.result_value, tr.unit, tr.status, tr.test_date, tr.delta_flag
+                FROM {source} tr
                 JOIN patients p ON tr.patient_id = p.id
                 WHERE tr.test_date BETWEEN ? AND ?
             """
@@ -1027,14 +6800,14 @@ def manage_test_results():
             
             query += " ORDER BY tr.test_date DESC"
             
-            cursor.execute(query, params)
-            results = cursor.fetchall()
+            df = read_typed_frame(db.conn, query, params, [
+                'full_name', 'test_type', 'parameter_code', 'result_value', 'unit', 'status', 'test_date',
+                'delta_flag'
+            ])
             
-            if results:
-                df = pd.DataFrame(results, columns=[
-                    'Бемор', 'Тахлил тури', 'Параметр', 'Қиймат', 
-                    'Ўлчов бирлиги', 'Холат', 'Сана'
-                ])
+            if not df.empty:
+                # Хотира ҳисоботи филтрдан олдинги тўлиқ жадвал бўйича
+                memory_caption = frame_memory_caption(df)
                 
                 # Фильтр қўшиш
                 col_search, col_status = st.columns(2)
@@ -1046,14 +6819,18 @@ def manage_test_results():
                                               ["Ҳаммаси", "Норма", "Паст", "Юқори", "Номаълум"])
                 
                 if patient_filter:
-                    df = df[df['Бемор'].str.contains(patient_filter, case=False, na=False)]
+                    # Қидирув ҳар бир қаторда эмас, фақат ноёб исмларда бажарилади
+                    names = df['Бемор'].cat.categories
+                    matched = np.flatnonzero(names.str.contains(patient_filter, case=False, regex=False))
+                    df = df[df['Бемор'].cat.codes.isin(matched)]
                 
                 if status_filter != "Ҳаммаси":
                     status_map = {"Норма": "normal", "Паст": "low", "Юқори": "high", "Номаълум": "unknown"}
                     df = df[df['Холат'] == status_map[status_filter]]
                 
                 if not df.empty:
-                    st.dataframe(df, use_container_width=True, height=500)
+                    st.dataframe(df, use_container_width=True, height=500, column_config=frame_column_config(df))
+                    st.caption(memory_caption)
                     
                     # Статистика
                     st.markdown("### 📈 Статистика")
@@ -1098,14 +6875,17 @@ def manage_test_results():
             start_date = date(2000, 1, 1)
         
         # Маълумотларни олиш
+        snapshot_conn = snapshot_banner("snapshot_refresh_stats")
         try:
-            cursor.execute("""
+            source = get_archive_manager().results_source(snapshot_conn, start_date)
+            cursor = snapshot_conn.cursor()
+            cursor.execute(f"""
                 SELECT 
                     test_type,
                     COUNT(*) as total,
                     SUM(CASE WHEN status = 'normal' THEN 1 ELSE 0 END) as normal,
                     SUM(CASE WHEN status != 'normal' THEN 1 ELSE 0 END) as abnormal
-                FROM test_results
+                FROM {source}
                 WHERE test_date >= ?
                 GROUP BY test_type
                 ORDER BY total DESC
@@ -1137,7 +6917,8 @@ def manage_settings():
     """Тахлил параметрлари ва нормалари созламалари"""
     st.markdown('<h1 class="section-title">⚙️ Созламалар</h1>', unsafe_allow_html=True)
     
-    tab1, tab2, tab3 = st.tabs(["🔬 Параметрлар", "📏 Нормалар", "📊 Категориялар"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["🔬 Параметрлар", "📏 Нормалар", "📊 Категориялар",
+                                            "🔀 Дельта-текширув", "🚨 Критик қийматлар"])
     
     with tab1:
         st.markdown("### 🔬 Тахлил параметрлари")
@@ -1161,24 +6942,33 @@ def manage_settings():
                     default_min = st.number_input("Стандарт мин. қиймат", value=0.0, format="%.2f")
                     default_max = st.number_input("Стандарт макс. қиймат", value=100.0, format="%.2f")
                 
+                formula = st.text_input("🧮 Формула (ҳисобланадиган параметр учун)",
+                                        help="Масалан: CHOL - HDL - TG / 2.2. AGE ва FEMALE ўзгарувчилари, "
+                                             "min, max, where, log, exp, sqrt функциялари мавжуд")
+                formula = normalize_formula(formula)
+                
                 submitted = st.form_submit_button("💾 Параметр қўшиш")
                 
                 if submitted:
                     if category and parameter_name and parameter_code and unit:
                         cursor = db.get_cursor()
                         try:
+                            if formula:
+                                FormulaEngine.validate(db.conn, parameter_code, formula)
                             cursor.execute('''
                                 INSERT INTO test_parameters 
                                 (category, parameter_name, parameter_code, unit,
                                  gender_specific, menstrual_phase_specific,
-                                 default_min_value, default_max_value)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                 default_min_value, default_max_value, formula)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                             ''', (category, parameter_name, parameter_code, unit,
                                  int(gender_specific), int(menstrual_specific), 
-                                 default_min, default_max))
+                                 default_min, default_max, formula or None))
                             db.conn.commit()
                             st.success("✅ Параметр муваффақиятли қўшилди!")
                             st.rerun()
+                        except ValueError as e:
+                            st.error(f"❌ {str(e)}")
                         except sqlite3.IntegrityError:
                             st.error("❌ Бундай параметр коди аллақачон мавжуд")
                         except Exception as e:
@@ -1200,7 +6990,7 @@ def manage_settings():
             df_params = pd.DataFrame(parameters, columns=[
                 'ID', 'Категория', 'Номи', 'Коди', 'Ўлчов бирлиги',
                 'Мин ёш', 'Макс ёш', 'Жинсга боғлиқ', 'Менструацияга боғлиқ',
-                'Стандарт мин', 'Стандарт макс', 'Яратилган', 'Янгиланган'
+                'Стандарт мин', 'Стандарт макс', 'Яратилган', 'Янгиланган', 'Формула'
             ])
             
             # Филтр
@@ -1234,18 +7024,51 @@ def manage_settings():
                                                     value=float(param[9] if param[9] else 0))
                             new_max = st.number_input("Янги макс. қиймат", 
                                                     value=float(param[10] if param[10] else 100))
+                        new_formula = normalize_formula(st.text_input("🧮 Формула", value=param[13] or ""))
                         
                         if st.button("💾 Ўзгартиришларни сақлаш"):
-                            cursor.execute('''
-                                UPDATE test_parameters 
-                                SET parameter_name = ?, parameter_code = ?, unit = ?,
-                                    default_min_value = ?, default_max_value = ?,
-                                    updated_at = CURRENT_TIMESTAMP
-                                WHERE id = ?
-                            ''', (new_name, new_code, new_unit, new_min, new_max, selected_id))
-                            db.conn.commit()
-                            st.success("✅ Параметр муваффақиятли янгиланди!")
-                            st.rerun()
+                            try:
+                                if new_formula:
+                                    FormulaEngine.validate(db.conn, new_code, new_formula)
+                                before = audit_row(db.conn, 'test_parameters', selected_id)
+                                cursor.execute('''
+                                    UPDATE test_parameters 
+                                    SET parameter_name = ?, parameter_code = ?, unit = ?,
+                                        default_min_value = ?, default_max_value = ?, formula = ?,
+                                        updated_at = CURRENT_TIMESTAMP
+                                    WHERE id = ?
+                                ''', (new_name, new_code, new_unit, new_min, new_max,
+                                      new_formula or None, selected_id))
+                                db.conn.commit()
+                                get_audit_log().record('update', 'parameter', selected_id, before=before,
+                                                       after=audit_row(db.conn, 'test_parameters', selected_id))
+                                st.success("✅ Параметр муваффақиятли янгиланди!")
+                                st.rerun()
+                            except ValueError as e:
+                                st.error(f"❌ {str(e)}")
+            
+            # Ҳисобланадиган параметрларни тарихий натижалар бўйича тўлдириш
+            with st.expander("🧮 Ҳисобланадиган параметрлар"):
+                try:
+                    engine = FormulaEngine(db.conn)
+                except ValueError as e:
+                    engine = None
+                    st.error(f"❌ {str(e)}")
+                if engine and engine.parameters:
+                    st.dataframe(pd.DataFrame([
+                        {'Коди': code, 'Номи': engine.parameters[code]['name'],
+                         'Формула': engine.parameters[code]['formula'],
+                         'Керакли параметрлар': ', '.join(sorted(engine.dependencies[code]))}
+                        for code in engine.order if code in engine.parameters
+                    ]), use_container_width=True, hide_index=True)
+                    backfill_codes = st.multiselect("Тўлдириладиган параметрлар",
+                                                    [c for c in engine.order if c in engine.parameters])
+                    if st.button("🔄 Мавжуд натижалар бўйича ҳисоблаш", key="calc_backfill_btn"):
+                        with st.spinner("Ҳисобланмоқда..."):
+                            summary = backfill_calculated(db, db.conn, backfill_codes or None)
+                        st.success("✅ Қўшилди: " + ", ".join(f"{k}: {v}" for k, v in summary.items()))
+                elif engine:
+                    st.info("📭 Ҳисобланадиган параметрлар мавжуд эмас")
         else:
             st.info("📭 Ҳали параметрлар мавжуд эмас")
     
@@ -1289,13 +7112,55 @@ def manage_settings():
                 with st.expander("🗑️ Нормани ўчириш"):
                     norm_id = st.selectbox("Ўчириш учун норма танланг", df_norms['ID'].tolist())
                     if st.button("Нормани ўчириш", use_container_width=True):
+                        before = audit_row(db.conn, 'age_gender_norms', norm_id)
                         cursor.execute("DELETE FROM age_gender_norms WHERE id = ?", (norm_id,))
                         db.conn.commit()
+                        get_audit_log().record('delete', 'norm', norm_id, before=before)
                         st.success("✅ Норма ўчирилди!")
                         st.rerun()
+                
+                # Параметр нормалари текшируви
+                param_issues = audit_norms(db.conn, [param_code])
+                if any(i['kind'] in NORM_BLOCKING_ISSUES for i in param_issues):
+                    st.error("❌ Нормалар зиддиятли — қидирув натижаси ноаниқ бўлиши мумкин")
+                if param_issues:
+                    with st.expander(f"🔍 Қамров текшируви ({len(param_issues)} та изоҳ)"):
+                        st.dataframe(norm_issues_frame(param_issues), use_container_width=True, hide_index=True)
             else:
                 st.info("⚠️ Ушбу параметр учун нормалар ўрнатилмаган")
             
+            # Популяция асосидаги интерваллар
+            with st.expander("📐 Популяция асосида текшириш"):
+                st.caption(f"Натижалар тарихидан 2.5–97.5 перцентиллар, 90% бутстреп ишонч оралиғи. "
+                           f"Ишончли баҳо учун гуруҳда камида {REFERENCE_MIN_SAMPLES} та қиймат керак.")
+                include_archive = st.checkbox("Архивдаги натижаларни ҳам қўшиш", value=True)
+                if st.button("📐 Интервалларни ҳисоблаш", use_container_width=True):
+                    with st.spinner("Ҳисобланмоқда..."):
+                        source = get_archive_manager().results_source(db.conn) if include_archive else 'test_results'
+                        df_ri = ReferenceIntervalEstimator(db.conn).run(param_code, source)
+                    
+                    def fmt_ci(ci):
+                        return f"{ci[0]:.2f} – {ci[1]:.2f}" if ci[0] is not None else "—"
+                    
+                    df_view = pd.DataFrame({
+                        'Ёш': df_ri['age'],
+                        'Жинси': df_ri['gender'],
+                        'Фаза': df_ri['phase'],
+                        'N': df_ri['n'],
+                        'Чиқарилган': df_ri['excluded'],
+                        'Таклиф мин': df_ri['lower'].round(2),
+                        'Мин 90% CI': df_ri['lower_ci'].map(fmt_ci),
+                        'Таклиф макс': df_ri['upper'].round(2),
+                        'Макс 90% CI': df_ri['upper_ci'].map(fmt_ci),
+                        'Ўрнатилган мин': df_ri['configured_min'],
+                        'Ўрнатилган макс': df_ri['configured_max'],
+                        'Холат': [
+                            "⚪ Маълумот кам" if not ok else ("✅ Мос" if agrees else ("⚠️ Фарқ бор" if agrees is False else "—"))
+                            for ok, agrees in zip(df_ri['sufficient'], df_ri['agrees'])
+                        ]
+                    })
+                    st.dataframe(df_view, use_container_width=True)
+            
             # Янги норма қўшиш
             with st.expander("➕ Янги норма қўшиш"):
                 with st.form("new_norm_form", clear_on_submit=True):
@@ -1330,16 +7195,67 @@ def manage_settings():
                     submitted = st.form_submit_button("💾 Норма қўшиш")
                     
                     if submitted:
-                        cursor.execute('''
-                            INSERT INTO age_gender_norms 
-                            (parameter_code, age_min, age_max, gender, 
-                             menstrual_phase, min_value, max_value)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                        ''', (param_code, age_min, age_max, gender_val, 
-                             menstrual_phase_val, min_value, max_value))
-                        db.conn.commit()
-                        st.success("✅ Норма муваффақиятли қўшилди!")
-                        st.rerun()
+                        new_norm = {'parameter_code': param_code, 'age_min': age_min, 'age_max': age_max,
+                                    'gender': gender_val, 'menstrual_phase': menstrual_phase_val,
+                                    'min_value': min_value, 'max_value': max_value}
+                        issues = check_new_norms(db.conn, [new_norm])
+                        blocking = [i for i in issues if i['kind'] in NORM_BLOCKING_ISSUES]
+                        if blocking:
+                            st.error("❌ Норма сақланмади — мавжуд нормалар билан зиддият")
+                            st.dataframe(norm_issues_frame(blocking), use_container_width=True, hide_index=True)
+                        else:
+                            try:
+                                cursor.execute('''
+                                    INSERT INTO age_gender_norms 
+                                    (parameter_code, age_min, age_max, gender, 
+                                     menstrual_phase, min_value, max_value)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                                ''', (param_code, age_min, age_max, gender_val, 
+                                     menstrual_phase_val, min_value, max_value))
+                                db.conn.commit()
+                                get_audit_log().record('create', 'norm', cursor.lastrowid, after=new_norm)
+                                st.success("✅ Норма муваффақиятли қўшилди!")
+                                if issues:
+                                    st.warning(f"⚠️ Қамралмаган ёш оралиқлари қолди: {len(issues)} та")
+                            except sqlite3.IntegrityError:
+                                st.error("❌ Бундай норма аллақачон мавжуд")
+            
+            # Бутун каталог текшируви ва YAML орқали оммавий алмашув
+            with st.expander("📦 Каталог текшируви ва YAML импорт/экспорт"):
+                if st.button("🔍 Барча нормаларни текшириш", use_container_width=True):
+                    catalog_issues = audit_norms(db.conn)
+                    if catalog_issues:
+                        df_issues = norm_issues_frame(catalog_issues)
+                        st.dataframe(df_issues['Муаммо'].value_counts().rename('Сони'), use_container_width=True)
+                        st.dataframe(df_issues, use_container_width=True, hide_index=True, height=400)
+                    else:
+                        st.success("✅ Нормаларда муаммо топилмади")
+                
+                st.download_button(
+                    "📥 YAML экспорт",
+                    data=norms_to_yaml(load_norms(db.conn)).encode('utf-8'),
+                    file_name=f"norms_{date.today()}.yaml",
+                    mime="application/x-yaml",
+                    use_container_width=True
+                )
+                
+                uploaded = st.file_uploader("YAML файл", type=["yaml", "yml"], key="norms_yaml_upload")
+                replace_existing = st.checkbox("Файлдаги параметрларнинг мавжуд нормаларини алмаштириш", value=True)
+                if uploaded is not None and st.button("📤 Импорт қилиш", use_container_width=True):
+                    try:
+                        imported_norms = norms_from_yaml(uploaded.getvalue().decode('utf-8'))
+                        summary = import_norms(db.conn, imported_norms, replace=replace_existing)
+                        if summary['unknown']:
+                            st.error(f"❌ Номаълум параметрлар: {', '.join(summary['unknown'])}")
+                        elif summary['imported']:
+                            st.success(f"✅ {summary['imported']} та норма импорт қилинди")
+                        else:
+                            st.error("❌ Импорт бекор қилинди — зиддиятли нормалар")
+                        if summary['issues']:
+                            st.dataframe(norm_issues_frame(summary['issues']), use_container_width=True,
+                                         hide_index=True)
+                    except (ValueError, yaml.YAMLError) as e:
+                        st.error(f"❌ Хатолик: {str(e)}")
         else:
             st.info("📭 Параметрлар мавжуд эмас")
     
@@ -1366,6 +7282,82 @@ def manage_settings():
             with col2:
                 st.markdown(f"*{description}*")
             st.divider()
+    
+    with tab4:
+        st.markdown("### 🔀 Дельта-текширув қоидалари")
+        st.caption("Янги натижа бемор олдинги қийматидан белгиланган чегарадан кўп фарқ қилса, "
+                   "огоҳлантириш берилади (намуналар алмашиб кетишининг белгиси)")
+        
+        cursor = db.get_cursor()
+        cursor.execute("SELECT parameter_code FROM test_parameters ORDER BY parameter_code")
+        all_codes = [r[0] for r in cursor.fetchall()]
+        cursor.execute('''
+            SELECT parameter_code, abs_threshold, pct_threshold, rate_threshold, max_interval_days
+            FROM delta_check_rules ORDER BY parameter_code
+        ''')
+        df_rules = pd.DataFrame(cursor.fetchall(), columns=[
+            'Параметр', 'Мутлақ фарқ', 'Фоиз фарқ', 'Кунлик тезлик', 'Макс. оралиқ (кун)'
+        ])
+        
+        edited_rules = st.data_editor(
+            df_rules,
+            num_rows="dynamic",
+            use_container_width=True,
+            column_config={
+                'Параметр': st.column_config.SelectboxColumn(options=all_codes, required=True),
+                'Макс. оралиқ (кун)': st.column_config.NumberColumn(min_value=1, step=1),
+            },
+            key="delta_rules_editor"
+        )
+        
+        if st.button("💾 Қоидаларни сақлаш", use_container_width=True):
+            rules = edited_rules.dropna(subset=['Параметр']).drop_duplicates(subset=['Параметр'], keep='last')
+            rules = rules.astype(object).where(rules.notna(), None)
+            cursor.execute("DELETE FROM delta_check_rules")
+            cursor.executemany('''
+                INSERT INTO delta_check_rules
+                (parameter_code, abs_threshold, pct_threshold, rate_threshold, max_interval_days)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [tuple(r) for r in rules.itertuples(index=False)])
+            db.conn.commit()
+            st.success(f"✅ {len(rules)} та қоида сақланди!")
+            st.rerun()
+    
+    with tab5:
+        st.markdown("### 🚨 Критик қиймат чегаралари")
+        st.caption("Натижа шу чегаралардан чиқса, масъул шифокорларга дарҳол хат юборилади "
+                   "(Система созламалари → Электрон почта)")
+        
+        cursor = db.get_cursor()
+        cursor.execute("SELECT parameter_code FROM test_parameters ORDER BY parameter_code")
+        all_codes = [r[0] for r in cursor.fetchall()]
+        cursor.execute('''
+            SELECT parameter_code, low_critical, high_critical
+            FROM critical_limits ORDER BY parameter_code
+        ''')
+        df_limits = pd.DataFrame(cursor.fetchall(), columns=['Параметр', 'Паст чегара', 'Юқори чегара'])
+        
+        edited_limits = st.data_editor(
+            df_limits,
+            num_rows="dynamic",
+            use_container_width=True,
+            column_config={
+                'Параметр': st.column_config.SelectboxColumn(options=all_codes, required=True),
+            },
+            key="critical_limits_editor"
+        )
+        
+        if st.button("💾 Чегараларни сақлаш", use_container_width=True):
+            limits = edited_limits.dropna(subset=['Параметр']).drop_duplicates(subset=['Параметр'], keep='last')
+            limits = limits.astype(object).where(limits.notna(), None)
+            cursor.execute("DELETE FROM critical_limits")
+            cursor.executemany('''
+                INSERT INTO critical_limits (parameter_code, low_critical, high_critical)
+                VALUES (?, ?, ?)
+            ''', [tuple(r) for r in limits.itertuples(index=False)])
+            db.conn.commit()
+            st.success(f"✅ {len(limits)} та чегара сақланди!")
+            st.rerun()
 
 # =================== БЛАНКА ШАБЛОНЛАРИ ===================
 def manage_templates():
@@ -1379,8 +7371,7 @@ def manage_templates():
         
         cursor = db.get_cursor()
         try:
-            cursor.execute("SELECT * FROM form_templates ORDER BY template_name")
-            templates = cursor.fetchall()
+            templates = cached_templates()
         except:
             templates = []
         
@@ -1590,6 +7581,15 @@ def manage_templates():
                     <div style="margin-top: 2rem; color: #7F8C8D;">
                         <p><strong>Таҳлил санаси:</strong> {date.today().strftime('%d.%m.%Y')}</p>"""
                 
+                if features.get('include_qr', False):
+                    cursor.execute("SELECT MAX(barcode) FROM specimens")
+                    sample_barcode = cursor.fetchone()[0]
+                    if sample_barcode is None:
+                        sample_barcode = date.today().strftime('%y%m%d') + "00001"
+                        sample_barcode += luhn_digit(sample_barcode)
+                    html_content += f"""
+                        <div style="float: right;">{qr_svg(specimen_link(sample_barcode))}</div>"""
+                
                 if features.get('include_signature', False):
                     html_content += """
                         <div style="margin-top: 3rem; text-align: right;">___________<br><em>Имзо</em></div>"""
@@ -1630,21 +7630,26 @@ def show_reports():
     """Ҳисоботлар ва статистика"""
     st.markdown('<h1 class="section-title">📈 Ҳисоботлар ва статистика</h1>', unsafe_allow_html=True)
     
-    tab1, tab2, tab3 = st.tabs(["📊 Умумий статистика", "📅 Кунлик ҳисобот", "📑 Тахлил ҳисоботи"])
+    # Оғир сўровлар маълумот киритиш уланишини эмас, фақат ўқиладиган нусхани банд қилади
+    conn = snapshot_banner("snapshot_refresh_reports")
+    
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["📊 Умумий статистика", "📅 Кунлик ҳисобот", "📑 Тахлил ҳисоботи",
+                                            "🧊 Когорта таҳлили", "⏱️ Бажарилиш вақти"])
     
     with tab1:
         st.markdown("### 📊 Умумий статистика")
         
-        cursor = db.get_cursor()
+        cursor = conn.cursor()
         
         try:
             # Ўзгармалар статистикаси
             col1, col2 = st.columns(2)
             
             with col1:
-                cursor.execute("""
+                source = get_archive_manager().results_source(conn)
+                cursor.execute(f"""
                     SELECT test_type, COUNT(*) as count
-                    FROM test_results
+                    FROM {source}
                     GROUP BY test_type
                     ORDER BY count DESC
                 """)
@@ -1713,17 +7718,18 @@ def show_reports():
         
         report_date = st.date_input("Ҳисобот санаси", value=date.today())
         
-        if st.button("Ҳисобот яратиш", use_container_width=True):
-            cursor = db.get_cursor()
+        if st.button("Ҳисобот яратиш", use_container_width=True, key="daily_report_btn"):
+            cursor = conn.cursor()
             
             try:
                 # Кунлик статистика
-                cursor.execute("""
+                source = get_archive_manager().results_source(conn, report_date)
+                cursor.execute(f"""
                     SELECT 
                         COUNT(DISTINCT patient_id) as patients_count,
                         COUNT(*) as tests_count,
                         SUM(CASE WHEN status != 'normal' THEN 1 ELSE 0 END) as abnormal_count
-                    FROM test_results
+                    FROM {source}
                     WHERE DATE(test_date) = DATE(?)
                 """, (report_date,))
                 
@@ -1742,24 +7748,19 @@ def show_reports():
                         st.metric("Патология тахлиллар", abnormal_count)
                     
                     # Тафсилотли рўйхат
-                    cursor.execute("""
+                    df_daily = read_typed_frame(conn, f"""
                         SELECT p.full_name, tr.test_type, tr.parameter_code, 
                                tr.result_value, tr.unit, tr.status
-                        FROM test_results tr
+                        FROM {source} tr
                         JOIN patients p ON tr.patient_id = p.id
                         WHERE DATE(tr.test_date) = DATE(?)
                         ORDER BY p.full_name
-                    """, (report_date,))
-                    
-                    daily_tests = cursor.fetchall()
+                    """, (report_date,), ['full_name', 'test_type', 'parameter_code', 'result_value', 'unit',
+                                          'status'])
                     
-                    if daily_tests:
-                        df_daily = pd.DataFrame(daily_tests, columns=[
-                            'Бемор', 'Тахлил тури', 'Параметр', 
-                            'Қиймат', 'Ўлчов бирлиги', 'Холат'
-                        ])
-                        
+                    if not df_daily.empty:
                         st.dataframe(df_daily, use_container_width=True, height=400)
+                        st.caption(frame_memory_caption(df_daily))
                         
                         # Экспорт
                         csv = df_daily.to_csv(index=False).encode('utf-8')
@@ -1781,7 +7782,7 @@ def show_reports():
         st.markdown("### 📑 Тахлил ҳисоботи")
         
         # Бемор ва давр танлаш
-        cursor = db.get_cursor()
+        cursor = conn.cursor()
         try:
             cursor.execute("SELECT id, full_name FROM patients ORDER BY full_name")
             patients = cursor.fetchall()
@@ -1800,7 +7801,7 @@ def show_reports():
             with col_date2:
                 end_date = st.date_input("Тугаш санаси", value=date.today())
             
-            if st.button("Ҳисобот яратиш", use_container_width=True):
+            if st.button("Ҳисобот яратиш", use_container_width=True, key="patient_report_btn"):
                 # Бемор маълумотлари
                 cursor.execute("""
                     SELECT patient_id, birth_date, gender, phone
@@ -1811,18 +7812,18 @@ def show_reports():
                 
                 if patient_info:
                     # Тахлил натижалари
-                    cursor.execute("""
+                    source = get_archive_manager().results_source(conn, start_date)
+                    df_patient = read_typed_frame(conn, f"""
                         SELECT test_type, parameter_code, result_value, 
                                unit, status, test_date
-                        FROM test_results
+                        FROM {source}
                         WHERE patient_id = ? 
                         AND test_date BETWEEN ? AND ?
                         ORDER BY test_date DESC
-                    """, (patient_id, start_date, end_date))
+                    """, (patient_id, start_date, end_date), ['test_type', 'parameter_code', 'result_value',
+                                                              'unit', 'status', 'test_date'])
                     
-                    patient_tests = cursor.fetchall()
-                    
-                    if patient_tests:
+                    if not df_patient.empty:
                         # Ҳисоботни кўрсатиш
                         st.markdown(f"""
                         <div style="
@@ -1840,15 +7841,9 @@ def show_reports():
                         </div>
                         """, unsafe_allow_html=True)
                         
-                        # Натижалар таблицаси
-                        df_patient = pd.DataFrame(patient_tests, columns=[
-                            'Тахлил тури', 'Параметр', 'Қиймат', 
-                            'Ўлчов бирлиги', 'Холат', 'Сана'
-                        ])
-                        
                         # Параметрлар бўйича график
-                        if len(patient_tests) > 1:
-                            unique_params = df_patient['Параметр'].unique()
+                        if len(df_patient) > 1:
+                            unique_params = df_patient['Параметр'].unique().tolist()
                             if len(unique_params) > 0:
                                 param_to_plot = st.selectbox(
                                     "График учун параметрни танланг",
@@ -1867,7 +7862,8 @@ def show_reports():
                                         st.info("График яратиб бўлмади")
                         
                         # Натижалар таблицаси
-                        st.dataframe(df_patient, use_container_width=True, height=400)
+                        st.dataframe(df_patient, use_container_width=True, height=400,
+                                     column_config=frame_column_config(df_patient))
                         
                         # Тавсиялар
                         abnormal_tests = df_patient[df_patient['Холат'] != 'normal']
@@ -1893,6 +7889,133 @@ def show_reports():
                     st.error("Бемор маълумотларини олиб бўлмади")
         else:
             st.info("📭 Беморлар мавжуд эмас")
+    
+    with tab4:
+        st.markdown("### 🧊 Когорта таҳлили")
+        st.caption("Патология улуши: параметр × ёш гуруҳи × жинс × ой (олдиндан ҳисобланган куб)")
+        
+        # Куб натижалар ёзилганда янгиланади ва тунги техник хизматда тўлиқ қайта қурилади —
+        # ҳисобот саҳифаси ёзмайди
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT parameter_code FROM cohort_cube ORDER BY parameter_code")
+        cube_params = [r[0] for r in cursor.fetchall()]
+        cursor.execute("SELECT DISTINCT month FROM cohort_cube ORDER BY month")
+        cube_months = [r[0] for r in cursor.fetchall()]
+        
+        if cube_params:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                selected_params = st.multiselect("Параметрлар", cube_params, default=cube_params[:5])
+                selected_genders = st.multiselect("Жинси", ["Эркак", "Аёл"])
+            with col2:
+                month_from = st.selectbox("Ойдан", cube_months, index=0)
+                month_to = st.selectbox("Ойгача", cube_months, index=len(cube_months) - 1)
+            with col3:
+                selected_bands = st.multiselect("Ёш гуруҳлари", COHORT_AGE_BANDS)
+                dimension_labels = {
+                    "Параметр": "parameter_code", "Ёш гуруҳи": "age_band",
+                    "Жинси": "gender", "Ой": "month"
+                }
+                selected_dims = st.multiselect("Гуруҳлаш", list(dimension_labels.keys()),
+                                               default=["Параметр", "Ёш гуруҳи", "Жинси"])
+            
+            started = time.perf_counter()
+            df_cube = query_cohort_cube(
+                conn, [dimension_labels[d] for d in selected_dims],
+                parameters=selected_params, genders=selected_genders, age_bands=selected_bands,
+                month_from=month_from, month_to=month_to
+            )
+            elapsed = time.perf_counter() - started
+            
+            df_view = df_cube.rename(columns={
+                'parameter_code': 'Параметр', 'age_band': 'Ёш гуруҳи', 'gender': 'Жинси', 'month': 'Ой',
+                'total': 'Жами', 'abnormal': 'Патология', 'low': 'Паст', 'high': 'Юқори',
+                'abnormal_rate': 'Патология %'
+            })
+            
+            if not df_view.empty:
+                if "Ой" in selected_dims:
+                    color = next((d for d in selected_dims if d != "Ой"), None)
+                    fig = px.line(df_view, x='Ой', y='Патология %', color=color, markers=True,
+                                  title='Патология улуши ойлар бўйича')
+                    st.plotly_chart(fig, use_container_width=True)
+                elif "Ёш гуруҳи" in selected_dims and "Жинси" in selected_dims:
+                    heat = df_view.groupby(['Ёш гуруҳи', 'Жинси'])[['Патология', 'Жами']].sum()
+                    heat = (heat['Патология'] / heat['Жами'] * 100).unstack('Жинси')
+                    fig = px.imshow(heat.reindex([b for b in COHORT_AGE_BANDS if b in heat.index]),
+                                    text_auto='.1f', aspect='auto', color_continuous_scale='Reds',
+                                    title='Патология улуши (%): ёш гуруҳи × жинс')
+                    st.plotly_chart(fig, use_container_width=True)
+                
+                st.dataframe(df_view, use_container_width=True, height=400)
+                st.caption(f"⏱️ Сўров {elapsed * 1000:.0f} мс")
+                
+                csv = df_view.to_csv(index=False).encode('utf-8')
+                st.download_button(
+                    label="📥 Когорта жадвалини юклаб олиш (CSV)",
+                    data=csv,
+                    file_name="kogorta_tahlili.csv",
+                    mime="text/csv",
+                    use_container_width=True
+                )
+            else:
+                st.info("📭 Филтрга мос маълумотлар йўқ")
+        else:
+            st.info("📭 Когорта кубида ҳали маълумот йўқ")
+        
+        if st.button("🔄 Кубни қайта қуриш", use_container_width=True):
+            with st.spinner("Куб қайта қурилмоқда..."):
+                with db.write_connection() as writer:
+                    rebuild_cohort_cube(writer)
+                get_snapshot_manager().refresh()
+            st.success("✅ Куб қайта қурилди!")
+            st.rerun()
+    
+    with tab5:
+        st.markdown("### ⏱️ Бажарилиш вақти (TAT)")
+        st.caption("Перцентиллар ёзиш пайтида янгиланадиган логарифмик скетчлардан олинади (±2% аниқлик)")
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            metric = st.selectbox("Кўрсаткич", list(TAT_METRICS.keys()), index=4,
+                                  format_func=TAT_METRIC_LABELS.get)
+        with col2:
+            group_labels = {'category': "Категория", 'shift': "Смена", 'day': "Кун"}
+            group_by = st.selectbox("Гуруҳлаш", list(group_labels.keys()), format_func=group_labels.get)
+        with col3:
+            tat_from = st.date_input("Бошланиш санаси", value=date.today() - timedelta(days=30), key="tat_from")
+        with col4:
+            tat_to = st.date_input("Тугаш санаси", value=date.today(), key="tat_to")
+        
+        started = time.perf_counter()
+        df_tat = tat_percentiles(conn, metric, group_by, tat_from, tat_to)
+        elapsed = time.perf_counter() - started
+        
+        if not df_tat.empty:
+            df_long = df_tat.melt(id_vars=['group', 'n'], value_vars=['p50', 'p90', 'p99'],
+                                  var_name='Перцентил', value_name='Дақиқа')
+            if group_by == 'day':
+                fig = px.line(df_long, x='group', y='Дақиқа', color='Перцентил', markers=True,
+                              title=TAT_METRIC_LABELS[metric])
+            else:
+                fig = px.bar(df_long, x='group', y='Дақиқа', color='Перцентил', barmode='group',
+                             title=TAT_METRIC_LABELS[metric])
+            fig.update_layout(xaxis_title=group_labels[group_by])
+            st.plotly_chart(fig, use_container_width=True)
+            
+            st.dataframe(df_tat.rename(columns={'group': group_labels[group_by], 'n': 'Буюртмалар'})
+                         .round({'p50': 1, 'p90': 1, 'p99': 1}),
+                         use_container_width=True, hide_index=True)
+            st.caption(f"⏱️ Сўров {elapsed * 1000:.0f} мс")
+        else:
+            st.info("📭 Танланган даврда якунланган босқичлар йўқ")
+        
+        if st.button("🔄 Скетчларни қайта қуриш", use_container_width=True):
+            with st.spinner("Қайта қурилмоқда..."):
+                with db.write_connection() as writer:
+                    rebuild_tat_sketch(writer)
+                get_snapshot_manager().refresh()
+            st.rerun()
 
 # =================== ШИФОКОРЛАР БОШҚАРУВИ ===================
 def manage_doctors():
@@ -2015,10 +8138,13 @@ def manage_doctors():
                         
                         with col_delete:
                             if st.button("🗑️ Шифокорни ўчириш", use_container_width=True, key=f"delete_{selected_id}"):
-                                cursor.execute("DELETE FROM doctors WHERE id = ?", (selected_id,))
-                                db.conn.commit()
-                                st.success("✅ Шифокор ўчирилди!")
-                                st.rerun()
+                                try:
+                                    with db.write_connection() as writer:
+                                        delete_doctor(writer, selected_id, deleted_by=st.session_state.username)
+                                    st.success("✅ Шифокор ўчирилди!")
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"❌ Хатолик: {str(e)}")
         else:
             st.info("📭 Ҳали шифокорлар мавжуд эмас")
     
@@ -2071,11 +8197,14 @@ def system_settings():
     """Система созламалари"""
     st.markdown('<h1 class="section-title">🔧 Система созламалари</h1>', unsafe_allow_html=True)
     
-    tab1, tab2, tab3, tab4 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
         "⚙️ Умумий", 
         "🔐 Хавфсизлик", 
         "📧 Электрон почта", 
-        "🔄 Резерв нусха"
+        "🔄 Резерв нусха",
+        "🧹 Техник хизмат",
+        "🔬 Профиллар",
+        "📡 Метрикалар"
     ])
     
     with tab1:
@@ -2092,7 +8221,8 @@ def system_settings():
                 'timezone': 'Tashkent (UTC+5)',
                 'items_per_page': 25,
                 'auto_logout': 30,
-                'enable_notifications': True
+                'enable_notifications': True,
+                **db.get_config('system_settings', {})
             }
         
         hospital_name = st.text_input("Шифохона номи", 
@@ -2138,6 +8268,7 @@ def system_settings():
                 'auto_logout': auto_logout,
                 'enable_notifications': enable_notifications
             })
+            db.set_config('system_settings', st.session_state.system_settings)
             st.success("✅ Умумий созламалар сақланди!")
     
     with tab2:
@@ -2152,7 +8283,8 @@ def system_settings():
                 'session_timeout': 8,
                 'max_login_attempts': 5,
                 'lockout_duration': 15,
-                'default_role': 'Шифокор'
+                'default_role': 'Шифокор',
+                **db.get_config('security_settings', {})
             }
         
         # Парол сиёсати
@@ -2195,7 +8327,83 @@ def system_settings():
                 'lockout_duration': lockout_duration,
                 'default_role': default_role
             })
+            db.set_config('security_settings', st.session_state.security_settings)
             st.success("✅ Хавфсизлик созламалари сақланди!")
+        
+        # Аудит журнали
+        st.markdown("#### 📜 Аудит журнали")
+        
+        audit = get_audit_log()
+        audit.flush()
+        col_a1, col_a2, col_a3, col_a4 = st.columns(4)
+        with col_a1:
+            audit_entity = st.selectbox("Объект", ["", "patient", "test_results", "norm", "norms", "parameter",
+                                                   "doctor"], format_func=lambda e: e or "Ҳаммаси")
+        with col_a2:
+            audit_entity_id = st.text_input("Объект ID", key="audit_entity_id")
+        with col_a3:
+            audit_actor_name = st.text_input("Фойдаланувчи", key="audit_actor")
+        with col_a4:
+            audit_from = st.date_input("Санадан", value=date.today() - timedelta(days=30), key="audit_from")
+        
+        df_audit = query_audit_log(db.conn, audit_entity, audit_entity_id.strip(), audit_actor_name.strip(),
+                                   audit_from)
+        if not df_audit.empty:
+            df_audit['action'] = df_audit['action'].map(AUDIT_ACTIONS).fillna(df_audit['action'])
+            st.dataframe(df_audit.rename(columns={
+                'logged_at': 'Вақт', 'actor': 'Фойдаланувчи', 'action': 'Амал', 'entity': 'Объект',
+                'entity_id': 'ID', 'changes': 'Ўзгаришлар (олдин → кейин)'
+            }), use_container_width=True, hide_index=True, height=300)
+        else:
+            st.info("📭 Филтрга мос аудит ёзувлари йўқ")
+        if audit.last_error:
+            st.warning(f"Аудит ёзишда охирги хатолик: {audit.last_error}")
+        
+        # Фаол сессиялар
+        st.markdown("#### 🖥️ Фаол сессиялар")
+        
+        registry = get_session_registry()
+        sessions = registry.snapshot()
+        col_s1, col_s2, col_s3, col_s4 = st.columns(4)
+        with col_s1:
+            st.metric("Сессиялар", len(sessions))
+        with col_s2:
+            st.metric("Тизимга кирганлар", int((sessions['username'] != '—').sum()))
+        with col_s3:
+            st.metric("Хотира (тахминий)", f"{sessions['memory_mb'].sum():.1f} МБ")
+        with col_s4:
+            st.metric("Чиқарилган сессиялар", registry.stats['reaped'],
+                      help=f"Бўшатилган хотира: {registry.stats['freed_bytes'] / 1024 ** 2:.1f} МБ")
+        
+        memory_budget = st.number_input(
+            "Сессиялар хотираси чегараси (МБ)", min_value=64, max_value=16384,
+            value=int(db.get_config('session_memory_budget_mb', SESSION_MEMORY_BUDGET_MB)),
+            help="Ошиб кетса, энг узоқ фаол бўлмаган сессиялар ёпилади")
+        
+        if not sessions.empty:
+            st.dataframe(sessions.sort_values('memory_mb', ascending=False).rename(columns={
+                'session_id': 'Сессия', 'username': 'Фойдаланувчи', 'page': 'Саҳифа', 'started_at': 'Бошланган',
+                'idle_min': 'Фаолсиз (мин)', 'runs': 'Сўровлар', 'memory_mb': 'Хотира (МБ)'
+            }), use_container_width=True, hide_index=True)
+        
+        col_r1, col_r2, col_r3 = st.columns(3)
+        with col_r1:
+            if st.button("💾 Чегарани сақлаш", use_container_width=True):
+                db.set_config('session_memory_budget_mb', int(memory_budget))
+                st.success("✅ Хотира чегараси сақланди!")
+        with col_r2:
+            if st.button("🧹 Ҳозир текшириш", use_container_width=True):
+                reaped = registry.reap()
+                st.success(f"✅ {len(reaped)} та сессия чиқарилди")
+        with col_r3:
+            own_session = get_script_run_ctx().session_id
+            others = [sid for sid in sessions['session_id'] if sid != own_session]
+            if others:
+                target = st.selectbox("Сессия", others, label_visibility="collapsed",
+                                      format_func=lambda sid: f"{sessions.loc[sessions['session_id'] == sid, 'username'].iloc[0]} • {sid[:8]}")
+                if st.button("🚪 Сессияни якунлаш", use_container_width=True):
+                    freed = registry.end(target)
+                    st.success(f"✅ Сессия якунланди ({freed / 1024 ** 2:.1f} МБ бўшатилди)")
     
     with tab3:
         st.markdown("### 📧 Электрон почта созламалари")
@@ -2219,113 +8427,1786 @@ def system_settings():
 Натижаларни файл иловасида кўришингиз мумкин.
 
 Ҳурмат билан,
-{shifoxona_nomi}"""
+{shifoxona_nomi}""",
+                'alert_recipients': '',
+                **db.get_config('email_settings', {})
+            }
+        
+        # SMTP сервер созламалари
+        smtp_server = st.text_input("SMTP сервери", 
+                                  value=st.session_state.email_settings['smtp_server'])
+        smtp_port = st.number_input("SMTP порти", min_value=1, max_value=65535, 
+                                  value=st.session_state.email_settings['smtp_port'])
+        
+        col_email1, col_email2 = st.columns(2)
+        
+        with col_email1:
+            email_username = st.text_input("Электрон почта логини", 
+                                         value=st.session_state.email_settings['email_username'])
+            email_password = st.text_input("Электрон почта пароли", type="password",
+                                           help="Фақат синов хати учун, сақланмайди")
+        
+        with col_email2:
+            email_from = st.text_input("Жўнатувчи номи", 
+                                     value=st.session_state.email_settings['email_from'])
+            email_ssl = st.checkbox("SSL фойдаланиш", 
+                                  value=st.session_state.email_settings['email_ssl'])
+        
+        st.caption(f"🔑 Доимий пароль {SMTP_PASSWORD_ENV} муҳит ўзгарувчиси ёки .streamlit/secrets.toml даги "
+                   f"smtp_password орқали берилади: {'✅ созланган' if smtp_password() else '⚠️ созланмаган'}")
+        
+        # Натижалар жўнатиш шаблони
+        st.markdown("#### 📝 Жўнатиш шаблони")
+        
+        email_subject = st.text_input("Мавзу", 
+                                    value=st.session_state.email_settings['email_subject'])
+        email_template = st.text_area("Хат шаблони", 
+                                    value=st.session_state.email_settings['email_template'], 
+                                    height=200)
+        
+        # Критик натижалар огоҳлантириши
+        st.markdown("#### 🚨 Критик натижалар огоҳлантириши")
+        alert_recipients = st.text_input(
+            "Қабул қилувчилар (вергул билан)",
+            value=st.session_state.email_settings.get('alert_recipients', ''),
+            help="Критик чегарадан чиққан натижалар ҳақида хат шу манзилларга юборилади"
+        )
+        
+        if st.button("💾 Электрон почта созламаларини сақлаш", use_container_width=True):
+            st.session_state.email_settings.update({
+                'smtp_server': smtp_server,
+                'smtp_port': smtp_port,
+                'email_username': email_username,
+                'email_from': email_from,
+                'email_ssl': email_ssl,
+                'email_subject': email_subject,
+                'email_template': email_template,
+                'alert_recipients': alert_recipients
+            })
+            db.set_config('email_settings', st.session_state.email_settings)
+            ALERT_WAKEUP.set()
+            st.success("✅ Электрон почта созламалари сақланди!")
+        
+        # Огоҳлантиришлар навбати ҳолати
+        st.markdown("#### 📤 Огоҳлантиришлар навбати")
+        dispatcher = get_alert_dispatcher()
+        cursor = db.get_cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM alert_outbox GROUP BY status")
+        counts = dict(cursor.fetchall())
+        
+        col_q1, col_q2, col_q3, col_q4 = st.columns(4)
+        with col_q1:
+            st.metric("Навбатда", counts.get('pending', 0))
+        with col_q2:
+            st.metric("Юборилди", counts.get('sent', 0))
+        with col_q3:
+            st.metric("Юборилмади", counts.get('failed', 0))
+        with col_q4:
+            st.metric("Юборувчи", "🟢 Ишламоқда" if dispatcher.running else "🔴 Тўхтаган")
+        
+        if dispatcher.last_error:
+            st.warning(f"Охирги хатолик: {dispatcher.last_error}")
+        
+        col_a1, col_a2, col_a3 = st.columns(3)
+        with col_a1:
+            if st.button("▶️ Юборувчини ишга тушириш", disabled=dispatcher.running, use_container_width=True):
+                dispatcher.start()
+                st.rerun()
+        with col_a2:
+            if st.button("🔁 Юборилмаганларни қайта навбатга", disabled=not counts.get('failed'),
+                         use_container_width=True):
+                cursor.execute('''
+                    UPDATE alert_outbox SET status = 'pending', attempts = 0, next_attempt_at = 0
+                    WHERE status = 'failed'
+                ''')
+                db.conn.commit()
+                ALERT_WAKEUP.set()
+                st.rerun()
+        with col_a3:
+            if st.button("✉️ Синов хати", use_container_width=True):
+                recipients = [r.strip() for r in alert_recipients.replace(';', ',').split(',') if r.strip()]
+                if recipients:
+                    try:
+                        send_alert_email({**st.session_state.email_settings,
+                                          'email_password': email_password or smtp_password()},
+                                         recipients, "Синов хати", "Огоҳлантиришлар созламаси текширилди.")
+                        st.success("✅ Синов хати юборилди")
+                    except Exception as e:
+                        st.error(f"❌ Хатолик: {str(e)}")
+                else:
+                    st.warning("Қабул қилувчиларни киритинг")
+        
+        outbox = pd.read_sql_query('''
+            SELECT a.id, a.created_at, p.full_name, a.parameter_code, a.result_value,
+                   a.limit_kind, a.status, a.attempts, a.last_error
+            FROM alert_outbox a LEFT JOIN patients p ON p.id = a.patient_id
+            ORDER BY a.id DESC LIMIT 100
+        ''', db.conn)
+        if not outbox.empty:
+            st.dataframe(outbox.rename(columns={
+                'id': 'ID', 'created_at': 'Вақт', 'full_name': 'Бемор', 'parameter_code': 'Параметр',
+                'result_value': 'Қиймат', 'limit_kind': 'Чегара', 'status': 'Ҳолат',
+                'attempts': 'Уринишлар', 'last_error': 'Хатолик'
+            }), use_container_width=True, hide_index=True)
+    
+    with tab4:
+        st.markdown("### 🔄 Резерв нусха олиш")
+        
+        if 'backup_settings' not in st.session_state:
+            st.session_state.backup_settings = {
+                'backup_frequency': 'Ҳар куни',
+                'backup_time': datetime.now().time(),
+                'keep_backups': 30,
+                'backup_location': 'Маҳаллий сервер',
+                'auto_backup': True,
+                'compress_backup': True
             }
         
-        # SMTP сервер созламалари
-        smtp_server = st.text_input("SMTP сервери", 
-                                  value=st.session_state.email_settings['smtp_server'])
-        smtp_port = st.number_input("SMTP порти", min_value=1, max_value=65535, 
-                                  value=st.session_state.email_settings['smtp_port'])
+        col_backup1, col_backup2 = st.columns(2)
+        
+        with col_backup1:
+            backup_frequency = st.selectbox(
+                "Резерв нусха олиш жихози", 
+                ["Ҳар куни", "Ҳар хафта", "Ҳар ой", "Қўлда"],
+                index=["Ҳар куни", "Ҳар хафта", "Ҳар ой", "Қўлда"].index(
+                    st.session_state.backup_settings['backup_frequency'])
+            )
+            
+            backup_time = st.time_input("Резерв нусха вақти", 
+                                      value=st.session_state.backup_settings['backup_time'])
+            
+            keep_backups = st.number_input("Сақланадиган нусхалар сони", min_value=1, max_value=100, 
+                                         value=st.session_state.backup_settings['keep_backups'])
+        
+        with col_backup2:
+            backup_location = st.selectbox(
+                "Сақлаш жойи",
+                ["Маҳаллий сервер", "Cloud Storage", "Диск", "Бошқа"],
+                index=["Маҳаллий сервер", "Cloud Storage", "Диск", "Бошқа"].index(
+                    st.session_state.backup_settings['backup_location'])
+            )
+            
+            auto_backup = st.checkbox("Автомат резерв нусха олиш", 
+                                    value=st.session_state.backup_settings['auto_backup'])
+            compress_backup = st.checkbox("Архивлаш", 
+                                        value=st.session_state.backup_settings['compress_backup'])
+        
+        st.markdown("---")
+        
+        col_btn1, col_btn2 = st.columns(2)
+        
+        with col_btn1:
+            if st.button("🔄 Ҳозирги вақтда резерв нусха олиш", use_container_width=True):
+                try:
+                    summary = incremental_backup(db.conn, backup_directory(db.db_path), full=True)
+                    st.success(f"✅ Резерв нусха муваффақиятли олинди! "
+                               f"({summary['full']['bytes'] / 1024 / 1024:.1f} МБ, "
+                               f"{summary['full']['duration_ms']:.0f} мс)")
+                except Exception as e:
+                    st.error(f"❌ Хатолик: {str(e)}")
+        
+        with col_btn2:
+            if st.button("📥 Охирги резерв нусхани юклаб олиш", use_container_width=True):
+                st.info("Резерв нусха юклаб олинмоқда...")
+        
+        if st.button("💾 Резерв нусха созламаларини сақлаш", use_container_width=True):
+            st.session_state.backup_settings.update({
+                'backup_frequency': backup_frequency,
+                'backup_time': backup_time,
+                'keep_backups': keep_backups,
+                'backup_location': backup_location,
+                'auto_backup': auto_backup,
+                'compress_backup': compress_backup
+            })
+            st.success("✅ Резерв нусха созламалари сақланди!")
+        
+        st.markdown("### 🕒 Ўзгаришлар журнали ва вақт нуқтасига тиклаш")
+        
+        directory = backup_directory(db.db_path)
+        fulls = list_full_backups(directory)
+        segments = list_journal_segments(directory)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Тўлиқ нусхалар", len(fulls),
+                      help=f"Охиргиси: {fulls[-1]['created']:%Y-%m-%d %H:%M}" if fulls else None)
+        with col2:
+            st.metric("Журнал сегментлари", len(segments),
+                      help=f"{sum(seg['bytes'] for seg in segments) / 1024 / 1024:.1f} МБ")
+        with col3:
+            st.metric("Сиқилмаган ўзгаришлар", db.conn.execute("SELECT COUNT(*) FROM change_journal").fetchone()[0])
+        st.caption(f"📁 {directory} · тўлиқ нусха ҳар {BACKUP_FULL_EVERY_DAYS} кунда, "
+                   f"журнал ҳар тунги техник хизматда сиқилади")
+        
+        if st.button("🗜️ Журнални ҳозир сиқиш", use_container_width=True):
+            try:
+                summary = incremental_backup(db.conn, directory)
+                st.success(f"✅ {summary['rows']} та ўзгариш {summary['segments']} та сегментга ёзилди")
+            except Exception as e:
+                st.error(f"❌ Хатолик: {str(e)}")
+        
+        if fulls:
+            col_r1, col_r2 = st.columns(2)
+            with col_r1:
+                restore_date = st.date_input("Тиклаш санаси", value=date.today(),
+                                             min_value=fulls[0]['created'].date(), key="pitr_date")
+            with col_r2:
+                restore_time = st.time_input("Тиклаш вақти", value=datetime.now().time(), key="pitr_time")
+            if st.button("⏪ Шу вақт ҳолатини тиклаш (янги файлга)", use_container_width=True):
+                until = datetime.combine(restore_date, restore_time)
+                output = os.path.join(directory, f"restore-{until.strftime(BACKUP_TIME_FORMAT)}.db")
+                try:
+                    with st.spinner("Журнал қайта ўйналмоқда..."):
+                        summary = restore_point_in_time(directory, until, output, db.conn)
+                    st.success(f"✅ {summary['path']} — {summary['applied']} та ўзгариш, "
+                               f"{summary['duration_ms'] / 1000:.2f} с")
+                    st.caption("Тикланган файл ишлаётган базани алмаштирмайди; "
+                               "уни MEDICAL_LAB_DB орқали улаш мумкин")
+                except Exception as e:
+                    st.error(f"❌ Хатолик: {str(e)}")
+        
+        st.markdown("---")
+        st.markdown("### 🗄️ Эски натижаларни архивлаш")
+        
+        archive = get_archive_manager()
+        archive_after_days = st.number_input(
+            "Архивга ўтказиш муддати (кун)", min_value=30, max_value=3650,
+            value=int(db.get_config('archive_after_days', ARCHIVE_AFTER_DAYS)))
+        
+        col_arch1, col_arch2, col_arch3 = st.columns(3)
+        with col_arch1:
+            st.metric("Архивдаги натижалар", db.get_config('archived_results', 0))
+        with col_arch2:
+            years = archive.archive_years()
+            st.metric("Йиллик файллар", len(years))
+        with col_arch3:
+            st.metric("Архив чегараси", db.get_config('archive_boundary', '—'))
+        combined_years = db.get_config('archive_combined_years', [])
+        if years or combined_years:
+            caption = "Архив йиллари: " + (", ".join(str(y) for y in years) or "—")
+            if combined_years:
+                caption += (f" · умумий файлда: {combined_years[0]}–{combined_years[-1]} "
+                            f"({len(combined_years)} йил)")
+            st.caption(caption)
+        
+        col_arch_btn1, col_arch_btn2 = st.columns(2)
+        with col_arch_btn1:
+            if st.button("💾 Муддатни сақлаш", use_container_width=True):
+                db.set_config('archive_after_days', int(archive_after_days))
+                st.success("✅ Архив муддати сақланди!")
+        with col_arch_btn2:
+            if st.button("🗄️ Архивлашни бошлаш", use_container_width=True):
+                with st.spinner("Архивланмоқда..."):
+                    summary = archive.run(int(archive_after_days), max_batches=200)
+                st.success(f"✅ {summary['moved']} та натижа {summary['seconds']:.1f} сонияда архивланди "
+                           f"({summary['batches']} бўлак)")
+                if summary['combined']:
+                    st.info(f"🗃️ Умумий архив файлига кўчирилган йиллар: {', '.join(map(str, summary['combined']))}")
+    
+    with tab5:
+        st.markdown("### 🗑️ Ўчириш сиёсати")
+        
+        delete_mode = st.radio("Бемор ва шифокорни ўчиришда", list(DELETE_MODES.keys()),
+                               index=list(DELETE_MODES).index(db.get_config('delete_mode', 'soft')),
+                               format_func=DELETE_MODES.get)
+        if st.button("💾 Ўчириш сиёсатини сақлаш", use_container_width=True):
+            db.set_config('delete_mode', delete_mode)
+            st.success("✅ Ўчириш сиёсати сақланди!")
+        
+        recycle = pd.read_sql_query('''
+            SELECT id, entity, label, deleted_by, deleted_at FROM recycle_bin ORDER BY id DESC LIMIT 200
+        ''', db.conn)
+        with st.expander(f"♻️ Сават ({len(recycle)})"):
+            if recycle.empty:
+                st.info("📭 Сават бўш")
+            else:
+                st.dataframe(recycle.rename(columns={
+                    'id': 'ID', 'entity': 'Тур', 'label': 'Ёзув', 'deleted_by': 'Ўчирган', 'deleted_at': 'Вақт'
+                }), use_container_width=True, hide_index=True)
+                bin_id = st.selectbox("Тикланадиган ёзув", recycle['id'].tolist(),
+                                      format_func=lambda i: recycle.loc[recycle['id'] == i, 'label'].iloc[0])
+                if st.button("♻️ Қайта тиклаш", use_container_width=True):
+                    try:
+                        with db.write_connection() as writer:
+                            restored = restore_deleted(writer, bin_id)
+                        st.success(f"✅ {restored} қайта тикланди")
+                    except Exception as e:
+                        st.error(f"❌ Хатолик: {str(e)}")
+        
+        st.markdown("### 📸 Ҳисобот нусхаси")
+        
+        snapshots = get_snapshot_manager()
+        snapshot_settings = {**SNAPSHOT_DEFAULTS, **db.get_config('snapshot_settings', {})}
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            snapshot_enabled = st.checkbox("Даврий янгилаш", value=snapshot_settings['enabled'])
+        with col2:
+            snapshot_interval = st.number_input("Оралиқ (дақиқа)", min_value=1, max_value=1440,
+                                                value=int(snapshot_settings['interval_minutes']))
+        with col3:
+            st.metric("Янгиловчи", "🟢 Ишламоқда" if snapshots.running else "🔴 Тўхтаган")
+        st.caption(snapshot_freshness(snapshots) + (f" · охирги нусха {snapshots.last_duration_ms:.0f} мс"
+                                                    if snapshots.last_duration_ms is not None else ""))
+        
+        col_s1, col_s2 = st.columns(2)
+        with col_s1:
+            if st.button("💾 Нусха созламаларини сақлаш", use_container_width=True):
+                db.set_config('snapshot_settings', {'enabled': snapshot_enabled,
+                                                    'interval_minutes': int(snapshot_interval)})
+                st.success("✅ Сақланди!")
+        with col_s2:
+            if st.button("📸 Нусхани ҳозир янгилаш", use_container_width=True):
+                try:
+                    st.success(f"✅ Нусха янгиланди: {snapshots.refresh():.0f} мс")
+                except Exception as e:
+                    st.error(f"❌ Хатолик: {str(e)}")
+        if snapshots.last_error:
+            st.warning(f"Охирги хатолик: {snapshots.last_error}")
+        
+        st.markdown("### 🧹 Режали техник хизмат")
+        
+        scheduler = get_maintenance_scheduler()
+        maintenance = {**MAINTENANCE_DEFAULTS, **db.get_config('maintenance_settings', {})}
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            maintenance_enabled = st.checkbox("Автомат ишга тушириш", value=maintenance['enabled'])
+        with col2:
+            window_start = st.time_input("Бошланиш", value=datetime.strptime(maintenance['start'], '%H:%M').time())
+        with col3:
+            window_end = st.time_input("Тугаш", value=datetime.strptime(maintenance['end'], '%H:%M').time())
+        with col4:
+            st.metric("Режалаштирувчи", "🟢 Ишламоқда" if scheduler.running else "🔴 Тўхтаган")
+        st.caption(f"Охирги ишга тушиш: {db.get_config('maintenance_last_run', '—')}")
+        
+        col_m1, col_m2 = st.columns(2)
+        with col_m1:
+            if st.button("💾 Ойнани сақлаш", use_container_width=True):
+                db.set_config('maintenance_settings', {
+                    'enabled': maintenance_enabled,
+                    'start': window_start.strftime('%H:%M'),
+                    'end': window_end.strftime('%H:%M'),
+                })
+                st.success("✅ Техник хизмат ойнаси сақланди!")
+        with col_m2:
+            if st.button("▶️ Ҳозир бажариш", use_container_width=True):
+                with st.spinner("Техник хизмат бажарилмоқда..."):
+                    results = run_maintenance(db)
+                failed = [r for r in results if r['status'] == 'error']
+                if failed:
+                    st.error("❌ " + "; ".join(f"{r['task']}: {r['details']}" for r in failed))
+                else:
+                    st.success(f"✅ Бажарилди: {sum(r['duration_ms'] for r in results) / 1000:.2f} с")
+        if scheduler.last_error:
+            st.warning(f"Охирги хатолик: {scheduler.last_error}")
+        
+        runs = pd.read_sql_query('''
+            SELECT run_id, task, started_at, duration_ms, status, details
+            FROM maintenance_runs ORDER BY id DESC LIMIT 250
+        ''', db.conn)
+        if not runs.empty:
+            runs['task'] = runs['task'].map(lambda t: MAINTENANCE_TASKS.get(t, t))
+            fig = px.bar(runs.iloc[::-1], x='started_at', y='duration_ms', color='task',
+                         labels={'started_at': 'Вақт', 'duration_ms': 'Давомийлик (мс)', 'task': 'Вазифа'},
+                         title="Техник хизмат вазифалари давомийлиги")
+            st.plotly_chart(fig, use_container_width=True)
+            st.dataframe(runs.rename(columns={
+                'run_id': 'Ишга тушиш', 'task': 'Вазифа', 'started_at': 'Бошланди',
+                'duration_ms': 'Давомийлик (мс)', 'status': 'Ҳолат', 'details': 'Тафсилот'
+            }), use_container_width=True, hide_index=True)
+        else:
+            st.info("📭 Техник хизмат ҳали бажарилмаган")
+    
+    with tab6:
+        st.markdown("### 🔬 Саҳифа профиллари")
+        st.caption(f"Охирги {PROFILE_RING_SIZE} та профиллаштирилган саҳифа. "
+                   "Профиллаш ён панелдаги «🔬 Профиллаш» билан сессия бўйича ёқилади.")
+        
+        store = get_profile_store()
+        profiles = store.summary()
+        if profiles.empty:
+            st.info("📭 Профиллар йўқ")
+        else:
+            st.dataframe(profiles.iloc[::-1].rename(columns={
+                'id': '№', 'started_at': 'Вақт', 'username': 'Фойдаланувчи', 'page': 'Саҳифа',
+                'wall_ms': 'Вақт (мс)', 'cpu_ms': 'CPU (мс)', 'peak_mb': 'Чўққи хотира (МБ)',
+                'retained_kb': 'Сақланган хотира (КБ)', 'status': 'Ҳолат'
+            }), use_container_width=True, hide_index=True)
+            
+            profile_id = st.selectbox("Профил", profiles['id'].iloc[::-1].tolist(),
+                                      format_func=lambda i: "#{} {} · {}".format(
+                                          i, *profiles.loc[profiles['id'] == i, ['page', 'started_at']].iloc[0]))
+            profile = store.get(profile_id)
+            if profile:
+                col1, col2, col3, col4 = st.columns(4)
+                col1.metric("Вақт", f"{profile['wall_ms']:.0f} мс")
+                col2.metric("CPU", f"{profile['cpu_ms']:.0f} мс")
+                col3.metric("Чўққи хотира", f"{profile['peak_mb']:.2f} МБ")
+                col4.metric("Сақланган хотира", f"{profile['retained_kb']:.0f} КБ")
+                
+                st.markdown("#### ⏱️ Энг қиммат функциялар")
+                st.dataframe(pd.DataFrame(profile['functions'], columns=[
+                    'Функция', 'Чақирувлар', 'Ўз вақти (мс)', 'Жами вақт (мс)'
+                ]), use_container_width=True, hide_index=True)
+                
+                st.markdown("#### 🧠 Хотира ўсиши (қаторлар бўйича)")
+                if profile['allocations']:
+                    st.dataframe(pd.DataFrame(profile['allocations'], columns=[
+                        'Қатор', 'Ўсиш (КБ)', 'Блоклар'
+                    ]), use_container_width=True, hide_index=True)
+                else:
+                    st.info("📭 Хотира ўсиши қайд этилмаган")
+                
+                stem = f"profile_{profile['id']}_{profile['started_at'].replace(':', '')}"
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.download_button("📥 pstats", profile['pstats'], file_name=f"{stem}.pstats",
+                                       mime="application/octet-stream", use_container_width=True)
+                with col2:
+                    st.download_button("📥 Flamegraph стеклари", profile['collapsed'],
+                                       file_name=f"{stem}.collapsed.txt", mime="text/plain",
+                                       use_container_width=True)
+            
+            if st.button("🗑️ Профилларни тозалаш", use_container_width=True):
+                store.clear()
+                st.rerun()
+    
+    with tab7:
+        st.markdown("### 📡 Prometheus метрикалари")
+        
+        server = get_metrics_server()
+        metrics_settings = {**METRICS_DEFAULTS, **db.get_config('metrics_settings', {})}
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            metrics_enabled = st.checkbox("Ёқилган", value=metrics_settings['enabled'], key="metrics_enabled")
+        with col2:
+            metrics_host = st.text_input("Манзил", value=metrics_settings['host'], key="metrics_host")
+        with col3:
+            metrics_port = st.number_input("Порт", min_value=1, max_value=65535,
+                                           value=int(metrics_settings['port']), key="metrics_port")
+        
+        if st.button("💾 Сақлаш ва қайта ишга тушириш", use_container_width=True, key="metrics_save"):
+            db.set_config('metrics_settings', {'enabled': metrics_enabled, 'host': metrics_host.strip(),
+                                               'port': int(metrics_port)})
+            server.stop()
+            server.start()
+            if server.last_error:
+                st.error(f"❌ Хатолик: {str(server.last_error)}")
+            else:
+                st.success("✅ Метрикалар сервери янгиланди!")
+        
+        if server.running:
+            host, port = server.address
+            st.success(f"🟢 Ишламоқда: http://{host}:{port}/metrics")
+        elif server.last_error:
+            st.warning(f"🔴 Ишга тушмади: {server.last_error}")
+        else:
+            st.info("⚪ Ўчирилган")
+        
+        with st.expander("👁️ Жорий қийматлар"):
+            st.code(get_metrics().exposition(), language="text")
+        
+        st.markdown("### 🗃️ Умумий кеш")
+        shared_cache = get_shared_cache()
+        location = getattr(shared_cache.backend, 'directory', 'жараён хотираси')
+        requests_text = ", ".join(f"{ns}/{result}: {count}"
+                                  for (ns, result), count in sorted(shared_cache.stats.items()))
+        st.caption(f"📁 {location} · сўровлар: {requests_text or '—'}")
+        if shared_cache.warning:
+            st.warning(f"⚠️ Жараёнлараро кеш ўчирилган: {shared_cache.warning}")
+        if st.button("🧹 Кешни тозалаш", use_container_width=True, key="shared_cache_clear"):
+            shared_cache.clear()
+            st.success("✅ Умумий кеш тозаланди!")
+
+# =================== АНАЛИЗАТОРЛАР ===================
+def manage_analyzers():
+    """ASTM анализатор уланишлари"""
+    st.markdown('<h1 class="section-title">🔌 Анализаторлар</h1>', unsafe_allow_html=True)
+    
+    tab1, tab2, tab3, tab4 = st.tabs(["📡 Тингловчи", "📥 Хабарлар", "📝 Қўлда импорт", "🧪 Симулятор"])
+    
+    listener = get_astm_listener()
+    
+    with tab1:
+        st.markdown("### 📡 ASTM TCP тингловчи")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            host = st.text_input("Манзил", value=listener.host, disabled=listener.running)
+        with col2:
+            port = st.number_input("Порт", min_value=1, max_value=65535, value=int(listener.port),
+                                   disabled=listener.running)
+        
+        if listener.running:
+            st.success(f"🟢 Тингловчи ишламоқда: {listener.host}:{listener.port}")
+            if st.button("⏹️ Тўхтатиш", use_container_width=True):
+                listener.stop()
+                st.rerun()
+        else:
+            st.warning("🔴 Тингловчи тўхтатилган")
+            if st.button("▶️ Ишга тушириш", use_container_width=True):
+                listener.host = host
+                listener.port = int(port)
+                try:
+                    listener.start()
+                    st.rerun()
+                except OSError as e:
+                    st.error(f"❌ Портни очиб бўлмади: {str(e)}")
+        
+        col_s1, col_s2, col_s3, col_s4, col_s5 = st.columns(5)
+        with col_s1:
+            st.metric("Фаол уланишлар", listener.stats['active'])
+        with col_s2:
+            st.metric("Хабарлар", listener.stats['messages'])
+        with col_s3:
+            st.metric("Импорт қилинган", listener.stats['imported'])
+        with col_s4:
+            st.metric("Мос келмаган", listener.stats['unmatched'])
+        with col_s5:
+            st.metric("Дельта огоҳлантириш", listener.stats['delta_flagged'])
+        
+        if listener.last_error:
+            st.error(f"Охирги хатолик: {listener.last_error}")
+    
+    with tab2:
+        st.markdown("### 📥 Охирги хабарлар")
+        
+        cursor = db.get_cursor()
+        cursor.execute("""
+            SELECT id, received_at, peer, instrument, imported_count, unmatched_count, error
+            FROM analyzer_messages
+            ORDER BY id DESC
+            LIMIT 200
+        """)
+        messages = cursor.fetchall()
+        
+        if messages:
+            df = pd.DataFrame(messages, columns=[
+                'ID', 'Қабул қилинган', 'Манба', 'Анализатор', 'Импорт', 'Мос келмаган', 'Хатолик'
+            ])
+            st.dataframe(df, use_container_width=True, height=400)
+            
+            message_id = st.selectbox("Хабар матнини кўриш", df['ID'].tolist())
+            cursor.execute("SELECT raw_message FROM analyzer_messages WHERE id = ?", (message_id,))
+            raw = cursor.fetchone()
+            if raw:
+                st.code(raw[0])
+        else:
+            st.info("📭 Ҳали хабарлар келмаган")
+    
+    with tab3:
+        st.markdown("### 📝 ASTM ёзувларини қўлда импорт қилиш")
+        st.caption("Кетма-кет порт журналидан нусха олинган H/P/O/R/L ёзувлари (ҳар бири алоҳида қаторда)")
+        
+        raw_text = st.text_area("ASTM ёзувлари", height=200)
+        
+        if st.button("📥 Импорт қилиш", use_container_width=True):
+            records = [line for line in raw_text.replace('\r', '\n').split('\n') if line.strip()]
+            if records:
+                try:
+                    with db.write_connection() as writer:
+                        summary = import_astm_message(db, writer, records, peer="қўлда")
+                    st.success(f"✅ {summary['imported']} та натижа импорт қилинди")
+                    if summary['delta_flagged']:
+                        st.warning(f"🔀 {summary['delta_flagged']} та натижа олдинги қийматдан кескин фарқ қилади")
+                    if summary['qc_recorded']:
+                        st.info(f"🎯 {summary['qc_recorded']} та назорат материали натижаси ёзилди")
+                    if summary['held']:
+                        st.error(f"⛔ {summary['held']} та натижа сифат назорати туфайли ушлаб қолинди — "
+                                 f"назорат ўтгач ёзилади, хабарни қайта юбориш шарт эмас")
+                    if summary['released']:
+                        st.success(f"📤 Аввал ушлаб қолинган {summary['released']} та натижа чиқарилди")
+                    if summary['unmatched']:
+                        st.warning(f"⚠️ {len(summary['unmatched'])} та натижа бемор ёки параметрга мос келмади")
+                        st.dataframe(pd.DataFrame(summary['unmatched']), use_container_width=True)
+                except Exception as e:
+                    st.error(f"❌ Хатолик: {str(e)}")
+            else:
+                st.warning("ASTM ёзувларини киритинг")
+    
+    with tab4:
+        st.markdown("### 🧪 Анализатор симулятори")
+        
+        if not listener.running:
+            st.info("Симулятор учун аввал тингловчини ишга туширинг")
+        else:
+            col1, col2 = st.columns(2)
+            with col1:
+                sim_messages = st.number_input("Хабарлар сони", min_value=1, max_value=10000, value=20)
+            with col2:
+                sim_connections = st.number_input("Уланишлар сони", min_value=1, max_value=500, value=5)
+            
+            if st.button("🚀 Юбориш", use_container_width=True):
+                messages = demo_astm_messages(db.conn, int(sim_messages))
+                if messages:
+                    simulator = ASTMSimulator('127.0.0.1', listener.port)
+                    outcome = simulator.run_load(messages, int(sim_connections))
+                    st.success(f"✅ {outcome['sent']} та хабар {outcome['seconds']:.2f} сонияда юборилди "
+                               f"({outcome['failed']} та рад этилди)")
+                else:
+                    st.warning("⚠️ Симуляция учун бемор ва параметрлар керак")
+
+# =================== СИФАТ НАЗОРАТИ САҲИФАСИ ===================
+def manage_quality_control():
+    """Ички сифат назорати: назорат материаллари ва Westgard қоидалари"""
+    st.markdown('<h1 class="section-title">🎯 Сифат назорати</h1>', unsafe_allow_html=True)
+    
+    cursor = db.get_cursor()
+    cursor.execute("""
+        SELECT parameter_code, parameter_name, unit FROM test_parameters
+        WHERE formula IS NULL OR TRIM(formula) = ''
+        ORDER BY category, parameter_name
+    """)
+    parameters = {row[0]: row for row in cursor.fetchall()}
+    
+    if not parameters:
+        st.info("📭 Ҳали параметрлар мавжуд эмас")
+        return
+    
+    blocked = qc_release_blocked(db.conn)
+    if blocked:
+        st.error("⛔ Натижалар чиқариш тўхтатилган: " + ", ".join(
+            f"{code} ({rules})" for code, rules in sorted(blocked.items())))
+    
+    tab1, tab2, tab3 = st.tabs(["📝 Назорат натижаси", "📈 Levey-Jennings", "🎯 Ҳолат ва мақсадлар"])
+    
+    with tab1:
+        with st.form("qc_result_form", clear_on_submit=True):
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                parameter_code = st.selectbox(
+                    "Параметр*", list(parameters.keys()),
+                    format_func=lambda c: f"{parameters[c][1]} ({c})"
+                )
+                level = st.selectbox("Назорат даражаси*", ["1", "2", "3"])
+            
+            with col2:
+                value = st.number_input("Қиймат*", value=0.0, format="%.3f")
+                lot_number = st.text_input("Лот рақами")
+            
+            submitted = st.form_submit_button("💾 Сақлаш ва текшириш")
+            
+            if submitted:
+                try:
+                    with db.write_connection() as writer:
+                        outcome = record_qc_result(writer, parameter_code, level, value, lot_number or None)
+                        released = release_held_results(db, writer)
+                    if outcome['z_score'] is None:
+                        st.info(f"📊 Статистика тўпланмоқда — камида {QC_MIN_BASELINE} та қиймат "
+                                f"ёки паспорт ўртача/SD қиймати керак")
+                    elif outcome['status'] == 'reject':
+                        st.error(f"⛔ Рад этилди: {', '.join(outcome['rules'])} (z = {outcome['z_score']:.2f})")
+                    elif outcome['status'] == 'warning':
+                        st.warning(f"⚠️ {', '.join(outcome['rules'])} огоҳлантириш (z = {outcome['z_score']:.2f})")
+                    else:
+                        st.success(f"✅ Қабул қилинди (z = {outcome['z_score']:.2f})")
+                    if released:
+                        st.success(f"📤 Ушлаб қолинган {released} та натижа чиқарилди")
+                except Exception as e:
+                    st.error(f"❌ Хатолик: {str(e)}")
+    
+    with tab2:
+        col1, col2, col3 = st.columns(3)
+        
+        with col1:
+            chart_code = st.selectbox(
+                "Параметр", list(parameters.keys()),
+                format_func=lambda c: f"{parameters[c][1]} ({c})", key="qc_chart_param"
+            )
+        with col2:
+            chart_level = st.selectbox("Даража", ["1", "2", "3"], key="qc_chart_level")
+        with col3:
+            chart_limit = st.number_input("Охирги қийматлар", min_value=10, max_value=1000, value=60, step=10)
         
-        col_email1, col_email2 = st.columns(2)
+        df = pd.read_sql_query("""
+            SELECT id, measured_at, value, z_score, rules, status, lot_number
+            FROM qc_results
+            WHERE parameter_code = ? AND level = ?
+            ORDER BY id DESC LIMIT ?
+        """, db.conn, params=(chart_code, chart_level, int(chart_limit))).iloc[::-1]
         
-        with col_email1:
-            email_username = st.text_input("Электрон почта логини", 
-                                         value=st.session_state.email_settings['email_username'])
-            email_password = st.text_input("Электрон почта пароли", type="password")
+        if not df.empty:
+            mean, sd = _qc_reference(load_qc_state(db.conn, chart_code, chart_level))
+            colors = {'accept': '#2ECC71', 'warning': '#F39C12', 'reject': '#E74C3C'}
+            fig = go.Figure()
+            fig.add_trace(go.Scatter(
+                x=df['measured_at'], y=df['value'], mode='lines+markers',
+                marker=dict(color=[colors.get(s, '#95A5A6') for s in df['status']], size=9),
+                line=dict(color='#7F8C8D'),
+                text=df['rules'].fillna(''), name=chart_code
+            ))
+            if sd:
+                for k, dash, color in [(0, 'solid', '#2C3E50'), (1, 'dot', '#27AE60'),
+                                       (2, 'dash', '#F39C12'), (3, 'dash', '#E74C3C')]:
+                    for sign in ((1,) if k == 0 else (1, -1)):
+                        fig.add_hline(y=mean + sign * k * sd, line_dash=dash, line_color=color,
+                                      annotation_text=f"{'+' if sign > 0 else '-'}{k}SD" if k else "Ўртача")
+            fig.update_layout(title=f"Levey-Jennings: {parameters[chart_code][1]}, даража {chart_level}",
+                              xaxis_title="Вақт", yaxis_title=parameters[chart_code][2])
+            st.plotly_chart(fig, use_container_width=True)
+            
+            df['status'] = df['status'].map(QC_STATUS_LABELS)
+            st.dataframe(df.rename(columns={
+                'id': 'ID', 'measured_at': 'Вақт', 'value': 'Қиймат', 'z_score': 'z',
+                'rules': 'Қоидалар', 'status': 'Ҳолат', 'lot_number': 'Лот'
+            }), use_container_width=True, hide_index=True)
+        else:
+            st.info("📭 Бу параметр учун назорат натижалари йўқ")
+    
+    with tab3:
+        block_release = st.checkbox(
+            "Назорат рад этилганда бемор натижаларини сақлашни тўхтатиш",
+            value=db.get_config('qc_block_release', True)
+        )
+        if block_release != db.get_config('qc_block_release', True):
+            db.set_config('qc_block_release', block_release)
+            if not block_release:
+                with db.write_connection() as writer:
+                    release_held_results(db, writer)
         
-        with col_email2:
-            email_from = st.text_input("Жўнатувчи номи", 
-                                     value=st.session_state.email_settings['email_from'])
-            email_ssl = st.checkbox("SSL фойдаланиш", 
-                                  value=st.session_state.email_settings['email_ssl'])
+        states = pd.read_sql_query("""
+            SELECT parameter_code, level, target_mean, target_sd, n, mean,
+                   CASE WHEN n > 1 THEN SQRT(m2 / (n - 1)) END AS sd, status, last_rules, updated_at
+            FROM qc_state ORDER BY parameter_code, level
+        """, db.conn)
         
-        # Натижалар жўнатиш шаблони
-        st.markdown("#### 📝 Жўнатиш шаблони")
+        if not states.empty:
+            states['status'] = states['status'].map(QC_STATUS_LABELS)
+            st.dataframe(states.rename(columns={
+                'parameter_code': 'Параметр', 'level': 'Даража', 'target_mean': 'Мақсад ўртача',
+                'target_sd': 'Мақсад SD', 'n': 'n', 'mean': 'Жорий ўртача', 'sd': 'Жорий SD',
+                'status': 'Ҳолат', 'last_rules': 'Қоидалар', 'updated_at': 'Янгиланган'
+            }), use_container_width=True, hide_index=True)
         
-        email_subject = st.text_input("Мавзу", 
-                                    value=st.session_state.email_settings['email_subject'])
-        email_template = st.text_area("Хат шаблони", 
-                                    value=st.session_state.email_settings['email_template'], 
-                                    height=200)
+        with st.expander("🎯 Паспорт қийматларини белгилаш"):
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                target_code = st.selectbox("Параметр", list(parameters.keys()), key="qc_target_param")
+            with col2:
+                target_level = st.selectbox("Даража", ["1", "2", "3"], key="qc_target_level")
+            with col3:
+                target_mean = st.number_input("Ўртача", value=0.0, format="%.3f")
+            with col4:
+                target_sd = st.number_input("SD", min_value=0.0, value=0.0, format="%.3f")
+            
+            if st.button("💾 Мақсадни сақлаш", key="qc_target_btn"):
+                if target_sd > 0:
+                    set_qc_target(db.conn, target_code, target_level, target_mean, target_sd)
+                else:
+                    set_qc_target(db.conn, target_code, target_level, None, None)
+                st.success("✅ Сақланди (SD = 0 бўлса жорий статистика ишлатилади)")
+                st.rerun()
         
-        if st.button("💾 Электрон почта созламаларини сақлаш", use_container_width=True):
-            st.session_state.email_settings.update({
-                'smtp_server': smtp_server,
-                'smtp_port': smtp_port,
-                'email_username': email_username,
-                'email_from': email_from,
-                'email_ssl': email_ssl,
-                'email_subject': email_subject,
-                'email_template': email_template
-            })
-            st.success("✅ Электрон почта созламалари сақланди!")
+        if blocked:
+            with st.expander("🔧 Тузатиш чоралари"):
+                reset_code = st.selectbox("Параметр", sorted(blocked.keys()), key="qc_reset_param")
+                st.caption("Сабаб бартараф этилгандан кейин қоидалар ойнаси тозаланади ва блок олинади")
+                if st.button("✅ Назорат ҳолатини тиклаш", key="qc_reset_btn"):
+                    reset_qc_run(db.conn, reset_code)
+                    with db.write_connection() as writer:
+                        released = release_held_results(db, writer)
+                    st.success(f"✅ Блок олинди, ушлаб қолинган {released} та натижа чиқарилди")
+                    st.rerun()
+        
+        held = pd.read_sql_query("""
+            SELECT h.id, h.held_at, p.patient_id AS patient_code, p.full_name, h.parameter_code,
+                   json_extract(h.row_data, '$.result_value') AS result_value, h.reason
+            FROM held_results h JOIN patients p ON p.id = h.patient_id
+            ORDER BY h.id
+        """, db.conn)
+        if not held.empty:
+            with st.expander(f"⏸️ Ушлаб қолинган натижалар ({len(held)})"):
+                st.caption("Параметр назорати ўтганда натижалар автоматик ёзилади. "
+                           "Намуна қайта ўлчанадиган бўлса, эскиси бекор қилинади.")
+                st.dataframe(held.rename(columns={
+                    'id': 'ID', 'held_at': 'Вақт', 'patient_code': 'Бемор ID', 'full_name': 'Бемор',
+                    'parameter_code': 'Параметр', 'result_value': 'Қиймат', 'reason': 'Сабаб'
+                }), use_container_width=True, hide_index=True)
+                discard_ids = st.multiselect("Бекор қилинадиган натижалар", held['id'].tolist(),
+                                             key="qc_discard_ids")
+                if st.button("🗑️ Бекор қилиш", key="qc_discard_btn", disabled=not discard_ids):
+                    st.success(f"✅ {discard_held_results(db.conn, discard_ids)} та натижа бекор қилинди")
+                    st.rerun()
+
+# =================== ИШ РЎЙХАТИ САҲИФАСИ ===================
+def manage_worklist():
+    """Буюртмалар ва категориялар бўйича иш рўйхати"""
+    st.markdown('<h1 class="section-title">🗂️ Иш рўйхати</h1>', unsafe_allow_html=True)
     
-    with tab4:
-        st.markdown("### 🔄 Резерв нусха олиш")
+    categories = ["Пренатал", "Неонатал", "ИФА", "Биохимик", "Клиник", "Гормонлар", "Бошқа"]
+    tab1, tab2, tab3 = st.tabs(["📋 Иш рўйхати", "➕ Янги буюртма", "🔎 Буюртмалар тарихи"])
+    
+    with tab1:
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            category = st.selectbox("🔬 Категория", categories, key="worklist_category")
+        with col2:
+            limit = st.number_input("Кўрсатиладиган сони", min_value=10, max_value=500, value=50, step=10)
         
-        if 'backup_settings' not in st.session_state:
-            st.session_state.backup_settings = {
-                'backup_frequency': 'Ҳар куни',
-                'backup_time': datetime.now().time(),
-                'keep_backups': 30,
-                'backup_location': 'Маҳаллий сервер',
-                'auto_backup': True,
-                'compress_backup': True
-            }
+        worklist = get_worklist(category)
+        counts = worklist.counts()
         
-        col_backup1, col_backup2 = st.columns(2)
+        col_m1, col_m2, col_m3 = st.columns(3)
+        with col_m1:
+            st.metric("Очиқ буюртмалар", len(worklist))
+        with col_m2:
+            st.metric("🚨 STAT", sum(v for (priority, _), v in counts.items() if priority == 'STAT'))
+        with col_m3:
+            st.metric("🔬 Бажарилмоқда", sum(v for (_, status), v in counts.items() if status == 'in_progress'))
         
-        with col_backup1:
-            backup_frequency = st.selectbox(
-                "Резерв нусха олиш жихози", 
-                ["Ҳар куни", "Ҳар хафта", "Ҳар ой", "Қўлда"],
-                index=["Ҳар куни", "Ҳар хафта", "Ҳар ой", "Қўлда"].index(
-                    st.session_state.backup_settings['backup_frequency'])
-            )
+        top = worklist.top(int(limit))
+        if top:
+            df = pd.DataFrame([{
+                'ID': row[0],
+                'Устуворлик': ORDER_PRIORITY_LABELS[row[4]],
+                'Ҳолат': ORDER_STATUS_LABELS[row[2]],
+                'Бемор': f"{row[8]} ({row[9]})",
+                'Параметрлар': ', '.join(json.loads(row[6])),
+                'Яратилган': row[5],
+                'Изоҳ': row[7] or '',
+            } for row in top])
+            st.dataframe(df, use_container_width=True, hide_index=True)
             
-            backup_time = st.time_input("Резерв нусха вақти", 
-                                      value=st.session_state.backup_settings['backup_time'])
+            col_a1, col_s1, col_s2, col_a2, col_a3, col_a4 = st.columns([2, 1, 1, 1, 1, 1])
+            with col_a1:
+                order_id = st.selectbox("Буюртма", df['ID'].tolist(),
+                                        format_func=lambda i: f"#{i} — {df.loc[df['ID'] == i, 'Бемор'].iloc[0]}")
+            with col_s1:
+                if st.button("🩸 Намуна", use_container_width=True, help="Намуна олинди"):
+                    record_order_stage(db.conn, [order_id], 'collected')
+                    db.conn.commit()
+                    st.rerun()
+            with col_s2:
+                if st.button("📥 Қабул", use_container_width=True, help="Намуна лабораторияга қабул қилинди"):
+                    record_order_stage(db.conn, [order_id], 'received')
+                    db.conn.commit()
+                    st.rerun()
+            with col_a2:
+                if st.button("▶️ Бошлаш", use_container_width=True):
+                    advance_orders(db.conn, [order_id], 'in_progress', from_statuses=('pending',))
+                    db.conn.commit()
+                    st.rerun()
+            with col_a3:
+                if st.button("✅ Тасдиқлаш", use_container_width=True):
+                    cursor = db.get_cursor()
+                    cursor.execute("SELECT COUNT(*) FROM test_results WHERE order_id = ?", (order_id,))
+                    if cursor.fetchone()[0]:
+                        advance_orders(db.conn, [order_id], 'validated', from_statuses=ORDER_OPEN_STATUSES)
+                        db.conn.commit()
+                        st.rerun()
+                    else:
+                        st.warning("⚠️ Буюртма бўйича натижалар ҳали киритилмаган")
+            with col_a4:
+                if st.button("🚫 Бекор қилиш", use_container_width=True):
+                    advance_orders(db.conn, [order_id], 'cancelled', from_statuses=ORDER_OPEN_STATUSES)
+                    db.conn.commit()
+                    st.rerun()
+        else:
+            st.info("📭 Бу категория бўйича очиқ буюртмалар йўқ")
+    
+    with tab2:
+        cursor = db.get_cursor()
+        cursor.execute("SELECT id, patient_id, full_name FROM patients ORDER BY full_name")
+        patients = cursor.fetchall()
+        cursor.execute("SELECT id, full_name FROM doctors ORDER BY full_name")
+        doctors = cursor.fetchall()
+        
+        if not patients:
+            st.warning("⚠️ Аввал бемор қўшинг")
+        else:
+            order_category = st.selectbox("🔬 Тахлил тури*", categories, key="order_category")
+            cursor.execute("""
+                SELECT parameter_code, parameter_name FROM test_parameters
+                WHERE category = ? AND (formula IS NULL OR TRIM(formula) = '')
+                ORDER BY parameter_name
+            """, (order_category,))
+            category_params = {row[0]: row[1] for row in cursor.fetchall()}
             
-            keep_backups = st.number_input("Сақланадиган нусхалар сони", min_value=1, max_value=100, 
-                                         value=st.session_state.backup_settings['keep_backups'])
+            with st.form("new_order_form", clear_on_submit=True):
+                patient_options = {f"{p[2]} ({p[1]})": p[0] for p in patients}
+                selected_patient = st.selectbox("👤 Бемор*", list(patient_options.keys()))
+                selected_params = st.multiselect(
+                    "Параметрлар*", list(category_params.keys()),
+                    default=list(category_params.keys()),
+                    format_func=lambda c: f"{category_params[c]} ({c})"
+                )
+                col1, col2 = st.columns(2)
+                with col1:
+                    priority = st.radio("Устуворлик", list(ORDER_PRIORITIES.keys()), index=1,
+                                        format_func=ORDER_PRIORITY_LABELS.get, horizontal=True)
+                with col2:
+                    doctor_options = {"": None, **{d[1]: d[0] for d in doctors}}
+                    doctor = st.selectbox("👨‍⚕️ Йўлланма берган шифокор", list(doctor_options.keys()))
+                notes = st.text_input("📝 Изоҳ")
+                
+                if st.form_submit_button("💾 Буюртма яратиш"):
+                    if selected_params:
+                        order_id = create_order(db.conn, patient_options[selected_patient], order_category,
+                                                selected_params, priority, doctor_options[doctor], notes or None)
+                        st.success(f"✅ Буюртма #{order_id} яратилди!")
+                    else:
+                        st.error("⚠️ Камида битта параметр танланг")
+    
+    with tab3:
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            status_filter = st.multiselect("Ҳолат", list(ORDER_STATUS_LABELS.keys()),
+                                           format_func=ORDER_STATUS_LABELS.get)
+        with col2:
+            start_date = st.date_input("Бошланиш санаси", value=date.today() - timedelta(days=7), key="orders_from")
+        with col3:
+            end_date = st.date_input("Тугаш санаси", value=date.today(), key="orders_to")
         
-        with col_backup2:
-            backup_location = st.selectbox(
-                "Сақлаш жойи",
-                ["Маҳаллий сервер", "Cloud Storage", "Диск", "Бошқа"],
-                index=["Маҳаллий сервер", "Cloud Storage", "Диск", "Бошқа"].index(
-                    st.session_state.backup_settings['backup_location'])
-            )
+        query = """
+            SELECT o.id, o.category, o.priority, o.status, p.full_name, o.parameter_codes,
+                   o.created_at, o.updated_at
+            FROM orders o JOIN patients p ON p.id = o.patient_id
+            WHERE DATE(o.created_at) BETWEEN ? AND ?
+        """
+        params = [start_date, end_date]
+        if status_filter:
+            query += f" AND o.status IN ({','.join('?' * len(status_filter))})"
+            params += status_filter
+        df_orders = pd.read_sql_query(query + " ORDER BY o.id DESC LIMIT 1000", db.conn, params=params)
+        
+        if not df_orders.empty:
+            df_orders['priority'] = df_orders['priority'].map(ORDER_PRIORITY_LABELS)
+            df_orders['status'] = df_orders['status'].map(ORDER_STATUS_LABELS)
+            df_orders['parameter_codes'] = df_orders['parameter_codes'].map(lambda v: ', '.join(json.loads(v)))
+            st.dataframe(df_orders.rename(columns={
+                'id': 'ID', 'category': 'Категория', 'priority': 'Устуворлик', 'status': 'Ҳолат',
+                'full_name': 'Бемор', 'parameter_codes': 'Параметрлар',
+                'created_at': 'Яратилган', 'updated_at': 'Янгиланган'
+            }), use_container_width=True, hide_index=True)
             
-            auto_backup = st.checkbox("Автомат резерв нусха олиш", 
-                                    value=st.session_state.backup_settings['auto_backup'])
-            compress_backup = st.checkbox("Архивлаш", 
-                                        value=st.session_state.backup_settings['compress_backup'])
+            # Тасдиқланган буюртма бланкаси
+            validated_ids = df_orders.loc[df_orders['status'] == ORDER_STATUS_LABELS['validated'], 'id'].tolist()
+            if validated_ids:
+                col_p1, col_p2 = st.columns([2, 1])
+                with col_p1:
+                    print_id = st.selectbox("🖨️ Бланка учун буюртма", validated_ids, format_func=lambda i: f"#{i}")
+                with col_p2:
+                    st.download_button(
+                        "🖨️ Бланкани юклаб олиш",
+                        data=render_order_blank(db.conn, print_id).encode('utf-8'),
+                        file_name=f"blanka_{print_id}.html",
+                        mime="text/html",
+                        on_click=mark_order_printed,
+                        args=(print_id,),
+                        use_container_width=True
+                    )
+            
+            # Буюртма босқичлари
+            with st.expander("⏱️ Буюртма босқичлари"):
+                stage_id = st.selectbox("Буюртма", df_orders['id'].tolist(), format_func=lambda i: f"#{i}",
+                                        key="stage_order")
+                stage_row = db.conn.execute(
+                    f"SELECT {', '.join(ORDER_STAGE_COLUMNS.values())} FROM orders WHERE id = ?", (stage_id,)
+                ).fetchone()
+                st.dataframe(pd.DataFrame({
+                    'Босқич': [ORDER_STAGE_LABELS[s] for s in ORDER_STAGES],
+                    'Вақт (UTC)': list(stage_row),
+                }), use_container_width=True, hide_index=True)
+        else:
+            st.info("📭 Танланган даврда буюртмалар йўқ")
+
+def manage_specimens():
+    """Намуналар, штрих-кодли ёрлиқлар ва сканерлаш"""
+    st.markdown('<h1 class="section-title">🧪 Намуналар</h1>', unsafe_allow_html=True)
+    
+    tab1, tab2, tab3 = st.tabs(["🏷️ Ёрлиқлар", "📷 Сканерлаш", "📋 Намуналар рўйхати"])
+    
+    with tab1:
+        cursor = db.get_cursor()
+        cursor.execute("SELECT id, patient_id, full_name FROM patients ORDER BY full_name")
+        patients = cursor.fetchall()
         
-        st.markdown("---")
+        if not patients:
+            st.warning("⚠️ Аввал бемор қўшинг")
+        else:
+            patient_options = {f"{p[2]} ({p[1]})": p[0] for p in patients}
+            selected_patient = st.selectbox("👤 Бемор*", list(patient_options.keys()), key="specimen_patient")
+            patient_db_id = patient_options[selected_patient]
+            cursor.execute('''
+                SELECT id, category, priority FROM orders
+                WHERE patient_id = ? AND status IN ('pending', 'in_progress')
+                ORDER BY priority_rank, created_at
+            ''', (patient_db_id,))
+            order_options = {"": None, **{f"#{o[0]} — {o[1]} ({o[2]})": o[0] for o in cursor.fetchall()}}
+            
+            with st.form("new_specimens_form"):
+                selected_order = st.selectbox("📦 Буюртма", list(order_options.keys()))
+                cols = st.columns(len(SPECIMEN_TYPES))
+                counts = {}
+                for col, kind in zip(cols, SPECIMEN_TYPES):
+                    with col:
+                        counts[kind] = st.number_input(kind, min_value=0, max_value=500,
+                                                       value=1 if kind == SPECIMEN_TYPES[0] else 0)
+                include_qr = st.checkbox("QR код қўшиш", value=False)
+                
+                if st.form_submit_button("🏷️ Ёрлиқлар яратиш"):
+                    kinds = [kind for kind, count in counts.items() for _ in range(int(count))]
+                    if kinds:
+                        try:
+                            with db.write_connection() as writer:
+                                barcodes = create_specimens(writer, patient_db_id, kinds,
+                                                            order_options[selected_order])
+                            st.session_state.specimen_sheet = (barcodes, include_qr)
+                            st.success(f"✅ {len(barcodes)} та ёрлиқ яратилди: {barcodes[0]} … {barcodes[-1]}")
+                        except Exception as e:
+                            st.error(f"❌ Хатолик: {str(e)}")
+                    else:
+                        st.error("⚠️ Камида битта намуна сонини киритинг")
         
-        col_btn1, col_btn2 = st.columns(2)
+        if 'specimen_sheet' in st.session_state:
+            barcodes, include_qr = st.session_state.specimen_sheet
+            sheet = render_label_sheet(db.conn, barcodes, include_qr=include_qr)
+            st.download_button("📥 Ёрлиқлар варағи (HTML)", sheet,
+                               file_name=f"labels_{barcodes[0]}.html", mime="text/html")
+            st.markdown(code128_svg(barcodes[0]), unsafe_allow_html=True)
+    
+    with tab2:
+        barcode = st.text_input("🔎 Штрих-код", key="specimen_scan", help="Сканер қийматни шу ерга киритади")
+        if barcode:
+            specimen = lookup_specimen(db.conn, barcode)
+            if specimen is None:
+                st.error("❌ Бундай штрих-кодли намуна топилмади")
+            else:
+                col1, col2 = st.columns([2, 1])
+                with col1:
+                    st.markdown(f"**👤 {specimen['full_name']}** ({specimen['patient_code']}), "
+                                f"{specimen['birth_date']}, {specimen['gender']}")
+                    st.markdown(f"**🧪 {specimen['specimen_type']}** — "
+                                f"{SPECIMEN_STATUS_LABELS.get(specimen['status'], specimen['status'])}")
+                    if specimen['order_id']:
+                        st.markdown(f"**📦 Буюртма #{specimen['order_id']}:** {specimen['order_category']}, "
+                                    f"{ORDER_PRIORITY_LABELS.get(specimen['order_priority'], '')}, "
+                                    f"{ORDER_STATUS_LABELS.get(specimen['order_status'], '')}")
+                with col2:
+                    st.markdown(qr_svg(specimen_link(specimen['barcode'])), unsafe_allow_html=True)
+                
+                col_b1, col_b2 = st.columns(2)
+                with col_b1:
+                    if st.button("🩸 Намуна олинди", use_container_width=True):
+                        mark_specimen(db.conn, specimen['barcode'], 'collected')
+                        st.rerun()
+                with col_b2:
+                    if st.button("📥 Қабул қилинди", use_container_width=True):
+                        mark_specimen(db.conn, specimen['barcode'], 'received')
+                        st.rerun()
+    
+    with tab3:
+        col1, col2 = st.columns(2)
+        with col1:
+            status_filter = st.multiselect("Ҳолат", list(SPECIMEN_STATUS_LABELS.keys()),
+                                           format_func=SPECIMEN_STATUS_LABELS.get, key="specimen_status_filter")
+        with col2:
+            day = st.date_input("Сана", value=date.today(), key="specimen_day")
         
-        with col_btn1:
-            if st.button("🔄 Ҳозирги вақтда резерв нусха олиш", use_container_width=True):
-                st.success("✅ Резерв нусха муваффақиятли олинди!")
+        query = '''
+            SELECT s.barcode, p.full_name, p.patient_id, s.specimen_type, s.status, s.order_id,
+                   s.created_at, s.collected_at, s.received_at
+            FROM specimens s JOIN patients p ON p.id = s.patient_id
+            WHERE s.barcode >= ? AND s.barcode < ?
+        '''
+        prefix = day.strftime('%y%m%d')
+        params = [prefix, prefix + ':']
+        if status_filter:
+            query += f" AND s.status IN ({','.join('?' * len(status_filter))})"
+            params += status_filter
+        df = pd.read_sql_query(query + " ORDER BY s.barcode", db.conn, params=params)
+        if not df.empty:
+            df['status'] = df['status'].map(SPECIMEN_STATUS_LABELS)
+            df.columns = ['Штрих-код', 'Бемор', 'Бемор ID', 'Намуна', 'Ҳолат', 'Буюртма',
+                          'Яратилган', 'Олинган', 'Қабул қилинган']
+            st.dataframe(df, use_container_width=True, hide_index=True)
+            sheet = render_label_sheet(db.conn, df['Штрих-код'].tolist())
+            st.download_button("🖨️ Ёрлиқларни қайта чоп этиш", sheet,
+                               file_name=f"labels_{prefix}.html", mime="text/html")
+        else:
+            st.info("📭 Бу сана бўйича намуналар йўқ")
+
+def manage_bulk_import():
+    """Беморлар ва тарихий натижаларни CSV/XLSX файлдан оммавий импорт қилиш"""
+    st.markdown('<h1 class="section-title">📥 Оммавий импорт</h1>', unsafe_allow_html=True)
+    
+    if st.session_state.get('role') != 'admin':
+        st.warning("⚠️ Оммавий импорт фақат администратор учун")
+        return
+    
+    profiles = import_profiles(db.conn)
+    
+    # 1-қадам: файл ва профиль
+    st.markdown("### 1️⃣ Файл")
+    col1, col2 = st.columns(2)
+    with col1:
+        profile_name = st.selectbox("💾 Профиль", ["— Янги профиль —"] + sorted(profiles), key="import_profile")
+    profile = dict(profiles.get(profile_name, IMPORT_PROFILE_DEFAULTS))
+    with col2:
+        kinds = list(IMPORT_KIND_LABELS)
+        profile['kind'] = st.radio("Маълумот тури", kinds, index=kinds.index(profile['kind']),
+                                   format_func=IMPORT_KIND_LABELS.get, horizontal=True,
+                                   key=f"import_kind_{profile_name}")
+    kind = profile['kind']
+    
+    uploaded = st.file_uploader("CSV ёки XLSX файл", type=["csv", "txt", "xlsx"], key="import_file")
+    with st.expander("⚙️ Файл формати"):
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            profile['delimiter'] = st.text_input("Ажратувчи", profile['delimiter'], max_chars=1,
+                                                 key=f"import_delimiter_{profile_name}")
+        with col2:
+            profile['encoding'] = st.text_input("Кодировка", profile['encoding'], key=f"import_encoding_{profile_name}")
+        with col3:
+            profile['date_format'] = st.text_input("Сана формати", profile['date_format'],
+                                                   help="Бўш бўлса: " + ", ".join(IMPORT_DATE_FORMATS),
+                                                   key=f"import_date_format_{profile_name}")
+        with col4:
+            profile['decimal'] = st.selectbox("Ўнли ажратувчи", ['.', ','], index=['.', ','].index(profile['decimal']),
+                                              key=f"import_decimal_{profile_name}")
+    
+    if uploaded is None:
+        st.info("📂 Файл юкланг")
+        return
+    
+    try:
+        preview = next(read_import_chunks(io.BytesIO(uploaded.getvalue()), uploaded.name, profile,
+                                          IMPORT_PREVIEW_ROWS), None)
+    except (ValueError, UnicodeDecodeError, pd.errors.ParserError) as e:
+        st.error(f"❌ Файлни ўқиб бўлмади: {str(e)}")
+        return
+    if preview is None or preview.empty:
+        st.warning("⚠️ Файлда маълумот йўқ")
+        return
+    st.dataframe(preview.head(10), use_container_width=True, hide_index=True)
+    
+    # 2-қадам: устунларни мослаш
+    st.markdown("### 2️⃣ Устунларни мослаш")
+    header = list(preview.columns)
+    guessed = guess_import_columns(header, kind)
+    columns = {}
+    mapping_cols = st.columns(3)
+    for i, (field, (label, required, _)) in enumerate(IMPORT_FIELDS[kind].items()):
+        default = profile['columns'].get(field) if profile['columns'].get(field) in header else guessed[field]
+        options = [''] + header
+        with mapping_cols[i % 3]:
+            columns[field] = st.selectbox(f"{label}{'*' if required else ''}", options, index=options.index(default),
+                                          format_func=lambda column: column or "—",
+                                          key=f"import_map_{kind}_{field}_{uploaded.name}")
+    profile['columns'] = columns
+    missing = [IMPORT_FIELDS[kind][field][0] for field, (_, required, _) in IMPORT_FIELDS[kind].items()
+               if required and not columns[field]]
+    
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        new_name = st.text_input("Профиль номи", "" if profile_name.startswith("—") else profile_name,
+                                 key="import_profile_name")
+    with col2:
+        st.markdown("<br>", unsafe_allow_html=True)
+        if st.button("💾 Профилни сақлаш", use_container_width=True, disabled=not new_name.strip()):
+            save_import_profile(new_name.strip(), profile, db.conn)
+            st.success(f"✅ '{new_name.strip()}' профили сақланди")
+    
+    if missing:
+        st.warning(f"⚠️ Мажбурий майдонлар танланмаган: {', '.join(missing)}")
+        return
+    
+    # 3-қадам: текширув (биринчи бўлак бўйича, базага ёзмасдан)
+    st.markdown("### 3️⃣ Текширув")
+    if kind == 'patients':
+        _, errors = validate_patient_chunk(db.conn, preview, profile)
+    else:
+        _, errors = validate_result_chunk(db.conn, preview, profile, import_patient_lookup(db.conn))
+    rejected = errors.ne('')
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Текширилган қаторлар", len(preview))
+    with col2:
+        st.metric("✅ Тўғри", int((~rejected).sum()))
+    with col3:
+        st.metric("❌ Рад этилган", int(rejected.sum()))
+    if rejected.any():
+        st.dataframe(errors[rejected].value_counts().rename('Сони'), use_container_width=True)
+        st.dataframe(preview[rejected].assign(Хатолик=errors[rejected]).head(50), use_container_width=True)
+    
+    # 4-қадам: импорт
+    st.markdown("### 4️⃣ Импорт")
+    if st.button("📥 Импортни бошлаш", type="primary", use_container_width=True):
+        data = uploaded.getvalue()
+        total = data.count(b'\n') if not uploaded.name.lower().endswith('.xlsx') else 0
+        progress_bar = st.progress(0.0, text="⏳ Импорт...")
+        errors_path = os.path.join(tempfile.gettempdir(), f"import_errors_{uuid.uuid4().hex}.csv")
         
-        with col_btn2:
-            if st.button("📥 Охирги резерв нусхани юклаб олиш", use_container_width=True):
-                st.info("Резерв нусха юклаб олинмоқда...")
+        def report(summary):
+            fraction = min(summary['read'] / total, 1.0) if total else 0.0
+            progress_bar.progress(fraction, text=f"⏳ {summary['read']:,} қатор ўқилди, "
+                                                 f"{summary['imported']:,} та ёзилди")
         
-        if st.button("💾 Резерв нусха созламаларини сақлаш", use_container_width=True):
-            st.session_state.backup_settings.update({
-                'backup_frequency': backup_frequency,
-                'backup_time': backup_time,
-                'keep_backups': keep_backups,
-                'backup_location': backup_location,
-                'auto_backup': auto_backup,
-                'compress_backup': compress_backup
-            })
-            st.success("✅ Резерв нусха созламалари сақланди!")
+        try:
+            # Импорт ўз уланишида: бўлак транзакциялари бошқа сессияларнинг умумий уланишига тегмайди
+            with db.write_connection() as writer:
+                summary = run_bulk_import(writer, io.BytesIO(data), uploaded.name, profile, errors_path,
+                                          progress=report)
+        except (ValueError, UnicodeDecodeError, pd.errors.ParserError, sqlite3.Error) as e:
+            st.error(f"❌ Импорт тўхтатилди: {str(e)}")
+            return
+        progress_bar.progress(1.0, text="✅ Импорт тугади")
+        st.session_state.import_summary = summary
+    
+    summary = st.session_state.get('import_summary')
+    if summary:
+        st.success(f"✅ {summary['imported']:,} та ёзув импорт қилинди, {summary['rejected']:,} та рад этилди "
+                   f"({summary['seconds']:.1f} с, {summary['rows_per_second']:,.0f} қатор/с)")
+        if summary['reasons']:
+            st.dataframe(pd.Series(summary['reasons'], name='Сони').sort_values(ascending=False),
+                         use_container_width=True)
+        if summary['rejected'] and summary['errors_path'] and os.path.exists(summary['errors_path']):
+            with open(summary['errors_path'], 'rb') as f:
+                st.download_button("📥 Рад этилган қаторлар (CSV)", f.read(),
+                                   file_name=f"import_errors_{date.today()}.csv", mime="text/csv",
+                                   use_container_width=True)
+
+# =================== БУЙРУҚЛАР САТРИ ===================
+def cli_astm_listen(args):
+    listener = ASTMListener(db, args.host, args.port)
+    listener.start()
+    dispatcher = AlertDispatcher(db)
+    dispatcher.start()
+    print(f"ASTM тингловчи {listener.host}:{listener.port} да ишламоқда (Ctrl+C — тўхтатиш)")
+    try:
+        while listener.running:
+            time.sleep(5)
+            print(f"  {listener.stats}")
+    except KeyboardInterrupt:
+        listener.stop()
+        dispatcher.stop()
+
+def cli_astm_simulate(args):
+    messages = demo_astm_messages(db.conn, args.messages)
+    if not messages:
+        print("Симуляция учун базада бемор ва параметрлар йўқ")
+        return 1
+    outcome = ASTMSimulator(args.host, args.port).run_load(messages, args.connections)
+    rate = outcome['sent'] / outcome['seconds'] if outcome['seconds'] else 0
+    print(f"Юборилди: {outcome['sent']}, рад этилди: {outcome['failed']}, "
+          f"{outcome['seconds']:.2f} с ({rate:.1f} хабар/с)")
+    return 0 if outcome['failed'] == 0 else 1
+
+def cli_archive(args):
+    archive = ArchiveManager(db)
+    total = 0
+    while True:
+        summary = archive.run(args.days, args.batch, max_batches=10)
+        total += summary['moved']
+        print(f"  {summary['moved']} та натижа кўчирилди, йиллар: {summary['years']}, "
+              f"{summary['seconds']:.2f} с")
+        if summary['combined']:
+            print(f"  Умумий архив файлига кўчирилган йиллар: {summary['combined']}")
+        if summary['batches'] < 10 or args.once:
+            break
+    print(f"Жами архивланди: {total} (чегара {summary['cutoff']})")
+
+def cli_cube_rebuild(args):
+    started = time.perf_counter()
+    last_id = rebuild_cohort_cube(db.conn)
+    rows = db.conn.execute("SELECT COUNT(*), COALESCE(SUM(total), 0) FROM cohort_cube").fetchone()
+    print(f"Куб қайта қурилди: {rows[0]} катак, {rows[1]} натижа, охирги ID {last_id}, "
+          f"{time.perf_counter() - started:.2f} с")
+
+def cli_smtp_standin(args):
+    server = LocalSMTPServer(args.host, args.port, args.mbox).start()
+    print(f"Синов SMTP сервери {server.host}:{server.port} да ишламоқда, хатлар: {args.mbox or 'хотирада'}")
+    try:
+        seen = 0
+        while True:
+            time.sleep(1)
+            for message in server.messages[seen:]:
+                print(f"  ✉️ {message['from']} → {', '.join(message['to'])}")
+            seen = len(server.messages)
+    except KeyboardInterrupt:
+        server.stop()
+
+def cli_norms_audit(args):
+    started = time.perf_counter()
+    issues = audit_norms(db.conn, args.codes or None)
+    for issue in issues:
+        print(f"  {NORM_ISSUE_LABELS[issue['kind']]}: {issue['parameter_code']} "
+              f"{issue['gender'] or '*'}/{issue['phase'] or '*'} {issue['age_from']}–{issue['age_to']} "
+              f"{' '.join(issue['norms'])} {issue['message']}")
+    blocking = sum(i['kind'] in NORM_BLOCKING_ISSUES for i in issues)
+    print(f"Жами: {len(issues)} та изоҳ, {blocking} та зиддият, {time.perf_counter() - started:.2f} с")
+    if args.round_trip:
+        rejected = norms_round_trip_issues(db.conn, args.codes or None)
+        for issue in rejected:
+            print(f"  ↩️ {NORM_ISSUE_LABELS[issue['kind']]}: {issue['parameter_code']} {' '.join(issue['norms'])} "
+                  f"{issue['message']}")
+        print(f"Экспорт → импорт: {'ўтди' if not rejected else f'{len(rejected)} та зиддият туфайли рад этилади'}")
+        blocking += len(rejected)
+    return 1 if blocking else 0
+
+def cli_norms_export(args):
+    with open(args.path, 'w', encoding='utf-8') as f:
+        f.write(norms_to_yaml(load_norms(db.conn)))
+    print(f"Нормалар {args.path} файлига ёзилди")
+
+def cli_norms_import(args):
+    with open(args.path, encoding='utf-8') as f:
+        norms = norms_from_yaml(f.read())
+    started = time.perf_counter()
+    summary = import_norms(db.conn, norms, replace=not args.append)
+    blocking = [i for i in summary['issues'] if i['kind'] in NORM_BLOCKING_ISSUES]
+    for issue in blocking:
+        print(f"  {NORM_ISSUE_LABELS[issue['kind']]}: {issue['parameter_code']} {' '.join(issue['norms'])} "
+              f"{issue['message']}")
+    if summary['unknown']:
+        print(f"Номаълум параметрлар: {', '.join(summary['unknown'])}")
+    print(f"Импорт: {summary['imported']} / {len(norms)}, {time.perf_counter() - started:.2f} с")
+    return 0 if summary['imported'] else 1
+
+def cli_tat_rebuild(args):
+    started = time.perf_counter()
+    total = rebuild_tat_sketch(db.conn)
+    print(f"TAT скетчлари қайта қурилди: {total} та интервал, {time.perf_counter() - started:.2f} с")
+
+def cli_calc_backfill(args):
+    started = time.perf_counter()
+    summary = backfill_calculated(db, db.conn, args.codes or None)
+    for code, count in summary.items():
+        print(f"  {code}: {count} та натижа ҳисобланди")
+    print(f"Тайёр: {time.perf_counter() - started:.2f} с")
+
+def cli_id_stress(args):
+    # Синов базанинг нусхасида ўтказилади, асосий базага стресс беморлар ёзилмайди
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    target = sqlite3.connect(path)
+    db.conn.backup(target)
+    target.close()
+    manager = DatabaseManager(path)
+    done = threading.Event()
+    reads = collections.Counter()
+
+    def reader():
+        # Бошқа сессиялар умумий уланишдан ўқишда давом этади
+        while not done.is_set():
+            manager.conn.execute("SELECT COUNT(*) FROM patients").fetchone()
+            reads['count'] += 1
+            time.sleep(0.001)
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers + 1) as pool:
+            pool.submit(reader)
+            results = list(pool.map(_id_stress_worker, [manager] * args.workers, [args.count] * args.workers))
+            done.set()
+        elapsed = time.perf_counter() - started
+    finally:
+        done.set()
+        manager.conn.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    ids = [patient_id for worker_ids, _, _ in results for patient_id in worker_ids]
+    conflicts = sum(result[1] for result in results)
+    errors = sum(result[2] for result in results)
+    monotonic = all(worker_ids == sorted(worker_ids) for worker_ids, _, _ in results)
+    print(f"{args.workers} оқим × {args.count} рўйхатга олиш: {elapsed:.2f} с, "
+          f"{len(ids) / elapsed:.0f} бемор/с (умумий уланишдан {reads['count']} ўқиш)")
+    print(f"  Ноёб ID лар: {len(set(ids))}/{len(ids)}, IntegrityError: {conflicts}, бошқа хатолар: {errors}, "
+          f"оқим ичида ўсувчи: {'ҳа' if monotonic else 'йўқ'}")
+    return 0 if conflicts == errors == 0 and len(ids) == len(set(ids)) == args.workers * args.count \
+        and monotonic else 1
+
+def cli_dedupe_scan(args):
+    started = time.perf_counter()
+    pairs = find_duplicate_patients(db.conn, args.threshold)
+    print(f"{len(pairs)} та ўхшаш жуфтлик топилди, {time.perf_counter() - started:.2f} с")
+    for row in pairs.head(args.limit).itertuples(index=False):
+        print(f"  {row.keep_id} ↔ {row.merge_id}: {row.score:.3f}")
+
+def cli_maintenance(args):
+    for result in run_maintenance(db, args.tasks or None):
+        print(f"  {result['task']:<20} {result['status']:<8} {result['duration_ms']:>10.1f} мс  {result['details']}")
+
+def cli_snapshot(args):
+    manager = get_snapshot_manager()
+    duration_ms = manager.refresh()
+    size_mb = os.path.getsize(manager.path) / 1024 / 1024
+    print(f"Ҳисобот нусхаси янгиланди: {manager.path} ({size_mb:.1f} МБ, {duration_ms:.0f} мс)")
+
+def cli_loadtest(args):
+    # Синов базанинг нусхасида ўтказилади, асосий базага синов натижалари ёзилмайди
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    target = sqlite3.connect(path)
+    db.conn.backup(target)
+    target.close()
+    password = uuid.uuid4().hex
+    script = os.path.abspath(__file__)
+    try:
+        added = seed_loadtest_database(path, args.patients, password)
+        print(f"Синов базаси: {added} та бемор қўшилди")
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.users) as pool:
+            results = list(pool.map(_loadtest_worker, [script] * args.users, [path] * args.users,
+                                    range(args.users), [password] * args.users,
+                                    [args.iterations] * args.users, [args.timeout] * args.users))
+        elapsed = time.perf_counter() - started
+    finally:
+        for suffix in ('', '-wal', '-shm', SNAPSHOT_SUFFIX):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    
+    samples = pd.DataFrame([sample for result in results for sample in result],
+                           columns=['step', 'seconds', 'error', 'message'])
+    flows = int((samples['step'] == 'panel').sum())
+    compile_started = time.perf_counter()
+    compile(Path(script).read_text(encoding='utf-8'), script, 'exec')
+    compile_ms = (time.perf_counter() - compile_started) * 1000
+    print(f"{args.users} фойдаланувчи × {args.iterations} такрор: {elapsed:.1f} с, "
+          f"{len(samples) / elapsed:.1f} қадам/с, {flows / elapsed:.2f} панел/с")
+    # AppTest ҳар қайта юклашда скриптни қайта компиляция қилади, сервер эса кешлайди
+    print(f"  (кечикишлар ҳар қайта юклашдаги ~{compile_ms:.0f} мс компиляцияни ўз ичига олади)")
+    print(f"  {'қадам':<8} {'сони':>6} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9} {'макс мс':>9} {'хато':>6}")
+    worst_p95 = 0.0
+    for step in LOADTEST_STEPS:
+        rows = samples[samples['step'] == step]
+        if rows.empty:
+            continue
+        p50, p95, p99 = np.percentile(rows['seconds'] * 1000, [50, 95, 99])
+        worst_p95 = max(worst_p95, p95)
+        print(f"  {step:<8} {len(rows):>6} {p50:>9.0f} {p95:>9.0f} {p99:>9.0f} "
+              f"{rows['seconds'].max() * 1000:>9.0f} {rows['error'].notna().sum():>6}")
+    lock_errors = int((samples['error'] == 'lock').sum())
+    other_errors = int((samples['error'] == 'error').sum())
+    print(f"  Блокировка хатолари: {lock_errors}, бошқа хатолар: {other_errors}")
+    for message, count in samples['message'].dropna().value_counts().head(5).items():
+        print(f"    {count} × {message}")
+    if args.max_p95 and worst_p95 > args.max_p95:
+        print(f"  ⚠️ p95 {worst_p95:.0f} мс > {args.max_p95:.0f} мс")
+        return 1
+    return 0 if lock_errors + other_errors == 0 else 1
+
+def cli_backup(args):
+    summary = incremental_backup(db.conn, backup_directory(db.db_path), full=args.full)
+    print(f"Журнал: {summary['rows']} та ўзгариш → {summary['segments']} та сегмент "
+          f"({summary['bytes'] / 1024:.1f} КБ)")
+    if 'full' in summary:
+        full = summary['full']
+        print(f"Тўлиқ нусха: {full['path']} ({full['bytes'] / 1024 / 1024:.1f} МБ, {full['duration_ms']:.0f} мс)")
+    if summary['pruned']:
+        print(f"Эски файллар ўчирилди: {summary['pruned']}")
+
+def cli_restore(args):
+    until = datetime.fromisoformat(args.until)
+    directory = backup_directory(db.db_path)
+    output = args.output or os.path.join(directory, f"restore-{until.strftime(BACKUP_TIME_FORMAT)}.db")
+    summary = restore_point_in_time(directory, until, output, db.conn)
+    print(f"Тикланди: {summary['path']}")
+    print(f"  Асос: {summary['base']}, қайта ўйналди: {summary['applied']} та ўзгариш "
+          f"(seq ≤ {summary['last_seq']}), {summary['duration_ms'] / 1000:.2f} с")
+
+def cli_journal_bench(args):
+    # Синов базанинг нусхасида ўтказилади, асосий база ва унинг нусхалари ўзгармайди
+    workdir = tempfile.mkdtemp(prefix='journal-bench-')
+    path = os.path.join(workdir, 'bench.db')
+    directory = os.path.join(workdir, 'backups')
+    conn = sqlite3.connect(path, timeout=60)
+    db.conn.backup(conn)
+    conn.execute("PRAGMA journal_mode=WAL")
+    try:
+        compact_change_journal(conn, directory)
+        full = create_full_backup(conn, directory)
+        rng = np.random.default_rng(0)
+        if not conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]:
+            for i in range(200):
+                register_patient(conn, f"Синов Бемор {i}", '1980-01-01', str(rng.choice(["Эркак", "Аёл"])))
+        patient_ids = [row[0] for row in conn.execute("SELECT id FROM patients")]
+        parameters = conn.execute("SELECT parameter_code, unit, category FROM test_parameters").fetchall()
+        # Ўзгаришлар тўлиқ нусхадан кейинги кунларга ёйилади
+        start = datetime.now().replace(microsecond=0) + timedelta(minutes=1)
+        stamp = lambda day: start + timedelta(days=day)
+        checkpoint = args.days // 2
+        write_seconds, expected_mid = 0.0, None
+        for day in range(args.days):
+            first_seq = _journal_sequence(conn)
+            started = time.perf_counter()
+            picks = rng.integers(0, len(parameters), args.per_day)
+            conn.executemany('''
+                INSERT INTO test_results (patient_id, test_type, parameter_code, result_value, unit, status, test_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(int(rng.choice(patient_ids)), parameters[i][2], parameters[i][0],
+                   float(rng.lognormal(1.5, 0.8)), parameters[i][1], 'normal', stamp(day).date().isoformat())
+                  for i in picks])
+            ids = [row[0] for row in conn.execute("SELECT id FROM test_results ORDER BY id DESC LIMIT ?",
+                                                  (args.per_day * 5,))]
+            conn.executemany("UPDATE test_results SET status = 'high', result_value = result_value * 1.5 "
+                             "WHERE id = ?", [(int(i),) for i in rng.choice(ids, args.per_day // 10)])
+            conn.executemany("DELETE FROM test_results WHERE id = ?",
+                             [(int(i),) for i in rng.choice(ids, args.per_day // 50, replace=False)])
+            conn.commit()
+            write_seconds += time.perf_counter() - started
+            conn.execute("UPDATE change_journal SET changed_at = ? WHERE seq > ?",
+                         (stamp(day).strftime('%Y-%m-%d %H:%M:%S.000'), first_seq))
+            conn.commit()
+            if day == checkpoint:
+                expected_mid = journal_table_checksums(conn)
+            compact_change_journal(conn, directory)
+        expected_end = journal_table_checksums(conn)
+        segments = list_journal_segments(directory)
+        print(f"Тўлиқ нусха: {full['bytes'] / 1024 / 1024:.1f} МБ, {full['duration_ms']:.0f} мс")
+        print(f"{args.days} кун × {args.per_day} натижа: {_journal_sequence(conn) - full['base_seq']} та ўзгариш, "
+              f"{len(segments)} та сегмент, {sum(s['bytes'] for s in segments) / 1024 / 1024:.1f} МБ, "
+              f"ёзиш {write_seconds:.2f} с")
+        ok = True
+        for label, until, expected in (("Охирги кунгача", stamp(args.days - 1), expected_end),
+                                       ("Ўртадаги кунгача", stamp(checkpoint), expected_mid)):
+            output = os.path.join(workdir, 'restored.db')
+            summary = restore_point_in_time(directory, until + timedelta(hours=1), output)
+            restored = sqlite3.connect(output)
+            matches = journal_table_checksums(restored) == expected
+            restored.close()
+            ok = ok and matches
+            print(f"  {label}: {summary['applied']} та ўзгариш, {summary['duration_ms'] / 1000:.2f} с, "
+                  f"{'мос' if matches else 'МОС ЭМАС'}")
+        return 0 if ok else 1
+    finally:
+        conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def _cli_import_profile(path: str, kind: str, name: Optional[str], delimiter: Optional[str]) -> Dict:
+    """Сақланган профиль ёки сарлавҳадан тахминланган устунлар"""
+    if name:
+        profiles = import_profiles(db.conn)
+        if name not in profiles:
+            raise ValueError(f"'{name}' профили топилмади (мавжуд: {', '.join(sorted(profiles)) or '—'})")
+        profile = profiles[name]
+        if profile['kind'] != kind:
+            raise ValueError(f"'{name}' профили {profile['kind']} учун, {kind} эмас")
+    else:
+        profile = {**IMPORT_PROFILE_DEFAULTS, 'kind': kind}
+    if delimiter:
+        profile['delimiter'] = delimiter
+    if not profile['columns']:
+        header = next(read_import_chunks(path, path, profile, 1), pd.DataFrame()).columns
+        profile['columns'] = guess_import_columns(list(header), kind)
+    missing = [field for field, (_, required, _) in IMPORT_FIELDS[kind].items()
+               if required and not profile['columns'].get(field)]
+    if missing:
+        raise ValueError(f"Мажбурий устунлар топилмади: {', '.join(missing)} — профиль сақланг (--profile)")
+    return profile
+
+def _print_import_summary(summary: Dict):
+    print(f"  {summary['read']:,} қатор: {summary['imported']:,} та ёзилди, {summary['rejected']:,} та рад этилди, "
+          f"{summary['seconds']:.2f} с ({summary['rows_per_second']:,.0f} қатор/с)")
+    for reason, count in sorted(summary['reasons'].items(), key=lambda item: -item[1]):
+        print(f"    {count} × {reason}")
+
+def cli_import(args):
+    try:
+        profile = _cli_import_profile(args.path, args.kind, args.profile, args.delimiter)
+        errors_path = args.errors or f"{os.path.splitext(args.path)[0]}.errors.csv"
+        summary = run_bulk_import(db.conn, args.path, args.path, profile, errors_path, args.chunk_rows,
+                                  defer_indexes=args.defer_indexes,
+                                  progress=lambda s: print(f"  ... {s['read']:,} қатор", file=sys.stderr))
+    except (ValueError, OSError, UnicodeDecodeError, pd.errors.ParserError) as e:
+        print(f"Хатолик: {e}", file=sys.stderr)
+        return 1
+    get_audit_log().flush()
+    print(f"Импорт ({IMPORT_KIND_LABELS[args.kind]}): {args.path}")
+    _print_import_summary(summary)
+    if summary['rejected']:
+        print(f"  Рад этилган қаторлар: {errors_path}")
+
+def cli_import_bench(args):
+    # Синов базанинг нусхасида ўтказилади, асосий база ўзгармайди
+    workdir = tempfile.mkdtemp(prefix='import-bench-')
+    conn = sqlite3.connect(os.path.join(workdir, 'bench.db'), timeout=60)
+    db.conn.backup(conn)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    try:
+        rng = np.random.default_rng(0)
+        today = date.today()
+        # Беморлар: ~1% қасддан бузилган қаторлар (сана, жинс, исм)
+        births = pd.Timestamp(today) - pd.to_timedelta(rng.integers(365, 80 * 365, args.patients), unit='D')
+        patients = pd.DataFrame({
+            'ID': [f"IMP{i:07d}" for i in range(args.patients)],
+            'Исми-шарифи': [f"Импорт Бемор {i}" for i in range(args.patients)],
+            'Туғилган сана': births.strftime('%d.%m.%Y'),
+            'Жинси': rng.choice(['Эркак', 'Аёл', 'M', 'F'], args.patients),
+            'Телефон': [f"+99890{i:07d}" for i in range(args.patients)],
+        })
+        broken = rng.random(args.patients) < 0.01
+        patients.loc[broken, 'Туғилган сана'] = '31.02.1990'
+        patients_path = os.path.join(workdir, 'patients.csv')
+        patients.to_csv(patients_path, index=False)
+        profile = {**IMPORT_PROFILE_DEFAULTS, 'kind': 'patients', 'date_format': '%d.%m.%Y', 'columns': {
+            'patient_id': 'ID', 'full_name': 'Исми-шарифи', 'birth_date': 'Туғилган сана', 'gender': 'Жинси',
+            'phone': 'Телефон'}}
+        summary = run_bulk_import(conn, patients_path, patients_path, profile,
+                                  os.path.join(workdir, 'patients.errors.csv'), args.chunk_rows)
+        print(f"Беморлар ({args.patients:,}):")
+        _print_import_summary(summary)
+        
+        # Натижалар: импорт қилинган беморлар, туғилгандан кейинги саналар
+        parameters = conn.execute("SELECT parameter_code, default_min_value, default_max_value FROM test_parameters "
+                                  "WHERE (formula IS NULL OR TRIM(formula) = '') AND default_max_value IS NOT NULL").fetchall()
+        loaded = pd.read_sql_query("SELECT patient_id, birth_date FROM patients WHERE patient_id LIKE 'IMP%'", conn)
+        who = rng.integers(0, len(loaded), args.results)
+        picks = rng.integers(0, len(parameters), args.results)
+        low = np.array([p[1] or 0 for p in parameters], dtype=float)[picks]
+        high = np.array([p[2] for p in parameters], dtype=float)[picks]
+        birth = pd.to_datetime(loaded['birth_date'].to_numpy()[who])
+        span = (pd.Timestamp(today) - birth).days.to_numpy()
+        results = pd.DataFrame({
+            'patient_id': loaded['patient_id'].to_numpy()[who],
+            'code': np.array([p[0] for p in parameters], dtype=object)[picks],
+            'value': np.round(np.maximum(low + (high - low) * rng.uniform(-0.3, 1.3, args.results), 0), 3).astype(str),
+            'date': (birth + pd.to_timedelta((span * rng.random(args.results)).astype(int), unit='D'))
+                    .strftime('%Y-%m-%d'),
+        })
+        broken = rng.random(args.results)
+        results.loc[broken < 0.005, 'value'] = 'н/а'
+        results.loc[(broken >= 0.005) & (broken < 0.01), 'code'] = 'XXX'
+        results_path = os.path.join(workdir, 'results.csv')
+        results.to_csv(results_path, index=False)
+        profile = {**IMPORT_PROFILE_DEFAULTS, 'kind': 'results', 'columns': guess_import_columns(
+            list(results.columns), 'results')}
+        before = conn.execute("SELECT COUNT(*) FROM test_results").fetchone()[0]
+        summary = run_bulk_import(conn, results_path, results_path, profile,
+                                  os.path.join(workdir, 'results.errors.csv'), args.chunk_rows,
+                                  defer_indexes=args.defer_indexes)
+        print(f"Натижалар ({args.results:,}, индекслар {'импорт охирида' if args.defer_indexes else 'фаол'}):")
+        _print_import_summary(summary)
+        written = conn.execute("SELECT COUNT(*) FROM test_results").fetchone()[0] - before
+        
+        # Таққослаш: бемор бўйича оддий рўйхатга олиш
+        sample = patients.head(min(args.baseline, args.patients))
+        started = time.perf_counter()
+        for row in sample.itertuples(index=False):
+            register_patient(conn, row[1], '1980-01-01', 'Эркак', row[4])
+        baseline = len(sample) / (time.perf_counter() - started)
+        print(f"Таққослаш: register_patient {baseline:,.0f} бемор/с")
+        return 0 if written == summary['imported'] else 1
+    finally:
+        conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_cli(argv: List[str]) -> int:
+    """Маъмурий буйруқлар: python app.py <буйруқ> [параметрлар]"""
+    parser = argparse.ArgumentParser(prog="app.py", description="Тиббий тахлиллар тизими буйруқлари")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    listen = commands.add_parser("astm-listen", help="ASTM TCP тингловчини ишга тушириш")
+    listen.add_argument("--host", default="0.0.0.0")
+    listen.add_argument("--port", type=int, default=ASTM_DEFAULT_PORT)
+    listen.set_defaults(func=cli_astm_listen)
+    
+    simulate = commands.add_parser("astm-simulate", help="Анализатор симуляторидан хабарлар юбориш")
+    simulate.add_argument("--host", default="127.0.0.1")
+    simulate.add_argument("--port", type=int, default=ASTM_DEFAULT_PORT)
+    simulate.add_argument("--messages", type=int, default=100)
+    simulate.add_argument("--connections", type=int, default=10)
+    simulate.set_defaults(func=cli_astm_simulate)
+    
+    archive = commands.add_parser("archive", help="Эски натижаларни йиллик файлларга кўчириш")
+    archive.add_argument("--days", type=int, default=None, help="Архивга ўтказиш муддати (кун)")
+    archive.add_argument("--batch", type=int, default=ARCHIVE_BATCH_SIZE)
+    archive.add_argument("--once", action="store_true", help="Фақат 10 бўлак кўчириш")
+    archive.set_defaults(func=cli_archive)
+    
+    cube = commands.add_parser("cube-rebuild", help="Когорта кубини тўлиқ қайта қуриш")
+    cube.set_defaults(func=cli_cube_rebuild)
+    
+    calc = commands.add_parser("calc-backfill", help="Ҳисобланадиган параметрларни мавжуд натижалардан тўлдириш")
+    calc.add_argument("codes", nargs="*", help="Параметр кодлари (бўш бўлса ҳаммаси)")
+    calc.set_defaults(func=cli_calc_backfill)
+    
+    norms_audit = commands.add_parser("norms-audit", help="Норма оралиқларини устма-уст тушиш ва бўшлиққа текшириш")
+    norms_audit.add_argument("codes", nargs="*", help="Параметр кодлари (бўш бўлса ҳаммаси)")
+    norms_audit.add_argument("--round-trip", action="store_true",
+                             help="YAML экспорти қайта импорт қилинишини ҳам текшириш")
+    norms_audit.set_defaults(func=cli_norms_audit)
+    
+    norms_export = commands.add_parser("norms-export", help="Нормаларни YAML файлга ёзиш")
+    norms_export.add_argument("path")
+    norms_export.set_defaults(func=cli_norms_export)
+    
+    norms_import = commands.add_parser("norms-import", help="Нормаларни YAML файлдан текшириб юклаш")
+    norms_import.add_argument("path")
+    norms_import.add_argument("--append", action="store_true", help="Мавжуд нормаларни алмаштирмасдан қўшиш")
+    norms_import.set_defaults(func=cli_norms_import)
+    
+    maintenance = commands.add_parser("maintenance", help="Техник хизмат вазифаларини ҳозир бажариш")
+    maintenance.add_argument("tasks", nargs="*", metavar="TASK",
+                             help=f"Вазифалар: {', '.join(MAINTENANCE_TASKS)} (бўш бўлса, ҳаммаси)")
+    maintenance.set_defaults(func=cli_maintenance)
+    
+    snapshot = commands.add_parser("snapshot", help="Ҳисоботлар учун фақат ўқиладиган нусхани янгилаш")
+    snapshot.set_defaults(func=cli_snapshot)
+    
+    dedupe = commands.add_parser("dedupe-scan", help="Такрорий беморларни блоклаш индекси орқали излаш")
+    dedupe.add_argument("--threshold", type=float, default=DUPLICATE_THRESHOLD)
+    dedupe.add_argument("--limit", type=int, default=20, help="Кўрсатиладиган жуфтликлар сони")
+    dedupe.set_defaults(func=cli_dedupe_scan)
+    
+    stress = commands.add_parser("id-stress", help="Бемор ID ажратувчисини параллел сессиялар билан синаш")
+    stress.add_argument("--workers", type=int, default=8, help="Параллел сессия оқимлари сони")
+    stress.add_argument("--count", type=int, default=200, help="Ҳар бир оқимдаги рўйхатга олишлар")
+    stress.set_defaults(func=cli_id_stress)
+    
+    loadtest = commands.add_parser("loadtest", help="Бир вақтдаги лаборант сессиялари билан юклама синови")
+    loadtest.add_argument("--users", type=int, default=8, help="Бир вақтдаги сессиялар (ҳар бири алоҳида жараён)")
+    loadtest.add_argument("--iterations", type=int, default=3)
+    loadtest.add_argument("--patients", type=int, default=1000, help="Синов базасидаги беморлар сони")
+    loadtest.add_argument("--timeout", type=float, default=120, help="Битта қайта юклаш учун чегара (с)")
+    loadtest.add_argument("--max-p95", type=float, default=None, help="Бундан секин p95 (мс) хато ҳисобланади")
+    loadtest.set_defaults(func=cli_loadtest)
+    
+    backup = commands.add_parser("backup", help="Журнални сегментларга сиқиш (ва керак бўлса тўлиқ нусха)")
+    backup.add_argument("--full", action="store_true", help="Тўлиқ нусхани ҳозир олиш")
+    backup.set_defaults(func=cli_backup)
+    
+    restore = commands.add_parser("restore", help="Вақт нуқтасига тиклаш (янги файлга)")
+    restore.add_argument("until", help="Вақт, масалан: '2025-01-31 18:00'")
+    restore.add_argument("--output", help="Тикланган база файли (сукут бўйича backups/restore-<вақт>.db)")
+    restore.set_defaults(func=cli_restore)
+    
+    journal_bench = commands.add_parser("journal-bench", help="Бир ойлик журнални тиклаш вақтини ўлчаш")
+    journal_bench.add_argument("--days", type=int, default=30)
+    journal_bench.add_argument("--per-day", type=int, default=2000)
+    journal_bench.set_defaults(func=cli_journal_bench)
+    
+    bulk = commands.add_parser("import", help="Беморлар ёки натижаларни CSV/XLSX файлдан оммавий импорт қилиш")
+    bulk.add_argument("kind", choices=list(IMPORT_FIELDS))
+    bulk.add_argument("path")
+    bulk.add_argument("--profile", help="Сақланган устунлар профили")
+    bulk.add_argument("--delimiter", help="CSV ажратувчиси (профилдагини алмаштиради)")
+    bulk.add_argument("--errors", help="Рад этилган қаторлар файли (сукут бўйича <файл>.errors.csv)")
+    bulk.add_argument("--chunk-rows", type=int, default=IMPORT_CHUNK_ROWS)
+    bulk.add_argument("--defer-indexes", action="store_true",
+                      help="Натижалар индексларини импорт вақтида ўчириш (фақат илова тўхтатилганда)")
+    bulk.set_defaults(func=cli_import)
+    
+    import_bench = commands.add_parser("import-bench", help="Синтетик файллар билан импорт тезлигини ўлчаш")
+    import_bench.add_argument("--patients", type=int, default=20000)
+    import_bench.add_argument("--results", type=int, default=200000)
+    import_bench.add_argument("--chunk-rows", type=int, default=IMPORT_CHUNK_ROWS)
+    import_bench.add_argument("--baseline", type=int, default=500, help="register_patient билан таққосланадиган беморлар")
+    import_bench.add_argument("--defer-indexes", action="store_true", help="Натижалар индексларини импорт вақтида ўчириш")
+    import_bench.set_defaults(func=cli_import_bench)
+    
+    tat = commands.add_parser("tat-rebuild", help="TAT скетчларини буюртмалар тарихидан қайта қуриш")
+    tat.set_defaults(func=cli_tat_rebuild)
+    
+    smtp = commands.add_parser("smtp-standin", help="Огоҳлантиришларни синаш учун маҳаллий SMTP сервер")
+    smtp.add_argument("--host", default="127.0.0.1")
+    smtp.add_argument("--port", type=int, default=8025)
+    smtp.add_argument("--mbox", default=None, help="Хатлар ёзиладиган файл")
+    smtp.set_defaults(func=cli_smtp_standin)
+    
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
 
 # =================== АСОСИЙ ИШЛАШ ТАРТИБИ ===================
 def main():
@@ -2335,9 +10216,23 @@ def main():
     if 'username' not in st.session_state:
         st.session_state.username = ""
     
+    started = time.perf_counter()
     try:
+        # Огоҳлантиришлар фон юборувчиси (жараён учун бир марта)
+        get_alert_dispatcher().start()
+        get_maintenance_scheduler().start()
+        get_snapshot_manager().start()
+        get_audit_log().start()
+        get_session_registry().start()
+        get_metrics_server().start()
+        
+        # Фаолсиз ёки муддати тугаган сессия тизимдан чиқарилади
+        expired = track_session()
+        
         # Авторизация текшируви
         if not st.session_state.logged_in:
+            if expired:
+                st.warning(SESSION_EXPIRY_MESSAGES.get(expired, expired))
             login_page()
         else:
             main_page()
@@ -2348,7 +10243,12 @@ def main():
         # Қайтадан урганиш тугмаси
         if st.button("🔄 Қайтадан урганиш"):
             st.rerun()
+    finally:
+        page = st.session_state.get('main_menu', '—') if st.session_state.get('logged_in') else 'login'
+        get_metrics().rerun_seconds.observe(time.perf_counter() - started, page)
 
 # =================== ИШГА ТУШИРИШ ===================
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and not st.runtime.exists():
+        sys.exit(run_cli(sys.argv[1:]))
     main()